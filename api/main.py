@@ -1,11 +1,45 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, status
 from fastapi.exceptions import RequestValidationError
-from src.receipt_scanner_model.analyze import ReceiptDetail, get_receipt_detail
+from fastapi.responses import StreamingResponse
+from src.receipt_scanner_model.analyze import (
+    ReceiptDetail,
+    duplicate_index,
+    duplicate_scope,
+    get_receipt_detail,
+    get_receipt_detail_by_url,
+    get_receipt_details,
+    stream_receipt_detail,
+)
+from src.receipt_scanner_model.audit import AuditRecord, audit_log, audit_request
+from src.receipt_scanner_model.open_ai import create_openai_client
 from src.receipt_scanner_model.s3_client import S3Client
-from src.receipt_scanner_model.logger_config import set_logger
-import tomllib
+from src.receipt_scanner_model.logger_config import (
+    SAMPLED,
+    logging_snapshot,
+    set_logger,
+    stop_logger,
+)
+from src.receipt_scanner_model.circuit_breaker import (
+    s3_circuit_breaker,
+    openai_circuit_breaker,
+)
+from src.receipt_scanner_model.metrics import prompt_cache_metrics, routing_metrics
+from src.receipt_scanner_model.s3_object_cache import s3_object_cache
+from src.receipt_scanner_model.jobs import (
+    JobError,
+    JobRecord,
+    JobRunner,
+    create_job_store,
+)
+from src.receipt_scanner_model.setting import setting
+from src.receipt_scanner_model.single_flight import SingleFlight
+from src.receipt_scanner_model.version import get_version
+import json
 import logging
-from pydantic import BaseModel, field_validator
+import time
+from typing import Iterator
+from pydantic import BaseModel, Field, HttpUrl, field_validator
 from src.receipt_scanner_model.error import (
     S3BadRequest,
     S3NotFound,
@@ -15,18 +49,44 @@ from src.receipt_scanner_model.error import (
     OpenAIAuthenticationError,
     OpenAIServiceUnavailable,
     OpenAIResponseFormatError,
+    OpenAIImageUrlError,
+    JobNotFound,
+    JobQueueFull,
+    JobCallbackForbidden,
 )
 from pathvalidate import ValidationError, validate_filename
 
-# ログ設定を初期化
-set_logger()
 logger = logging.getLogger(__name__)
 
-with open("pyproject.toml", "rb") as f:
-    data = tomllib.load(f)
-    version = data["project"]["version"]
 
-app = FastAPI(version=version)
+def preload() -> None:
+    """SDKの読み込みとクライアントの初期化を先に行い、初回のリクエストが遅くならないようにする"""
+    start = time.perf_counter()
+    S3Client()
+    create_openai_client()
+    logger.info(f"SDKを読み込みました: {time.perf_counter() - start:.3f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ログ設定はimport時ではなく、サーバーの起動時に1回だけ行う
+    set_logger()
+    if setting.server_preload:
+        preload()
+    # 前回の起動で処理されなかったジョブを引き継ぐ
+    job_runner.recover()
+    yield
+    # 処理中のジョブを終えてからワーカーを停止する
+    job_runner.stop()
+    # バッファに残っている監査ログ・ログを書き出す
+    audit_log.flush()
+    stop_logger()
+
+
+app = FastAPI(version=get_version(), lifespan=lifespan)
+
+# 1回のバッチリクエストで解析できる最大ファイル数
+BATCH_MAX_FILES = 20
 
 
 @app.exception_handler(RequestValidationError)
@@ -55,6 +115,25 @@ class FileName(BaseModel):
             raise ValueError("無効なファイル名です。") from e
 
 
+class JobRequest(FileName):
+    callback_url: HttpUrl | None = None
+
+
+class FileNames(BaseModel):
+    filenames: list[str] = Field(min_length=1, max_length=BATCH_MAX_FILES)
+
+    @field_validator("filenames")
+    @classmethod
+    def validate_filenames(cls, value: list[str]) -> list[str]:
+        return [FileName.validate_filename(filename) for filename in value]
+
+
+class BatchReceiptResult(BaseModel):
+    filename: str
+    result: ReceiptDetail | None = None
+    error: JobError | None = None
+
+
 def handle_receipt_exception(e: Exception, filename: str | None):
     """例外を分類してHTTPExceptionに変換する
 
@@ -95,6 +174,77 @@ def handle_receipt_exception(e: Exception, filename: str | None):
         )
 
 
+# 同じファイル名の同時リクエストを1回の解析にまとめる
+receipt_single_flight: SingleFlight[ReceiptDetail] = SingleFlight()
+
+
+def analyze_receipt(filename: str) -> ReceiptDetail:
+    """S3から画像をダウンロードし、レシートを解析する
+
+    同じファイルを解析中の場合は、ダウンロード・解析を行わずにその結果を待って返す。
+
+    Args:
+        filename (str): S3のオブジェクトキー（ファイル名）
+
+    Returns:
+        ReceiptDetail: 解析したレシート詳細
+    """
+    # S3Clientを初期化
+    s3_client = S3Client()
+
+    # まとめるのは解析中のリクエストだけで、結果は保持しない。内容の更新は、後のリクエストの
+    # ダウンロード（キャッシュしたETagでの条件付きGET）で反映される
+    return receipt_single_flight.do(
+        filename, lambda: _analyze_receipt(s3_client, filename)
+    )
+
+
+def _analyze_receipt(s3_client: S3Client, filename: str) -> ReceiptDetail:
+    """S3から画像をダウンロードし、レシートを解析する"""
+    if setting.image_delivery == "presigned_url":
+        # 署名付きURLをOpenAIに渡し、画像の転送を省く
+        # HEIC・WebP（変換が必要）や先頭だけでは検証できない画像は、ダウンロードして送る
+        image_url, _ = s3_client.generate_presigned_image_url(filename)
+        if image_url is not None:
+            try:
+                return get_receipt_detail_by_url(image_url)
+            except OpenAIImageUrlError:
+                logger.warning(
+                    f"署名付きURLを利用できないため、画像を送信します。ファイル名: {filename}"
+                )
+
+    # S3からファイル名を指定して画像をダウンロード
+    image_bytes, content_type = s3_client.download_image_by_filename(filename)
+
+    return get_receipt_detail(image_bytes, content_type, duplicate_scope(filename))
+
+
+def to_job_error(e: Exception, filename: str) -> JobError:
+    """ジョブで発生した例外をHTTPレスポンスと同じ形式のエラーに変換する"""
+    http_exception = handle_receipt_exception(e, filename)
+    return JobError(
+        status_code=http_exception.status_code, detail=http_exception.detail
+    )
+
+
+def process_job(filename: str) -> ReceiptDetail:
+    """ジョブとしてレシートを解析する"""
+    with audit_request("/receipt-analyze/jobs", filename):
+        return analyze_receipt(filename)
+
+
+job_runner = JobRunner(
+    store=create_job_store(setting.job_store, setting.job_store_path),
+    process=process_job,
+    to_error=to_job_error,
+    workers=setting.job_workers,
+    queue_size=setting.job_queue_size,
+    callback_timeout=setting.job_callback_timeout,
+    callback_allowed_hosts=setting.job_callback_allowed_hosts,
+    lease_seconds=setting.job_lease_seconds,
+)
+
+
 @app.get("/")
 async def root():
     """
@@ -103,6 +253,28 @@ async def root():
     return {"version": app.version}
 
 
+@app.get("/circuit-breakers")
+async def circuit_breakers():
+    """
+    S3, OpenAIのサーキットブレーカーの状態を返す
+    """
+    return [s3_circuit_breaker.snapshot(), openai_circuit_breaker.snapshot()]
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    OpenAIのプロンプトキャッシュ、S3オブジェクトのキャッシュ、ログのキューの利用状況などのメトリクスを返す
+    """
+    return {
+        "prompt_cache": prompt_cache_metrics.snapshot(),
+        "image_routing": routing_metrics.snapshot(),
+        "duplicate_index": duplicate_index.snapshot(),
+        "s3_object_cache": s3_object_cache.snapshot(),
+        "logging": logging_snapshot(),
+    }
+
+
 @app.post("/receipt-analyze")
 def receipt_analyze(request: FileName) -> ReceiptDetail:
     """S3のファイル名からレシートを解析し、ReceiptDetailを返す
@@ -114,16 +286,163 @@ def receipt_analyze(request: FileName) -> ReceiptDetail:
         ReceiptDetail: 解析したレシート詳細
     """
     filename = None
-    try:
-        filename = request.filename
-        # S3Clientを初期化
-        s3_client = S3Client()
+    with audit_request("/receipt-analyze", request.filename):
+        try:
+            filename = request.filename
+            receipt_detail = analyze_receipt(filename)
+            logger.info(receipt_detail, extra={SAMPLED: True})
+            return receipt_detail
+        except Exception as e:
+            raise handle_receipt_exception(e, filename)
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Server-Sent Eventsの1イベント分の文字列を作成する"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 
-        # S3からファイル名を指定して画像をダウンロード
-        image_bytes, content_type = s3_client.download_image_by_filename(filename)
+@app.post("/receipt-analyze/stream")
+def receipt_analyze_stream(request: FileName) -> StreamingResponse:
+    """S3のファイル名からレシートを解析し、確定した項目から順にSSEで返す
 
-        receipt_detail = get_receipt_detail(image_bytes, content_type)
-        logger.info(receipt_detail)
-        return receipt_detail
+    `field` イベントで項目ごとの値、`done` イベントで ReceiptDetail 全体を返す。
+    解析中にエラーが起きた場合は `error` イベントを返す。
+
+    Args:
+        request (FileName): ファイル名
+
+    Returns:
+        StreamingResponse: text/event-stream のレスポンス
+    """
+    filename = request.filename
+    # イベントは1件ずつ別のスレッドで作られるため、監査ログのレコードは処理ごとに有効にする
+    record = AuditRecord("/receipt-analyze/stream", filename)
+    try:
+        with record.activate():
+            s3_client = S3Client()
+            image_bytes, content_type = s3_client.download_image_by_filename(filename)
+            events = stream_receipt_detail(image_bytes, content_type)
     except Exception as e:
-        raise handle_receipt_exception(e, filename)
+        http_exception = handle_receipt_exception(e, filename)
+        record.status = http_exception.status_code
+        record.finish()
+        raise http_exception
+
+    def event_stream() -> Iterator[str]:
+        try:
+            while True:
+                with record.activate():
+                    event = next(events, None)
+                if event is None:
+                    break
+                if event["event"] == "done":
+                    logger.info(event["data"], extra={SAMPLED: True})
+                yield format_sse(event["event"], event["data"])
+        except Exception as e:
+            http_exception = handle_receipt_exception(e, filename)
+            record.status = http_exception.status_code
+            yield format_sse(
+                "error",
+                {
+                    "status_code": http_exception.status_code,
+                    "detail": http_exception.detail,
+                },
+            )
+        finally:
+            record.finish()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.post("/receipt-analyze/batch")
+def receipt_analyze_batch(request: FileNames) -> list[BatchReceiptResult]:
+    """複数のS3のファイル名からレシートをまとめて解析する
+
+    OpenAIへは複数の画像をまとめて送るため、1枚ずつ解析するよりリクエストあたりのオーバーヘッドが小さい。
+    ファイルごとのエラーは error に入れて返し、他のファイルの解析は続ける。
+
+    Args:
+        request (FileNames): ファイル名のリスト
+
+    Returns:
+        list[BatchReceiptResult]: リクエストと同じ順の解析結果
+    """
+    with audit_request("/receipt-analyze/batch", ",".join(request.filenames)):
+        return _receipt_analyze_batch(request)
+
+
+def _receipt_analyze_batch(request: FileNames) -> list[BatchReceiptResult]:
+    results = [BatchReceiptResult(filename=filename) for filename in request.filenames]
+    downloaded: list[tuple[BatchReceiptResult, bytes, str]] = []
+    for result in results:
+        try:
+            s3_client = S3Client()
+            image_bytes, content_type = s3_client.download_image_by_filename(
+                result.filename
+            )
+            downloaded.append((result, image_bytes, content_type))
+        except Exception as e:
+            result.error = to_job_error(e, result.filename)
+
+    if downloaded:
+        try:
+            receipt_details = get_receipt_details(
+                [
+                    (image_bytes, content_type)
+                    for _, image_bytes, content_type in downloaded
+                ]
+            )
+            for (result, _, _), receipt_detail in zip(downloaded, receipt_details):
+                result.result = receipt_detail
+        except Exception as e:
+            for result, _, _ in downloaded:
+                result.error = to_job_error(e, result.filename)
+
+    logger.info(results, extra={SAMPLED: True})
+    return results
+
+
+@app.post("/receipt-analyze/jobs", status_code=status.HTTP_202_ACCEPTED)
+def submit_receipt_analyze_job(request: JobRequest) -> JobRecord:
+    """レシート解析ジョブを登録し、すぐにジョブIDを返す
+
+    Args:
+        request (JobRequest): ファイル名と任意のコールバックURL
+
+    Returns:
+        JobRecord: 登録したジョブ
+    """
+    callback_url = str(request.callback_url) if request.callback_url else None
+    try:
+        return job_runner.submit(request.filename, callback_url)
+    except JobCallbackForbidden:
+        logger.exception(f"ジョブの登録に失敗しました。ファイル名: {request.filename}")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="指定されたコールバックURLは使用できません。",
+        )
+    except JobQueueFull:
+        logger.exception(f"ジョブの登録に失敗しました。ファイル名: {request.filename}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="混み合っています。しばらくしてから再度お試しください。",
+        )
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> JobRecord:
+    """ジョブの状態と結果を返す
+
+    Args:
+        job_id (str): ジョブID
+
+    Returns:
+        JobRecord: ジョブ
+    """
+    try:
+        return job_runner.get(job_id)
+    except JobNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="指定されたジョブが存在しません。",
+        )
@@ -0,0 +1,63 @@
+"""本番用のAPIサーバーの起動
+
+    python -m api.server
+
+ワーカー数やキープアライブなどは環境変数（SERVER_WORKERS など）で設定する。
+開発時は SERVER_RELOAD=true でファイル変更時に再起動する。
+"""
+
+import logging
+import os
+
+import uvicorn
+
+from src.receipt_scanner_model.setting import setting
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_workers(workers: int) -> int:
+    """ワーカー数を決める。0 の場合はCPUコア数にする"""
+    if workers > 0:
+        return workers
+    return os.cpu_count() or 1
+
+
+def server_options() -> dict:
+    """設定値から uvicorn.run の引数を作成する"""
+    if setting.server_reload:
+        # reload は1プロセスでしか動かず、ファイル監視にCPUを使うため開発時のみ使う
+        return {
+            "host": setting.server_host,
+            "port": setting.server_port,
+            "reload": True,
+        }
+
+    workers = resolve_workers(setting.server_workers)
+    if workers > 1 and setting.job_store == "memory":
+        # JOB_STORE=memory ではジョブの状態がワーカーごとに分かれ、登録したワーカー以外への
+        # /jobs/{job_id} が404になるため、1ワーカーで起動する
+        logger.warning(
+            f"JOB_STORE=memory のため、1ワーカーで起動します（設定値: {workers}）。"
+            "複数ワーカーで起動する場合は JOB_STORE=sqlite を設定してください。"
+        )
+        workers = 1
+    return {
+        "host": setting.server_host,
+        "port": setting.server_port,
+        "workers": workers,
+        "loop": "uvloop",
+        "http": "httptools",
+        "timeout_keep_alive": setting.server_keep_alive,
+        "backlog": setting.server_backlog,
+        "timeout_graceful_shutdown": setting.server_graceful_shutdown,
+    }
+
+
+def main() -> None:
+    """設定値に従ってAPIサーバーを起動する"""
+    uvicorn.run("api.main:app", **server_options())
+
+
+if __name__ == "__main__":
+    main()
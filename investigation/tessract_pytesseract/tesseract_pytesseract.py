@@ -4,12 +4,11 @@ import cv2
 import glob
 import numpy as np
 
-import pytesseract
 import re
 
 import json
 
-LANG = "eng+jpn"
+from src.receipt_scanner_model.scan_receipt import OcrResult, ocr_image
 
 
 def preprocessing(image_path: str) -> Image.Image:
@@ -27,22 +26,12 @@ def preprocessing(image_path: str) -> Image.Image:
     return img
 
 
-def get_text(image: Image.Image) -> str:
+def get_bounding_boxes(image: Image.Image, ocr_result: OcrResult) -> cv2.typing.MatLike:
     """
-    画像データをtextに変換
+    OCR結果のバウンディングボックスを描画し、その画像を返す（OCRはやり直さない）
     """
-    return pytesseract.image_to_string(image, lang=LANG)
-
-
-def get_bounding_boxes(image_path: str) -> cv2.typing.MatLike:
-    """
-    バウンディングボックスを描画し、その画像を返す
-    """
-    img = cv2.imread(image_path)
-    d = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT, lang=LANG)
-    n_boxes = len(d["level"])
-    for i in range(n_boxes):
-        (x, y, w, h) = (d["left"][i], d["top"][i], d["width"][i], d["height"][i])
+    img = cv2.cvtColor(np.array(image.convert("L"), dtype=np.uint8), cv2.COLOR_GRAY2BGR)
+    for x, y, w, h in ocr_result.boxes.tolist():
         cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
     return img
 
@@ -146,13 +135,14 @@ def scan(fp: str, out_dir: str) -> None:
     preprocessed_fp = f"{output_file_name}_preprocessed.png"
     preprocessed_image.save(preprocessed_fp)
 
-    # textデータに変換
-    text = get_text(preprocessed_image)
+    # OCRを1回だけ行い、テキストとバウンディングボックスの両方に使う
+    ocr_result = ocr_image(preprocessed_image)
+    text = ocr_result.to_text()
     with open(f"{output_file_name}.txt", "w") as f:
         f.writelines(text)
 
-    # バウンディングボックスの取得
-    bounding_boxed_image = get_bounding_boxes(preprocessed_fp)
+    # バウンディングボックスの描画
+    bounding_boxed_image = get_bounding_boxes(preprocessed_image, ocr_result)
     cv2.imwrite(f"{output_file_name}_boxes.png", bounding_boxed_image)
 
     # レシートから合計を取得
@@ -0,0 +1,167 @@
+"""監査ログ（logs/audit.jsonl）を時間帯ごとに集計し、スループット・レイテンシ・コストを表示する
+
+    python -m scripts.audit_report --window 3600
+    python -m scripts.audit_report logs/audit.jsonl --since 2024-06-01T00:00 --endpoint /receipt-analyze
+
+ワーカープロセスごとのファイル（audit.12345.jsonl など）と、ローテーションした古いファイル
+（audit.12345.jsonl.1 など）もまとめて読み込む。
+"""
+
+import argparse
+import json
+import math
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from src.receipt_scanner_model.setting import setting
+
+
+def iter_records(fp: Path) -> Iterator[dict]:
+    """プロセスごとのファイルとローテーションしたファイルを含め、監査ログを読み込む
+
+    ファイルごとに古い順に読み込む（集計は時間帯ごとに行うため、ファイル間の順序は問わない）。
+    """
+    process_fps = sorted(
+        path
+        for path in fp.parent.glob(f"{fp.stem}.*{fp.suffix}")
+        if path.name[len(fp.stem) + 1 : -len(fp.suffix) or None].isdigit()
+    )
+    for base_fp in [fp, *process_fps]:
+        yield from _iter_file_records(base_fp)
+
+
+def _iter_file_records(fp: Path) -> Iterator[dict]:
+    """1つのファイルとそのローテーションしたファイルを古い順に読み込む"""
+    rotated = sorted(
+        (path for path in fp.parent.glob(f"{fp.name}.*") if path.suffix[1:].isdigit()),
+        key=lambda path: int(path.suffix[1:]),
+        reverse=True,
+    )
+    for path in [*rotated, fp]:
+        if not path.exists():
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で終了した行は読み飛ばす
+                    continue
+
+
+def percentile(values: list[float], q: float) -> float:
+    """ソート済みの値から、最近傍法でパーセンタイルを求める"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(records: Iterable[dict], window: int) -> list[dict]:
+    """レコードを window 秒ごとの時間帯に分けて集計する
+
+    Returns:
+        list[dict]: 時間帯の開始時刻の昇順の集計結果
+    """
+    windows: dict[int, list[dict]] = {}
+    for record in records:
+        start = int(record["ts"] // window * window)
+        windows.setdefault(start, []).append(record)
+
+    summaries = []
+    for start in sorted(windows):
+        records = windows[start]
+        latencies = sorted(record.get("ms", 0) for record in records)
+        summaries.append(
+            {
+                "start": start,
+                "requests": len(records),
+                "rps": len(records) / window,
+                "errors": sum(record.get("status", 200) >= 400 for record in records),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "s3_ms": sum(record.get("s3_ms", 0) for record in records),
+                "ai_ms": sum(record.get("ai_ms", 0) for record in records),
+                "bytes": sum(record.get("bytes", 0) for record in records),
+                "in": sum(record.get("in", 0) for record in records),
+                "cached": sum(record.get("cached", 0) for record in records),
+                "out": sum(record.get("out", 0) for record in records),
+                "usd": sum(record.get("usd", 0) for record in records),
+            }
+        )
+    return summaries
+
+
+def format_table(summaries: list[dict]) -> str:
+    """集計結果を表形式の文字列にする"""
+    header = (
+        f"{'start':<16} {'reqs':>6} {'req/s':>7} {'err':>5} {'p50ms':>8} "
+        f"{'p95ms':>8} {'avg_s3':>7} {'avg_ai':>7} {'in_tok':>9} {'cached':>9} "
+        f"{'out_tok':>8} {'usd':>9} {'usd/req':>9}"
+    )
+    lines = [header]
+    for s in summaries:
+        n = s["requests"]
+        lines.append(
+            f"{datetime.fromtimestamp(s['start']).strftime('%Y-%m-%d %H:%M'):<16} "
+            f"{n:>6} {s['rps']:>7.2f} {s['errors']:>5} {s['p50_ms']:>8.0f} "
+            f"{s['p95_ms']:>8.0f} {s['s3_ms'] / n:>7.0f} {s['ai_ms'] / n:>7.0f} "
+            f"{s['in']:>9} {s['cached']:>9} {s['out']:>8} "
+            f"{s['usd']:>9.4f} {s['usd'] / n:>9.6f}"
+        )
+    if summaries:
+        total_requests = sum(s["requests"] for s in summaries)
+        total_usd = sum(s["usd"] for s in summaries)
+        lines.append(
+            f"合計: {total_requests} リクエスト, "
+            f"エラー {sum(s['errors'] for s in summaries)} 件, "
+            f"推定コスト ${total_usd:.4f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "fp",
+        type=Path,
+        nargs="?",
+        default=setting.audit_log_path,
+        help="監査ログのファイル",
+    )
+    parser.add_argument(
+        "--window", type=int, default=3600, help="集計する時間帯の長さ（秒）"
+    )
+    parser.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        default=None,
+        help="この時刻以降のリクエストだけを集計する（例: 2024-06-01T00:00）",
+    )
+    parser.add_argument(
+        "--endpoint",
+        default=None,
+        help="集計するエンドポイント（例: /receipt-analyze）",
+    )
+    parser.add_argument("--json", action="store_true", help="JSONで出力する")
+    args = parser.parse_args()
+
+    since = args.since.timestamp() if args.since else None
+    records = (
+        record
+        for record in iter_records(args.fp)
+        if (since is None or record["ts"] >= since)
+        and (args.endpoint is None or record.get("ep") == args.endpoint)
+    )
+    summaries = summarize(records, args.window)
+    if args.json:
+        print(json.dumps(summaries, ensure_ascii=False, indent=2))
+    else:
+        print(format_table(summaries))
+
+
+if __name__ == "__main__":
+    main()
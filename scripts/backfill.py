@@ -0,0 +1,50 @@
+"""S3のプレフィックス配下のレシートを全て解析し、1行1件のJSONで出力する
+
+    python -m scripts.backfill receipts/2024/ --checkpoint data/backfill.json > results.jsonl
+
+中断した場合は、同じ --checkpoint を指定して再実行すると続きから解析する。
+"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+
+from src.receipt_scanner_model.analyze import duplicate_scope, get_receipt_detail
+from src.receipt_scanner_model.s3_scan import S3PrefixScanner
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """プレフィックス配下の画像をダウンロードしながら解析して出力する"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("prefix", help="S3のオブジェクトキーのプレフィックス")
+    parser.add_argument("--workers", type=int, default=8, help="ダウンロードの並列数")
+    parser.add_argument(
+        "--checkpoint", type=Path, default=None, help="処理済みのキーを保存するファイル"
+    )
+    args = parser.parse_args()
+
+    scanner = S3PrefixScanner(workers=args.workers, checkpoint_fp=args.checkpoint)
+    for key, image_bytes, content_type in scanner.scan(args.prefix):
+        try:
+            result = get_receipt_detail(
+                image_bytes, content_type, duplicate_scope(key)
+            ).model_dump()
+            error = None
+        except Exception as e:
+            logger.exception(f"レシート解析中にエラーが起きました。ファイル名: {key}")
+            result = None
+            error = str(e)
+        print(
+            json.dumps(
+                {"filename": key, "result": result, "error": error},
+                ensure_ascii=False,
+            ),
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""知覚ハッシュのインデックスの検索時間を、登録件数ごとに計測する
+
+ランダムなハッシュを登録し、max_distance ビット違いのハッシュ（見つかる）と、
+ランダムなハッシュ（ほとんど見つからない）で1件あたりの検索時間を計測する。
+
+    python -m scripts.benchmark_duplicate_index --entries 1000000
+"""
+
+import argparse
+import glob
+import random
+import statistics
+import time
+
+from src.receipt_scanner_model.duplicate_index import (
+    PerceptualHashIndex,
+    perceptual_hash,
+)
+
+
+def measure_lookup(index: PerceptualHashIndex, queries: list[int]) -> float:
+    """1件あたりの検索時間（マイクロ秒）を返す"""
+    start = time.perf_counter()
+    for query in queries:
+        index.find(query)
+    return (time.perf_counter() - start) / len(queries) * 1_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=1_000_000, help="登録件数")
+    parser.add_argument("--queries", type=int, default=1000, help="検索回数")
+    parser.add_argument(
+        "--max-distance", type=int, default=8, help="同じ画像とみなすハミング距離"
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index: PerceptualHashIndex[int] = PerceptualHashIndex(
+        max_distance=args.max_distance, max_entries=args.entries
+    )
+    hashes = [rng.getrandbits(64) for _ in range(args.entries)]
+    start = time.perf_counter()
+    for i, phash in enumerate(hashes):
+        index.add(phash, i)
+    print(f"add: {args.entries} entries in {time.perf_counter() - start:.2f}s")
+
+    near = []
+    for _ in range(args.queries):
+        query = rng.choice(hashes)
+        for bit in rng.sample(range(64), args.max_distance):
+            query ^= 1 << bit
+        near.append(query)
+    miss = [rng.getrandbits(64) for _ in range(args.queries)]
+    print(f"find (near duplicate): {measure_lookup(index, near):.0f}us/lookup")
+    print(f"find (random): {measure_lookup(index, miss):.0f}us/lookup")
+
+    elapsed = []
+    for fp in sorted(glob.glob("raw/*")):
+        with open(fp, "rb") as f:
+            img_bytes = f.read()
+        start = time.perf_counter()
+        perceptual_hash(img_bytes)
+        elapsed.append(time.perf_counter() - start)
+    print(f"perceptual_hash (raw/): {statistics.median(elapsed) * 1000:.1f}ms/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""リクエストごとのログ出力にかかる時間を、キューを使う場合と使わない場合で比較する
+
+receipt_analyze と同じく ReceiptDetail をINFOで出力し、1件あたりの呼び出し時間を計測する。
+
+    python -m scripts.benchmark_logging --count 20000
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from src.receipt_scanner_model.logger_config import SAMPLED, set_logger, stop_logger
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+
+RECEIPT_DETAIL = ReceiptDetail(
+    store_name="テストストア", date="2024/01/01", amount=1000, category="食費"
+)
+
+
+def set_direct_logger(log_fp: Path) -> None:
+    """キューを使わずに、ロガーに直接ハンドラーを設定する（以前の設定）"""
+    file_handler = RotatingFileHandler(
+        filename=log_fp, maxBytes=1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    file_handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            datefmt="%Y/%m/%d %H:%M:%S",
+        )
+    )
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+    logging.basicConfig(
+        level=logging.INFO, handlers=[file_handler, console_handler], force=True
+    )
+
+
+def measure(count: int) -> list[float]:
+    """ログ出力1件あたりの時間（マイクロ秒）を計測する"""
+    logger = logging.getLogger("benchmark")
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        logger.info(RECEIPT_DETAIL, extra={SAMPLED: True})
+        durations.append((time.perf_counter() - start) * 1_000_000)
+    return durations
+
+
+def main() -> None:
+    """設定ごとにログ出力の時間を計測して出力する"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=20000)
+    args = parser.parse_args()
+
+    # コンソールへの出力は計測の邪魔になるため捨てる
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_fp = Path(tmp_dir) / "server.log"
+
+        set_direct_logger(log_fp)
+        results["direct"] = measure(args.count)
+
+        for name, options in [
+            ("queue", {}),
+            ("queue+json", {"log_format": "json"}),
+            ("queue+sample0.1", {"sample_rate": 0.1}),
+        ]:
+            set_logger(log_fp=log_fp, queue_policy="block", **options)
+            results[name] = measure(args.count)
+            stop_logger()
+    sys.stderr = stderr
+
+    for name, durations in results.items():
+        quantiles = statistics.quantiles(durations, n=100)
+        print(
+            f"{name:>16}: mean={statistics.mean(durations):7.1f}us "
+            f"p50={quantiles[49]:7.1f}us p99={quantiles[98]:8.1f}us "
+            f"max={max(durations):9.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
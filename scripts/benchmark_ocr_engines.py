@@ -0,0 +1,119 @@
+"""raw/ のレシート画像で、OCRエンジン（Tesseract・ONNX）ごとの精度と処理時間を比較する
+
+画像ごとに前処理・OCR・合計金額の抽出を行い、合計金額が正解と一致した割合と、
+1枚あたりの処理時間（前処理を含む、中央値・最大）を出力する。
+ONNX のモデルは文字検出で領域を絞るため、前処理はグレースケール化だけにする（--onnx-preprocess default で Tesseract と同じ）。
+
+Tesseract・`onnxruntime` とモデルのどちらかがない場合、そのエンジンは飛ばす。
+
+    python -m scripts.benchmark_ocr_engines --threads 1 2 4 --batch-size 8
+"""
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+from scripts.labeled_receipts import load_actual_totals, load_raw_images
+from src.receipt_scanner_model.ocr_scheduler import configure_worker
+from src.receipt_scanner_model.scan_receipt import (
+    OcrEngine,
+    PreprocessConfig,
+    TesseractEngine,
+    default_preprocess_config,
+    scan,
+)
+from src.receipt_scanner_model.setting import setting
+
+# ONNX のエンジンの前処理（グレースケール化だけ）
+LIGHT_PREPROCESS = PreprocessConfig(contrast=1.0, denoise="none")
+
+
+def evaluate(
+    engine: OcrEngine,
+    config: PreprocessConfig,
+    images: dict[str, bytes],
+    actual_totals: dict[str, int],
+) -> dict:
+    """全ての画像を scan し、精度と処理時間を返す"""
+    # 1枚目はモデルの初期化などを含むため、計測の前に1回実行する
+    scan(next(iter(images.values())), config, engine=engine)
+    seconds = []
+    correct = 0
+    for name, image_bytes in images.items():
+        start = time.perf_counter()
+        result = scan(image_bytes, config, engine=engine)
+        seconds.append(time.perf_counter() - start)
+        correct += result["amount"] == actual_totals[name]
+    return {
+        "accuracy": correct / len(images),
+        "median": statistics.median(seconds),
+        "max": max(seconds),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["tesseract", "onnx"],
+        default=["tesseract", "onnx"],
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="OCRのスレッド数（Tesseract は OMP_THREAD_LIMIT、ONNX は intra-op）",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=setting.ocr_onnx_rec_batch_size
+    )
+    parser.add_argument("--det", type=Path, default=setting.ocr_onnx_det_model_path)
+    parser.add_argument("--rec", type=Path, default=setting.ocr_onnx_rec_model_path)
+    parser.add_argument("--dict", type=Path, default=setting.ocr_onnx_dict_path)
+    parser.add_argument(
+        "--onnx-preprocess", choices=["light", "default"], default="light"
+    )
+    args = parser.parse_args()
+
+    actual_totals = load_actual_totals()
+    images = load_raw_images()
+
+    print(f"{len(images)} images")
+    for threads in args.threads:
+        configure_worker(threads)
+        for name in args.engines:
+            try:
+                if name == "onnx":
+                    from src.receipt_scanner_model.onnx_ocr import OnnxOcrEngine
+
+                    engine: OcrEngine = OnnxOcrEngine(
+                        args.det,
+                        args.rec,
+                        args.dict,
+                        threads=threads,
+                        rec_batch_size=args.batch_size,
+                    )
+                    config = (
+                        LIGHT_PREPROCESS
+                        if args.onnx_preprocess == "light"
+                        else default_preprocess_config()
+                    )
+                else:
+                    engine = TesseractEngine()
+                    config = default_preprocess_config()
+                result = evaluate(engine, config, images, actual_totals)
+            except (ImportError, OSError) as e:
+                # TesseractNotFoundError も OSError
+                print(f"  {name:<10} threads={threads} skipped: {e!r}")
+                continue
+            print(
+                f"  {name:<10} threads={threads} accuracy={result['accuracy']:.2f} "
+                f"median={result['median']:.3f}s max={result['max']:.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
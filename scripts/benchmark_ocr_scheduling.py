@@ -0,0 +1,91 @@
+"""OCR のスレッド数（Tesseract・OpenCV の内部）とプロセス数の割り当てごとのスループットを比較する
+
+使えるコア数（CPU アフィニティと cgroup の CPU クォータ）を C として、
+プロセスごとのスレッド数 t = 1, 2, 4, ... と、プロセス数 C // t の組み合わせに加え、
+スレッド数を制限しない（OpenMP・OpenCV のデフォルト）場合の過剰な割り当て（C プロセス x C スレッド）で、
+raw/ の画像を --repeat 回ずつ処理し、1秒あたりの枚数を出力する。
+
+--stage scan は Tesseract が必要。--stage preprocess は前処理（OpenCV）だけを行う。
+
+    python -m scripts.benchmark_ocr_scheduling --repeat 3
+    python -m scripts.benchmark_ocr_scheduling --stage preprocess --affinity
+"""
+
+import argparse
+import glob
+import time
+
+from src.receipt_scanner_model.ocr_scheduler import (
+    OcrSchedule,
+    available_cpus,
+    cgroup_cpu_limit,
+    create_executor,
+    plan_schedule,
+)
+
+
+def process(image_bytes: bytes, stage: str) -> None:
+    from src.receipt_scanner_model.scan_receipt import preprocess_image, scan
+
+    if stage == "scan":
+        scan(image_bytes)
+    else:
+        preprocess_image(image_bytes)
+
+
+def _noop(_: int) -> None:
+    return None
+
+
+def schedules(cpus: int, affinity: bool) -> list[tuple[str, OcrSchedule]]:
+    """比較する割り当て（名前と OcrSchedule）を返す"""
+    candidates = []
+    threads = 1
+    while threads <= cpus:
+        schedule = plan_schedule(threads=threads, jobs=cpus // threads, pin=affinity)
+        candidates.append((f"{schedule.jobs}x{threads}", schedule))
+        threads *= 2
+    # スレッド数を制限しない場合、各プロセスの OpenMP・OpenCV がそれぞれ全てのコアを使おうとする
+    candidates.append(
+        (f"{cpus}x{cpus} (oversubscribed)", OcrSchedule(jobs=cpus, threads=cpus))
+    )
+    return candidates
+
+
+def measure(schedule: OcrSchedule, images: list[bytes], stage: str) -> float:
+    """1秒あたりに処理した枚数を返す（プロセスの起動時間は含まない）"""
+    with create_executor(schedule) as executor:
+        list(executor.map(_noop, range(schedule.jobs)))
+        start = time.perf_counter()
+        list(executor.map(process, images, [stage] * len(images)))
+        return len(images) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stage", choices=["scan", "preprocess"], default="scan")
+    parser.add_argument("--repeat", type=int, default=3, help="各画像を処理する回数")
+    parser.add_argument(
+        "--affinity", action="store_true", help="プロセスごとにコアを固定する"
+    )
+    args = parser.parse_args()
+
+    images = []
+    for fp in sorted(glob.glob("raw/*")):
+        with open(fp, "rb") as f:
+            images.append(f.read())
+    images *= args.repeat
+
+    cpus = available_cpus()
+    print(
+        f"cpus={cpus} (cgroup limit={cgroup_cpu_limit()}) "
+        f"images={len(images)} stage={args.stage}"
+    )
+    for name, schedule in schedules(cpus, args.affinity):
+        print(
+            f"  jobs x threads = {name:<20} {measure(schedule, images, args.stage):.2f} images/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
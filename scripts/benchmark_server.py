@@ -0,0 +1,129 @@
+"""APIサーバーの起動方法ごとのスループットを比較する
+
+以前の起動方法（uvicorn --reload の1プロセス）と、python -m api.server（本番用）を順に起動して、
+同じ負荷をかけた際のリクエスト数/秒とレイテンシを出力する。
+
+    python -m scripts.benchmark_server --requests 2000 --concurrency 32
+    python -m scripts.benchmark_server --path /receipt-analyze --json '{"filename": "xxx.png"}'
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+MODES = {
+    "reload": [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "api.main:app",
+        "--reload",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        "{port}",
+    ],
+    "production": [sys.executable, "-m", "api.server"],
+}
+
+
+def start_server(mode: str, port: int, workers: int) -> subprocess.Popen:
+    """サーバーを起動し、リクエストを受け付けるまで待つ"""
+    env = os.environ | {
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "SERVER_WORKERS": str(workers),
+        # JOB_STORE=memory では1ワーカーで起動するため、ジョブをワーカー間で共有する設定にする
+        "JOB_STORE": "sqlite",
+        "JOB_STORE_PATH": os.path.join(tempfile.gettempdir(), "benchmark_jobs.sqlite3"),
+    }
+    command = [arg.format(port=port) for arg in MODES[mode]]
+    process = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise TimeoutError(f"サーバーが起動しませんでした: {mode}")
+
+
+def run_load(
+    url: str, body: dict | None, requests: int, concurrency: int
+) -> tuple[float, list[float], int]:
+    """concurrency 並列で requests 件のリクエストを送る
+
+    Returns:
+        float: 全体の秒数
+        list[float]: リクエストごとのレイテンシ（秒）
+        int: ステータスコードが200以外だった件数
+    """
+    limits = httpx.Limits(max_connections=concurrency)
+    with httpx.Client(limits=limits, timeout=120) as client:
+
+        def send(_: int) -> tuple[float, int]:
+            start = time.perf_counter()
+            if body is None:
+                response = client.get(url)
+            else:
+                response = client.post(url, json=body)
+            return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, range(requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    errors = sum(status_code != 200 for _, status_code in results)
+    return elapsed, latencies, errors
+
+
+def main() -> None:
+    """起動方法ごとにサーバーを起動して負荷をかけ、結果を出力する"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--path", default="/")
+    parser.add_argument("--json", default=None, help="POSTする場合のリクエストボディ")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=0, help="0 の場合CPUコア数")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    body = json.loads(args.json) if args.json else None
+
+    for mode in args.modes:
+        process = start_server(mode, args.port, args.workers)
+        try:
+            url = f"http://127.0.0.1:{args.port}{args.path}"
+            # 接続の確立やワーカーの起動の影響を除くため、先に少し送っておく
+            run_load(url, body, args.concurrency, args.concurrency)
+            elapsed, latencies, errors = run_load(
+                url, body, args.requests, args.concurrency
+            )
+        finally:
+            process.terminate()
+            process.wait()
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{mode:>10}: {args.requests / elapsed:8.1f} req/s "
+            f"p50={quantiles[49] * 1000:.1f}ms p95={quantiles[94] * 1000:.1f}ms "
+            f"errors={errors}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""店名の辞書の1行あたりの検索時間を、登録した店の数ごとに計測する
+
+ランダムなカタカナの店名を登録し、支店名の付いた行（完全一致）、1文字を誤認識した行（あいまい一致）、
+店名を含まない行（住所・電話番号など）で、1行あたりの検索時間と見つかった割合を計測する。
+
+    python -m scripts.benchmark_store_index --stores 5000
+"""
+
+import argparse
+import random
+import time
+
+from src.receipt_scanner_model.store_index import StoreEntry, StoreIndex
+
+KATAKANA = [chr(code) for code in range(ord("ア"), ord("ン") + 1)]
+OTHER_LINES = [
+    "東京都渋谷区道玄坂1-2-3",
+    "TEL 03-1234-5678",
+    "2024年06月01日(土) 12:34",
+    "領収書",
+    "レジ No.0012 担当:山田",
+]
+
+
+def measure(index: StoreIndex, lines: list[str]) -> tuple[float, float]:
+    """1行あたりの検索時間（マイクロ秒）と、見つかった割合を返す"""
+    start = time.perf_counter()
+    found = sum(index.match_line(line) is not None for line in lines)
+    return (time.perf_counter() - start) / len(lines) * 1_000_000, found / len(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stores", type=int, default=5000, help="登録する店の数")
+    parser.add_argument("--queries", type=int, default=1000, help="検索回数")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = list(
+        {
+            "".join(rng.choices(KATAKANA, k=rng.randint(4, 10)))
+            for _ in range(args.stores)
+        }
+    )
+    start = time.perf_counter()
+    index = StoreIndex(
+        [StoreEntry(name=name, category="食費", count=1) for name in names]
+    )
+    print(f"build: {len(index)} stores in {time.perf_counter() - start:.2f}s")
+
+    exact = [f"{rng.choice(names)} 渋谷店" for _ in range(args.queries)]
+    typo = []
+    for _ in range(args.queries):
+        name = list(rng.choice(names))
+        name[rng.randrange(len(name))] = rng.choice(KATAKANA)
+        typo.append("".join(name))
+    other = [rng.choice(OTHER_LINES) for _ in range(args.queries)]
+    for label, lines in [("exact", exact), ("1 typo", typo), ("no store", other)]:
+        elapsed, found = measure(index, lines)
+        print(f"match_line ({label}): {elapsed:.1f}us/line, found={found:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""過去の解析結果から店名の辞書を作り、scan_receipt が読み込むファイル（設定 store_index_path）に保存する
+
+解析結果は、scripts.backfill の出力（1行1件のJSON）と、解析結果のキャッシュ・非同期ジョブの SQLite から読み込む。
+
+    python -m scripts.build_store_index results.jsonl --min-count 2
+    python -m scripts.build_store_index --result-cache data/results.sqlite3 --jobs data/jobs.sqlite3
+"""
+
+import argparse
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterator
+
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+from src.receipt_scanner_model.result_cache import decode_receipt_detail
+from src.receipt_scanner_model.setting import setting
+from src.receipt_scanner_model.store_index import StoreIndex
+
+
+def iter_backfill(fp: Path) -> Iterator[ReceiptDetail]:
+    """scripts.backfill の出力から、解析に成功した結果を読み込む"""
+    with open(fp, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            result = json.loads(line).get("result")
+            if result:
+                yield ReceiptDetail(**result)
+
+
+def iter_result_cache(fp: Path) -> Iterator[ReceiptDetail]:
+    """解析結果のキャッシュ（SQLite）から読み込む（期限切れのものも含む）"""
+    with sqlite3.connect(fp) as conn:
+        for (value,) in conn.execute("SELECT value FROM results"):
+            yield decode_receipt_detail(value)
+
+
+def iter_jobs(fp: Path) -> Iterator[ReceiptDetail]:
+    """非同期ジョブ（SQLite）から、成功したジョブの結果を読み込む"""
+    with sqlite3.connect(fp) as conn:
+        for (data,) in conn.execute("SELECT data FROM jobs"):
+            result = json.loads(data).get("result")
+            if result:
+                yield ReceiptDetail(**result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "backfill", type=Path, nargs="*", help="scripts.backfill の出力"
+    )
+    parser.add_argument("--result-cache", type=Path, default=None)
+    parser.add_argument("--jobs", type=Path, default=None)
+    parser.add_argument(
+        "--min-count", type=int, default=2, help="辞書に含める店の出現回数の下限"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=setting.store_index_path or Path("data/store_index.json"),
+    )
+    args = parser.parse_args()
+
+    details: list[ReceiptDetail] = []
+    for fp in args.backfill:
+        details.extend(iter_backfill(fp))
+    if args.result_cache is not None:
+        details.extend(iter_result_cache(args.result_cache))
+    if args.jobs is not None:
+        details.extend(iter_jobs(args.jobs))
+
+    index = StoreIndex.from_details(details, min_count=args.min_count)
+    index.save(args.output)
+    print(f"{len(details)} results -> {len(index)} stores: {args.output}")
+    for entry in sorted(index.entries, key=lambda entry: -entry.count)[:10]:
+        print(f"  {entry.count:>6} {entry.name} ({entry.category})")
+
+
+if __name__ == "__main__":
+    main()
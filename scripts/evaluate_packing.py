@@ -0,0 +1,78 @@
+"""raw/ のレシート画像で、1枚ずつの解析とまとめて解析した場合の精度・速度を比較する
+
+実行にはOpenAIのAPIキーが必要。
+
+    python -m scripts.evaluate_packing
+"""
+
+import glob
+import os
+import time
+
+from scripts.labeled_receipts import load_actual_totals
+from src.receipt_scanner_model.file_operations import encode_data_url
+from src.receipt_scanner_model.metrics import prompt_cache_metrics
+from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
+
+CONTENT_TYPES = {".jpeg": "image/jpeg", ".jpg": "image/jpeg", ".png": "image/png"}
+
+
+def load_images() -> tuple[list[str], list[str]]:
+    """raw/ の画像を読み込み、ファイル名と画像のdata URLを返す"""
+    names = []
+    images = []
+    for fp in sorted(glob.glob("raw/*")):
+        name, ext = os.path.splitext(os.path.basename(fp))
+        with open(fp, "rb") as f:
+            images.append(encode_data_url(f.read(), CONTENT_TYPES[ext]))
+        names.append(name)
+    return names, images
+
+
+def accuracy(names: list[str], results: list[ReceiptDetail]) -> float:
+    """合計金額が正解データと一致した割合を返す"""
+    actual_totals = load_actual_totals()
+    correct = sum(
+        result.amount == actual_totals[name] for name, result in zip(names, results)
+    )
+    return correct / len(names)
+
+
+def main() -> None:
+    """1枚ずつの解析とまとめて解析した場合を比較して出力する"""
+    names, images = load_images()
+    handler = OpenAIHandler()
+
+    prompt_cache_metrics.reset()
+    start = time.perf_counter()
+    single_results = [handler.analyze_image_url(image) for image in images]
+    single_elapsed = time.perf_counter() - start
+    single_tokens = prompt_cache_metrics.snapshot()["prompt_tokens"]
+
+    prompt_cache_metrics.reset()
+    start = time.perf_counter()
+    packed_results = handler.analyze_images(images)
+    packed_elapsed = time.perf_counter() - start
+    packed_tokens = prompt_cache_metrics.snapshot()["prompt_tokens"]
+
+    agreement = sum(
+        single == packed for single, packed in zip(single_results, packed_results)
+    ) / len(names)
+
+    print(f"images: {len(names)}")
+    print(
+        f"single: accuracy={accuracy(names, single_results):.2f} "
+        f"elapsed={single_elapsed:.2f}s prompt_tokens={single_tokens}"
+    )
+    print(
+        f"packed: accuracy={accuracy(names, packed_results):.2f} "
+        f"elapsed={packed_elapsed:.2f}s prompt_tokens={packed_tokens}"
+    )
+    print(f"single/packed agreement: {agreement:.2f}")
+    for name, single, packed in zip(names, single_results, packed_results):
+        if single != packed:
+            print(f"  {name}: single={single} packed={packed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""raw/ のレシート画像で、画像のルーティングの有無による精度・速度・トークン数を比較する
+
+実行にはOpenAIのAPIキーが必要。--dry-run の場合はOpenAIを呼び出さず、
+画像ごとに選ばれる設定と、画像の入力トークン数の見積もりだけを出力する。
+
+    python -m scripts.evaluate_routing
+    python -m scripts.evaluate_routing --dry-run
+"""
+
+import argparse
+import glob
+import math
+import os
+import time
+
+from scripts.evaluate_packing import CONTENT_TYPES, accuracy
+from scripts.labeled_receipts import ACTUAL_TOTALS_FP
+from src.receipt_scanner_model.file_operations import encode_data_url
+from src.receipt_scanner_model.metrics import prompt_cache_metrics, routing_metrics
+from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
+from src.receipt_scanner_model.routing import (
+    ROUTES,
+    analyze_with_routing,
+    choose_route,
+    measure_image,
+)
+
+
+def load_images() -> tuple[list[str], list[bytes], list[str]]:
+    """raw/ の画像を読み込み、ファイル名、画像のバイトデータ、data URLを返す"""
+    names = []
+    images = []
+    image_urls = []
+    for fp in sorted(glob.glob("raw/*")):
+        name, ext = os.path.splitext(os.path.basename(fp))
+        with open(fp, "rb") as f:
+            image = f.read()
+        names.append(name)
+        images.append(image)
+        image_urls.append(encode_data_url(image, CONTENT_TYPES[ext]))
+    return names, images, image_urls
+
+
+def estimate_image_tokens(width: int, height: int, detail: str) -> int:
+    """画像の入力トークン数を見積もる（gpt-4o の計算方法。detail: high はタイル数に比例する）"""
+    if detail == "low":
+        return 85
+    # 2048px 四方に収めた後、短辺を 768px 以下に縮小し、512px のタイルに分割する
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def dry_run(names: list[str], images: list[bytes]) -> None:
+    """画像ごとに選ばれる設定と、画像の入力トークン数の見積もりを出力する"""
+    baseline_total = 0
+    routed_total = 0
+    for name, image in zip(names, images):
+        start = time.perf_counter()
+        features = measure_image(image)
+        elapsed = time.perf_counter() - start
+        route = ROUTES[choose_route(features)]
+        baseline = estimate_image_tokens(features.width, features.height, "high")
+        routed = estimate_image_tokens(features.width, features.height, route.detail)
+        baseline_total += baseline
+        routed_total += routed
+        print(
+            f"{name:<20} {features.width}x{features.height} "
+            f"text_density={features.text_density:.3f} "
+            f"sharpness={features.sharpness:.0f} measure={elapsed * 1000:.1f}ms "
+            f"-> {route} image_tokens={baseline}->{routed}"
+        )
+    print(
+        f"image tokens: baseline={baseline_total} routed={routed_total} "
+        f"({1 - routed_total / baseline_total:.0%} fewer, before escalation)"
+    )
+
+
+def main() -> None:
+    """ルーティングなし（detail の指定なし）とルーティングありを比較して出力する"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="OpenAIを呼び出さずに見積もりだけを出力する",
+    )
+    args = parser.parse_args()
+
+    names, images, image_urls = load_images()
+    if args.dry_run:
+        dry_run(names, images)
+        return
+
+    handler = OpenAIHandler()
+
+    prompt_cache_metrics.reset()
+    start = time.perf_counter()
+    baseline_results = [handler.analyze_image_url(url) for url in image_urls]
+    baseline_elapsed = time.perf_counter() - start
+    baseline_tokens = prompt_cache_metrics.snapshot()["prompt_tokens"]
+
+    prompt_cache_metrics.reset()
+    routing_metrics.reset()
+    start = time.perf_counter()
+    routed_results: list[ReceiptDetail] = [
+        analyze_with_routing(handler, image, url)
+        for image, url in zip(images, image_urls)
+    ]
+    routed_elapsed = time.perf_counter() - start
+    routed_tokens = prompt_cache_metrics.snapshot()["prompt_tokens"]
+
+    print(f"images: {len(names)} (正解データ: {ACTUAL_TOTALS_FP})")
+    print(
+        f"baseline: accuracy={accuracy(names, baseline_results):.2f} "
+        f"elapsed={baseline_elapsed:.2f}s prompt_tokens={baseline_tokens}"
+    )
+    print(
+        f"routed:   accuracy={accuracy(names, routed_results):.2f} "
+        f"elapsed={routed_elapsed:.2f}s prompt_tokens={routed_tokens}"
+    )
+    print(f"routing: {routing_metrics.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
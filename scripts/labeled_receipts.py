@@ -0,0 +1,25 @@
+"""評価用のスクリプトで共通して使う、raw/ のレシート画像と正解の合計金額"""
+
+import glob
+import json
+import os
+
+# raw/ の画像ごとの正解の合計金額（拡張子を除いたファイル名 -> 金額）
+ACTUAL_TOTALS_FP = "investigation/tessract_pytesseract/actual_totals.json"
+RAW_IMAGES_GLOB = "raw/*"
+
+
+def load_actual_totals() -> dict[str, int]:
+    """正解の合計金額を読み込む"""
+    with open(ACTUAL_TOTALS_FP, "r") as f:
+        return json.load(f)
+
+
+def load_raw_images() -> dict[str, bytes]:
+    """raw/ の画像を、拡張子を除いたファイル名の順に読み込む"""
+    images = {}
+    for fp in sorted(glob.glob(RAW_IMAGES_GLOB)):
+        name, _ = os.path.splitext(os.path.basename(fp))
+        with open(fp, "rb") as f:
+            images[name] = f.read()
+    return images
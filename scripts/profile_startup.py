@@ -0,0 +1,74 @@
+"""api.main の読み込み時間を計測し、時間のかかっているモジュールを出力する
+
+新しいプロセスで `python -X importtime` を実行するため、既に読み込まれたモジュールの影響を受けない。
+
+    python -m scripts.profile_startup --top 20
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("openai", "boto3", "requests", "cv2", "numpy", "pytesseract")
+
+
+def profile_import(
+    module: str = "api.main",
+) -> tuple[float, list[tuple[str, int, int]], list[str]]:
+    """新しいプロセスでモジュールを読み込み、読み込み時間を計測する
+
+    Args:
+        module (str): 読み込むモジュール
+
+    Returns:
+        float: 読み込みにかかった秒数（インタープリターの起動を除く）
+        list[tuple[str, int, int]]: モジュール名、単体の読み込み時間、依存を含めた読み込み時間（マイクロ秒）
+        list[str]: 読み込まれた HEAVY_MODULES
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, loaded = completed.stdout.splitlines()[-2:]
+
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return float(elapsed), modules, [m for m in loaded.split(",") if m]
+
+
+def main() -> None:
+    """api.main の読み込み時間と、時間のかかっているモジュールを出力する"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="api.main", help="計測するモジュール")
+    parser.add_argument("--top", type=int, default=20, help="出力するモジュール数")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    elapsed, modules, loaded = profile_import(args.module)
+    total = time.perf_counter() - start
+
+    print(f"import {args.module}: {elapsed:.3f}s (process total {total:.3f}s)")
+    print(f"heavy modules loaded: {', '.join(loaded) or '-'}")
+    print(f"{'cumulative[ms]':>15} {'self[ms]':>10}  module")
+    for name, self_us, cumulative_us in sorted(
+        modules, key=lambda module: module[2], reverse=True
+    )[: args.top]:
+        print(f"{cumulative_us / 1000:>15.1f} {self_us / 1000:>10.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
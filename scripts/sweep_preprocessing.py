@@ -0,0 +1,76 @@
+"""raw/ のレシート画像で、前処理のパラメーター（コントラスト・ノイズ除去の強さ）ごとのOCRの精度・時間を比較する
+
+実行にはTesseractが必要。段階ごとの出力を --cache-dir にキャッシュするため、
+パラメーターを変えた場合は、その段階より後（ノイズ除去・OCR）だけが計算し直される。
+2回目以降の実行では、同じ組み合わせは計算しない。
+
+    python -m scripts.sweep_preprocessing --contrast 1.5 2 2.5 --denoise 10 20 30
+"""
+
+import argparse
+import itertools
+import time
+from pathlib import Path
+
+from scripts.labeled_receipts import load_actual_totals, load_raw_images
+from src.receipt_scanner_model.scan_receipt import PreprocessConfig, scan
+from src.receipt_scanner_model.stage_cache import StageCache
+
+
+def main() -> None:
+    default = PreprocessConfig()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--contrast", type=float, nargs="+", default=[default.contrast])
+    parser.add_argument(
+        "--denoise", type=int, nargs="+", default=[default.denoise_strength]
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=Path("data/stage_cache"),
+        help="段階ごとの出力の保存先",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=2 * 1024 * 1024 * 1024,
+        help="キャッシュのディスク使用量の上限（超えた場合は使われていないものから削除する）",
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="キャッシュを圧縮して保存する"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="キャッシュを使わずに全て計算する"
+    )
+    args = parser.parse_args()
+
+    actual_totals = load_actual_totals()
+    images = load_raw_images()
+
+    cache = (
+        None
+        if args.no_cache
+        else StageCache(args.cache_dir, args.cache_max_bytes, compress=args.compress)
+    )
+    total_start = time.perf_counter()
+    for contrast, denoise in itertools.product(args.contrast, args.denoise):
+        config = default.model_copy(
+            update={"contrast": contrast, "denoise_strength": denoise}
+        )
+        start = time.perf_counter()
+        correct = sum(
+            scan(image, config, cache=cache)["amount"] == actual_totals[name]
+            for name, image in images.items()
+        )
+        print(
+            f"contrast={contrast:<4} denoise={denoise:<3} "
+            f"accuracy={correct / len(images):.2f} "
+            f"elapsed={time.perf_counter() - start:.2f}s"
+        )
+    print(f"total: {time.perf_counter() - total_start:.2f}s")
+    if cache is not None:
+        print(f"cache: {cache.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""raw/ のレシート画像と正解の合計金額で、scan_receipt の前処理・OCRの設定を並列に探索する
+
+グレースケールの方法・拡大率・コントラスト・ノイズ除去の方法と強さ・画像ごとに前処理を選ぶか（adaptive）を
+--trials 通り選び、
+それぞれについて Tesseract の --psm/--oem の全ての組み合わせを評価する。
+前処理が同じ設定は同じプロセスでまとめて評価するため、前処理は画像ごとに1回だけ行う。
+精度（合計金額が一致した割合）と1枚あたりの処理時間のパレートフロンティアを出力し、
+推奨設定を --output に保存する（scan_receipt は設定 ocr_preprocess_config_path から読み込む）。
+
+探索と評価に同じ画像を使うと精度を高く見積もるため、1枚を除いた画像で推奨設定を選び、除いた画像で評価する
+leave-one-out の精度も出力する。leave-one-out の精度が現在のデフォルトの精度を下回る場合は、
+--force を指定しない限り推奨設定を保存しない。
+
+実行にはTesseractが必要。各プロセスのOCRは1スレッドで実行する。
+
+    python -m scripts.tune_ocr --trials 20 --workers 8
+    python -m scripts.tune_ocr --max-latency 1.5
+"""
+
+import argparse
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from scripts.labeled_receipts import load_actual_totals, load_raw_images
+from src.receipt_scanner_model.ocr_scheduler import configure_worker, plan_schedule
+from src.receipt_scanner_model.scan_receipt import (
+    PreprocessConfig,
+    extract_total_amount,
+    ocr_image,
+    preprocess_image,
+)
+
+# 前処理の探索範囲。ノイズ除去は (方法, 強さ) の組み合わせ
+PREPROCESS_SPACE: dict[str, list] = {
+    "grayscale": ["luma", "average", "min"],
+    "scale": [1.0, 1.5, 2.0],
+    "contrast": [1.0, 1.5, 2.0, 2.5],
+    "denoise": [
+        ("none", 0),
+        ("nlmeans", 10),
+        ("nlmeans", 20),
+        ("nlmeans", 30),
+        ("median", 3),
+        ("bilateral", 50),
+    ],
+    "adaptive": [False, True],
+}
+# 前処理ごとに全て評価する Tesseract の設定
+OCR_SPACE: dict[str, list[int]] = {"psm": [3, 4, 6, 11], "oem": [1, 3]}
+
+_images: dict[str, bytes] = {}
+_actual_totals: dict[str, int] = {}
+
+
+def sample_preprocess_configs(trials: int, seed: int = 0) -> list[dict]:
+    """前処理の設定を trials 通り選ぶ（現在のデフォルトを必ず含む）"""
+    default = PreprocessConfig()
+    grid = [
+        {
+            "grayscale": grayscale,
+            "scale": scale,
+            "contrast": contrast,
+            "denoise": denoise,
+            "denoise_strength": strength,
+            "adaptive": adaptive,
+        }
+        for grayscale, scale, contrast, (
+            denoise,
+            strength,
+        ), adaptive in itertools.product(*PREPROCESS_SPACE.values())
+    ]
+    baseline = default.model_dump(exclude=set(OCR_SPACE))
+    others = [params for params in grid if params != baseline]
+    random.Random(seed).shuffle(others)
+    return [baseline, *others[: max(trials - 1, 0)]]
+
+
+def _init_worker(images: dict[str, bytes], actual_totals: dict[str, int]) -> None:
+    # 複数プロセスで並列に実行するため、Tesseract（OpenMP）・OpenCV は1スレッドにする
+    configure_worker(1)
+    _images.update(images)
+    _actual_totals.update(actual_totals)
+
+
+def evaluate(name: str, preprocess: dict) -> list[dict]:
+    """1枚の画像を1通りの前処理で処理し、全ての Tesseract の設定で OCR して評価する
+
+    Returns:
+        list[dict]: 設定ごとの、画像名・合計金額が正解と一致したか・処理時間（前処理を含む）
+    """
+    start = time.perf_counter()
+    image = preprocess_image(_images[name], PreprocessConfig(**preprocess))
+    preprocess_seconds = time.perf_counter() - start
+
+    results = []
+    for psm, oem in itertools.product(*OCR_SPACE.values()):
+        config = PreprocessConfig(**preprocess, psm=psm, oem=oem)
+        start = time.perf_counter()
+        amount = extract_total_amount(ocr_image(image, config))
+        results.append(
+            {
+                "name": name,
+                "config": config.model_dump(),
+                "correct": amount == _actual_totals[name],
+                "seconds": preprocess_seconds + time.perf_counter() - start,
+            }
+        )
+    return results
+
+
+def summarize(results: list[dict]) -> list[dict]:
+    """画像ごとの結果を設定ごとに集計し、精度と1枚あたりの平均処理時間を返す"""
+    by_config: dict[str, list[dict]] = {}
+    for result in results:
+        key = json.dumps(result["config"], sort_keys=True)
+        by_config.setdefault(key, []).append(result)
+    return [
+        {
+            "config": items[0]["config"],
+            "accuracy": sum(item["correct"] for item in items) / len(items),
+            "latency": sum(item["seconds"] for item in items) / len(items),
+        }
+        for items in by_config.values()
+    ]
+
+
+def pareto_frontier(summaries: list[dict]) -> list[dict]:
+    """精度が高く処理時間が短い、他の設定に劣らない設定を処理時間の昇順に返す"""
+    frontier = []
+    best_accuracy = -1.0
+    for summary in sorted(summaries, key=lambda s: (s["latency"], -s["accuracy"])):
+        if summary["accuracy"] > best_accuracy:
+            frontier.append(summary)
+            best_accuracy = summary["accuracy"]
+    return frontier
+
+
+def recommend(frontier: list[dict], max_latency: float | None = None) -> dict:
+    """処理時間の上限以内で最も精度の高い設定を返す（同じ精度の場合は速いもの）"""
+    candidates = [
+        summary
+        for summary in frontier
+        if max_latency is None or summary["latency"] <= max_latency
+    ] or frontier[:1]
+    return max(candidates, key=lambda s: (s["accuracy"], -s["latency"]))
+
+
+def leave_one_out(results: list[dict], max_latency: float | None = None) -> dict:
+    """1枚を除いた画像で推奨設定を選び、除いた画像で評価することを全ての画像について行う
+
+    Returns:
+        dict: 除いた画像での精度と1枚あたりの平均処理時間
+    """
+    names = sorted({result["name"] for result in results})
+    correct = 0
+    seconds = 0.0
+    for held_out in names:
+        train = [result for result in results if result["name"] != held_out]
+        config = recommend(pareto_frontier(summarize(train)), max_latency)["config"]
+        test = next(
+            result
+            for result in results
+            if result["name"] == held_out and result["config"] == config
+        )
+        correct += test["correct"]
+        seconds += test["seconds"]
+    return {"accuracy": correct / len(names), "latency": seconds / len(names)}
+
+
+def format_summary(summary: dict) -> str:
+    config = PreprocessConfig(**summary["config"])
+    return (
+        f"accuracy={summary['accuracy']:.2f} latency={summary['latency']:.2f}s "
+        f"grayscale={config.grayscale} scale={config.scale} "
+        f"contrast={config.contrast} denoise={config.denoise}/{config.denoise_strength} "
+        f"adaptive={config.adaptive} {config.tesseract_config}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--trials", type=int, default=20, help="評価する前処理の設定の数"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=plan_schedule(threads=1).jobs,
+        help="並列のプロセス数（デフォルトは使えるコア数）",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=None,
+        help="推奨設定の1枚あたりの処理時間の上限（秒）",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("data/ocr_config.json"),
+        help="推奨設定の保存先",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=Path("data/ocr_tuning.json"),
+        help="全ての設定の結果とパレートフロンティアの保存先",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="leave-one-out の精度がデフォルトを下回る場合も推奨設定を保存する",
+    )
+    args = parser.parse_args()
+
+    actual_totals = load_actual_totals()
+    images = load_raw_images()
+
+    preprocess_configs = sample_preprocess_configs(args.trials, args.seed)
+    tasks = list(itertools.product(images, preprocess_configs))
+    n_configs = len(preprocess_configs) * len(
+        list(itertools.product(*OCR_SPACE.values()))
+    )
+    print(
+        f"{len(images)} images x {n_configs} configs "
+        f"({len(tasks)} tasks, {args.workers} workers)"
+    )
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=_init_worker,
+        initargs=(images, actual_totals),
+    ) as executor:
+        futures = [executor.submit(evaluate, name, params) for name, params in tasks]
+        for i, future in enumerate(as_completed(futures), 1):
+            results.extend(future.result())
+            if i % max(len(tasks) // 10, 1) == 0:
+                print(f"  {i}/{len(tasks)} tasks ({time.perf_counter() - start:.0f}s)")
+
+    summaries = summarize(results)
+    frontier = pareto_frontier(summaries)
+    recommended = recommend(frontier, args.max_latency)
+    baseline = next(
+        s for s in summaries if s["config"] == PreprocessConfig().model_dump()
+    )
+
+    print("pareto frontier:")
+    for summary in frontier:
+        print(f"  {format_summary(summary)}")
+    print(f"baseline:    {format_summary(baseline)}")
+    print(f"recommended: {format_summary(recommended)}")
+    # デフォルトは探索で選んでいないため、全ての画像での精度がそのまま汎化の見積もりになる
+    held_out = leave_one_out(results, args.max_latency)
+    print(
+        f"leave-one-out: accuracy={held_out['accuracy']:.2f} "
+        f"latency={held_out['latency']:.2f}s "
+        f"(baseline accuracy={baseline['accuracy']:.2f})"
+    )
+
+    if held_out["accuracy"] >= baseline["accuracy"] or args.force:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(
+            PreprocessConfig(**recommended["config"]).model_dump_json(indent=2),
+            encoding="utf-8",
+        )
+        print(f"saved: {args.output}")
+    else:
+        print(
+            f"leave-one-out の精度がデフォルトを下回るため、{args.output} は保存しません"
+            "（保存する場合は --force）"
+        )
+    args.report.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "images": len(images),
+                "elapsed": time.perf_counter() - start,
+                "baseline": baseline,
+                "recommended": recommended,
+                "leave_one_out": held_out,
+                "frontier": frontier,
+                "results": sorted(summaries, key=lambda s: -s["accuracy"]),
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    print(f"saved: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,146 @@
-from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
-from src.receipt_scanner_model.file_operations import encode_image
+import hashlib
+import logging
+import posixpath
+from typing import Iterator
 
+from src.receipt_scanner_model.open_ai import (
+    OpenAIHandler,
+    ReceiptDetail,
+    ReceiptStreamEvent,
+    prompt_builder,
+)
+from src.receipt_scanner_model.duplicate_index import (
+    PerceptualHashIndex,
+    perceptual_hash,
+)
+from src.receipt_scanner_model.file_operations import encode_data_url
+from src.receipt_scanner_model.result_cache import create_result_cache
+from src.receipt_scanner_model.routing import analyze_with_routing
+from src.receipt_scanner_model.setting import setting
 
-def get_receipt_detail(img_bytes: bytes, content_type: str) -> ReceiptDetail:
+logger = logging.getLogger(__name__)
+
+result_cache = create_result_cache(
+    setting.result_cache,
+    setting.result_cache_path,
+    setting.result_cache_redis_url,
+    setting.result_cache_ttl,
+)
+
+# 撮り直した同じレシートを見つけるためのインデックス（知覚ハッシュ -> 画像のSHA-256と解析結果）
+duplicate_index: PerceptualHashIndex[tuple[str, ReceiptDetail]] = PerceptualHashIndex(
+    max_distance=setting.duplicate_max_distance,
+    max_entries=setting.duplicate_index_max_entries,
+)
+
+
+def result_cache_key(img_bytes: bytes) -> str:
+    """画像の内容・モデル・プロンプトから解析結果のキャッシュのキーを作成する
+
+    プロンプトやモデルが変わった場合は別のキーになるため、古い解析結果は使われない。
+    """
+    digest = hashlib.sha256(img_bytes).hexdigest()
+    # ルーティングする場合は画像ごとにモデルが変わるため、モデル名の代わりに routed とする
+    model = "routed" if setting.image_routing else OpenAIHandler.MODEL
+    return f"{model}:{prompt_builder.prompt_cache_key}:{digest}"
+
+
+def duplicate_scope(filename: str) -> str:
+    """撮り直しの検出で比較する範囲を、S3のオブジェクトキーのプレフィックス（ディレクトリ）にする"""
+    return posixpath.dirname(filename)
+
+
+def get_receipt_detail(
+    img_bytes: bytes, content_type: str, scope: str = ""
+) -> ReceiptDetail:
     """レシートの解析を行い、ReceiptDetailを返す
 
     Args:
         img_bytes (bytes): ダウンロードした画像のバイトデータ
         content_type (str): コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+        scope (str): 撮り直しの検出で比較する範囲（duplicate_scope）。異なる範囲の画像とは比較しない
+
+    Returns:
+        ReceiptDetail: 店名、金額、日付、カテゴリー
+    """
+    phash = None
+    match = None
+    digest = None
+    if setting.duplicate_detection != "none":
+        try:
+            phash = perceptual_hash(img_bytes)
+            digest = hashlib.sha256(img_bytes).hexdigest()
+        except ValueError as e:
+            logger.warning(f"知覚ハッシュを作成できませんでした: {e}")
+    if phash is not None:
+        match = duplicate_index.find(phash, scope)
+        if match is not None:
+            (duplicate_digest, duplicate), distance = match
+            identical = duplicate_digest == digest
+            logger.warning(
+                f"撮り直した同じレシートの可能性があります"
+                f"（ハミング距離: {distance}, 同じ画像: {identical}）"
+            )
+            # 同じチェーンの別のレシートも知覚ハッシュが近くなるため、前回の結果を返すのは
+            # 画像の内容が完全に一致する場合だけにする
+            if setting.duplicate_detection == "reuse" and identical:
+                return duplicate
+
+    openai_handler = OpenAIHandler()
+
+    def analyze() -> ReceiptDetail:
+        image_url = encode_data_url(img_bytes, content_type)
+        if setting.image_routing:
+            return analyze_with_routing(openai_handler, img_bytes, image_url)
+        return openai_handler.analyze_image_url(image_url)
+
+    receipt_detail = result_cache.get_or_compute(result_cache_key(img_bytes), analyze)
+    if phash is not None and digest is not None and match is None:
+        duplicate_index.add(phash, (digest, receipt_detail), scope)
+    return receipt_detail
+
+
+def get_receipt_detail_by_url(image_url: str) -> ReceiptDetail:
+    """画像のURLを指定してレシートの解析を行い、ReceiptDetailを返す
+
+    Args:
+        image_url (str): OpenAIが取得できる画像のURL（例: S3の署名付きURL）
 
     Returns:
         ReceiptDetail: 店名、金額、日付、カテゴリー
     """
     openai_handler = OpenAIHandler()
-    base64_image = encode_image(img_bytes)
-    return openai_handler.analyze_image(base64_image, content_type)
+    return openai_handler.analyze_image_url(image_url)
+
+
+def get_receipt_details(images: list[tuple[bytes, str]]) -> list[ReceiptDetail]:
+    """複数のレシートをまとめて解析し、画像と同じ順でReceiptDetailを返す
+
+    Args:
+        images (list[tuple[bytes, str]]): ダウンロードした画像のバイトデータとコンテントのMIMEタイプ
+
+    Returns:
+        list[ReceiptDetail]: 店名、金額、日付、カテゴリー
+    """
+    openai_handler = OpenAIHandler()
+    return openai_handler.analyze_images(
+        [encode_data_url(img_bytes, content_type) for img_bytes, content_type in images]
+    )
+
+
+def stream_receipt_detail(
+    img_bytes: bytes, content_type: str
+) -> Iterator[ReceiptStreamEvent]:
+    """レシートの解析を行い、確定した項目から順に返す
+
+    Args:
+        img_bytes (bytes): ダウンロードした画像のバイトデータ
+        content_type (str): コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+
+    Returns:
+        Iterator[ReceiptStreamEvent]: 確定した項目ごとのイベントと、最後に全項目のイベント
+    """
+    openai_handler = OpenAIHandler()
+    return openai_handler.stream_analyze_image_url(
+        encode_data_url(img_bytes, content_type)
+    )
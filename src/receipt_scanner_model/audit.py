@@ -0,0 +1,268 @@
+"""リクエストごとの処理時間・トークン数・推定コストを1行1件のJSONで記録する監査ログ
+
+API側で audit_request のスコープを開始すると、その中で呼ばれた S3・OpenAI の処理時間やトークン数が
+同じレコードに集計され、スコープの終了時に1行書き出される。スコープの外で呼ばれた場合は何も記録しない。
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+from src.receipt_scanner_model.setting import setting
+
+if TYPE_CHECKING:
+    from openai.types import CompletionUsage
+
+logger = logging.getLogger(__name__)
+
+# 100万トークンあたりの料金（USD）: 入力、キャッシュされた入力、出力
+MODEL_PRICES: dict[str, tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+
+def estimate_cost(
+    model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int
+) -> float:
+    """トークン数から推定コスト（USD）を計算する。料金が不明なモデルは 0 を返す"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    input_price, cached_input_price, output_price = prices
+    return (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_input_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+
+
+_current_record: "ContextVar[AuditRecord | None]" = ContextVar(
+    "current_audit_record", default=None
+)
+
+
+class AuditRecord:
+    """1リクエスト分の集計
+
+    activate() のスコープ内で呼ばれた S3・OpenAI の処理が集計され、finish() で監査ログに書き出す。
+    """
+
+    def __init__(self, endpoint: str, filename: str | None = None) -> None:
+        self.endpoint = endpoint
+        self.filename = filename
+        self.status = 200
+        self.timestamp = time.time()
+        self._start = time.perf_counter()
+        self.image_bytes = 0
+        self.s3_seconds = 0.0
+        self.openai_seconds = 0.0
+        self.openai_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost_usd = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self) -> Iterator["AuditRecord"]:
+        """このスコープ内で呼ばれた S3・OpenAI の処理を、このレコードに集計する
+
+        ストリーミングのように、1リクエストの処理が複数のスレッドにまたがる場合は、処理ごとに呼び出す。
+        """
+        token = _current_record.set(self)
+        try:
+            yield self
+        finally:
+            _current_record.reset(token)
+
+    def finish(self) -> None:
+        """リクエストの処理時間を確定し、監査ログに書き出す"""
+        audit_log.write(self.to_json(time.perf_counter() - self._start))
+
+    def add_s3(self, elapsed: float, image_bytes: int = 0) -> None:
+        with self._lock:
+            self.s3_seconds += elapsed
+            self.image_bytes += image_bytes
+
+    def add_openai(
+        self, elapsed: float, usage: "CompletionUsage | None", model: str
+    ) -> None:
+        with self._lock:
+            self.openai_seconds += elapsed
+            self.openai_calls += 1
+            if usage is None:
+                return
+            details = usage.prompt_tokens_details
+            cached_tokens = (details.cached_tokens or 0) if details else 0
+            self.prompt_tokens += usage.prompt_tokens
+            self.completion_tokens += usage.completion_tokens
+            self.cached_tokens += cached_tokens
+            self.cost_usd += estimate_cost(
+                model, usage.prompt_tokens, cached_tokens, usage.completion_tokens
+            )
+
+    def to_json(self, latency: float) -> str:
+        """1行分のJSONを作成する（キーは短く、値のない項目は省く）"""
+        record = {
+            "ts": round(self.timestamp, 3),
+            "ep": self.endpoint,
+            "file": self.filename,
+            "status": self.status,
+            "ms": round(latency * 1000, 1),
+            "bytes": self.image_bytes,
+            "s3_ms": round(self.s3_seconds * 1000, 1),
+            "ai_ms": round(self.openai_seconds * 1000, 1),
+            "calls": self.openai_calls,
+            "in": self.prompt_tokens,
+            "cached": self.cached_tokens,
+            "out": self.completion_tokens,
+            "usd": round(self.cost_usd, 8),
+        }
+        return json.dumps(
+            {key: value for key, value in record.items() if value not in (None, 0)},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+
+class AuditLog:
+    """監査ログをバッファしてまとめて書き込み、サイズが上限を超えたらローテーションする
+
+    複数のワーカープロセスが同じファイルをローテーションすると行が失われるため、
+    per_process の場合はプロセスごとのファイル（例: audit.12345.jsonl）に書き込む。
+
+    Args:
+        fp (Path | None): 書き込み先。None の場合は記録しない
+        max_bytes (int): ローテーションするファイルサイズ
+        backup_count (int): 残す古いファイルの数
+        buffer_size (int): まとめて書き込む件数
+        flush_interval (float): バッファが一杯でなくても書き込む間隔（秒）
+        per_process (bool): ファイル名にプロセスIDを付けるかどうか
+    """
+
+    def __init__(
+        self,
+        fp: Path | None,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 10,
+        buffer_size: int = 100,
+        flush_interval: float = 5.0,
+        per_process: bool = False,
+    ) -> None:
+        self.fp = fp
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.per_process = per_process
+        self._lock = threading.Lock()
+        self._buffer: list[str] = []
+        self._last_flush = time.monotonic()
+
+    @property
+    def path(self) -> Path | None:
+        """実際に書き込むファイル。fork されたワーカーでも自身のプロセスIDになるよう、書き込む度に求める"""
+        if self.fp is None or not self.per_process:
+            return self.fp
+        return self.fp.with_name(f"{self.fp.stem}.{os.getpid()}{self.fp.suffix}")
+
+    def write(self, line: str) -> None:
+        """1行追加し、必要であれば書き込む"""
+        if self.fp is None:
+            return
+        with self._lock:
+            self._buffer.append(line)
+            if (
+                len(self._buffer) >= self.buffer_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self) -> None:
+        """バッファに残っている行を書き込む"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._last_flush = time.monotonic()
+        fp = self.path
+        if not self._buffer or fp is None:
+            return
+        data = ("\n".join(self._buffer) + "\n").encode("utf-8")
+        self._buffer.clear()
+        try:
+            fp.parent.mkdir(parents=True, exist_ok=True)
+            if fp.exists() and fp.stat().st_size + len(data) > self.max_bytes:
+                self._rotate(fp)
+            with open(fp, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error(f"監査ログの書き込みに失敗しました: {e}")
+
+    def _rotate(self, fp: Path) -> None:
+        for i in range(self.backup_count - 1, 0, -1):
+            src = fp.with_name(f"{fp.name}.{i}")
+            if src.exists():
+                os.replace(src, fp.with_name(f"{fp.name}.{i + 1}"))
+        if self.backup_count > 0:
+            os.replace(fp, fp.with_name(f"{fp.name}.1"))
+        else:
+            os.remove(fp)
+
+
+audit_log = AuditLog(setting.audit_log_path, per_process=True)
+atexit.register(audit_log.flush)
+
+
+@contextmanager
+def audit_request(endpoint: str, filename: str | None = None) -> Iterator[AuditRecord]:
+    """このスコープ内の処理を1リクエストとして集計し、終了時に監査ログに書き出す
+
+    例外で終了した場合は、例外の status_code（HTTPException）または code（ErrorResponse）をステータスとする。
+    """
+    record = AuditRecord(endpoint, filename)
+    try:
+        with record.activate():
+            yield record
+    except Exception as e:
+        record.status = getattr(e, "status_code", None) or getattr(e, "code", 500)
+        raise
+    finally:
+        record.finish()
+
+
+def record_openai(elapsed: float, usage: "CompletionUsage | None", model: str) -> None:
+    """実行中のリクエストにOpenAIの呼び出しを記録する"""
+    record = _current_record.get()
+    if record is not None:
+        record.add_openai(elapsed, usage, model)
+
+
+def audit_s3(func):
+    """S3の呼び出し時間と、ダウンロードした画像のバイト数を記録するデコレーター"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        record = _current_record.get()
+        if record is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        image_bytes = 0
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, tuple) and isinstance(result[0], bytes):
+                image_bytes = len(result[0])
+            return result
+        finally:
+            record.add_s3(time.perf_counter() - start, image_bytes)
+
+    return wrapper
@@ -0,0 +1,289 @@
+"""上流サービス（S3, OpenAI）の障害時に即座に失敗させるサーキットブレーカー"""
+
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from enum import Enum
+from functools import wraps
+from typing import Callable, NamedTuple
+
+from src.receipt_scanner_model.error import ErrorResponse
+from src.receipt_scanner_model.setting import setting
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class Admission(NamedTuple):
+    """呼び出しを許可した時点の状態（結果を記録する際に、許可した後に状態が変わったかの判定に使う）"""
+
+    # 状態が変わるたびに増える番号
+    generation: int
+    # HALF_OPEN の試験呼び出しか
+    probe: bool
+
+
+class CircuitBreaker:
+    """エラー率と遅延呼び出し率で開閉するサーキットブレーカー
+
+    CLOSED: 通常通り呼び出す。直近 window_size 件のエラー率・遅延率が閾値を超えると OPEN に遷移する。
+    OPEN: open_duration 秒の間、上流を呼ばずに即座に失敗させる。経過後 HALF_OPEN に遷移する。
+    HALF_OPEN: half_open_max_calls 件だけ試験的に呼び出し、全て成功すれば CLOSED、1件でも失敗すれば OPEN に戻す。
+
+    許可した後に状態が変わった呼び出し（CLOSED で許可し、OPEN になった後に終わったものなど）の結果は記録しない。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = 10.0,
+        slow_call_rate_threshold: float = 1.0,
+        window_size: int = 20,
+        minimum_calls: int = 5,
+        open_duration: float = 30.0,
+        half_open_max_calls: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """状態を CLOSED に戻し、集計をクリアする"""
+        with self._lock:
+            self._state = CircuitState.CLOSED
+            self._generation += 1
+            # (失敗したか, 遅延したか) を直近 window_size 件保持する
+            self._calls: deque[tuple[bool, bool]] = deque(maxlen=self.window_size)
+            self._opened_at = 0.0
+            self._half_open_in_flight = 0
+            self._half_open_successes = 0
+            self._rejected_count = 0
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def allow_request(self) -> bool:
+        """上流を呼び出してよいかを判定する
+
+        Returns:
+            bool: 呼び出してよい場合 True、即座に失敗させる場合 False
+        """
+        return self.acquire() is not None
+
+    def acquire(self) -> Admission | None:
+        """上流を呼び出してよいかを判定し、許可した時点の状態を返す
+
+        Returns:
+            Admission | None: 呼び出してよい場合は record_success などに渡す値、即座に失敗させる場合 None
+        """
+        with self._lock:
+            self._refresh_state()
+            if self._state == CircuitState.CLOSED:
+                return Admission(self._generation, probe=False)
+            if (
+                self._state == CircuitState.HALF_OPEN
+                and self._half_open_in_flight < self.half_open_max_calls
+            ):
+                self._half_open_in_flight += 1
+                return Admission(self._generation, probe=True)
+            self._rejected_count += 1
+            return None
+
+    def record_success(
+        self, elapsed: float, admission: Admission | None = None
+    ) -> None:
+        """呼び出し成功を記録する
+
+        Args:
+            elapsed (float): 呼び出しにかかった秒数
+            admission (Admission | None): acquire の戻り値。None の場合は現在の状態で許可した呼び出しとみなす
+        """
+        self._record(failed=False, elapsed=elapsed, admission=admission)
+
+    def record_failure(
+        self, elapsed: float, admission: Admission | None = None
+    ) -> None:
+        """呼び出し失敗を記録する
+
+        Args:
+            elapsed (float): 呼び出しにかかった秒数
+            admission (Admission | None): acquire の戻り値。None の場合は現在の状態で許可した呼び出しとみなす
+        """
+        self._record(failed=True, elapsed=elapsed, admission=admission)
+
+    def release(self, admission: Admission) -> None:
+        """成功・失敗のどちらにも数えずに、呼び出しを終える（HALF_OPEN の試験呼び出しの枠を空ける）"""
+        with self._lock:
+            if admission.probe and admission.generation == self._generation:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+
+    def snapshot(self) -> dict:
+        """監視用に現在の状態を返す"""
+        with self._lock:
+            self._refresh_state()
+            total = len(self._calls)
+            return {
+                "name": self.name,
+                "state": self._state.value,
+                "calls": total,
+                "failure_rate": self._failure_rate(),
+                "slow_call_rate": self._slow_call_rate(),
+                "rejected": self._rejected_count,
+            }
+
+    def _record(
+        self, failed: bool, elapsed: float, admission: Admission | None
+    ) -> None:
+        slow = elapsed >= self.slow_call_duration
+        with self._lock:
+            if admission is not None and admission.generation != self._generation:
+                # 許可した後に状態が変わった呼び出しは、今の状態の判定に使わない
+                return
+            if self._state == CircuitState.HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+                if failed or slow:
+                    self._transition(CircuitState.OPEN)
+                    return
+                self._half_open_successes += 1
+                if self._half_open_successes >= self.half_open_max_calls:
+                    self._transition(CircuitState.CLOSED)
+                return
+
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.minimum_calls:
+                return
+            if (
+                self._failure_rate() >= self.failure_rate_threshold
+                or self._slow_call_rate() >= self.slow_call_rate_threshold
+            ):
+                self._transition(CircuitState.OPEN)
+
+    def _failure_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(failed for failed, _ in self._calls) / len(self._calls)
+
+    def _slow_call_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(slow for _, slow in self._calls) / len(self._calls)
+
+    def _refresh_state(self) -> None:
+        if (
+            self._state == CircuitState.OPEN
+            and self._clock() - self._opened_at >= self.open_duration
+        ):
+            self._transition(CircuitState.HALF_OPEN)
+
+    def _transition(self, state: CircuitState) -> None:
+        logger.warning(
+            f"サーキットブレーカーの状態が変化しました: {self.name} {self._state.value} -> {state.value}"
+        )
+        self._state = state
+        self._generation += 1
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        if state == CircuitState.OPEN:
+            self._opened_at = self._clock()
+        if state == CircuitState.CLOSED:
+            self._calls.clear()
+
+
+def circuit_breaker(
+    breaker: CircuitBreaker,
+    failure_errors: tuple[type[Exception], ...],
+    open_error: Callable[[], ErrorResponse],
+):
+    """関数呼び出しをサーキットブレーカーで保護するデコレーター
+
+    Args:
+        breaker (CircuitBreaker): 使用するサーキットブレーカー
+        failure_errors (tuple[type[Exception], ...]): 上流の障害として数える例外
+        open_error (Callable[[], ErrorResponse]): OPEN 中に送出する例外を生成する関数
+    """
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            # ストリーミングの場合は、最後まで読み切るかエラーで終わるまでを1回の呼び出しとして数える
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                admission = breaker.acquire()
+                if admission is None:
+                    raise open_error()
+                start = time.perf_counter()
+                try:
+                    yield from func(*args, **kwargs)
+                except failure_errors:
+                    breaker.record_failure(time.perf_counter() - start, admission)
+                    raise
+                except GeneratorExit:
+                    # 最後まで読まずに閉じられた場合は、成功・失敗のどちらにも数えない
+                    breaker.release(admission)
+                    raise
+                except Exception:
+                    breaker.record_success(time.perf_counter() - start, admission)
+                    raise
+                breaker.record_success(time.perf_counter() - start, admission)
+
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            admission = breaker.acquire()
+            if admission is None:
+                raise open_error()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except failure_errors:
+                breaker.record_failure(time.perf_counter() - start, admission)
+                raise
+            except Exception:
+                # クライアント起因のエラーは上流の障害として数えない
+                breaker.record_success(time.perf_counter() - start, admission)
+                raise
+            breaker.record_success(time.perf_counter() - start, admission)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def create_circuit_breaker(name: str) -> CircuitBreaker:
+    """設定値からサーキットブレーカーを作成する"""
+    return CircuitBreaker(
+        name=name,
+        failure_rate_threshold=setting.circuit_breaker_failure_rate_threshold,
+        slow_call_duration=setting.circuit_breaker_slow_call_duration,
+        slow_call_rate_threshold=setting.circuit_breaker_slow_call_rate_threshold,
+        window_size=setting.circuit_breaker_window_size,
+        minimum_calls=setting.circuit_breaker_minimum_calls,
+        open_duration=setting.circuit_breaker_open_duration,
+        half_open_max_calls=setting.circuit_breaker_half_open_max_calls,
+    )
+
+
+s3_circuit_breaker = create_circuit_breaker("s3")
+openai_circuit_breaker = create_circuit_breaker("openai")
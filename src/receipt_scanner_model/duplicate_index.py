@@ -0,0 +1,232 @@
+"""同じレシートを撮り直した画像（ほぼ同じ画像）を見つけるための知覚ハッシュのインデックス
+
+バイト列のハッシュは撮り直すと一致しないため、画像を縮小して離散コサイン変換した低周波成分から
+64bit の知覚ハッシュ（pHash）を作成し、ハミング距離が近い画像を同じレシートとみなす。
+"""
+
+import logging
+import threading
+from array import array
+from collections import deque
+from itertools import combinations
+from typing import Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+HASH_BITS = 64
+# 余白を切り取る前に縮小する長辺のピクセル数
+TRIM_MAX_SIDE = 512
+# ハッシュを作成する際に縮小する大きさと、使う低周波成分の大きさ
+DCT_SIZE = 32
+LOW_FREQUENCY_SIZE = 8
+
+_dct_matrix = None
+
+
+def _get_dct_matrix():
+    global _dct_matrix
+    if _dct_matrix is None:
+        import numpy as np
+
+        k = np.arange(DCT_SIZE)
+        matrix = np.sqrt(2 / DCT_SIZE) * np.cos(
+            np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * DCT_SIZE)
+        )
+        matrix[0] /= np.sqrt(2)
+        _dct_matrix = matrix
+    return _dct_matrix
+
+
+def perceptual_hash(img_bytes: bytes) -> int:
+    """画像の知覚ハッシュ（64bit）を作成する
+
+    撮り直すと写る範囲が変わるため、文字のある範囲の外側の余白を切り取ってから、
+    グレースケールで 32x32 に縮小して離散コサイン変換し、左上 8x8 の低周波成分が中央値より大きいかを1bitとする。
+    多少の切り抜き・余白・拡大縮小・明るさ・圧縮の違いではハミング距離が小さく保たれる。
+
+    Args:
+        img_bytes (bytes): 画像のバイトデータ
+
+    Returns:
+        int: 知覚ハッシュ
+    """
+    # cv2 は読み込みに時間がかかるため、初めて使う際に読み込む
+    import cv2
+    import numpy as np
+
+    gray = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("画像を読み込めませんでした")
+    scale = TRIM_MAX_SIDE / max(gray.shape)
+    gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # 文字とみなした画素の範囲（外れ値を除く）の外側を切り取る
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15
+    )
+    # レシートの縁や背景との境目などの長い直線は文字ではないため除く
+    height, width = binary.shape
+    for kernel in [(max(width // 3, 1), 1), (1, max(height // 3, 1))]:
+        lines = cv2.morphologyEx(
+            binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, kernel)
+        )
+        binary = cv2.subtract(binary, lines)
+    ys, xs = np.nonzero(binary)
+    if len(xs) > 0:
+        x0, x1 = np.percentile(xs, [0.5, 99.5]).astype(int)
+        y0, y1 = np.percentile(ys, [0.5, 99.5]).astype(int)
+        gray = gray[y0 : y1 + 1, x0 : x1 + 1]
+
+    small = cv2.resize(gray, (DCT_SIZE, DCT_SIZE), interpolation=cv2.INTER_AREA).astype(
+        np.float64
+    )
+    dct = _get_dct_matrix()
+    low = (dct @ small @ dct.T)[:LOW_FREQUENCY_SIZE, :LOW_FREQUENCY_SIZE].flatten()
+    bits = low > np.median(low)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class PerceptualHashIndex(Generic[T]):
+    """知覚ハッシュのハミング距離が max_distance 以内の登録済みの値を探すインデックス
+
+    64bit を blocks 個のブロックに分けて、ブロックごとに辞書を持つ（multi-index hashing）。
+    ハミング距離が max_distance 以内であれば、少なくとも1つのブロックは距離 max_distance // blocks 以内になるため、
+    各ブロックでその距離以内の値だけを辞書から引き、候補のみ距離を計算する。
+    登録数が max_entries を超えた場合は、古いものから削除する。
+    scope（ユーザーやS3のプレフィックスなど）を指定した場合は、同じ scope で登録した値だけを探す。
+
+    Args:
+        max_distance (int): 同じ画像とみなすハミング距離の上限
+        max_entries (int): 保持する件数の上限
+        blocks (int): ハッシュを分割するブロック数
+    """
+
+    def __init__(
+        self, max_distance: int = 8, max_entries: int = 100_000, blocks: int = 3
+    ) -> None:
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.blocks = blocks
+        # 割り切れない場合は先頭のブロックを1bitずつ長くする
+        widths = [
+            HASH_BITS // blocks + (1 if i < HASH_BITS % blocks else 0)
+            for i in range(blocks)
+        ]
+        self._shifts = [sum(widths[:i]) for i in range(blocks)]
+        self._masks = [(1 << width) - 1 for width in widths]
+        # ブロックごとの、距離 max_distance // blocks 以内になる差分のビットパターン
+        self._probes = [
+            [
+                sum(1 << bit for bit in bits)
+                for distance in range(max_distance // blocks + 1)
+                for bits in combinations(range(width), distance)
+            ]
+            for width in widths
+        ]
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._values)
+
+    def clear(self) -> None:
+        """登録した値を全て削除する"""
+        with self._lock:
+            self._tables: list[dict[tuple[str, int], list[int]]] = [
+                {} for _ in range(self.blocks)
+            ]
+            # スロット番号ごとのハッシュと、scope・値
+            self._hashes = array("Q")
+            self._values: dict[int, tuple[str, T]] = {}
+            self._order: deque[int] = deque()
+            self._lookups = 0
+            self._matches = 0
+
+    def add(self, phash: int, value: T, scope: str = "") -> None:
+        """ハッシュと値を scope に登録する"""
+        with self._lock:
+            if len(self._values) >= self.max_entries:
+                # 最も古いものを削除し、そのスロットを再利用する
+                slot = self._order.popleft()
+                self._remove(slot)
+                self._hashes[slot] = phash
+            else:
+                slot = len(self._hashes)
+                self._hashes.append(phash)
+            self._values[slot] = (scope, value)
+            self._order.append(slot)
+            for table, key in zip(self._tables, self._split(phash)):
+                table.setdefault((scope, key), []).append(slot)
+
+    def find(self, phash: int, scope: str = "") -> tuple[T, int] | None:
+        """scope の中でハミング距離が max_distance 以内で最も近い値と、その距離を返す。ない場合は None を返す"""
+        with self._lock:
+            self._lookups += 1
+            candidates: list[int] = []
+            for table, key, probes in zip(
+                self._tables, self._split(phash), self._probes
+            ):
+                for probe in probes:
+                    slots = table.get((scope, key ^ probe))
+                    if slots:
+                        candidates.extend(slots)
+            if not candidates:
+                return None
+            slot, distance = self._nearest(phash, candidates)
+            if distance > self.max_distance:
+                return None
+            self._matches += 1
+            return self._values[slot][1], distance
+
+    def snapshot(self) -> dict:
+        """監視用に現在の件数と、見つかった回数を返す"""
+        with self._lock:
+            return {
+                "entries": len(self._values),
+                "lookups": self._lookups,
+                "matches": self._matches,
+            }
+
+    def _split(self, phash: int) -> list[int]:
+        return [
+            (phash >> shift) & mask for shift, mask in zip(self._shifts, self._masks)
+        ]
+
+    def _nearest(self, phash: int, candidates: list[int]) -> tuple[int, int]:
+        if len(candidates) < 64:
+            return min(
+                (
+                    (slot, (self._hashes[slot] ^ phash).bit_count())
+                    for slot in candidates
+                ),
+                key=lambda item: item[1],
+            )
+        # 候補が多い場合は NumPy でまとめて距離を計算する
+        import numpy as np
+
+        hashes = np.array([self._hashes[slot] for slot in candidates], dtype=np.uint64)
+        distances = _popcount(hashes ^ np.uint64(phash))
+        best = int(distances.argmin())
+        return candidates[best], int(distances[best])
+
+    def _remove(self, slot: int) -> None:
+        phash = self._hashes[slot]
+        scope = self._values[slot][0]
+        for table, key in zip(self._tables, self._split(phash)):
+            slots = table[(scope, key)]
+            slots.remove(slot)
+            if not slots:
+                del table[(scope, key)]
+        del self._values[slot]
+
+
+def _popcount(values):
+    """uint64 の配列の各要素の立っているビット数を返す"""
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
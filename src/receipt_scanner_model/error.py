@@ -44,3 +44,19 @@ class OpenAIUnexpectedError(ErrorResponse):
 
 class OpenAIResponseFormatError(ErrorResponse):
     pass
+
+
+class OpenAIImageUrlError(ErrorResponse):
+    pass
+
+
+class JobNotFound(ErrorResponse):
+    pass
+
+
+class JobQueueFull(ErrorResponse):
+    pass
+
+
+class JobCallbackForbidden(ErrorResponse):
+    pass
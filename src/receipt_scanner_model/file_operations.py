@@ -1,4 +1,8 @@
 import base64
+import binascii
+
+# Base64は3バイト単位でエンコードされるため、チャンクは3の倍数にする
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
 
 
 def encode_image(image_bytes: bytes):
@@ -9,3 +13,33 @@ def encode_image(image_bytes: bytes):
     Returns: str: Base64エンコードされた画像データ
     """
     return base64.b64encode(image_bytes).decode("utf-8")
+
+
+def encode_data_url(image_bytes: bytes, content_type: str) -> str:
+    """画像のバイトデータをBase64エンコードし、data URLを作成する
+
+    encode_image の結果を f-string で data URL にすると、Base64のbytes・str・data URLと
+    画像全体のコピーが複数できる。ここでは確保済みのバッファにチャンクごとにエンコードし、
+    最後に一度だけ str に変換する。
+
+    Args:
+        image_bytes (bytes): 画像のバイトデータ
+        content_type (str): コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+
+    Returns:
+        str: data URL（例: "data:image/png;base64,..."）
+    """
+    prefix = f"data:{content_type};base64,".encode("ascii")
+    encoded_length = 4 * ((len(image_bytes) + 2) // 3)
+    buffer = bytearray(len(prefix) + encoded_length)
+    buffer[: len(prefix)] = prefix
+
+    offset = len(prefix)
+    view = memoryview(image_bytes)
+    for start in range(0, len(view), BASE64_CHUNK_SIZE):
+        encoded = binascii.b2a_base64(
+            view[start : start + BASE64_CHUNK_SIZE], newline=False
+        )
+        buffer[offset : offset + len(encoded)] = encoded
+        offset += len(encoded)
+    return buffer.decode("ascii")
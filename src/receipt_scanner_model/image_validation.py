@@ -0,0 +1,201 @@
+"""OpenAIに送る前に、画像のバイトデータが本当に対応した画像かを安く検証する
+
+S3のContent-Typeは拡張子などから付けられるため、実際の中身と一致するとは限らない。
+先頭のマジックバイトで実際の形式を判定し、Pillow でヘッダーだけを読んで縦横のピクセル数を確認する
+（画素のデコードは行わないため、数ミリ秒で終わる）。
+HEIC・WebP は OpenAI（とOCR）で扱えるよう JPEG に変換する。
+"""
+
+import logging
+from io import BytesIO
+
+from src.receipt_scanner_model.error import S3BadRequest
+from src.receipt_scanner_model.setting import setting
+
+logger = logging.getLogger(__name__)
+
+# そのまま送れる形式
+PASSTHROUGH_CONTENT_TYPES = ("image/png", "image/jpeg")
+# JPEG に変換して送る形式
+CONVERTIBLE_CONTENT_TYPES = ("image/webp", "image/heic", "image/heif")
+SUPPORTED_CONTENT_TYPES = PASSTHROUGH_CONTENT_TYPES + CONVERTIBLE_CONTENT_TYPES
+
+# Pillow の形式名と Content-Type の対応
+_PILLOW_FORMATS = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "HEIF": "image/heic",
+}
+# ISO BMFF（ftyp ボックス）のブランドのうち HEIC・HEIF のもの
+_HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1")
+# 変換後の JPEG の品質
+JPEG_QUALITY = 95
+# 署名付きURLを渡す前に、範囲指定で取得する先頭のバイト数（通常はこの中に縦横のピクセル数がある）
+HEADER_PROBE_BYTES = 64 * 1024
+
+
+def sniff_image_type(head: bytes) -> str | None:
+    """先頭のマジックバイトから画像の形式を判定し、Content-Typeを返す。判定できない場合は None を返す
+
+    Args:
+        head (bytes): 画像の先頭のバイトデータ（16バイト以上）
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS:
+        return "image/heic"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def validate_image_bytes(
+    img_bytes: bytes, declared_content_type: str | None = None
+) -> tuple[bytes, str]:
+    """画像の実際の形式と大きさを検証し、OpenAIに送れる形式の画像を返す
+
+    Content-Typeとマジックバイトが一致しない場合は、マジックバイトの形式を使う。
+    縦横のピクセル数が image_max_pixels を超える画像（展開するとメモリを使い切る画像）は拒否する。
+
+    Args:
+        img_bytes (bytes): 画像のバイトデータ
+        declared_content_type (str | None): S3のContent-Type
+
+    Returns:
+        bytes: 画像のバイトデータ（HEIC・WebP の場合は JPEG に変換したもの）
+        str: コンテントのMIMEタイプ（"image/jpeg" または "image/png"）
+    """
+    content_type = sniff_image_type(img_bytes[:16])
+    if content_type not in SUPPORTED_CONTENT_TYPES:
+        logger.error(
+            f"サポートされていない画像形式です: {content_type or '不明'} "
+            f"(Content-Type: {declared_content_type})"
+        )
+        raise S3BadRequest(
+            400, f"サポートされていない画像形式です: {content_type or '不明'}"
+        )
+    if declared_content_type is not None and declared_content_type != content_type:
+        logger.warning(
+            f"Content-Typeと画像の形式が一致しません: "
+            f"{declared_content_type} (実際は {content_type})"
+        )
+
+    # Pillow は読み込みに時間がかかるため、初めて使う際に読み込む
+    from PIL import Image, UnidentifiedImageError
+
+    if content_type == "image/heic":
+        _register_heif_opener()
+    try:
+        # open はヘッダーだけを読み、画素は load するまでデコードしない
+        image = Image.open(BytesIO(img_bytes))
+    except Image.DecompressionBombError as e:
+        logger.error(f"画像のピクセル数が制限を超えています: {e}")
+        raise S3BadRequest(400, f"画像のピクセル数が制限を超えています: {e}")
+    except (UnidentifiedImageError, OSError) as e:
+        logger.error(f"画像のヘッダーを読み込めませんでした: {content_type} {e}")
+        raise S3BadRequest(400, f"画像のヘッダーを読み込めませんでした: {e}")
+
+    with image:
+        _check_image(image, content_type)
+        if content_type in PASSTHROUGH_CONTENT_TYPES:
+            return img_bytes, content_type
+        return _to_jpeg(image), "image/jpeg"
+
+
+def validate_image_header(head: bytes, declared_content_type: str) -> str | None:
+    """画像の先頭のバイトデータだけで、そのまま送れる画像かを検証する（署名付きURLを渡す前の検証）
+
+    マジックバイトの形式が Content-Type と一致し、縦横のピクセル数が image_max_pixels 以下の場合は
+    Content-Type を返す。変換が必要な形式の場合や、先頭だけではヘッダーを読めない場合は None を返す
+    （ダウンロードして validate_image_bytes で検証する）。
+    画素のデコードは行わないため、ヘッダーより後ろが壊れている画像は検出できない。
+
+    Args:
+        head (bytes): 画像の先頭 HEADER_PROBE_BYTES バイト（画像全体の場合を含む）
+        declared_content_type (str): S3のContent-Type
+
+    Raises:
+        S3BadRequest: 対応していない形式の場合や、ピクセル数が制限を超える場合
+    """
+    content_type = sniff_image_type(head[:16])
+    if content_type not in SUPPORTED_CONTENT_TYPES:
+        logger.error(
+            f"サポートされていない画像形式です: {content_type or '不明'} "
+            f"(Content-Type: {declared_content_type})"
+        )
+        raise S3BadRequest(
+            400, f"サポートされていない画像形式です: {content_type or '不明'}"
+        )
+    if content_type != declared_content_type:
+        logger.warning(
+            f"Content-Typeと画像の形式が一致しません: "
+            f"{declared_content_type} (実際は {content_type})"
+        )
+        return None
+    if content_type not in PASSTHROUGH_CONTENT_TYPES:
+        return None
+
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        image = Image.open(BytesIO(head))
+    except Image.DecompressionBombError as e:
+        logger.error(f"画像のピクセル数が制限を超えています: {e}")
+        raise S3BadRequest(400, f"画像のピクセル数が制限を超えています: {e}")
+    except (UnidentifiedImageError, OSError) as e:
+        logger.info(f"画像の先頭だけではヘッダーを読み込めませんでした: {e}")
+        return None
+    with image:
+        _check_image(image, content_type)
+    return content_type
+
+
+def _check_image(image, content_type: str) -> None:
+    """Pillow で開いた画像の形式と縦横のピクセル数を検証する"""
+    if _PILLOW_FORMATS.get(image.format or "") != content_type:
+        logger.error(f"画像の形式が不正です: {content_type} ({image.format})")
+        raise S3BadRequest(400, f"画像の形式が不正です: {content_type}")
+    width, height = image.size
+    if width <= 0 or height <= 0 or width * height > setting.image_max_pixels:
+        logger.error(f"画像のピクセル数が制限を超えています: {width}x{height}")
+        raise S3BadRequest(
+            400, f"画像のピクセル数が制限を超えています: {width}x{height}"
+        )
+
+
+def _to_jpeg(image) -> bytes:
+    """画像を JPEG に変換する（透過は白で塗りつぶす）"""
+    from PIL import Image, ImageOps
+
+    try:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    except (OSError, ValueError) as e:
+        logger.error(f"画像を JPEG に変換できませんでした: {e}")
+        raise S3BadRequest(400, f"画像を JPEG に変換できませんでした: {e}")
+    return buffer.getvalue()
+
+
+def _register_heif_opener() -> None:
+    """HEIC を Pillow で読み込めるようにする（pillow-heif が必要）"""
+    try:
+        from pillow_heif import register_heif_opener  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        logger.error("HEIC の画像を読み込むには pillow-heif が必要です")
+        raise S3BadRequest(
+            400, "サポートされていない画像形式です: image/heic（pillow-heif が未導入）"
+        )
+    register_heif_opener()
@@ -0,0 +1,498 @@
+"""レシート解析の非同期ジョブ（ジョブの保存とワーカープール）"""
+
+import ipaddress
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Literal
+from urllib.parse import urlsplit
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.error import (
+    JobCallbackForbidden,
+    JobNotFound,
+    JobQueueFull,
+)
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUS = Literal["queued", "running", "succeeded", "failed"]
+
+
+def validate_callback_url(url: str, allowed_hosts: list[str] | None = None) -> None:
+    """コールバックURLが、サーバーから通知してよい宛先かを確認する
+
+    allowed_hosts を指定した場合は、そのホストだけを許可する（内部のホストも指定できる）。
+    指定しない場合は、ホスト名を名前解決し、プライベート・ループバック・リンクローカル
+    （クラウドのメタデータ 169.254.169.254 など）・予約済み・マルチキャストのアドレスを拒否する。
+
+    Raises:
+        JobCallbackForbidden: 許可されていない宛先の場合
+    """
+    parsed = urlsplit(url)
+    host = parsed.hostname
+    if parsed.scheme not in ("http", "https") or not host:
+        raise JobCallbackForbidden(422, f"コールバックURLが不正です: {url}")
+    if allowed_hosts:
+        if host.lower() not in {allowed.lower() for allowed in allowed_hosts}:
+            raise JobCallbackForbidden(
+                422, f"コールバックURLのホストが許可されていません: {host}"
+            )
+        return
+    try:
+        infos = socket.getaddrinfo(host, parsed.port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise JobCallbackForbidden(
+            422, f"コールバックURLのホストを名前解決できません: {host}"
+        ) from e
+    for info in infos:
+        # IPv6 のスコープID（"fe80::1%eth0" の "%eth0"）を除く
+        address = ipaddress.ip_address(str(info[4][0]).split("%")[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise JobCallbackForbidden(
+                422, f"コールバックURLが内部のアドレスを指しています: {host} {address}"
+            )
+
+
+class JobError(BaseModel):
+    status_code: int
+    detail: str
+
+
+class JobRecord(BaseModel):
+    job_id: str
+    status: JOB_STATUS
+    filename: str
+    callback_url: str | None = None
+    result: ReceiptDetail | None = None
+    error: JobError | None = None
+    created_at: float
+    # running の間は、処理中のワーカーが定期的に更新する（リースの期限の判定に使う）
+    updated_at: float
+    # 処理中（running）のワーカー
+    worker_id: str | None = None
+
+
+class JobStore(ABC):
+    """ジョブの状態を保存するストア"""
+
+    @abstractmethod
+    def save(self, job: JobRecord) -> None:
+        """ジョブを保存する（既にある場合は上書きする）"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> JobRecord | None:
+        """ジョブを取得する。存在しない場合は None を返す"""
+
+    @abstractmethod
+    def claim(self, job_id: str, worker_id: str) -> JobRecord | None:
+        """ジョブが queued の場合だけ、worker_id が処理する running にして返す。それ以外の場合は None を返す
+
+        複数のプロセスが同じジョブをキューに積んでも、処理するのは1つだけになる。
+        """
+
+    @abstractmethod
+    def heartbeat(self, worker_id: str) -> None:
+        """worker_id が処理中のジョブの updated_at を更新し、リースを延長する"""
+
+    @abstractmethod
+    def fail_expired(self, expires_before: float, error: JobError) -> list[JobRecord]:
+        """updated_at が expires_before より前の running のジョブ（リースが切れたジョブ）を失敗にして返す
+
+        処理中のワーカーは heartbeat でリースを延長するため、生きているワーカーのジョブは失敗にしない。
+        """
+
+    @abstractmethod
+    def find_by_status(self, statuses: list[JOB_STATUS]) -> list[JobRecord]:
+        """指定した状態のジョブを登録順に返す"""
+
+
+class InMemoryJobStore(JobStore):
+    """プロセス内のメモリにジョブを保存するストア
+
+    max_jobs を超えた場合は古いジョブから削除する。
+    """
+
+    def __init__(self, max_jobs: int = 10000) -> None:
+        self.max_jobs = max_jobs
+        self._jobs: OrderedDict[str, JobRecord] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(self, job: JobRecord) -> None:
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def get(self, job_id: str) -> JobRecord | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def claim(self, job_id: str, worker_id: str) -> JobRecord | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "queued":
+                return None
+            job = job.model_copy(
+                update={
+                    "status": "running",
+                    "worker_id": worker_id,
+                    "updated_at": time.time(),
+                }
+            )
+            self._jobs[job_id] = job
+            return job
+
+    def heartbeat(self, worker_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            for job_id, job in self._jobs.items():
+                if job.status == "running" and job.worker_id == worker_id:
+                    self._jobs[job_id] = job.model_copy(update={"updated_at": now})
+
+    def fail_expired(self, expires_before: float, error: JobError) -> list[JobRecord]:
+        now = time.time()
+        failed = []
+        with self._lock:
+            for job_id, job in self._jobs.items():
+                if job.status == "running" and job.updated_at < expires_before:
+                    job = job.model_copy(
+                        update={"status": "failed", "error": error, "updated_at": now}
+                    )
+                    self._jobs[job_id] = job
+                    failed.append(job)
+        return failed
+
+    def find_by_status(self, statuses: list[JOB_STATUS]) -> list[JobRecord]:
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if job.status in statuses]
+        return sorted(jobs, key=lambda job: job.created_at)
+
+
+class SQLiteJobStore(JobStore):
+    """SQLiteファイルにジョブを保存するストア"""
+
+    def __init__(self, db_fp: Path) -> None:
+        db_fp.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_fp, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+
+    def save(self, job: JobRecord) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, data) VALUES (?, ?)",
+                (job.job_id, job.model_dump_json()),
+            )
+
+    def get(self, job_id: str) -> JobRecord | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return JobRecord.model_validate_json(row[0])
+
+    def claim(self, job_id: str, worker_id: str) -> JobRecord | None:
+        # 状態の確認と更新を1つの UPDATE で行い、他のプロセスと同じジョブを取り合わないようにする
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET data = json_set(data, '$.status', 'running', "
+                "'$.worker_id', ?, '$.updated_at', ?) "
+                "WHERE job_id = ? AND json_extract(data, '$.status') = 'queued'",
+                (worker_id, time.time(), job_id),
+            )
+            if cursor.rowcount != 1:
+                return None
+        return self.get(job_id)
+
+    def heartbeat(self, worker_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET data = json_set(data, '$.updated_at', ?) "
+                "WHERE json_extract(data, '$.status') = 'running' "
+                "AND json_extract(data, '$.worker_id') = ?",
+                (time.time(), worker_id),
+            )
+
+    def fail_expired(self, expires_before: float, error: JobError) -> list[JobRecord]:
+        now = time.time()
+        failed = []
+        for job in self.find_by_status(["running"]):
+            if job.updated_at >= expires_before:
+                continue
+            job = job.model_copy(
+                update={"status": "failed", "error": error, "updated_at": now}
+            )
+            # 確認してから更新するまでに、処理中のワーカーがリースを延長した場合は失敗にしない
+            with self._lock, self._conn:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET data = ? WHERE job_id = ? "
+                    "AND json_extract(data, '$.status') = 'running' "
+                    "AND json_extract(data, '$.updated_at') < ?",
+                    (job.model_dump_json(), job.job_id, expires_before),
+                )
+            if cursor.rowcount == 1:
+                failed.append(job)
+        return failed
+
+    def find_by_status(self, statuses: list[JOB_STATUS]) -> list[JobRecord]:
+        placeholders = ", ".join("?" * len(statuses))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT data FROM jobs WHERE json_extract(data, '$.status') "
+                f"IN ({placeholders}) ORDER BY json_extract(data, '$.created_at')",
+                statuses,
+            ).fetchall()
+        return [JobRecord.model_validate_json(row[0]) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobRunner:
+    """有界キューと固定数のワーカースレッドでジョブを処理する
+
+    Args:
+        store (JobStore): ジョブの保存先
+        process (Callable[[str], ReceiptDetail]): ファイル名からレシートを解析する関数
+        to_error (Callable[[Exception, str], JobError]): 例外とファイル名からジョブのエラーを作成する関数
+        workers (int): ワーカースレッド数
+        queue_size (int): 処理待ちジョブの上限
+        callback_timeout (float): コールバックURLへの通知のタイムアウト秒数
+        callback_allowed_hosts (list[str] | None): コールバックURLに指定できるホスト。
+            None または空の場合は、内部のアドレスを指さないURLだけを許可する
+        lease_seconds (float): 処理中のジョブのリースの秒数。処理中のジョブは lease_seconds / 3 ごとに延長し、
+            この間延長されなかったジョブ（処理中にプロセスが終了したもの）を失敗にする
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        process: Callable[[str], ReceiptDetail],
+        to_error: Callable[[Exception, str], JobError],
+        workers: int = 4,
+        queue_size: int = 100,
+        callback_timeout: float = 5.0,
+        callback_allowed_hosts: list[str] | None = None,
+        lease_seconds: float = 60.0,
+    ) -> None:
+        self.store = store
+        self.process = process
+        self.to_error = to_error
+        self.workers = workers
+        self.callback_timeout = callback_timeout
+        self.callback_allowed_hosts = callback_allowed_hosts
+        self.lease_seconds = lease_seconds
+        # ストアを共有する他のプロセスと区別する、処理中のジョブの所有者
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._queue: queue.Queue[str | None] = queue.Queue(maxsize=queue_size)
+        self._threads: list[threading.Thread] = []
+        self._lease_thread: threading.Thread | None = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """ワーカースレッドと、リースを延長するスレッドを起動する（起動済みの場合は何もしない）"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopped.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"receipt-job-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._lease_thread = threading.Thread(
+                target=self._renew_leases, name="receipt-job-lease", daemon=True
+            )
+            self._lease_thread.start()
+
+    def recover(self) -> None:
+        """前回の起動で処理されなかったジョブを引き継ぐ（サーバーの起動時に呼ぶ）
+
+        queued のジョブはキューに積み直し、リースが切れた running のジョブは処理中にプロセスが終了したものとして
+        失敗にする（コールバックURLがある場合は通知する）。リースが切れていない running のジョブは
+        他のプロセスが処理中の可能性があるため、起動後もリースを延長するスレッドが定期的に確認する。
+        """
+        self.start()
+        self._fail_expired()
+        for job in self.store.find_by_status(["queued"]):
+            try:
+                self._queue.put_nowait(job.job_id)
+            except queue.Full:
+                logger.error(f"ジョブキューが上限に達しました: {self._queue.maxsize}")
+                self._fail(
+                    job, JobError(status_code=503, detail="ジョブキューが満杯です")
+                )
+            else:
+                logger.info(f"未処理のジョブをキューに積み直しました: {job.job_id}")
+
+    def stop(self, timeout: float | None = None) -> None:
+        """キューに積まれたジョブを処理し終えてからワーカースレッドを停止する"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            lease_thread, self._lease_thread = self._lease_thread, None
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+        self._stopped.set()
+        if lease_thread is not None:
+            lease_thread.join(timeout)
+
+    def submit(self, filename: str, callback_url: str | None = None) -> JobRecord:
+        """ジョブを登録する
+
+        Args:
+            filename (str): S3のオブジェクトキー（ファイル名）
+            callback_url (str | None): 完了時に結果をPOSTするURL
+
+        Returns:
+            JobRecord: 登録したジョブ
+
+        Raises:
+            JobCallbackForbidden: コールバックURLが許可されていない宛先の場合
+            JobQueueFull: キューが満杯の場合
+        """
+        if callback_url is not None:
+            validate_callback_url(callback_url, self.callback_allowed_hosts)
+        self.start()
+        now = time.time()
+        job = JobRecord(
+            job_id=uuid.uuid4().hex,
+            status="queued",
+            filename=filename,
+            callback_url=callback_url,
+            created_at=now,
+            updated_at=now,
+        )
+        self.store.save(job)
+        try:
+            self._queue.put_nowait(job.job_id)
+        except queue.Full:
+            logger.error(f"ジョブキューが上限に達しました: {self._queue.maxsize}")
+            self._fail(job, JobError(status_code=503, detail="ジョブキューが満杯です"))
+            raise JobQueueFull(503, "ジョブキューが上限に達しました。")
+        return job
+
+    def get(self, job_id: str) -> JobRecord:
+        """ジョブを取得する
+
+        Raises:
+            JobNotFound: ジョブが存在しない場合
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            raise JobNotFound(404, f"ジョブが存在しません: {job_id}")
+        return job
+
+    def _work(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            try:
+                if job_id is None:
+                    return
+                self._run(job_id)
+            except Exception:
+                # ストアに保存できない場合なども、スレッドを止めずに次のジョブを処理する
+                logger.exception(f"ジョブを処理できませんでした: {job_id}")
+            finally:
+                self._queue.task_done()
+
+    def _renew_leases(self) -> None:
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self.store.heartbeat(self.worker_id)
+                self._fail_expired()
+            except Exception:
+                logger.exception("ジョブのリースを延長できませんでした")
+
+    def _fail_expired(self) -> None:
+        """リースが切れた running のジョブを失敗にし、コールバックURLがある場合は通知する"""
+        for job in self.store.fail_expired(
+            time.time() - self.lease_seconds,
+            JobError(status_code=500, detail="ジョブの処理が中断されました"),
+        ):
+            logger.warning(f"処理中に中断されたジョブを失敗にしました: {job.job_id}")
+            if job.callback_url:
+                self._notify(job)
+
+    def _fail(self, job: JobRecord, error: JobError) -> JobRecord:
+        job = job.model_copy(
+            update={"status": "failed", "error": error, "updated_at": time.time()}
+        )
+        self.store.save(job)
+        return job
+
+    def _run(self, job_id: str) -> None:
+        job = self.store.claim(job_id, self.worker_id)
+        if job is None:
+            logger.info(
+                f"処理対象のジョブがないか、他のワーカーが処理済みです: {job_id}"
+            )
+            return
+        try:
+            result = self.process(job.filename)
+            job = job.model_copy(
+                update={
+                    "status": "succeeded",
+                    "result": result,
+                    "updated_at": time.time(),
+                }
+            )
+        except Exception as e:
+            job = job.model_copy(
+                update={
+                    "status": "failed",
+                    "error": self.to_error(e, job.filename),
+                    "updated_at": time.time(),
+                }
+            )
+        self.store.save(job)
+        if job.callback_url:
+            self._notify(job)
+
+    def _notify(self, job: JobRecord) -> None:
+        # requests はコールバックを使う場合のみ必要なため、ここで読み込む
+        import requests
+
+        try:
+            # 登録後に名前解決の結果が変わっていないかを、通知の直前にも確認する
+            validate_callback_url(job.callback_url, self.callback_allowed_hosts)  # type: ignore[arg-type]
+            # リダイレクト先は確認していないため、リダイレクトには従わない
+            response = requests.post(
+                job.callback_url,  # type: ignore[arg-type]
+                data=job.model_dump_json(),
+                headers={"Content-Type": "application/json"},
+                timeout=self.callback_timeout,
+                allow_redirects=False,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.error(f"コールバックURLへの通知に失敗しました: {job.job_id} {e}")
+
+
+def create_job_store(kind: Literal["memory", "sqlite"], db_fp: Path) -> JobStore:
+    """設定値からジョブストアを作成する"""
+    if kind == "sqlite":
+        return SQLiteJobStore(db_fp)
+    return InMemoryJobStore()
@@ -1,9 +1,85 @@
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 from typing import Literal
 
+from src.receipt_scanner_model.setting import setting
+
 LOG_TYPE = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+LOG_FORMAT = Literal["text", "json"]
+QUEUE_POLICY = Literal["drop", "block"]
+
+# サンプリングの対象にするログに付ける extra のキー
+# 例: logger.info(receipt_detail, extra={SAMPLED: True})
+SAMPLED = "sampled"
+
+
+class BoundedQueueHandler(QueueHandler):
+    """上限付きのキューにログを積むハンドラー
+
+    ファイルへの書き込みやローテーションは QueueListener のスレッドで行うため、リクエストを処理するスレッドを止めない。
+    キューが一杯の場合、policy が "drop" なら破棄して件数を数え、"block" なら空くまで待つ。
+    """
+
+    def __init__(
+        self, log_queue: "queue.Queue[logging.LogRecord]", policy: QUEUE_POLICY = "drop"
+    ):
+        super().__init__(log_queue)
+        # QueueHandler.queue は put・qsize を持たない型のため、キューは型を付けて別に保持する
+        self.log_queue = log_queue
+        self.policy: QUEUE_POLICY = policy
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def dropped(self) -> int:
+        """キューが一杯で破棄したログの件数"""
+        with self._lock:
+            return self._dropped
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.policy == "block":
+            self.log_queue.put(record)
+            return
+        try:
+            self.log_queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """extra={SAMPLED: True} を付けた INFO 以下のログを sample_rate の割合だけ残す"""
+
+    def __init__(self, sample_rate: float, rand=random.random):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self._rand = rand
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, SAMPLED, False) or record.levelno > logging.INFO:
+            return True
+        return self._rand() < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行1件のJSONで出力するフォーマッター"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            log["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(log, ensure_ascii=False, default=str)
 
 
 class LoggerConfig:
@@ -13,9 +89,20 @@ class LoggerConfig:
         self,
         level: LOG_TYPE,
         log_fp: Path,
+        log_format: LOG_FORMAT = "text",
+        queue_size: int = 10000,
+        queue_policy: QUEUE_POLICY = "drop",
+        sample_rate: float = 1.0,
     ):
         self.log_fp = log_fp
         self.log_level = getattr(logging, level)
+        self.log_format: LOG_FORMAT = log_format
+        self.queue_size = queue_size
+        self.queue_policy: QUEUE_POLICY = queue_policy
+        self.sample_rate = sample_rate
+        self.handlers: list[logging.Handler] = []
+        self.queue_handler: BoundedQueueHandler | None = None
+        self.listener: QueueListener | None = None
 
     def setup_logging(self) -> None:
         """ログ設定を初期化"""
@@ -32,30 +119,63 @@ class LoggerConfig:
             backupCount=5,
             encoding="utf-8",
         )
-        file_formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            datefmt="%Y/%m/%d %H:%M:%S",
+        file_formatter = (
+            JsonFormatter()
+            if self.log_format == "json"
+            else logging.Formatter(
+                "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                datefmt="%Y/%m/%d %H:%M:%S",
+            )
         )
         file_handler.setFormatter(file_formatter)
         handlers.append(file_handler)
 
         # コンソールハンドラー
         console_handler = logging.StreamHandler()
-        console_formatter = logging.Formatter(
-            "%(levelname)s - %(message)s",
+        console_formatter = (
+            JsonFormatter()
+            if self.log_format == "json"
+            else logging.Formatter(
+                "%(levelname)s - %(message)s",
+            )
         )
         console_handler.setFormatter(console_formatter)
         handlers.append(console_handler)
+        self.handlers = handlers
+
+        # 書き込みは別スレッドで行い、ロガーにはキューに積むハンドラーだけを設定する
+        self.queue_handler = BoundedQueueHandler(
+            queue.Queue(self.queue_size), self.queue_policy
+        )
+        # キューに積む前にメッセージだけを組み立て、書式は書き込み側のハンドラーで適用する
+        self.queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.queue_handler.addFilter(SamplingFilter(self.sample_rate))
+        self.listener = QueueListener(
+            self.queue_handler.log_queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
 
         # 基本設定
         logging.basicConfig(
             level=self.log_level,
-            handlers=handlers,
+            handlers=[self.queue_handler],
             force=True,
         )
 
         # Uvicorn/FastAPIログの統合
-        self._configure_third_party_loggers(handlers, self.log_level)
+        self._configure_third_party_loggers([self.queue_handler], self.log_level)
+
+    def shutdown(self) -> None:
+        """キューに残っているログを書き出し、書き込みスレッドを停止する
+
+        停止後のログ（サーバーの終了時のログなど）は、ハンドラーで直接書き込む。
+        """
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        logging.basicConfig(level=self.log_level, handlers=self.handlers, force=True)
+        self._configure_third_party_loggers(self.handlers, self.log_level)
 
     def _configure_third_party_loggers(self, handlers: list, log_level: int) -> None:
         """サードパーティライブラリのログ設定"""
@@ -69,10 +189,53 @@ class LoggerConfig:
             logger.propagate = False
 
 
+_logger_config: LoggerConfig | None = None
+
+
 def set_logger(
     level: LOG_TYPE = "INFO",
     log_fp: Path = Path("logs/python_server.log"),
-) -> None:
-    """ログ設定を初期化"""
-    config = LoggerConfig(level=level, log_fp=log_fp)
+    log_format: LOG_FORMAT | None = None,
+    queue_size: int | None = None,
+    queue_policy: QUEUE_POLICY | None = None,
+    sample_rate: float | None = None,
+) -> LoggerConfig:
+    """ログ設定を初期化
+
+    log_format などを指定しない場合は設定値（LOG_FORMAT など）を使う。
+    既に初期化されている場合は、前の書き込みスレッドを停止してから設定し直す。
+    """
+    global _logger_config
+    stop_logger()
+    config = LoggerConfig(
+        level=level,
+        log_fp=log_fp,
+        log_format=log_format or setting.log_format,
+        queue_size=queue_size or setting.log_queue_size,
+        queue_policy=queue_policy or setting.log_queue_policy,
+        sample_rate=(
+            sample_rate if sample_rate is not None else setting.log_sample_rate
+        ),
+    )
     config.setup_logging()
+    _logger_config = config
+    return config
+
+
+def stop_logger() -> None:
+    """キューに残っているログを書き出し、書き込みスレッドを停止する"""
+    global _logger_config
+    if _logger_config is not None:
+        _logger_config.shutdown()
+        _logger_config = None
+
+
+def logging_snapshot() -> dict:
+    """監視用にログのキューの状態を返す"""
+    handler = _logger_config.queue_handler if _logger_config else None
+    if handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": handler.log_queue.qsize(), "dropped": handler.dropped}
+
+
+atexit.register(stop_logger)
@@ -0,0 +1,94 @@
+"""APIの監視用メトリクス"""
+
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai.types import CompletionUsage
+
+
+class PromptCacheMetrics:
+    """OpenAIのプロンプトキャッシュの利用状況を集計する"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """集計をクリアする"""
+        with self._lock:
+            self._requests = 0
+            self._prompt_tokens = 0
+            self._cached_tokens = 0
+
+    def record(self, usage: "CompletionUsage | None") -> float | None:
+        """レスポンスの usage を集計する
+
+        Args:
+            usage (CompletionUsage | None): OpenAIのレスポンスの usage
+
+        Returns:
+            float | None: このリクエストでキャッシュされたトークンの割合。usage がない場合は None
+        """
+        if usage is None:
+            return None
+        details = usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens or 0) if details else 0
+        with self._lock:
+            self._requests += 1
+            self._prompt_tokens += usage.prompt_tokens
+            self._cached_tokens += cached_tokens
+        if usage.prompt_tokens == 0:
+            return 0.0
+        return cached_tokens / usage.prompt_tokens
+
+    def snapshot(self) -> dict:
+        """監視用に現在の集計を返す"""
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "prompt_tokens": self._prompt_tokens,
+                "cached_tokens": self._cached_tokens,
+                "cached_token_ratio": (
+                    self._cached_tokens / self._prompt_tokens
+                    if self._prompt_tokens
+                    else 0.0
+                ),
+            }
+
+
+class RoutingMetrics:
+    """画像のルーティングで選んだ設定と、解析し直した回数を集計する"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """集計をクリアする"""
+        with self._lock:
+            self._routes: Counter[str] = Counter()
+            self._escalations: Counter[str] = Counter()
+
+    def record_route(self, route: str) -> None:
+        """最初に選んだ設定を集計する"""
+        with self._lock:
+            self._routes[route] += 1
+
+    def record_escalation(self, route: str) -> None:
+        """検証に失敗して解析し直した設定を集計する"""
+        with self._lock:
+            self._escalations[route] += 1
+
+    def snapshot(self) -> dict:
+        """監視用に現在の集計を返す"""
+        with self._lock:
+            return {
+                "routes": dict(self._routes),
+                "escalations": dict(self._escalations),
+            }
+
+
+prompt_cache_metrics = PromptCacheMetrics()
+routing_metrics = RoutingMetrics()
@@ -0,0 +1,172 @@
+"""OCR（Tesseract・OpenCV）を複数プロセスで並列に実行する際の、スレッド数とプロセス数の割り当て
+
+Tesseract は内部で OpenMP を、OpenCV は独自のスレッドプールを使うため、
+何も設定せずに scan を並列に実行すると、コア数を大きく超えるスレッドが動いてスループットが落ちる。
+使えるコア数（CPU アフィニティと cgroup の CPU クォータの小さい方）を求め、
+プロセスごとのスレッド数（OMP_THREAD_LIMIT・cv2.setNumThreads）とプロセス数を決める。
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.setting import setting
+
+if TYPE_CHECKING:
+    from src.receipt_scanner_model.scan_receipt import ReceiptAnalyzedData
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+class OcrSchedule(BaseModel):
+    """プロセス数と、プロセスごとのスレッド数
+
+    cpus を指定した場合、i 番目のプロセスは cpus[i * threads:(i + 1) * threads] のコアだけで動く。
+    """
+
+    jobs: int
+    threads: int
+    cpus: list[int] | None = None
+
+
+def cgroup_cpu_limit(root: Path = CGROUP_ROOT) -> float | None:
+    """cgroup の CPU クォータ（使えるコア数、小数あり）を返す。制限がない場合は None を返す
+
+    cgroup v2 の cpu.max と、v1 の cpu.cfs_quota_us / cpu.cfs_period_us に対応する。
+    """
+    try:
+        quota, period = (root / "cpu.max").read_text().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    for directory in (root / "cpu", root / "cpu,cpuacct"):
+        try:
+            quota = (directory / "cpu.cfs_quota_us").read_text().strip()
+            period = (directory / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            continue
+        if int(quota) <= 0:
+            return None
+        return int(quota) / int(period)
+    return None
+
+
+def affinity_cpus() -> list[int]:
+    """このプロセスが使えるコアの番号を返す（sched_getaffinity がない環境では全てのコア）"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_cpus(root: Path = CGROUP_ROOT) -> int:
+    """使えるコア数（CPU アフィニティと cgroup の CPU クォータの小さい方、1以上）を返す
+
+    クォータが小数の場合は切り捨てる（超えた分は待たされるため、スレッドを増やしても速くならない）。
+    """
+    cpus = len(affinity_cpus())
+    limit = cgroup_cpu_limit(root)
+    if limit is not None:
+        cpus = min(cpus, math.floor(limit))
+    return max(cpus, 1)
+
+
+def plan_schedule(
+    threads: int | None = None,
+    jobs: int | None = None,
+    pin: bool | None = None,
+) -> OcrSchedule:
+    """プロセス数とプロセスごとのスレッド数を決める
+
+    Tesseract はスレッドを増やしてもほとんど速くならないため、デフォルトは1スレッドのプロセスをコア数だけ動かす。
+
+    Args:
+        threads (int | None): プロセスごとのスレッド数。None の場合は設定 ocr_threads
+        jobs (int | None): プロセス数。None または 0 の場合は設定 ocr_jobs、それも 0 の場合は コア数 // threads
+        pin (bool | None): プロセスごとにコアを固定する。None の場合は設定 ocr_cpu_affinity
+    """
+    threads = max(threads or setting.ocr_threads, 1)
+    jobs = jobs or setting.ocr_jobs
+    pin = setting.ocr_cpu_affinity if pin is None else pin
+    cpus = available_cpus()
+    if not jobs:
+        jobs = max(cpus // threads, 1)
+    if jobs * threads > cpus:
+        logger.warning(
+            f"OCRのスレッド数の合計がコア数を超えています: "
+            f"{jobs} プロセス x {threads} スレッド > {cpus} コア"
+        )
+
+    pinned = None
+    if pin:
+        pinned = affinity_cpus()
+        if jobs * threads > len(pinned):
+            logger.warning(
+                f"コアが足りないため、CPU アフィニティを設定しません: "
+                f"{jobs} プロセス x {threads} スレッド > {len(pinned)} コア"
+            )
+            pinned = None
+    return OcrSchedule(jobs=jobs, threads=threads, cpus=pinned)
+
+
+def configure_worker(threads: int, cpus: Iterable[int] | None = None) -> None:
+    """このプロセスの Tesseract・OpenCV のスレッド数と、使うコアを設定する
+
+    pytesseract は tesseract をサブプロセスとして実行するため、
+    OMP_THREAD_LIMIT・CPU アフィニティはその後に起動する tesseract に引き継がれる。
+    """
+    # OpenCV は読み込みに時間がかかるため、ワーカーの初期化時に読み込む
+    import cv2
+
+    os.environ["OMP_THREAD_LIMIT"] = str(threads)
+    cv2.setNumThreads(threads)
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, set(cpus))
+
+
+def _init_worker(schedule: OcrSchedule, counter) -> None:
+    cpus = None
+    if schedule.cpus is not None:
+        # 起動した順に番号を振り、番号ごとに重ならないコアを割り当てる
+        with counter.get_lock():
+            slot = counter.value % schedule.jobs
+            counter.value += 1
+        cpus = schedule.cpus[slot * schedule.threads : (slot + 1) * schedule.threads]
+    configure_worker(schedule.threads, cpus)
+
+
+def create_executor(schedule: OcrSchedule | None = None) -> ProcessPoolExecutor:
+    """スレッド数・コアを設定したプロセスで OCR を実行する ProcessPoolExecutor を作る
+
+    Args:
+        schedule (OcrSchedule | None): None の場合は plan_schedule()
+    """
+    schedule = schedule or plan_schedule()
+    logger.info(
+        f"OCRのワーカー: {schedule.jobs} プロセス x {schedule.threads} スレッド"
+        + (" (CPU アフィニティあり)" if schedule.cpus is not None else "")
+    )
+    return ProcessPoolExecutor(
+        max_workers=schedule.jobs,
+        initializer=_init_worker,
+        initargs=(schedule, multiprocessing.Value("i", 0)),
+    )
+
+
+def scan_all(
+    images: Iterable[bytes], schedule: OcrSchedule | None = None
+) -> list["ReceiptAnalyzedData"]:
+    """複数の画像を並列に scan する（結果は images と同じ順）"""
+    from src.receipt_scanner_model.scan_receipt import scan
+
+    with create_executor(schedule) as executor:
+        return list(executor.map(scan, images))
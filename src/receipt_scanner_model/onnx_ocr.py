@@ -0,0 +1,242 @@
+"""ONNX Runtime（CPU）の文字検出・文字認識モデルによるOCRエンジン（PaddleOCR 形式のモデル）
+
+文字検出（DB）で文字列の領域を求め、領域ごとに切り出した画像を、
+縦横比の近いもの同士でまとめて文字認識（CTC）のモデルにバッチで入力する。
+セッションはモデルのパスとスレッド数ごとにプロセス内で使い回す。
+
+`onnxruntime` パッケージ（`pip install '.[onnx]'`）と、以下のファイルが必要。
+    - 文字検出のモデル（PP-OCR の det、出力は文字の確率マップ）
+    - 文字認識のモデル（PP-OCR の rec、出力は時刻ごとの文字の確率）
+    - 文字認識の辞書（1行に1文字、日本語の場合は japan_dict.txt）
+"""
+
+import logging
+import math
+from functools import cache
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.receipt_scanner_model.scan_receipt import (
+    OcrEngine,
+    OcrResult,
+    PreprocessConfig,
+)
+
+logger = logging.getLogger(__name__)
+
+# 文字検出の入力の長辺の上限（32の倍数に丸める）。レシートは縦長で文字が小さいため大きめにする
+DET_MAX_SIDE = 1536
+# 文字の確率がこれを超える画素を文字とみなす
+DET_THRESHOLD = 0.3
+# 領域内の文字の確率の平均がこれ未満の領域は捨てる
+DET_BOX_THRESHOLD = 0.6
+# 領域を広げる割合（DB は文字の中心部分だけを検出するため、面積 x 割合 / 周長 だけ外側に広げる）
+DET_UNCLIP_RATIO = 1.5
+# 領域の短辺がこれ未満（ピクセル、検出の入力の大きさ）のものは捨てる
+DET_MIN_SIZE = 3
+# 文字認識の入力の高さと、バッチ内の最小の縦横比
+REC_HEIGHT = 48
+REC_MIN_WIDTH_RATIO = 320 / 48
+# 入力の正規化（ImageNet の平均・標準偏差、RGB）
+_DET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+_DET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+
+@cache
+def load_session(model_path: Path, threads: int):
+    """ONNX Runtime のセッションを作る（同じモデル・スレッド数のセッションは使い回す）
+
+    Args:
+        model_path (Path): モデルのパス
+        threads (int): 1つの演算に使うスレッド数（intra-op）。0 の場合は ONNX Runtime のデフォルト
+    """
+    import onnxruntime  # pyright: ignore[reportMissingImports]
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    # 演算は順に実行する（並列にするのは1つの演算の中だけ）
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    logger.info(f"ONNX のモデルを読み込みます: {model_path} (threads={threads})")
+    return onnxruntime.InferenceSession(
+        str(model_path), sess_options=options, providers=["CPUExecutionProvider"]
+    )
+
+
+def load_characters(dict_path: Path, use_space_char: bool = True) -> list[str]:
+    """文字認識の辞書を読み込み、CTC のラベル（0 は空白ラベル）の順の文字を返す"""
+    characters = [
+        line.rstrip("\r\n") for line in dict_path.read_text("utf-8").splitlines()
+    ]
+    if use_space_char:
+        characters.append(" ")
+    return ["", *characters]
+
+
+class OnnxOcrEngine(OcrEngine):
+    """ONNX Runtime（CPU）の文字検出・文字認識モデルによるOCR
+
+    OcrResult の1単語は、文字検出で求めた1つの文字列の領域（空白を含むことがある）。
+
+    Args:
+        det_model_path (Path): 文字検出のモデルのパス
+        rec_model_path (Path): 文字認識のモデルのパス
+        dict_path (Path): 文字認識の辞書のパス
+        threads (int): セッションの intra-op のスレッド数
+        rec_batch_size (int): 文字認識で1回に入力する領域の数
+        det_max_side (int): 文字検出の入力の長辺の上限
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        det_model_path: Path,
+        rec_model_path: Path,
+        dict_path: Path,
+        threads: int = 1,
+        rec_batch_size: int = 8,
+        det_max_side: int = DET_MAX_SIDE,
+    ) -> None:
+        self.det_model_path = det_model_path
+        self.rec_model_path = rec_model_path
+        self.dict_path = dict_path
+        self.rec_batch_size = max(rec_batch_size, 1)
+        self.det_max_side = det_max_side
+        self.characters = load_characters(dict_path)
+        self._det = load_session(det_model_path, threads)
+        self._rec = load_session(rec_model_path, threads)
+        self._det_input = self._det.get_inputs()[0].name
+        self._rec_input = self._rec.get_inputs()[0].name
+
+    def recognize(
+        self, image: Image.Image, config: PreprocessConfig | None = None
+    ) -> OcrResult:
+        rgb = np.asarray(image.convert("RGB"))
+        boxes = self.detect(rgb)
+        texts, confs = self.recognize_crops(
+            [rgb[top:bottom, left:right] for left, top, right, bottom in boxes]
+        )
+        return to_ocr_result(boxes, texts, confs)
+
+    def cache_params(self, config: PreprocessConfig) -> dict:
+        return {
+            "engine": self.name,
+            "det": str(self.det_model_path),
+            "rec": str(self.rec_model_path),
+            "dict": str(self.dict_path),
+            "det_max_side": self.det_max_side,
+        }
+
+    def detect(self, rgb: np.ndarray) -> np.ndarray:
+        """文字列の領域を検出する
+
+        Returns:
+            np.ndarray: (領域数, 4) の配列で、各行は元の画像での left, top, right, bottom
+        """
+        height, width = rgb.shape[:2]
+        ratio = min(1.0, self.det_max_side / max(height, width))
+        input_height = max(32, round(height * ratio / 32) * 32)
+        input_width = max(32, round(width * ratio / 32) * 32)
+        resized = cv2.resize(rgb, (input_width, input_height))
+        tensor = (resized.transpose(2, 0, 1).astype(np.float32) / 255 - _DET_MEAN) / (
+            _DET_STD
+        )
+        prob = self._det.run(None, {self._det_input: tensor[np.newaxis]})[0][0, 0]
+
+        mask = (prob > DET_THRESHOLD).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        scale_x, scale_y = width / input_width, height / input_height
+        boxes = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if min(w, h) < DET_MIN_SIZE:
+                continue
+            if prob[y : y + h, x : x + w].mean() < DET_BOX_THRESHOLD:
+                continue
+            offset = w * h * DET_UNCLIP_RATIO / (2 * (w + h))
+            boxes.append(
+                [
+                    max(int((x - offset) * scale_x), 0),
+                    max(int((y - offset) * scale_y), 0),
+                    min(math.ceil((x + w + offset) * scale_x), width),
+                    min(math.ceil((y + h + offset) * scale_y), height),
+                ]
+            )
+        return np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+
+    def recognize_crops(self, crops: list[np.ndarray]) -> tuple[list[str], np.ndarray]:
+        """切り出した領域の文字列を認識する
+
+        縦横比の順に並べて rec_batch_size ずつまとめ、バッチ内で最も横長の領域の幅に揃えて入力する
+        （縦横比の近いもの同士をまとめるため、余白の計算が少なくなる）。
+
+        Returns:
+            list[str]: 領域ごとの文字列
+            np.ndarray: 領域ごとの信頼度（0〜100）
+        """
+        texts = [""] * len(crops)
+        confs = np.zeros(len(crops), dtype=np.float32)
+        ratios = [crop.shape[1] / max(crop.shape[0], 1) for crop in crops]
+        order = np.argsort(ratios, kind="stable")
+        for start in range(0, len(order), self.rec_batch_size):
+            batch = order[start : start + self.rec_batch_size]
+            max_ratio = max(REC_MIN_WIDTH_RATIO, max(ratios[i] for i in batch))
+            input_width = math.ceil(REC_HEIGHT * max_ratio)
+            tensor = np.zeros(
+                (len(batch), 3, REC_HEIGHT, input_width), dtype=np.float32
+            )
+            for row, i in enumerate(batch):
+                crop_width = min(math.ceil(REC_HEIGHT * ratios[i]), input_width)
+                resized = cv2.resize(crops[i], (max(crop_width, 1), REC_HEIGHT))
+                tensor[row, :, :, : resized.shape[1]] = (
+                    resized.transpose(2, 0, 1).astype(np.float32) / 255 - 0.5
+                ) / 0.5
+            probs = self._rec.run(None, {self._rec_input: tensor})[0]
+            for row, i in enumerate(batch):
+                texts[i], confs[i] = self.decode(probs[row])
+        return texts, confs
+
+    def decode(self, probs: np.ndarray) -> tuple[str, float]:
+        """CTC の出力（時刻, ラベル）を貪欲に文字列にする（同じラベルの連続と空白ラベルを除く）"""
+        labels = probs.argmax(axis=1)
+        keep = labels != 0
+        keep[1:] &= labels[1:] != labels[:-1]
+        if not keep.any():
+            return "", 0.0
+        text = "".join(self.characters[label] for label in labels[keep])
+        return text, float(probs.max(axis=1)[keep].mean() * 100)
+
+
+def to_ocr_result(boxes: np.ndarray, texts: list[str], confs: np.ndarray) -> OcrResult:
+    """領域と認識した文字列から、上の行から順・行内は左から順の OcrResult を作る
+
+    縦の中心が、その行の最初の領域の上端〜下端の範囲にある領域を同じ行とみなす。
+    """
+    keep = np.array([bool(text.strip()) for text in texts], dtype=bool)
+    boxes, confs = boxes.reshape(-1, 4)[keep], confs[keep]
+    texts = [text.strip() for text, k in zip(texts, keep) if k]
+
+    line = np.zeros(len(boxes), dtype=np.int32)
+    order = np.argsort(boxes[:, 1], kind="stable")
+    line_id, line_bottom = -1, -1.0
+    for i in order:
+        center = (boxes[i, 1] + boxes[i, 3]) / 2
+        if center > line_bottom:
+            line_id += 1
+            line_bottom = float(boxes[i, 3])
+        line[i] = line_id
+    order = np.lexsort((boxes[:, 0], line))
+    return OcrResult(
+        text=np.asarray(texts, dtype=str)[order],
+        left=boxes[order, 0],
+        top=boxes[order, 1],
+        width=boxes[order, 2] - boxes[order, 0],
+        height=boxes[order, 3] - boxes[order, 1],
+        conf=confs[order].astype(np.float32),
+        line=line[order],
+    )
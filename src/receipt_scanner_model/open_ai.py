@@ -1,24 +1,39 @@
+from __future__ import annotations
+
 from src.receipt_scanner_model.setting import setting
-from pydantic import BaseModel, Field
-from openai import OpenAI
-from openai.types.chat import (
-    ChatCompletionMessageParam,
-    ChatCompletionSystemMessageParam,
-    ChatCompletionUserMessageParam,
-)
-from openai import (
-    APITimeoutError,
-    PermissionDeniedError,
-    InternalServerError,
-    RateLimitError,
-    AuthenticationError,
+from src.receipt_scanner_model.partial_json import PartialJSONObjectParser
+from src.receipt_scanner_model.metrics import prompt_cache_metrics
+from src.receipt_scanner_model.audit import record_openai
+from pydantic import BaseModel, Field, ValidationError
+from typing import TYPE_CHECKING, Any, Iterator, Literal, TypedDict
+
+# openai は読み込みに時間がかかるため、起動時ではなく初めて呼び出す際に読み込む
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.types import CompletionUsage
+    from openai.types.chat import (
+        ChatCompletionContentPartParam,
+        ChatCompletionMessageParam,
+        ChatCompletionSystemMessageParam,
+        ChatCompletionUserMessageParam,
+    )
+    from openai.types.chat.chat_completion_content_part_image_param import ImageURL
+from src.receipt_scanner_model.circuit_breaker import (
+    circuit_breaker,
+    openai_circuit_breaker,
 )
 from src.receipt_scanner_model.error import (
+    ErrorResponse,
     OpenAIAuthenticationError,
     OpenAIServiceUnavailable,
     OpenAIUnexpectedError,
     OpenAIResponseFormatError,
+    OpenAIImageUrlError,
 )
+import hashlib
+import json
+import time
+from collections import Counter
 import logging
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -32,6 +47,19 @@ class ReceiptDetail(BaseModel):
     category: str | None = Field(description="買い物のカテゴリー")
 
 
+class PackedReceiptDetail(ReceiptDetail):
+    index: int = Field(description="画像の番号（0始まり）")
+
+
+class PackedReceiptDetails(BaseModel):
+    receipts: list[PackedReceiptDetail] = Field(description="画像ごとの解析結果")
+
+
+class ReceiptStreamEvent(TypedDict):
+    event: Literal["field", "done"]
+    data: dict[str, Any]
+
+
 SYSTEM_PROMPT = """
 あなたは家計簿アプリのレシート解析AIです。
 与えられる画像はレシートの写真です。以下の情報を抽出してください。
@@ -54,47 +82,203 @@ SYSTEM_PROMPT = """
 取得できない場合は None としてください。
 """
 
+PACKED_PROMPT = """
+## 複数画像
+複数のレシート画像が与えられます。各画像の直前に "index: 番号" というテキストがあります。
+画像ごとに上記の情報を抽出し、index にその画像の番号を入れて、全ての画像分を receipts に出力してください。
+1枚の画像には1枚のレシートが写っています。複数の画像の内容を混ぜないでください。
+"""
+
+# OpenAIのプロンプトキャッシュが効く最小のプロンプト長
+# NOTE: 現在の静的な部分（システムプロンプトと response_format のスキーマ）は見積もりで
+# 1枚の解析が約580、まとめて解析する場合が約820トークンのため、キャッシュは効かない。
+# キャッシュのためだけにプロンプトを水増しすると解析結果が変わるため、長さは揃えない
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数を大まかに見積もる（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    n_ascii = sum(1 for char in text if char.isascii())
+    return n_ascii // 4 + (len(text) - n_ascii)
+
+
+class PromptBuilder:
+    """プロンプトキャッシュが効くように、静的なプロンプト部分を一度だけ作成する
+
+    システムプロンプトはリクエストによらず同じ内容のため、起動時に作成して使い回す。
+    出力スキーマは response_format で送られるため、システムプロンプトには含めない。
+    メッセージは静的な部分を先頭に、画像を最後に並べ、先頭部分が毎回一致するようにする。
+    """
+
+    def __init__(
+        self,
+        system_prompt: str = SYSTEM_PROMPT,
+        response_format: type[BaseModel] = ReceiptDetail,
+    ) -> None:
+        schema = json.dumps(
+            response_format.model_json_schema(), ensure_ascii=False, sort_keys=True
+        )
+        self.system_message: ChatCompletionSystemMessageParam = {
+            "role": "system",
+            "content": system_prompt,
+        }
+        self.prompt_cache_key = (
+            "receipt-detail-"
+            + hashlib.sha256(f"{system_prompt}\n{schema}".encode()).hexdigest()[:16]
+        )
+        # response_format のスキーマもプロンプトの先頭に含まれる
+        self.static_prefix_tokens = estimate_tokens(system_prompt) + estimate_tokens(
+            schema
+        )
+        if self.static_prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+            logger.info(
+                f"静的なプロンプトがキャッシュの最小長に満たないため、プロンプトキャッシュは効きません: "
+                f"{self.static_prefix_tokens} < {PROMPT_CACHE_MIN_TOKENS} tokens"
+            )
+
+    def build_messages(
+        self, image_url: str, detail: Literal["low", "high"] | None = None
+    ) -> list[ChatCompletionMessageParam]:
+        """静的なシステムメッセージの後ろに画像を追加したメッセージを作成する
+
+        Args:
+            image_url (str): 画像のURL（data URLを含む）
+            detail (Literal["low", "high"] | None): 画像の解像度。None の場合は指定しない（OpenAIのデフォルト）
+
+        Returns:
+            list[ChatCompletionMessageParam]: OpenAIに送るメッセージ
+        """
+        image: ImageURL = {"url": image_url}
+        if detail is not None:
+            image["detail"] = detail
+        user_prompt_message: ChatCompletionUserMessageParam = {
+            "role": "user",
+            "content": [{"type": "image_url", "image_url": image}],
+        }
+        return [self.system_message, user_prompt_message]
+
+    def build_packed_messages(
+        self, image_urls: list[str]
+    ) -> list[ChatCompletionMessageParam]:
+        """静的なシステムメッセージの後ろに、番号付きで複数の画像を追加したメッセージを作成する
+
+        Args:
+            image_urls (list[str]): 画像のURL（data URLを含む）
+
+        Returns:
+            list[ChatCompletionMessageParam]: OpenAIに送るメッセージ
+        """
+        content: list[ChatCompletionContentPartParam] = []
+        for index, image_url in enumerate(image_urls):
+            content.append({"type": "text", "text": f"index: {index}"})
+            content.append({"type": "image_url", "image_url": {"url": image_url}})
+        user_prompt_message: ChatCompletionUserMessageParam = {
+            "role": "user",
+            "content": content,
+        }
+        return [self.system_message, user_prompt_message]
+
+
+prompt_builder = PromptBuilder()
+packed_prompt_builder = PromptBuilder(
+    system_prompt=SYSTEM_PROMPT + PACKED_PROMPT,
+    response_format=PackedReceiptDetails,
+)
+
+
+def _openai_circuit_open_error() -> OpenAIServiceUnavailable:
+    logger.error(
+        "OpenAIのサーキットブレーカーが開いているため、リクエストを遮断しました"
+    )
+    return OpenAIServiceUnavailable(
+        503,
+        "OpenAIのサービスが一時的に利用できません。時間をおいて再度お試しください。",
+    )
+
+
+def convert_openai_error(e: Exception) -> ErrorResponse:
+    """OpenAIの例外をアプリケーションの例外に変換する
+
+    Args:
+        e (Exception): OpenAIの呼び出し中に発生した例外
+
+    Returns:
+        ErrorResponse: 変換後の例外
+    """
+    if isinstance(e, (OpenAIResponseFormatError, OpenAIImageUrlError)):
+        return e
+
+    from openai import (
+        APITimeoutError,
+        AuthenticationError,
+        BadRequestError,
+        InternalServerError,
+        PermissionDeniedError,
+        RateLimitError,
+    )
+
+    if isinstance(e, BadRequestError) and e.code == "invalid_image_url":
+        logger.error(f"OpenAIが画像のURLを取得できませんでした: {str(e)}")
+        return OpenAIImageUrlError(400, "OpenAIが画像のURLを取得できませんでした。")
+    if isinstance(e, (AuthenticationError, PermissionDeniedError)):
+        logger.error(f"OpenAIの認証エラー: {str(e)}")
+        return OpenAIAuthenticationError(
+            401, "OpenAIの認証に失敗しました。APIキーを確認してください。"
+        )
+    if isinstance(e, (APITimeoutError, RateLimitError, InternalServerError)):
+        logger.error(f"OpenAIの一時的なエラー: {str(e)}")
+        return OpenAIServiceUnavailable(
+            503,
+            "OpenAIのサービスが一時的に利用できません。時間をおいて再度お試しください。",
+        )
+    logger.error(f"OpenAIの予期しないエラー: {str(e)}")
+    return OpenAIUnexpectedError(500, "OpenAIの予期しないエラーが発生しました。")
+
 
 def openai_error_handling(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except OpenAIResponseFormatError:
-            raise
-        except (AuthenticationError, PermissionDeniedError) as e:
-            logger.error(f"OpenAIの認証エラー: {str(e)}")
-            raise OpenAIAuthenticationError(
-                401, "OpenAIの認証に失敗しました。APIキーを確認してください。"
-            )
-        except (
-            APITimeoutError,
-            RateLimitError,
-            InternalServerError,
-        ) as e:
-            logger.error(f"OpenAIの一時的なエラー: {str(e)}")
-            raise OpenAIServiceUnavailable(
-                503,
-                "OpenAIのサービスが一時的に利用できません。時間をおいて再度お試しください。",
-            )
         except Exception as e:
-            logger.error(f"OpenAIの予期しないエラー: {str(e)}")
-            raise OpenAIUnexpectedError(500, "OpenAIの予期しないエラーが発生しました。")
+            converted = convert_openai_error(e)
+            if converted is e:
+                raise
+            raise converted
+
+    return wrapper
+
+
+def openai_stream_error_handling(func):
+    def wrapper(*args, **kwargs):
+        try:
+            yield from func(*args, **kwargs)
+        except Exception as e:
+            converted = convert_openai_error(e)
+            if converted is e:
+                raise
+            raise converted
 
     return wrapper
 
 
+def create_openai_client() -> OpenAI:
+    """OpenAIのクライアントを作成する"""
+    from openai import OpenAI
+
+    return OpenAI(api_key=setting.openai_api_key, max_retries=OpenAIHandler.MAX_RETRIES)
+
+
 class OpenAIHandler:
     MODEL = "gpt-4o-mini"
+    # 画像のルーティングで、読み取りが難しい画像に使うモデル
+    STRONG_MODEL = "gpt-4o"
     TEMPERATURE = 0
     MAX_TOKENS = 16384
     MAX_RETRIES = 3
 
     def __init__(self):
-        self.client = OpenAI(
-            api_key=setting.openai_api_key, max_retries=OpenAIHandler.MAX_RETRIES
-        )
+        self.client = create_openai_client()
 
-    @openai_error_handling
     def analyze_image(self, base64_image: str, content_type: str) -> ReceiptDetail:
         """OpenAIのAPIを呼び出し、レシートの解析を行う
 
@@ -104,31 +288,173 @@ class OpenAIHandler:
         Returns:
             ReceiptDetail: 解析されたレシートの詳細情報
         """
-        messages: list[ChatCompletionMessageParam] = []
-        system_prompt_message: ChatCompletionSystemMessageParam = {
-            "role": "system",
-            "content": SYSTEM_PROMPT,
-        }
-        messages.append(system_prompt_message)
+        return self.analyze_image_url(f"data:{content_type};base64,{base64_image}")
 
-        user_prompt_message: ChatCompletionUserMessageParam = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:{content_type};base64,{base64_image}"},
-                }
-            ],
-        }
-        messages.append(user_prompt_message)
+    @circuit_breaker(
+        openai_circuit_breaker,
+        failure_errors=(OpenAIServiceUnavailable, OpenAIUnexpectedError),
+        open_error=_openai_circuit_open_error,
+    )
+    @openai_error_handling
+    def analyze_image_url(
+        self,
+        image_url: str,
+        model: str | None = None,
+        detail: Literal["low", "high"] | None = None,
+    ) -> ReceiptDetail:
+        """画像のURL（data URLを含む）を指定してOpenAIのAPIを呼び出し、レシートの解析を行う
+
+        Args:
+            image_url (str): 画像のURL（例: file_operations.encode_data_url で作成した data URL）
+            model (str | None): 使用するモデル。None の場合は MODEL
+            detail (Literal["low", "high"] | None): 画像の解像度。None の場合は指定しない
+        Returns:
+            ReceiptDetail: 解析されたレシートの詳細情報
+        """
+        model = model or OpenAIHandler.MODEL
+        start = time.perf_counter()
         response = self.client.beta.chat.completions.parse(
-            model=OpenAIHandler.MODEL,
-            messages=messages,
+            model=model,
+            messages=prompt_builder.build_messages(image_url, detail),
             response_format=ReceiptDetail,
+            prompt_cache_key=prompt_builder.prompt_cache_key,
         )
+        self._record_usage(response.usage, time.perf_counter() - start, model)
         output = response.choices[0].message.parsed
         if not isinstance(output, ReceiptDetail):
             raise OpenAIResponseFormatError(
                 code=503, message="OpenAIの応答の解析に失敗しました。"
             )
         return output
+
+    def analyze_images(self, image_urls: list[str]) -> list[ReceiptDetail]:
+        """複数のレシート画像を、最大 setting.openai_pack_size 枚ずつまとめて解析する
+
+        応答の index が画像と対応しない場合は、対応しない画像だけを1枚ずつ解析し直す。
+
+        Args:
+            image_urls (list[str]): 画像のURL（data URLを含む）
+
+        Returns:
+            list[ReceiptDetail]: image_urls と同じ順の解析結果
+        """
+        results: list[ReceiptDetail] = []
+        pack_size = max(setting.openai_pack_size, 1)
+        for start in range(0, len(image_urls), pack_size):
+            pack = image_urls[start : start + pack_size]
+            if len(pack) == 1:
+                results.append(self.analyze_image_url(pack[0]))
+                continue
+            try:
+                aligned = self._analyze_packed_images(pack)
+            except OpenAIResponseFormatError:
+                aligned = {}
+            missing = [index for index in range(len(pack)) if index not in aligned]
+            if missing:
+                logger.warning(
+                    f"まとめて解析した結果が画像と対応しないため、1枚ずつ解析し直します: {missing}"
+                )
+            for index in missing:
+                aligned[index] = self.analyze_image_url(pack[index])
+            results.extend(aligned[index] for index in range(len(pack)))
+        return results
+
+    @circuit_breaker(
+        openai_circuit_breaker,
+        failure_errors=(OpenAIServiceUnavailable, OpenAIUnexpectedError),
+        open_error=_openai_circuit_open_error,
+    )
+    @openai_error_handling
+    def _analyze_packed_images(self, image_urls: list[str]) -> dict[int, ReceiptDetail]:
+        """複数の画像を1回のリクエストで解析し、index が一意に対応した結果のみを返す"""
+        messages = packed_prompt_builder.build_packed_messages(image_urls)
+        start = time.perf_counter()
+        response = self.client.beta.chat.completions.parse(
+            model=OpenAIHandler.MODEL,
+            messages=messages,
+            response_format=PackedReceiptDetails,
+            prompt_cache_key=packed_prompt_builder.prompt_cache_key,
+        )
+        self._record_usage(
+            response.usage, time.perf_counter() - start, OpenAIHandler.MODEL
+        )
+        output = response.choices[0].message.parsed
+        if not isinstance(output, PackedReceiptDetails):
+            raise OpenAIResponseFormatError(
+                code=503, message="OpenAIの応答の解析に失敗しました。"
+            )
+
+        counts = Counter(receipt.index for receipt in output.receipts)
+        return {
+            receipt.index: ReceiptDetail(**receipt.model_dump(exclude={"index"}))
+            for receipt in output.receipts
+            if 0 <= receipt.index < len(image_urls) and counts[receipt.index] == 1
+        }
+
+    def stream_analyze_image(
+        self, base64_image: str, content_type: str
+    ) -> Iterator[ReceiptStreamEvent]:
+        """OpenAIのストリーミングAPIを呼び出し、確定した項目から順に返す
+
+        Args:
+            base64_image (str): Base64エンコードされた画像データ
+            content_type (str): コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+        Returns:
+            Iterator[ReceiptStreamEvent]: 項目が確定するごとに "field"、最後に全項目を "done" で返す
+        """
+        return self.stream_analyze_image_url(
+            f"data:{content_type};base64,{base64_image}"
+        )
+
+    @circuit_breaker(
+        openai_circuit_breaker,
+        failure_errors=(OpenAIServiceUnavailable, OpenAIUnexpectedError),
+        open_error=_openai_circuit_open_error,
+    )
+    @openai_stream_error_handling
+    def stream_analyze_image_url(self, image_url: str) -> Iterator[ReceiptStreamEvent]:
+        """画像のURL（data URLを含む）を指定してOpenAIのストリーミングAPIを呼び出し、確定した項目から順に返す
+
+        Args:
+            image_url (str): 画像のURL（例: file_operations.encode_data_url で作成した data URL）
+        Returns:
+            Iterator[ReceiptStreamEvent]: 項目が確定するごとに "field"、最後に全項目を "done" で返す
+        """
+        messages = prompt_builder.build_messages(image_url)
+        parser = PartialJSONObjectParser()
+        start = time.perf_counter()
+        with self.client.beta.chat.completions.stream(
+            model=OpenAIHandler.MODEL,
+            messages=messages,
+            response_format=ReceiptDetail,
+            prompt_cache_key=prompt_builder.prompt_cache_key,
+            stream_options={"include_usage": True},
+        ) as stream:
+            for event in stream:
+                if event.type == "chunk" and event.chunk.usage is not None:
+                    self._record_usage(
+                        event.chunk.usage,
+                        time.perf_counter() - start,
+                        OpenAIHandler.MODEL,
+                    )
+                if event.type != "content.delta":
+                    continue
+                for key, value in parser.feed(event.delta):
+                    if key in ReceiptDetail.model_fields:
+                        yield {"event": "field", "data": {key: value}}
+
+        try:
+            output = ReceiptDetail.model_validate_json(parser.text)
+        except ValidationError:
+            raise OpenAIResponseFormatError(
+                code=503, message="OpenAIの応答の解析に失敗しました。"
+            )
+        yield {"event": "done", "data": output.model_dump()}
+
+    def _record_usage(
+        self, usage: CompletionUsage | None, elapsed: float, model: str
+    ) -> None:
+        record_openai(elapsed, usage, model)
+        cached_token_ratio = prompt_cache_metrics.record(usage)
+        if cached_token_ratio is not None:
+            logger.debug(f"プロンプトキャッシュの割合: {cached_token_ratio:.2f}")
@@ -0,0 +1,80 @@
+"""ストリーミングで届くJSONオブジェクトを少しずつ解析するパーサー"""
+
+import json
+from typing import Any, Iterator
+
+
+class PartialJSONObjectParser:
+    """トップレベルのJSONオブジェクトを、メンバーが確定するごとに返すパーサー
+
+    文字列の途中や数値の途中ではメンバーを返さず、`,` か `}` で値が確定した時点で返す。
+
+    Examples:
+        >>> parser = PartialJSONObjectParser()
+        >>> list(parser.feed('{"store_name": "OK'))
+        []
+        >>> list(parser.feed('ストア", "amount": 10'))
+        [('store_name', 'OKストア')]
+        >>> list(parser.feed("00}"))
+        [('amount', 1000)]
+    """
+
+    def __init__(self) -> None:
+        self._buffer: list[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start: int | None = None
+        self._length = 0
+        self.finished = False
+
+    def feed(self, chunk: str) -> Iterator[tuple[str, Any]]:
+        """チャンクを追加し、確定したメンバーを (キー, 値) で返す
+
+        Args:
+            chunk (str): 追加で届いたJSON文字列
+
+        Returns:
+            Iterator[tuple[str, Any]]: 確定したメンバー
+        """
+        for char in chunk:
+            self._buffer.append(char)
+            self._length += 1
+            if self.finished:
+                continue
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = self._length
+            elif char in "}]":
+                if self._depth == 1:
+                    yield from self._emit_member(self._length - 1)
+                    self.finished = True
+                self._depth -= 1
+            elif char == "," and self._depth == 1:
+                yield from self._emit_member(self._length - 1)
+                self._member_start = self._length
+
+    @property
+    def text(self) -> str:
+        """これまでに受け取ったJSON文字列"""
+        return "".join(self._buffer)
+
+    def _emit_member(self, end: int) -> Iterator[tuple[str, Any]]:
+        if self._member_start is None:
+            return
+        member = "".join(self._buffer[self._member_start : end]).strip()
+        if not member:
+            return
+        yield from json.loads("{" + member + "}").items()
@@ -0,0 +1,358 @@
+"""レシート解析結果のキャッシュ（複数のワーカー・Podで共有できるバックエンドを含む）"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Literal
+
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+from src.receipt_scanner_model.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_DETAIL_FIELDS = list(ReceiptDetail.model_fields)
+
+
+def encode_receipt_detail(receipt_detail: ReceiptDetail) -> bytes:
+    """ReceiptDetailをキーを含まないJSON配列にシリアライズする"""
+    return json.dumps(
+        [getattr(receipt_detail, field) for field in RECEIPT_DETAIL_FIELDS],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def decode_receipt_detail(data: bytes) -> ReceiptDetail:
+    """encode_receipt_detail でシリアライズしたデータをReceiptDetailに戻す"""
+    return ReceiptDetail(**dict(zip(RECEIPT_DETAIL_FIELDS, json.loads(data))))
+
+
+class ResultCacheBackend(ABC):
+    """解析結果を保存するバックエンド"""
+
+    @abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """有効期限内の値を取得する。存在しない場合は None を返す"""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        """値を ttl 秒の有効期限付きで保存する"""
+
+    @abstractmethod
+    def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        """他のワーカーと共有するロックを token を所有者として取得する。既に取得されている場合は False を返す"""
+
+    @abstractmethod
+    def release_lock(self, key: str, token: str) -> None:
+        """ロックの所有者が token の場合だけロックを解放する"""
+
+    @abstractmethod
+    def is_locked(self, key: str) -> bool:
+        """ロックが取得されているかを返す"""
+
+
+class InMemoryResultCacheBackend(ResultCacheBackend):
+    """プロセス内のメモリに保存するバックエンド。max_entries を超えると古いものから削除する"""
+
+    def __init__(
+        self, max_entries: int = 10000, clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._values: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        # キー -> (有効期限, 所有者のトークン)
+        self._locks: dict[str, tuple[float, str]] = {}
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= self._clock():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        with self._lock:
+            self._values[key] = (self._clock() + ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        with self._lock:
+            item = self._locks.get(key)
+            if item is not None and item[0] > self._clock():
+                return False
+            self._locks[key] = (self._clock() + ttl, token)
+            return True
+
+    def release_lock(self, key: str, token: str) -> None:
+        with self._lock:
+            item = self._locks.get(key)
+            if item is not None and item[1] == token:
+                del self._locks[key]
+
+    def is_locked(self, key: str) -> bool:
+        with self._lock:
+            item = self._locks.get(key)
+            return item is not None and item[0] > self._clock()
+
+
+class SQLiteResultCacheBackend(ResultCacheBackend):
+    """SQLiteファイルに保存するバックエンド。同じホストの複数ワーカーで共有できる"""
+
+    # set の呼び出しごとに期限切れの行を削除する間隔
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, db_fp: Path, clock: Callable[[], float] = time.time) -> None:
+        db_fp.parent.mkdir(parents=True, exist_ok=True)
+        self._clock = clock
+        self._conn = sqlite3.connect(db_fp, check_same_thread=False, timeout=5.0)
+        self._lock = threading.Lock()
+        self._set_count = 0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS locks "
+                "(key TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM results WHERE key = ? AND expires_at > ?",
+                (key, self._clock()),
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        now = self._clock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl),
+            )
+            self._set_count += 1
+            if self._set_count % self.PURGE_INTERVAL == 0:
+                self._conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+
+    def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        now = self._clock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM locks WHERE key = ? AND expires_at <= ?", (key, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO locks (key, token, expires_at) VALUES (?, ?, ?)",
+                (key, token, now + ttl),
+            )
+            return cursor.rowcount == 1
+
+    def release_lock(self, key: str, token: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM locks WHERE key = ? AND token = ?", (key, token)
+            )
+
+    def is_locked(self, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM locks WHERE key = ? AND expires_at > ?",
+                (key, self._clock()),
+            ).fetchone()
+        return row is not None
+
+
+class RedisResultCacheBackend(ResultCacheBackend):
+    """Redisプロトコルのサーバーに保存するバックエンド。複数のPodで共有できる
+
+    Args:
+        client: redis.Redis 互換のクライアント。None の場合は url から作成する
+        url (str | None): RedisのURL（例: "redis://localhost:6379/0"）
+        prefix (str): キーの接頭辞
+    """
+
+    def __init__(self, client=None, url: str | None = None, prefix: str = "receipt:"):
+        if client is None:
+            # redis は RESULT_CACHE=redis の場合のみ必要なため、ここで読み込む
+            import redis
+
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self._client = client
+        self._prefix = prefix
+
+    def get(self, key: str) -> bytes | None:
+        raw = self._client.get(f"{self._prefix}result:{key}")
+        # decode_responses=True のクライアントは str を返す
+        if isinstance(raw, str):
+            return raw.encode()
+        return raw if isinstance(raw, bytes) else None
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._client.set(f"{self._prefix}result:{key}", value, px=int(ttl * 1000))
+
+    def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        return bool(
+            self._client.set(
+                f"{self._prefix}lock:{key}", token, nx=True, px=int(ttl * 1000)
+            )
+        )
+
+    def release_lock(self, key: str, token: str) -> None:
+        # 値が token の場合だけ削除する。WATCH している間に他のワーカーが書き換えた場合は
+        # EXEC が失敗するため、他のワーカーのロックは削除しない
+        # （Lua スクリプトを使わないのは、fakeredis などの Lua を実行できない実装でも動かすため）
+        from redis.exceptions import WatchError
+
+        name = f"{self._prefix}lock:{key}"
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                if pipe.get(name) not in (token, token.encode()):
+                    pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.delete(name)
+                pipe.execute()
+            except WatchError:
+                pass
+
+    def is_locked(self, key: str) -> bool:
+        return bool(self._client.exists(f"{self._prefix}lock:{key}"))
+
+
+class ResultCache:
+    """解析結果のキャッシュ
+
+    同じキーの同時リクエストは、プロセス内では SingleFlight で、ワーカー間ではバックエンドのロックでまとめ、
+    OpenAIの呼び出しを1回にする。ロックは呼び出しごとのトークンで所有者を区別し、自分が取得したロックだけを解放する。
+    バックエンドに接続できない場合は、キャッシュ・ロックなしで解析する。
+
+    Args:
+        backend (ResultCacheBackend | None): 保存先。None の場合はキャッシュしない
+        ttl (float): 結果の有効秒数
+        lock_ttl (float): ワーカー間のロックの有効秒数（解析の最大時間の目安）
+        poll_interval (float): 他のワーカーの解析完了を待つ際の確認間隔
+    """
+
+    def __init__(
+        self,
+        backend: ResultCacheBackend | None,
+        ttl: float = 24 * 60 * 60,
+        lock_ttl: float = 60.0,
+        poll_interval: float = 0.1,
+    ) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._single_flight: SingleFlight[ReceiptDetail] = SingleFlight()
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], ReceiptDetail]
+    ) -> ReceiptDetail:
+        """キャッシュがあれば返し、なければ compute で解析して保存する
+
+        Args:
+            key (str): キャッシュのキー
+            compute (Callable[[], ReceiptDetail]): 解析を行う関数
+
+        Returns:
+            ReceiptDetail: 解析結果
+        """
+        if self.backend is None:
+            return compute()
+        return self._single_flight.do(key, lambda: self._load_or_compute(key, compute))
+
+    def _load_or_compute(
+        self, key: str, compute: Callable[[], ReceiptDetail]
+    ) -> ReceiptDetail:
+        backend = self.backend
+        assert backend is not None
+
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+
+        token = uuid.uuid4().hex
+        try:
+            acquired = backend.acquire_lock(key, token, self.lock_ttl)
+            if not acquired:
+                # 他のワーカーが解析中のため、結果が保存されるのを待つ
+                deadline = time.monotonic() + self.lock_ttl
+                while backend.is_locked(key) and time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    cached = self._get(key)
+                    if cached is not None:
+                        return cached
+                cached = self._get(key)
+                if cached is not None:
+                    return cached
+                acquired = backend.acquire_lock(key, token, self.lock_ttl)
+        except Exception as e:
+            logger.error(f"解析結果のキャッシュのロックの取得に失敗しました: {e}")
+            acquired = False
+        if not acquired:
+            logger.warning(
+                f"ロックを取得できなかったため、ロックなしで解析します: {key}"
+            )
+
+        try:
+            result = compute()
+            self._set(key, result)
+            return result
+        finally:
+            if acquired:
+                self._release_lock(key, token)
+
+    def _get(self, key: str) -> ReceiptDetail | None:
+        try:
+            data = self.backend.get(key)  # type: ignore[union-attr]
+        except Exception as e:
+            logger.error(f"解析結果のキャッシュの取得に失敗しました: {e}")
+            return None
+        return None if data is None else decode_receipt_detail(data)
+
+    def _set(self, key: str, result: ReceiptDetail) -> None:
+        try:
+            self.backend.set(key, encode_receipt_detail(result), self.ttl)  # type: ignore[union-attr]
+        except Exception as e:
+            logger.error(f"解析結果のキャッシュの保存に失敗しました: {e}")
+
+    def _release_lock(self, key: str, token: str) -> None:
+        try:
+            self.backend.release_lock(key, token)  # type: ignore[union-attr]
+        except Exception as e:
+            logger.error(f"解析結果のキャッシュのロックの解放に失敗しました: {e}")
+
+
+def create_result_cache(
+    kind: Literal["none", "memory", "sqlite", "redis"],
+    db_fp: Path,
+    redis_url: str | None,
+    ttl: float,
+) -> ResultCache:
+    """設定値から解析結果のキャッシュを作成する"""
+    backend: ResultCacheBackend | None = None
+    if kind == "memory":
+        backend = InMemoryResultCacheBackend()
+    elif kind == "sqlite":
+        backend = SQLiteResultCacheBackend(db_fp)
+    elif kind == "redis":
+        backend = RedisResultCacheBackend(url=redis_url)
+    return ResultCache(backend, ttl=ttl)
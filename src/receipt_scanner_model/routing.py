@@ -0,0 +1,163 @@
+"""画像の難しさに応じて、OpenAIに送る画像の解像度（detail）とモデルを選ぶ
+
+解像度・文字の密度・ぼけ具合をローカルで計測し、読み取りやすい画像は detail: low（固定の少ないトークン数）で送る。
+解析結果の検証に失敗した場合（合計金額がない、日付の形式が不正）は、ROUTES の次の段階で解析し直す。
+"""
+
+import logging
+import time
+from datetime import datetime
+from typing import Literal
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.metrics import routing_metrics
+from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
+from src.receipt_scanner_model.setting import setting
+
+logger = logging.getLogger(__name__)
+
+# detail: low の場合、画像はこの大きさに収まるよう縮小される
+LOW_DETAIL_SIZE = 512
+# 計測時に縮小する長辺のピクセル数
+MEASURE_MAX_SIDE = 1024
+
+
+class Route(BaseModel):
+    model: str
+    detail: Literal["low", "high"]
+
+    def __str__(self) -> str:
+        return f"{self.model}/{self.detail}"
+
+
+# 安い順。検証に失敗した場合は次の段階で解析し直す
+ROUTES = [
+    Route(model=OpenAIHandler.MODEL, detail="low"),
+    Route(model=OpenAIHandler.MODEL, detail="high"),
+    Route(model=OpenAIHandler.STRONG_MODEL, detail="high"),
+]
+
+
+class ImageFeatures(BaseModel):
+    width: int
+    height: int
+    # 文字とみなした画素の割合（0.0〜1.0）
+    text_density: float
+    # ラプラシアンの分散。小さいほどぼけている
+    sharpness: float
+
+    @property
+    def low_detail_scale(self) -> float:
+        """detail: low で送った場合の縮小率"""
+        return min(1.0, LOW_DETAIL_SIZE / max(self.width, self.height))
+
+
+def measure_image(img_bytes: bytes) -> ImageFeatures:
+    """画像の解像度・文字の密度・ぼけ具合を計測する
+
+    Args:
+        img_bytes (bytes): 画像のバイトデータ
+
+    Returns:
+        ImageFeatures: 計測結果
+    """
+    # cv2 は読み込みに時間がかかるため、初めて使う際に読み込む
+    import cv2
+    import numpy as np
+
+    buffer = np.frombuffer(img_bytes, dtype=np.uint8)
+    gray = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("画像を読み込めませんでした")
+    height, width = gray.shape
+
+    # 大きい画像でも計測の時間が一定になるよう縮小する
+    scale = MEASURE_MAX_SIDE / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15
+    )
+    return ImageFeatures(
+        width=width,
+        height=height,
+        text_density=float(binary.mean() / 255),
+        sharpness=float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+    )
+
+
+def choose_route(features: ImageFeatures) -> int:
+    """最初に使う ROUTES の段階を選ぶ
+
+    縮小しても文字が潰れない、文字が密集していない、ぼけていない画像は detail: low で送る。
+    ぼけている画像は、最初から上位のモデルで解析する。
+    """
+    if features.sharpness < setting.routing_blur_threshold:
+        return len(ROUTES) - 1
+    if (
+        features.low_detail_scale >= setting.routing_low_detail_min_scale
+        and features.text_density <= setting.routing_max_text_density
+    ):
+        return 0
+    return 1
+
+
+def validate_receipt_detail(receipt_detail: ReceiptDetail) -> list[str]:
+    """解析結果を検証し、問題のある項目名を返す（問題がない場合は空）"""
+    problems = []
+    if receipt_detail.amount is None or receipt_detail.amount <= 0:
+        problems.append("amount")
+    if receipt_detail.date is not None:
+        try:
+            datetime.strptime(receipt_detail.date, "%Y/%m/%d")
+        except ValueError:
+            problems.append("date")
+    return problems
+
+
+def analyze_with_routing(
+    openai_handler: OpenAIHandler, img_bytes: bytes, image_url: str
+) -> ReceiptDetail:
+    """画像の難しさに応じた設定で解析し、検証に失敗した場合は上位の設定で解析し直す
+
+    全ての段階で検証に失敗した場合は、最後の段階の結果を返す。
+
+    Args:
+        openai_handler (OpenAIHandler): 使用するハンドラー
+        img_bytes (bytes): 計測に使う画像のバイトデータ
+        image_url (str): OpenAIに送る画像のURL（data URLを含む）
+
+    Returns:
+        ReceiptDetail: 解析されたレシートの詳細情報
+    """
+    start = time.perf_counter()
+    try:
+        features = measure_image(img_bytes)
+        index = choose_route(features)
+        logger.info(
+            f"画像のルーティング: {ROUTES[index]} "
+            f"(size={features.width}x{features.height} "
+            f"text_density={features.text_density:.3f} "
+            f"sharpness={features.sharpness:.0f} "
+            f"measure={(time.perf_counter() - start) * 1000:.1f}ms)"
+        )
+    except ValueError as e:
+        index = 1
+        logger.warning(f"画像を計測できないため、{ROUTES[index]} で解析します: {e}")
+    routing_metrics.record_route(str(ROUTES[index]))
+
+    while True:
+        route = ROUTES[index]
+        receipt_detail = openai_handler.analyze_image_url(
+            image_url, model=route.model, detail=route.detail
+        )
+        problems = validate_receipt_detail(receipt_detail)
+        if not problems or index == len(ROUTES) - 1:
+            return receipt_detail
+        index += 1
+        logger.info(
+            f"解析結果の検証に失敗したため、{ROUTES[index]} で解析し直します: {problems}"
+        )
+        routing_metrics.record_escalation(str(ROUTES[index]))
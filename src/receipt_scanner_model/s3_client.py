@@ -1,9 +1,13 @@
 """S3からの画像ダウンロード処理を担当するクライアント"""
 
-import boto3
 import logging
+from typing import Iterator
 from src.receipt_scanner_model.setting import setting
 from botocore.exceptions import ClientError
+from src.receipt_scanner_model.circuit_breaker import (
+    circuit_breaker,
+    s3_circuit_breaker,
+)
 from src.receipt_scanner_model.error import (
     S3BadRequest,
     S3NotFound,
@@ -12,77 +16,32 @@ from src.receipt_scanner_model.error import (
     S3InternalServerError,
     S3UnexpectedError,
 )
+from src.receipt_scanner_model.image_validation import (
+    HEADER_PROBE_BYTES,
+    PASSTHROUGH_CONTENT_TYPES,
+    SUPPORTED_CONTENT_TYPES,
+    validate_image_bytes,
+    validate_image_header,
+)
+from src.receipt_scanner_model.s3_object_cache import CachedObject, s3_object_cache
+from src.receipt_scanner_model.audit import audit_s3
 
 logger = logging.getLogger(__name__)
 
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
 
-class S3Client:
-    """S3からの画像ダウンロードを行うクライアント"""
-
-    def __init__(self) -> None:
-        self.bucket_name = setting.bucket_name
-
-        self.s3_client = boto3.client(
-            "s3",
-            region_name=setting.aws_default_region,
-            aws_access_key_id=setting.aws_access_key_id,
-            aws_secret_access_key=setting.aws_secret_access_key,
-        )
-
-    def download_image_by_filename(
-        self, filename: str, max_size: int = MAX_FILE_SIZE
-    ) -> tuple[bytes, str]:
-        """S3からファイル名を指定して画像をダウンロードする
+def _s3_circuit_open_error() -> S3ServiceUnavailable:
+    logger.error("S3のサーキットブレーカーが開いているため、リクエストを遮断しました")
+    return S3ServiceUnavailable(
+        503, "S3サービスが一時的に利用できません: サーキットブレーカーが開いています"
+    )
 
-        Args:
-            filename: S3のオブジェクトキー（ファイル名）
 
-        Returns:
-            bytes: ダウンロードした画像
-            str: コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
-        """
+def s3_error_handling(func):
+    def wrapper(*args, **kwargs):
         try:
-            # まずheadでファイルサイズを確認
-            head_response = self.s3_client.head_object(
-                Bucket=self.bucket_name, Key=filename
-            )
-            content_length = head_response.get("ContentLength", 0)
-
-            if content_length <= 0:
-                logger.error(f"ファイルサイズが0バイト以下です: {content_length} bytes")
-                raise S3BadRequest(
-                    400, f"ファイルサイズが0バイト以下です: {content_length} bytes"
-                )
-            elif content_length > max_size:
-                logger.error(
-                    f"ファイルサイズが制限を超えています: {content_length} bytes"
-                )
-                raise S3BadRequest(
-                    400, f"ファイルサイズが制限を超えています: {content_length} bytes"
-                )
-
-            content_type = head_response.get("ContentType", None)
-
-            if content_type is None or not content_type.startswith("image/"):
-                logger.error(
-                    f"ファイルのContent-Typeが画像ではありません: {content_type}"
-                )
-                raise S3BadRequest(
-                    400, f"ファイルのContent-Typeが画像ではありません: {content_type}"
-                )
-            if content_type not in ["image/png", "image/jpeg"]:
-                logger.error(f"サポートされていない画像形式です: {content_type}")
-                raise S3BadRequest(
-                    400, f"サポートされていない画像形式です: {content_type}"
-                )
-
-            # サイズ・画像タイプに問題なければダウンロード
-            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=filename)
-            with response["Body"] as stream:
-                return stream.read(), content_type
-
+            return func(*args, **kwargs)
         except ClientError as e:
             error_message = e.response["Error"]["Message"]
             http_status_code = int(
@@ -144,3 +103,273 @@ class S3Client:
             raise S3UnexpectedError(
                 500, f"ダウンロード中に予期しないエラーが発生しました: {e}"
             )
+
+    return wrapper
+
+
+class S3Client:
+    """S3からの画像ダウンロードを行うクライアント"""
+
+    def __init__(self, max_pool_connections: int | None = None) -> None:
+        """
+        Args:
+            max_pool_connections: 複数スレッドから同時に使う場合のコネクションプールの大きさ
+        """
+        # boto3 は読み込みに時間がかかるため、起動時ではなく初めて使う際に読み込む
+        import boto3
+        from botocore.config import Config
+
+        self.bucket_name = setting.bucket_name
+
+        # 複数スレッドで使う場合は、スレッド数分のコネクションを使い回せるようにする
+        extra_args = (
+            {"config": Config(max_pool_connections=max_pool_connections)}
+            if max_pool_connections
+            else {}
+        )
+        self.s3_client = boto3.client(
+            "s3",
+            region_name=setting.aws_default_region,
+            aws_access_key_id=setting.aws_access_key_id,
+            aws_secret_access_key=setting.aws_secret_access_key,
+            **extra_args,
+        )
+        self.object_cache = s3_object_cache
+
+    @audit_s3
+    @circuit_breaker(
+        s3_circuit_breaker,
+        failure_errors=(S3ServiceUnavailable, S3InternalServerError, S3UnexpectedError),
+        open_error=_s3_circuit_open_error,
+    )
+    @s3_error_handling
+    def download_image_by_filename(
+        self, filename: str, max_size: int = MAX_FILE_SIZE
+    ) -> tuple[bytes, str]:
+        """S3からファイル名を指定して画像をダウンロードする
+
+        ダウンロードした画像は実際の形式と大きさを検証し、HEIC・WebP は JPEG に変換する。
+
+        Args:
+            filename: S3のオブジェクトキー（ファイル名）
+
+        Returns:
+            bytes: ダウンロードした画像
+            str: コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+        """
+        cache_key = f"{self.bucket_name}/{filename}"
+        cached = self.object_cache.get(cache_key)
+        if cached is not None:
+            # キャッシュがある場合は、ETagが変わっていなければ転送せずにキャッシュを使う
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=filename, IfNoneMatch=cached.etag
+                )
+            except ClientError as e:
+                status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                if status == 404:
+                    # 削除されたオブジェクトのキャッシュは残さない
+                    self.object_cache.delete(cache_key)
+                if status != 304:
+                    raise
+                # 変換後の body ではなく、元のオブジェクトの大きさで検証する
+                self._validate_image(cached.size, cached.content_type, max_size)
+                return cached.body, cached.content_type
+            with response["Body"] as stream:
+                content_type = self._validate_image(
+                    response.get("ContentLength", 0),
+                    response.get("ContentType", None),
+                    max_size,
+                )
+                body = stream.read()
+        else:
+            content_type = self._head_image(filename, max_size)
+
+            # サイズ・画像タイプに問題なければダウンロード
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=filename)
+            with response["Body"] as stream:
+                body = stream.read()
+        # キャッシュには検証・変換済みの画像を保存する
+        size = len(body)
+        body, content_type = validate_image_bytes(body, content_type)
+
+        etag = response.get("ETag")
+        if etag:
+            self.object_cache.put(
+                cache_key,
+                CachedObject(
+                    body=body, etag=etag, content_type=content_type, size=size
+                ),
+            )
+        return body, content_type
+
+    @audit_s3
+    @circuit_breaker(
+        s3_circuit_breaker,
+        failure_errors=(S3ServiceUnavailable, S3InternalServerError, S3UnexpectedError),
+        open_error=_s3_circuit_open_error,
+    )
+    @s3_error_handling
+    def generate_presigned_image_url(
+        self,
+        filename: str,
+        max_size: int = MAX_FILE_SIZE,
+        expires_in: int | None = None,
+    ) -> tuple[str | None, str]:
+        """画像を検証し、短時間だけ有効な署名付きURLを発行する
+
+        HEADでサイズとContent-Typeを検証した上で、先頭 HEADER_PROBE_BYTES バイトだけを範囲指定で取得し、
+        マジックバイトの形式と縦横のピクセル数をダウンロード時と同じ基準で検証する。
+        画素のデコードは行わないため、ヘッダーより後ろが壊れている画像は OpenAI が取得した際に
+        エラーになる（呼び出し側でダウンロードして送り直す）。
+        変換が必要な形式（HEIC・WebP）や、先頭だけでは検証できない画像は、URLを発行せずに None を返す。
+
+        Args:
+            filename: S3のオブジェクトキー（ファイル名）
+            expires_in: 署名付きURLの有効秒数。None の場合は設定値を使う
+
+        Returns:
+            str | None: 署名付きURL。ダウンロードして送る必要がある場合は None
+            str: コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+
+        Raises:
+            S3BadRequest: サイズ・形式・ピクセル数の検証に失敗した場合
+        """
+        content_type = self._head_image(filename, max_size)
+        if content_type not in PASSTHROUGH_CONTENT_TYPES:
+            return None, content_type
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=filename,
+            Range=f"bytes=0-{HEADER_PROBE_BYTES - 1}",
+        )
+        with response["Body"] as stream:
+            head = stream.read()
+        if validate_image_header(head, content_type) is None:
+            return None, content_type
+        url = self.s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket_name, "Key": filename},
+            ExpiresIn=expires_in or setting.presigned_url_expires_in,
+        )
+        return url, content_type
+
+    def iter_objects(
+        self, prefix: str, start_after: str | None = None
+    ) -> Iterator[tuple[str, int]]:
+        """プレフィックス配下のオブジェクトをキーの昇順に、ページ単位で取得しながら返す
+
+        Args:
+            prefix: S3のオブジェクトキーのプレフィックス
+            start_after: このキーより後のオブジェクトから返す
+
+        Returns:
+            Iterator[tuple[str, int]]: オブジェクトキーとサイズ
+        """
+        continuation_token = None
+        while True:
+            page = self._list_objects_page(prefix, start_after, continuation_token)
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["Size"]
+            if not page.get("IsTruncated"):
+                return
+            continuation_token = page["NextContinuationToken"]
+
+    # ジェネレーターの iter_objects ではなく、1ページ分の一覧の取得ごとに処理時間を記録する
+    @audit_s3
+    @circuit_breaker(
+        s3_circuit_breaker,
+        failure_errors=(S3ServiceUnavailable, S3InternalServerError, S3UnexpectedError),
+        open_error=_s3_circuit_open_error,
+    )
+    @s3_error_handling
+    def _list_objects_page(
+        self,
+        prefix: str,
+        start_after: str | None,
+        continuation_token: str | None,
+    ) -> dict:
+        """list_objects_v2 の1ページ分を取得する"""
+        params = {"Bucket": self.bucket_name, "Prefix": prefix}
+        if continuation_token:
+            params["ContinuationToken"] = continuation_token
+        elif start_after:
+            params["StartAfter"] = start_after
+        return self.s3_client.list_objects_v2(**params)
+
+    @audit_s3
+    @circuit_breaker(
+        s3_circuit_breaker,
+        failure_errors=(S3ServiceUnavailable, S3InternalServerError, S3UnexpectedError),
+        open_error=_s3_circuit_open_error,
+    )
+    @s3_error_handling
+    def get_image(
+        self,
+        filename: str,
+        max_size: int = MAX_FILE_SIZE,
+        content_types: tuple[str, ...] = SUPPORTED_CONTENT_TYPES,
+    ) -> tuple[bytes, str]:
+        """HEADを行わずに画像を取得し、GETのレスポンスヘッダーでサイズ・Content-Typeを検証する
+
+        一覧から取得したキーをまとめてダウンロードする場合に、リクエスト数を減らすために使う。
+        検証に失敗した場合は本文を読まずに S3BadRequest を送出する。
+        本文は download_image_by_filename と同様に、実際の形式と大きさを検証する。
+
+        Args:
+            filename: S3のオブジェクトキー（ファイル名）
+            content_types: 取得する画像のContent-Type。HEIC・WebP の変換前のContent-Typeで判定する
+
+        Returns:
+            bytes: ダウンロードした画像
+            str: コンテントのMIMEタイプ（例: "image/jpeg", "image/png"）
+        """
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=filename)
+        with response["Body"] as stream:
+            content_type = self._validate_image(
+                response.get("ContentLength", 0),
+                response.get("ContentType", None),
+                max_size,
+            )
+            if content_type not in content_types:
+                logger.error(f"対象外の画像形式です: {content_type}")
+                raise S3BadRequest(400, f"対象外の画像形式です: {content_type}")
+            body = stream.read()
+        return validate_image_bytes(body, content_type)
+
+    def _head_image(self, filename: str, max_size: int) -> str:
+        """HEADでファイルサイズとContent-Typeを検証し、Content-Typeを返す"""
+        # まずheadでファイルサイズを確認
+        head_response = self.s3_client.head_object(
+            Bucket=self.bucket_name, Key=filename
+        )
+        return self._validate_image(
+            head_response.get("ContentLength", 0),
+            head_response.get("ContentType", None),
+            max_size,
+        )
+
+    def _validate_image(
+        self, content_length: int, content_type: str | None, max_size: int
+    ) -> str:
+        """ファイルサイズとContent-Typeを検証し、Content-Typeを返す"""
+        if content_length <= 0:
+            logger.error(f"ファイルサイズが0バイト以下です: {content_length} bytes")
+            raise S3BadRequest(
+                400, f"ファイルサイズが0バイト以下です: {content_length} bytes"
+            )
+        elif content_length > max_size:
+            logger.error(f"ファイルサイズが制限を超えています: {content_length} bytes")
+            raise S3BadRequest(
+                400, f"ファイルサイズが制限を超えています: {content_length} bytes"
+            )
+
+        if content_type is None or not content_type.startswith("image/"):
+            logger.error(f"ファイルのContent-Typeが画像ではありません: {content_type}")
+            raise S3BadRequest(
+                400, f"ファイルのContent-Typeが画像ではありません: {content_type}"
+            )
+        if content_type not in SUPPORTED_CONTENT_TYPES:
+            logger.error(f"サポートされていない画像形式です: {content_type}")
+            raise S3BadRequest(400, f"サポートされていない画像形式です: {content_type}")
+        return content_type
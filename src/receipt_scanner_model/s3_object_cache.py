@@ -0,0 +1,203 @@
+"""S3からダウンロードした画像をETagとともに保持するローカルキャッシュ"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.setting import setting
+
+logger = logging.getLogger(__name__)
+
+
+class CachedObject(BaseModel):
+    body: bytes
+    etag: str
+    content_type: str
+    # 変換前の元のオブジェクトのバイト数（HEIC・WebP は変換後の body と異なる）
+    size: int
+
+
+class S3ObjectCache:
+    """メモリ（バイト数上限のLRU）と、任意でディスクの2段で画像を保持するキャッシュ
+
+    キャッシュした画像は古い可能性があるため、利用する側で ETag による再検証（IfNoneMatch）を行う。
+
+    Args:
+        max_bytes (int): メモリに保持する合計バイト数の上限。0 の場合はメモリに保持しない
+        disk_dir (Path | None): ディスクに保持する場合の保存先ディレクトリ
+        disk_max_bytes (int): ディスクに保持する合計バイト数の上限
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Path | None = None,
+        disk_max_bytes: int = 0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, CachedObject] = OrderedDict()
+        self._memory_bytes = 0
+        # ファイル名 -> サイズ（古い順）
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        if disk_dir is not None:
+            disk_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key: str) -> CachedObject | None:
+        """キャッシュした画像を取得する。ない場合は None を返す"""
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+                return cached
+        cached = self._read_disk(key)
+        if cached is not None:
+            with self._lock:
+                self._put_memory(key, cached)
+        return cached
+
+    def put(self, key: str, cached: CachedObject) -> None:
+        """画像をキャッシュする"""
+        with self._lock:
+            self._put_memory(key, cached)
+        self._write_disk(key, cached)
+
+    def delete(self, key: str) -> None:
+        """キャッシュした画像をメモリ・ディスクから削除する"""
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old.body)
+            if self.disk_dir is not None:
+                name = self._disk_name(key)
+                size = self._disk.pop(name, None)
+                if size is not None:
+                    self._disk_bytes -= size
+                    self._remove_disk_file(name)
+
+    def clear(self) -> None:
+        """メモリ・ディスクのキャッシュを全て削除する"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for name in self._disk:
+                self._remove_disk_file(name)
+            self._disk.clear()
+            self._disk_bytes = 0
+
+    def snapshot(self) -> dict:
+        """監視用に現在の使用量を返す"""
+        with self._lock:
+            return {
+                "memory_objects": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_objects": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _put_memory(self, key: str, cached: CachedObject) -> None:
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old.body)
+        if len(cached.body) > self.max_bytes:
+            return
+        self._memory[key] = cached
+        self._memory_bytes += len(cached.body)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.body)
+
+    def _disk_name(self, key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _load_disk_index(self) -> None:
+        assert self.disk_dir is not None
+        entries = [
+            entry
+            for entry in os.scandir(self.disk_dir)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        ]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            size = entry.stat().st_size
+            self._disk[entry.name] = size
+            self._disk_bytes += size
+
+    def _read_disk(self, key: str) -> CachedObject | None:
+        if self.disk_dir is None:
+            return None
+        name = self._disk_name(key)
+        with self._lock:
+            if name not in self._disk:
+                return None
+            self._disk.move_to_end(name)
+        try:
+            with open(self.disk_dir / name, "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+            os.utime(self.disk_dir / name)
+        except (OSError, ValueError) as e:
+            logger.warning(f"S3オブジェクトのキャッシュを読み込めませんでした: {e}")
+            return None
+        if header["key"] != key:
+            return None
+        return CachedObject(
+            body=body,
+            etag=header["etag"],
+            content_type=header["content_type"],
+            size=header.get("size", len(body)),
+        )
+
+    def _write_disk(self, key: str, cached: CachedObject) -> None:
+        if self.disk_dir is None or len(cached.body) > self.disk_max_bytes:
+            return
+        name = self._disk_name(key)
+        header = json.dumps(
+            {
+                "key": key,
+                "etag": cached.etag,
+                "content_type": cached.content_type,
+                "size": cached.size,
+            }
+        ).encode("utf-8")
+        tmp_fp = self.disk_dir / f"{name}.{threading.get_ident()}.tmp"
+        try:
+            # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+            with open(tmp_fp, "wb") as f:
+                f.write(header + b"\n")
+                f.write(cached.body)
+            os.replace(tmp_fp, self.disk_dir / name)
+        except OSError as e:
+            logger.warning(f"S3オブジェクトのキャッシュを保存できませんでした: {e}")
+            return
+        size = len(header) + 1 + len(cached.body)
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(name, 0)
+            self._disk[name] = size
+            while self._disk_bytes > self.disk_max_bytes:
+                evicted, evicted_size = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                self._remove_disk_file(evicted)
+
+    def _remove_disk_file(self, name: str) -> None:
+        assert self.disk_dir is not None
+        try:
+            os.remove(self.disk_dir / name)
+        except FileNotFoundError:
+            pass
+
+
+s3_object_cache = S3ObjectCache(
+    max_bytes=setting.s3_object_cache_max_bytes,
+    disk_dir=setting.s3_object_cache_dir,
+    disk_max_bytes=setting.s3_object_cache_disk_max_bytes,
+)
@@ -0,0 +1,139 @@
+"""S3のプレフィックス配下の画像をまとめてダウンロードする（バックフィル用）"""
+
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Generator
+
+from src.receipt_scanner_model.error import S3BadRequest, S3NotFound
+from src.receipt_scanner_model.image_validation import SUPPORTED_CONTENT_TYPES
+from src.receipt_scanner_model.s3_client import MAX_FILE_SIZE, S3Client
+
+logger = logging.getLogger(__name__)
+
+# HEIC・WebP はダウンロード時に JPEG に変換される
+IMAGE_CONTENT_TYPES = SUPPORTED_CONTENT_TYPES
+
+
+class S3PrefixScanner:
+    """プレフィックス配下の画像を一覧しながら並列にダウンロードする
+
+    一覧は list_objects_v2 をページ単位で取得するため、オブジェクト数が多くてもメモリに全件を保持しない。
+    ダウンロード中・未取得の画像は workers * 2 件までに抑える。
+    checkpoint_fp を指定すると、処理済みのキーのうち、それより前のキーが全て処理済みである最後のキーを保存し、
+    次回はその続きから再開する。
+    一覧にはContent-Typeが含まれないため、画像かどうかはダウンロード時のレスポンスヘッダーで判定する
+    （拡張子のないキーも対象にする）。一覧の取得後に削除されたオブジェクトはスキップする。
+
+    Args:
+        s3_client (S3Client | None): 使用するクライアント。None の場合はスレッド数分のコネクションで作成する
+        workers (int): ダウンロードの並列数
+        max_size (int): ダウンロードする画像の最大バイト数
+        content_types (tuple[str, ...]): ダウンロードする画像のContent-Type（JPEG に変換する前のもの）
+        checkpoint_fp (Path | None): 処理済みのキーを保存するファイル
+    """
+
+    def __init__(
+        self,
+        s3_client: S3Client | None = None,
+        workers: int = 8,
+        max_size: int = MAX_FILE_SIZE,
+        content_types: tuple[str, ...] = IMAGE_CONTENT_TYPES,
+        checkpoint_fp: Path | None = None,
+    ) -> None:
+        self.s3_client = s3_client or S3Client(max_pool_connections=workers)
+        self.workers = workers
+        self.max_size = max_size
+        self.content_types = content_types
+        self.checkpoint_fp = checkpoint_fp
+
+    def scan(self, prefix: str) -> Generator[tuple[str, bytes, str], None, None]:
+        """プレフィックス配下の画像を、ダウンロードが終わった順に返す
+
+        次の画像を要求された時点で、直前に返した画像は処理済みとみなす。
+
+        Args:
+            prefix (str): S3のオブジェクトキーのプレフィックス
+
+        Returns:
+            Generator[tuple[str, bytes, str], None, None]: オブジェクトキー、画像のバイトデータ、コンテントのMIMEタイプ
+        """
+        objects = (
+            key
+            for key, size in self.s3_client.iter_objects(
+                prefix, self.load_checkpoint(prefix)
+            )
+            if self._is_target(key, size)
+        )
+        # 一覧の順のキーと、処理済みかどうか
+        pending: deque[list] = deque()
+        in_flight: dict[Future, list] = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while True:
+                    while len(in_flight) < self.workers * 2:
+                        key = next(objects, None)
+                        if key is None:
+                            break
+                        entry = [key, False]
+                        pending.append(entry)
+                        in_flight[executor.submit(self._download, key)] = entry
+
+                    if not in_flight:
+                        return
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    # 同時に終わったものは一覧の順に返す
+                    for future in sorted(done, key=lambda future: in_flight[future][0]):
+                        entry = in_flight.pop(future)
+                        image = future.result()
+                        if image is not None:
+                            yield entry[0], image[0], image[1]
+                        entry[1] = True
+                        self._advance_checkpoint(prefix, pending)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def load_checkpoint(self, prefix: str) -> str | None:
+        """保存した処理済みのキーを読み込む。プレフィックスが異なる場合は None を返す"""
+        if self.checkpoint_fp is None or not self.checkpoint_fp.exists():
+            return None
+        with open(self.checkpoint_fp, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("prefix") != prefix:
+            return None
+        return checkpoint.get("last_key")
+
+    def _is_target(self, key: str, size: int) -> bool:
+        # Content-Type は GET のレスポンスヘッダーで確認し、本文を読む前に対象外のものを除く
+        return 0 < size <= self.max_size
+
+    def _download(self, key: str) -> tuple[bytes, str] | None:
+        try:
+            # Content-Type は HEIC・WebP を JPEG に変換する前のもので判定する
+            return self.s3_client.get_image(key, self.max_size, self.content_types)
+        except S3BadRequest as e:
+            logger.warning(f"対象外のファイルのためスキップしました: {key} {e.message}")
+            return None
+        except S3NotFound as e:
+            logger.warning(
+                f"一覧の取得後に削除されたためスキップしました: {key} {e.message}"
+            )
+            return None
+
+    def _advance_checkpoint(self, prefix: str, pending: deque[list]) -> None:
+        last_key = None
+        while pending and pending[0][1]:
+            last_key = pending.popleft()[0]
+        if last_key is None or self.checkpoint_fp is None:
+            return
+        self.checkpoint_fp.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fp = self.checkpoint_fp.with_suffix(".tmp")
+        with open(tmp_fp, "w") as f:
+            json.dump({"prefix": prefix, "last_key": last_key}, f)
+        os.replace(tmp_fp, self.checkpoint_fp)
@@ -6,57 +6,482 @@ import cv2
 import numpy as np
 
 import pytesseract
+import logging
 import re
 
+from abc import ABC, abstractmethod
+from functools import cache
 from io import BytesIO
+from pathlib import Path
 
-from typing import TypedDict
+from typing import Literal, TypedDict
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.setting import setting
+from src.receipt_scanner_model.stage_cache import StageCache, StageChain
+from src.receipt_scanner_model.store_index import StoreIndex
+
+logger = logging.getLogger(__name__)
 
 LANG = "eng+jpn"
+# image_to_data の level のうち、単語を表すもの
+WORD_LEVEL = 5
+
+# 画像ごとに前処理を選ぶ（adaptive）場合の基準
+# ノイズの標準偏差の推定値がこれ未満の画像は、ノイズ除去を行わない
+NOISE_SKIP_SIGMA = 2.0
+# ノイズ除去（nlmeans）の強さ h を、ノイズの標準偏差の推定値の何倍にするか（設定の強さが上限）
+NOISE_TO_STRENGTH = 3.0
+# ラプラシアンの分散がこれ未満の（ぼけている）画像は、文字が潰れないようノイズ除去を行わない
+BLUR_SKIP_SHARPNESS = 100.0
+# 明るさの範囲（1〜99パーセンタイルの差）がこれ以上の画像は、コントラストを強調しない
+CONTRAST_SKIP_RANGE = 200.0
+# ノイズの推定に使う、中央を切り出す大きさ
+NOISE_SAMPLE_SIZE = 1024
+# ノイズの推定に使うカーネル（滑らかな変化を打ち消し、ノイズだけを取り出す）
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
 
 
 class ReceiptAnalyzedData(TypedDict):
     amount: int
     text: str
+    # 実際に行った前処理（PreprocessPath）
+    preprocessing: dict
+    # 店名の辞書で見つかった店（StoreMatch）。辞書がない場合・見つからない場合は None
+    store: dict | None
+
+
+class PreprocessConfig(BaseModel):
+    """前処理とOCRの設定
+
+    デフォルトは手で選んだ値。scripts.tune_ocr で探索した推奨設定をJSONで保存し、読み込める。
+    denoise_strength の意味はノイズ除去の方法ごとに異なる
+    （nlmeans: フィルタの強さ h、median: カーネルサイズ（奇数）、bilateral: 色・距離のシグマ）。
+    """
+
+    grayscale: Literal["luma", "average", "min"] = "luma"
+    scale: float = 1.0
+    contrast: float = 2.0
+    denoise: Literal["none", "nlmeans", "median", "bilateral"] = "nlmeans"
+    denoise_strength: int = 20
+    # Tesseract のページ分割モードとエンジン
+    psm: int = 3
+    oem: int = 3
+    # 画像ごとにノイズ・ぼけ・コントラストを推定し、コントラストの強調とノイズ除去を行うか・強さを選ぶ
+    adaptive: bool = False
+
+    @property
+    def tesseract_config(self) -> str:
+        return f"--psm {self.psm} --oem {self.oem}"
+
+
+def load_preprocess_config(fp: Path | None) -> PreprocessConfig:
+    """JSONファイルから前処理の設定を読み込む。None またはファイルがない場合はデフォルトを返す"""
+    if fp is None or not fp.exists():
+        return PreprocessConfig()
+    return PreprocessConfig.model_validate_json(fp.read_text(encoding="utf-8"))
+
+
+@cache
+def default_preprocess_config() -> PreprocessConfig:
+    """設定（ocr_preprocess_config_path）の前処理の設定を返す。初めて呼ばれた際に1度だけ読み込む"""
+    return load_preprocess_config(setting.ocr_preprocess_config_path)
+
 
+@cache
+def default_store_index() -> StoreIndex | None:
+    """設定 store_index_path の店名の辞書を読み込む（ない場合は None）"""
+    fp = setting.store_index_path
+    if fp is None or not fp.exists():
+        return None
+    index = StoreIndex.load(fp, setting.store_index_min_confidence)
+    logger.info(f"店名の辞書を読み込みました: {fp} ({len(index)} 店)")
+    return index
 
-def preprocess_image(image_bytes: bytes) -> Image.Image:
+
+class PreprocessPath(BaseModel):
+    """実際に行った前処理と、その判断に使った推定値（adaptive でない場合、推定値は None）"""
+
+    adaptive: bool
+    # 1.0 の場合はコントラストを強調していない
+    contrast: float
+    # "none" の場合はノイズ除去を行っていない
+    denoise: str
+    denoise_strength: int
+    noise: float | None = None
+    sharpness: float | None = None
+    dynamic_range: float | None = None
+
+
+class OcrResult:
+    """1回のOCRで得た単語ごとの結果を、列ごとのNumPy配列で保持する
+
+    単語の順番はTesseractの読み取り順（ブロック・段落・行・単語の順）で、
+    line は同じ行の単語に同じ値を持つ、0から始まる行番号。
+
+    Args:
+        text (np.ndarray): 単語の文字列
+        left (np.ndarray): バウンディングボックスの左端
+        top (np.ndarray): バウンディングボックスの上端
+        width (np.ndarray): バウンディングボックスの幅
+        height (np.ndarray): バウンディングボックスの高さ
+        conf (np.ndarray): 単語の信頼度（0〜100）
+        line (np.ndarray): 行番号
+    """
+
+    def __init__(
+        self,
+        text: np.ndarray,
+        left: np.ndarray,
+        top: np.ndarray,
+        width: np.ndarray,
+        height: np.ndarray,
+        conf: np.ndarray,
+        line: np.ndarray,
+    ) -> None:
+        self.text = text
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.conf = conf
+        self.line = line
+
+    @classmethod
+    def from_data(cls, data: dict[str, list]) -> "OcrResult":
+        """pytesseract.image_to_data（Output.DICT）の結果から、空でない単語だけを取り出して作成する"""
+        text = np.asarray(data["text"], dtype=object)
+        is_word = (np.asarray(data["level"]) == WORD_LEVEL) & np.array(
+            [bool(str(word).strip()) for word in text], dtype=bool
+        )
+        # ブロック・段落・行の番号の組み合わせを、読み取り順の行番号にする
+        line_keys = np.stack(
+            [
+                np.asarray(data[key], dtype=np.int32)[is_word]
+                for key in ("page_num", "block_num", "par_num", "line_num")
+            ],
+            axis=1,
+        ).reshape(-1, 4)
+        _, line = np.unique(line_keys, axis=0, return_inverse=True)
+        return cls(
+            text=text[is_word].astype(str),
+            left=np.asarray(data["left"], dtype=np.int32)[is_word],
+            top=np.asarray(data["top"], dtype=np.int32)[is_word],
+            width=np.asarray(data["width"], dtype=np.int32)[is_word],
+            height=np.asarray(data["height"], dtype=np.int32)[is_word],
+            conf=np.asarray(data["conf"], dtype=np.float32)[is_word],
+            line=line.reshape(-1).astype(np.int32),
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """列ごとの配列を返す（キャッシュに保存する形式）"""
+        return {
+            "text": self.text,
+            "left": self.left,
+            "top": self.top,
+            "width": self.width,
+            "height": self.height,
+            "conf": self.conf,
+            "line": self.line,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "OcrResult":
+        """to_arrays の結果から作成する"""
+        return cls(**arrays)
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    @property
+    def n_lines(self) -> int:
+        return int(self.line.max()) + 1 if len(self) else 0
+
+    @property
+    def boxes(self) -> np.ndarray:
+        """(単語数, 4) の配列で、各行は left, top, width, height"""
+        return np.stack([self.left, self.top, self.width, self.height], axis=1)
+
+    def lines(self) -> list[str]:
+        """行ごとに単語を空白でつないだ文字列を返す"""
+        return [" ".join(self.text[self.line == i]) for i in range(self.n_lines)]
+
+    def to_text(self) -> str:
+        """image_to_string と同様に、行ごとに改行した文字列を返す"""
+        return "\n".join(self.lines())
+
+    def row_text(self, line_id: int) -> str:
+        """指定した行と同じ高さにある単語を、左から順に空白でつないだ文字列を返す
+
+        レシートの金額は右寄せで、項目名との間が空いているため、Tesseractが別の行（ブロック）と
+        判定することがある。行の単語の縦の中心の範囲に中心がある単語を、同じ行とみなす。
+        """
+        in_line = self.line == line_id
+        centers = self.top + self.height / 2
+        row_top = self.top[in_line].min()
+        row_bottom = (self.top[in_line] + self.height[in_line]).max()
+        in_row = (centers >= row_top) & (centers <= row_bottom)
+        order = np.argsort(self.left[in_row], kind="stable")
+        return " ".join(self.text[in_row][order])
+
+
+def preprocess_image(
+    image_bytes: bytes,
+    config: PreprocessConfig | None = None,
+    chain: StageChain | None = None,
+) -> Image.Image:
     """画像の前処理を行う
 
     Args:
         image_bytes (bytes): 画像のバイトデータ
+        config (PreprocessConfig | None): 前処理の設定。None の場合は default_preprocess_config()
+        chain (StageChain | None): 段階ごとの出力をキャッシュする場合に指定する
 
     Returns:
         Image.Image: 画像データ
     """
-    # 画像の読み込み
-    img = Image.open(BytesIO(image_bytes))
+    image, _ = preprocess_image_with_path(image_bytes, config, chain)
+    return image
+
+
+def preprocess_image_with_path(
+    image_bytes: bytes,
+    config: PreprocessConfig | None = None,
+    chain: StageChain | None = None,
+) -> tuple[Image.Image, PreprocessPath]:
+    """画像の前処理を行い、実際に行った前処理を返す
+
+    config.adaptive の場合は、コントラストの強調の前に明るさの範囲とぼけ具合を、
+    ノイズ除去の前にノイズの大きさを推定し、不要な段階を省く（ノイズ除去が最も時間がかかる）。
+
+    Args:
+        image_bytes (bytes): 画像のバイトデータ
+        config (PreprocessConfig | None): 前処理の設定。None の場合は default_preprocess_config()
+        chain (StageChain | None): 段階ごとの出力をキャッシュする場合に指定する
 
-    # グレースケールに変換
-    img = img.convert("L")
+    Returns:
+        Image.Image: 画像データ
+        PreprocessPath: 実際に行った前処理
+    """
+    config = config or default_preprocess_config()
+    chain = chain or StageChain(None, image_bytes)
+
+    # 画像を読み込み、グレースケールに変換
+    gray = chain.run(
+        "grayscale",
+        {"method": config.grayscale},
+        lambda: to_grayscale(Image.open(BytesIO(image_bytes)), config.grayscale),
+    )
+
+    # 拡大・縮小
+    if config.scale != 1.0:
+        gray = chain.run(
+            "scale",
+            {"factor": config.scale},
+            lambda: cv2.resize(
+                np.asarray(gray),
+                None,
+                fx=config.scale,
+                fy=config.scale,
+                interpolation=cv2.INTER_CUBIC if config.scale > 1 else cv2.INTER_AREA,
+            ),
+        )
+
+    contrast = config.contrast
+    path = PreprocessPath(
+        adaptive=config.adaptive,
+        contrast=contrast,
+        denoise=config.denoise,
+        denoise_strength=config.denoise_strength,
+    )
+    if config.adaptive:
+        path.sharpness = estimate_sharpness(np.asarray(gray))
+        path.dynamic_range = estimate_dynamic_range(np.asarray(gray))
+        if path.dynamic_range >= CONTRAST_SKIP_RANGE:
+            contrast = path.contrast = 1.0
 
     # コントラストを強調
-    img = ImageEnhance.Contrast(img).enhance(2)
+    enhanced = gray
+    if contrast != 1.0:
+        enhanced = chain.run(
+            "contrast",
+            {"factor": contrast},
+            lambda: np.array(
+                ImageEnhance.Contrast(Image.fromarray(np.asarray(gray))).enhance(
+                    contrast
+                ),
+                dtype=np.uint8,
+            ),
+        )
+
+    if config.adaptive:
+        assert path.sharpness is not None
+        path.noise = estimate_noise(np.asarray(enhanced))
+        if path.noise < NOISE_SKIP_SIGMA or path.sharpness < BLUR_SKIP_SHARPNESS:
+            path.denoise, path.denoise_strength = "none", 0
+        elif config.denoise == "nlmeans":
+            path.denoise_strength = min(
+                config.denoise_strength,
+                max(1, round(path.noise * NOISE_TO_STRENGTH)),
+            )
+        logger.info(f"前処理: {path.model_dump()}")
 
     # ノイズ除去
-    cv2_img = np.array(img, dtype=np.uint8)
-    cv2_img = cv2.fastNlMeansDenoising(cv2_img, None, 20)
+    denoised = enhanced
+    if path.denoise != "none":
+        denoised = chain.run(
+            "denoise",
+            {"filter": path.denoise, "strength": path.denoise_strength},
+            lambda: denoise(np.asarray(enhanced), path.denoise, path.denoise_strength),
+        )
 
     # NumPy配列 -> PIL画像
-    img = Image.fromarray(cv2_img)
-    return img
+    return Image.fromarray(np.asarray(denoised)), path
+
+
+def estimate_noise(gray: np.ndarray) -> float:
+    """ノイズの標準偏差を推定する
+
+    滑らかな変化を打ち消すカーネルの応答の中央値から推定する（文字の輪郭など、まばらな強い応答の影響を受けにくい）。
+    時間が一定になるよう、中央の NOISE_SAMPLE_SIZE 四方だけを使う。
+    """
+    height, width = gray.shape
+    top = max((height - NOISE_SAMPLE_SIZE) // 2, 0)
+    left = max((width - NOISE_SAMPLE_SIZE) // 2, 0)
+    sample = gray[top : top + NOISE_SAMPLE_SIZE, left : left + NOISE_SAMPLE_SIZE]
+    response = cv2.filter2D(sample.astype(np.float32), -1, _NOISE_KERNEL)[1:-1, 1:-1]
+    if response.size == 0:
+        return 0.0
+    # 正規分布のノイズに対する応答の標準偏差は 6σ、中央絶対偏差は標準偏差の 0.6745 倍
+    return float(np.median(np.abs(response)) / 0.6745 / 6)
+
+
+def estimate_sharpness(gray: np.ndarray) -> float:
+    """ラプラシアンの分散を返す。小さいほどぼけている"""
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def estimate_dynamic_range(gray: np.ndarray) -> float:
+    """明るさのヒストグラムの1〜99パーセンタイルの差を返す。小さいほどコントラストが低い"""
+    hist = np.bincount(gray.ravel(), minlength=256).cumsum()
+    low, high = np.searchsorted(hist, [hist[-1] * 0.01, hist[-1] * 0.99])
+    return float(high - low)
+
 
+def to_grayscale(img: Image.Image, method: str) -> np.ndarray:
+    """画像をグレースケールの配列に変換する
 
-def extract_text_from_image(image: Image.Image) -> str:
+    luma は輝度（Pillow の "L"）、average はRGBの平均、min はRGBの最小値（色の付いた文字も濃くなる）。
+    """
+    if method == "luma":
+        return np.array(img.convert("L"), dtype=np.uint8)
+    rgb = np.asarray(img.convert("RGB"))
+    if method == "average":
+        return rgb.mean(axis=2).round().astype(np.uint8)
+    return rgb.min(axis=2)
+
+
+def denoise(gray: np.ndarray, method: str, strength: int) -> np.ndarray:
+    """グレースケールの配列のノイズを除去する"""
+    if method == "nlmeans":
+        return cv2.fastNlMeansDenoising(gray, None, strength)
+    if method == "median":
+        return cv2.medianBlur(gray, strength | 1)
+    if method == "bilateral":
+        return cv2.bilateralFilter(gray, 5, strength, strength)
+    return gray
+
+
+class OcrEngine(ABC):
+    """前処理済みの画像をOCRし、単語（または文字列の塊）ごとの OcrResult を返すエンジン"""
+
+    name: str
+
+    @abstractmethod
+    def recognize(
+        self, image: Image.Image, config: PreprocessConfig | None = None
+    ) -> OcrResult:
+        """画像をOCRする
+
+        Args:
+            image (Image.Image): 前処理済みの画像データ
+            config (PreprocessConfig | None): エンジン固有の設定（Tesseract の psm・oem など）
+        """
+
+    @abstractmethod
+    def cache_params(self, config: PreprocessConfig) -> dict:
+        """OCRの結果をキャッシュする際に、キーに含めるパラメーターを返す"""
+
+
+class TesseractEngine(OcrEngine):
+    """Tesseract（pytesseract）によるOCR"""
+
+    name = "tesseract"
+
+    def recognize(
+        self, image: Image.Image, config: PreprocessConfig | None = None
+    ) -> OcrResult:
+        data = pytesseract.image_to_data(
+            image,
+            lang=LANG,
+            config=config.tesseract_config if config else "",
+            output_type=pytesseract.Output.DICT,
+        )
+        return OcrResult.from_data(data)
+
+    def cache_params(self, config: PreprocessConfig) -> dict:
+        return {"lang": LANG, "psm": config.psm, "oem": config.oem}
+
+
+@cache
+def default_ocr_engine() -> OcrEngine:
+    """設定 ocr_engine のOCRエンジンを返す（プロセス内で1つを使い回す）"""
+    if setting.ocr_engine == "onnx":
+        # ONNX Runtime は任意の依存のため、使う場合だけ読み込む
+        from src.receipt_scanner_model.onnx_ocr import OnnxOcrEngine
+
+        return OnnxOcrEngine(
+            setting.ocr_onnx_det_model_path,
+            setting.ocr_onnx_rec_model_path,
+            setting.ocr_onnx_dict_path,
+            threads=setting.ocr_threads,
+            rec_batch_size=setting.ocr_onnx_rec_batch_size,
+        )
+    return TesseractEngine()
+
+
+def ocr_image(
+    image: Image.Image,
+    config: PreprocessConfig | None = None,
+    engine: OcrEngine | None = None,
+) -> OcrResult:
+    """画像をOCRし、単語ごとの文字列・バウンディングボックス・信頼度を取得する
+
+    テキスト・バウンディングボックス・信頼度は、全てこの1回のOCRの結果から取得する。
+
+    Args:
+        image (Image.Image): 画像データ
+        config (PreprocessConfig | None): psm・oem を指定する場合の設定
+        engine (OcrEngine | None): OCRエンジン。None の場合は default_ocr_engine()
+
+    Returns:
+        OcrResult: 単語ごとのOCR結果
+    """
+    return (engine or default_ocr_engine()).recognize(image, config)
+
+
+def extract_text_from_image(image: Image.Image, engine: OcrEngine | None = None) -> str:
     """画像データをtextに変換
 
     Args:
         image (Image.Image): 画像データ
+        engine (OcrEngine | None): OCRエンジン。None の場合は default_ocr_engine()
 
     Returns:
         str: 画像のテキストデータ
     """
-    return pytesseract.image_to_string(image, lang=LANG)
+    return ocr_image(image, engine=engine).to_text()
 
 
 def extract_amount_from_line(text_line: str) -> int | None:
@@ -146,11 +571,13 @@ def dict_max(count_amount_dict: dict[int, int]) -> int:
             return max(max_counts_list)
 
 
-def extract_total_amount(text: str) -> int:
+def extract_total_amount(text: str | OcrResult) -> int:
     """レシートのテキストデータから合計を取得する
 
+    OCR結果を渡した場合は、キーワードのある行と同じ高さにある右寄せの金額も、同じ行として扱う。
+
     Args:
-        text (str): レシートのテキストデータ
+        text (str | OcrResult): レシートのテキストデータ、またはOCR結果
 
     Returns:
         int: 合計金額
@@ -163,12 +590,17 @@ def extract_total_amount(text: str) -> int:
 
     kws_amount_dict = {word: [] for word in keywords}
 
+    text_lines = text.lines() if isinstance(text, OcrResult) else text.splitlines()
+
     # テキストデータを1行ずつに分け、合計となり得るものを kws_dict に入れていく
-    for text_line in text.splitlines():
+    for line_id, text_line in enumerate(text_lines):
         text_line_clean = clean_text_line(text_line)
         found = [word for word in keywords if word in text_line_clean]
         found_illegal = [word for word in illegal_keywords if word in text_line_clean]
         if len(found) > 0 and len(found_illegal) == 0:
+            if isinstance(text, OcrResult):
+                # 金額が別の行と判定されていても、同じ高さの右端の数字を取得する
+                text_line_clean = clean_text_line(text.row_text(line_id))
             total = extract_amount_from_line(text_line_clean)
             if total:
                 # totalsに取得したtotalがない場合、追加する
@@ -185,23 +617,54 @@ def extract_total_amount(text: str) -> int:
     return get_most_likely(kws_amount_dict, totals)
 
 
-def scan(image_bytes: bytes) -> ReceiptAnalyzedData:
+def scan(
+    image_bytes: bytes,
+    config: PreprocessConfig | None = None,
+    cache: StageCache | None = None,
+    engine: OcrEngine | None = None,
+    store_index: StoreIndex | None = None,
+) -> ReceiptAnalyzedData:
     """レシートから最もらしい合計金額を出力する
 
     Args:
         image_bytes (bytes): 画像のバイトデータ
+        config (PreprocessConfig | None): 前処理とOCRの設定。None の場合は default_preprocess_config()
+        cache (StageCache | None): 前処理・OCRの段階ごとの出力をキャッシュする場合に指定する
+            （パラメーターを変えて何度も実行する場合に、変わった段階より後だけを計算し直す）
+        engine (OcrEngine | None): OCRエンジン。None の場合は default_ocr_engine()
+        store_index (StoreIndex | None): 店名の辞書。None の場合は default_store_index()
 
     Returns:
         ReceiptAnalyzedData: 合計金額とレシートのOCR結果
     """
+    config = config or default_preprocess_config()
+    engine = engine or default_ocr_engine()
+    chain = StageChain(cache, image_bytes)
 
     # 画像の前処理
-    preprocessed_image = preprocess_image(image_bytes)
-
-    # textデータに変換
-    text = extract_text_from_image(preprocessed_image)
+    preprocessed_image, path = preprocess_image_with_path(
+        image_bytes, config, chain=chain
+    )
+
+    # OCRは1回だけ行い、テキストと配置の両方に使う
+    ocr_result = OcrResult.from_arrays(
+        chain.run_arrays(
+            "ocr",
+            engine.cache_params(config),
+            lambda: engine.recognize(preprocessed_image, config).to_arrays(),
+        )
+    )
 
     # レシートから合計を取得
-    total = extract_total_amount(text)
-
-    return {"amount": total, "text": text}
+    total = extract_total_amount(ocr_result)
+
+    # レシートの先頭の行から店名を探す
+    store_index = store_index or default_store_index()
+    store = store_index.match(ocr_result.lines()) if store_index else None
+
+    return {
+        "amount": total,
+        "text": ocr_result.to_text(),
+        "preprocessing": path.model_dump(),
+        "store": store.model_dump() if store else None,
+    }
@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -11,6 +14,123 @@ class Settings(BaseSettings):
     aws_default_region: str
     openai_api_key: str
 
+    # APIサーバー（python -m api.server で起動する場合）
+    # workers は 0 の場合CPUコア数にする。reload は開発時のみ使う（workers は1になる）
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    server_workers: int = 0
+    server_reload: bool = False
+    # ロードバランサーのアイドルタイムアウト（ALBは60秒）より長くし、接続を使い回す
+    server_keep_alive: int = 65
+    server_backlog: int = 2048
+    # 停止時に処理中のリクエスト（OpenAIの呼び出しを含む）を待つ最大秒数
+    server_graceful_shutdown: int = 60
+    # ワーカーの起動時にSDKを読み込み、初回のリクエストが遅くならないようにする
+    server_preload: bool = False
+
+    # ログ
+    # text: 人が読む形式、json: 1行1件のJSON
+    log_format: Literal["text", "json"] = "text"
+    # 書き込み待ちのログの上限。一杯の場合 drop は破棄し、block は空くまで待つ
+    log_queue_size: int = 10000
+    log_queue_policy: Literal["drop", "block"] = "drop"
+    # 解析結果など件数の多いINFOログを残す割合（0.0〜1.0）
+    log_sample_rate: float = 1.0
+
+    # リクエストごとの処理時間・トークン数・推定コストを記録する監査ログ（未設定の場合は記録しない）
+    audit_log_path: Path | None = Path("logs/audit.jsonl")
+
+    # サーキットブレーカー（S3, OpenAIそれぞれに適用）
+    circuit_breaker_failure_rate_threshold: float = 0.5
+    circuit_breaker_slow_call_duration: float = 10.0
+    circuit_breaker_slow_call_rate_threshold: float = 1.0
+    circuit_breaker_window_size: int = 20
+    circuit_breaker_minimum_calls: int = 5
+    circuit_breaker_open_duration: float = 30.0
+    circuit_breaker_half_open_max_calls: int = 1
+
+    # OpenAIへの画像の渡し方
+    # inline: S3からダウンロードしてBase64で送る
+    # presigned_url: S3の署名付きURLを送り、OpenAIに直接取得させる（取得できない場合は inline で送り直す）
+    image_delivery: Literal["inline", "presigned_url"] = "inline"
+    presigned_url_expires_in: int = 300
+
+    # 複数画像をまとめてOpenAIに送る際の1リクエストあたりの最大枚数
+    openai_pack_size: int = 4
+
+    # 画像の難しさに応じて detail（low/high）とモデルを選び、検証に失敗した場合は上位の設定で解析し直す
+    image_routing: bool = False
+    # detail: low で送る画像の、512px に縮小した際の縮小率の下限（小さいと文字が潰れる）
+    routing_low_detail_min_scale: float = 0.45
+    # detail: low で送る画像の、文字とみなした画素の割合の上限
+    routing_max_text_density: float = 0.2
+    # これよりラプラシアンの分散が小さい（ぼけている）画像は、最初から上位のモデルで解析する
+    routing_blur_threshold: float = 100.0
+
+    # 同じレシートを撮り直した画像の検出（知覚ハッシュのハミング距離で判定する）
+    # none: 検出しない
+    # flag: 検出した場合は警告ログを出し、解析は行う
+    # reuse: 画像の内容（SHA-256）まで一致する場合は解析せずに前回の結果を返す。
+    #        知覚ハッシュだけが近い場合（同じチェーンの別のレシートなど）は flag と同じ
+    duplicate_detection: Literal["none", "flag", "reuse"] = "none"
+    duplicate_max_distance: int = 8
+    duplicate_index_max_entries: int = 100_000
+
+    # 画像の縦横のピクセル数の上限（展開するとメモリを使い切る画像を拒否する）
+    image_max_pixels: int = 36_000_000
+
+    # scan_receipt（Tesseract によるOCR）の前処理の設定ファイル（scripts.tune_ocr の推奨設定）
+    # 未設定またはファイルがない場合は、デフォルトの設定を使う
+    ocr_preprocess_config_path: Path | None = Path("data/ocr_config.json")
+    # OCRを複数プロセスで並列に実行する際の、プロセスごとのスレッド数（OMP_THREAD_LIMIT・cv2.setNumThreads）
+    # プロセス数（0 の場合は使えるコア数 // スレッド数）と、プロセスごとにコアを固定するか
+    ocr_threads: int = 1
+    ocr_jobs: int = 0
+    ocr_cpu_affinity: bool = False
+
+    # scan_receipt のOCRエンジン
+    # tesseract: Tesseract（pytesseract）
+    # onnx: ONNX Runtime（CPU）の文字検出・文字認識モデル（PaddleOCR 形式、`onnxruntime` パッケージが必要）
+    #   スレッド数（intra-op）は ocr_threads を使う
+    ocr_engine: Literal["tesseract", "onnx"] = "tesseract"
+    ocr_onnx_det_model_path: Path = Path("models/ocr/det.onnx")
+    ocr_onnx_rec_model_path: Path = Path("models/ocr/rec.onnx")
+    ocr_onnx_dict_path: Path = Path("models/ocr/dict.txt")
+    ocr_onnx_rec_batch_size: int = 8
+
+    # 過去の解析結果から作った店名の辞書（scripts.build_store_index）。ファイルがない場合は使わない
+    # scan_receipt はレシートの先頭の行から店名を探し、信頼度がこれ以上の店を返す
+    store_index_path: Path | None = Path("data/store_index.json")
+    store_index_min_confidence: float = 0.8
+
+    # S3からダウンロードした画像のキャッシュ（ETagで再検証する）
+    # メモリの上限（0で無効）と、任意でディスクの保存先・上限
+    s3_object_cache_max_bytes: int = 64 * 1024 * 1024
+    s3_object_cache_dir: Path | None = None
+    s3_object_cache_disk_max_bytes: int = 1024 * 1024 * 1024
+
+    # 非同期ジョブ
+    job_store: Literal["memory", "sqlite"] = "memory"
+    job_store_path: Path = Path("data/jobs.sqlite3")
+    job_workers: int = 4
+    job_queue_size: int = 100
+    job_callback_timeout: float = 5.0
+    # コールバックURLに指定できるホスト（例: ["hooks.example.com"]）。空の場合は、
+    # 名前解決したアドレスがプライベート・ループバック・リンクローカルなどではないURLだけを許可する
+    job_callback_allowed_hosts: list[str] = []
+    # 処理中のジョブのリースの秒数。延長されないまま過ぎたジョブ（処理中にプロセスが終了したもの）を失敗にする
+    job_lease_seconds: float = 60.0
+
+    # 解析結果のキャッシュ（同じ画像の解析結果を再利用する）
+    # none: キャッシュしない
+    # memory: プロセス内のメモリ
+    # sqlite: SQLiteファイル（同じホストのワーカー間で共有）
+    # redis: Redisプロトコルのサーバー（複数Pod間で共有、`redis` パッケージが必要）
+    result_cache: Literal["none", "memory", "sqlite", "redis"] = "none"
+    result_cache_path: Path = Path("data/results.sqlite3")
+    result_cache_redis_url: str = "redis://localhost:6379/0"
+    result_cache_ttl: float = 24 * 60 * 60
+
 
 # NOTE: 自動的に.envから環境変数を読み込むため、Settingの引数は必要ない
 setting = Settings()  # type: ignore
@@ -0,0 +1,56 @@
+"""同じキーの処理が同時に実行された場合に、1回の実行結果を共有する"""
+
+import threading
+from concurrent.futures import Future
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """キーごとに実行中の処理を1つにまとめる
+
+    同じキーで実行中の処理がある間に呼ばれた場合は、新たに実行せずにその処理の結果（または例外）を待って返す。
+    処理が終わるとキーは解放されるため、結果はキャッシュしない。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future[T]] = {}
+
+    def do(self, key: str, func: Callable[[], T]) -> T:
+        """キーに対応する処理を実行する、または実行中の処理の結果を待つ
+
+        Args:
+            key (str): 同一の処理とみなすキー
+            func (Callable[[], T]): 実行する処理
+
+        Returns:
+            T: 処理の結果
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if future is None:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def in_flight(self) -> int:
+        """実行中の処理の数を返す"""
+        with self._lock:
+            return len(self._in_flight)
@@ -0,0 +1,200 @@
+"""前処理の段階ごとの出力（NumPy配列）をディスクに保持する、内容アドレスのキャッシュ
+
+前処理のパラメーターを調整する際に、画像ごと・パラメーターの組み合わせごとに
+読み込み・グレースケール化・ノイズ除去・OCRを全てやり直さないようにする。
+各段階のキーは、前の段階のキー・段階名・パラメーターのハッシュから作るため、
+あるパラメーターを変えると、その段階より後の段階だけが計算し直される。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 段階の出力（名前付きの配列。OCR結果の列など）
+Arrays = dict[str, np.ndarray]
+# 画像など1つの配列を出力する段階の、配列の名前
+SINGLE_ARRAY = "__array__"
+
+
+def image_key(img_bytes: bytes) -> str:
+    """画像のバイトデータのハッシュ（最初の段階のキー）を返す"""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def stage_key(parent_key: str, stage: str, params: dict) -> str:
+    """前の段階のキー・段階名・パラメーターから、この段階のキーを作る"""
+    payload = json.dumps([parent_key, stage, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """段階ごとの出力を1ファイルずつ保存し、合計サイズが max_bytes を超えたら最後に使った時刻が古いものから削除する
+
+    出力は名前付きの配列で、SINGLE_ARRAY の1つだけの場合は .npy で保存し、memory-map で読み込む
+    （ページに触れるまでディスクから読まない）。compress が True の場合と、それ以外の出力は .npz で保存する
+    （compress の場合は圧縮する）。
+
+    Args:
+        cache_dir (Path): 保存先ディレクトリ
+        max_bytes (int): ディスクに保持する合計バイト数の上限
+        compress (bool): 圧縮して保存する（ディスクを節約する代わりに読み書きが遅くなる）
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int = 1024 * 1024 * 1024,
+        compress: bool = False,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._lock = threading.Lock()
+        # ファイル名 -> サイズ（最後に使った時刻が古い順）
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Arrays]) -> Arrays:
+        """キャッシュした出力を返す。ない場合は計算して保存する"""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def get(self, key: str) -> Arrays | None:
+        """キャッシュした出力を取得する。ない場合は None を返す"""
+        with self._lock:
+            name = next(
+                (name for name in self._names(key) if name in self._files), None
+            )
+            if name is None:
+                self._misses += 1
+                return None
+            self._files.move_to_end(name)
+            self._hits += 1
+        fp = self.cache_dir / name
+        try:
+            if name.endswith(".npy"):
+                value = {SINGLE_ARRAY: np.load(fp, mmap_mode="r", allow_pickle=False)}
+            else:
+                with np.load(fp, allow_pickle=False) as npz:
+                    value = {k: npz[k] for k in npz.files}
+            os.utime(fp)
+        except (OSError, ValueError) as e:
+            logger.warning(f"前処理のキャッシュを読み込めませんでした: {name} {e}")
+            with self._lock:
+                self._discard(name)
+            return None
+        return value
+
+    def put(self, key: str, value: Arrays) -> None:
+        """出力を保存する"""
+        single = not self.compress and list(value) == [SINGLE_ARRAY]
+        name = f"{key}.npy" if single else f"{key}.npz"
+        tmp_fp = self.cache_dir / f"{name}.{threading.get_ident()}.tmp"
+        try:
+            # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+            with open(tmp_fp, "wb") as f:
+                if single:
+                    np.save(f, value[SINGLE_ARRAY], allow_pickle=False)
+                elif self.compress:
+                    np.savez_compressed(f, allow_pickle=False, **value)
+                else:
+                    np.savez(f, allow_pickle=False, **value)
+            size = tmp_fp.stat().st_size
+            os.replace(tmp_fp, self.cache_dir / name)
+        except OSError as e:
+            logger.warning(f"前処理のキャッシュを保存できませんでした: {name} {e}")
+            return
+        with self._lock:
+            self._bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                evicted = next(iter(self._files))
+                self._discard(evicted)
+
+    def clear(self) -> None:
+        """キャッシュを全て削除する"""
+        with self._lock:
+            for name in list(self._files):
+                self._discard(name)
+            self._hits = 0
+            self._misses = 0
+
+    def snapshot(self) -> dict:
+        """現在の使用量と、ヒットした回数を返す"""
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def _names(self, key: str) -> tuple[str, str]:
+        return f"{key}.npy", f"{key}.npz"
+
+    def _load_index(self) -> None:
+        entries = [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file() and entry.name.endswith((".npy", ".npz"))
+        ]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            size = entry.stat().st_size
+            self._files[entry.name] = size
+            self._bytes += size
+
+    def _discard(self, name: str) -> None:
+        self._bytes -= self._files.pop(name, 0)
+        try:
+            os.remove(self.cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+
+class StageChain:
+    """1枚の画像の前処理の段階を順に実行し、段階ごとの出力をキャッシュする
+
+    cache が None の場合はキャッシュせずに実行する。
+
+    Args:
+        cache (StageCache | None): 使用するキャッシュ
+        img_bytes (bytes): 画像のバイトデータ
+    """
+
+    def __init__(self, cache: StageCache | None, img_bytes: bytes) -> None:
+        self.cache = cache
+        self.key = image_key(img_bytes) if cache is not None else ""
+
+    def run(
+        self, stage: str, params: dict, compute: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """1つの配列を出力する段階を実行し、出力を返す"""
+        return self.run_arrays(stage, params, lambda: {SINGLE_ARRAY: compute()})[
+            SINGLE_ARRAY
+        ]
+
+    def run_arrays(
+        self, stage: str, params: dict, compute: Callable[[], Arrays]
+    ) -> Arrays:
+        """段階を実行し、出力を返す。同じ画像・同じ前の段階・同じパラメーターの出力がある場合は再利用する"""
+        if self.cache is None:
+            return compute()
+        self.key = stage_key(self.key, stage, params)
+        return self.cache.get_or_compute(self.key, compute)
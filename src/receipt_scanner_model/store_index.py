@@ -0,0 +1,296 @@
+"""過去の解析結果（ReceiptDetail）から作る店名の辞書と、OCRのテキストとのあいまい一致
+
+店名の表記ゆれ（全角・半角、大文字・小文字、空白・記号、支店名、OCRで誤認識しやすい似た文字）を
+正規化したキーで店をまとめ、
+最も多い表記を正式な店名、最も多いカテゴリーをその店のカテゴリーとする。
+キーはトライ木（完全一致）と、文字の2-gramの転置インデックス（あいまい一致の候補）に登録し、
+レシートの先頭の行から店名を探す（1行あたり数十マイクロ秒）。
+"""
+
+import json
+import logging
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Iterable
+
+from pydantic import BaseModel
+
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+
+logger = logging.getLogger(__name__)
+
+# 店名を探すレシートの先頭の行数
+HEADER_LINES = 8
+# あいまい一致で、2-gram の何割が行に含まれる店を候補にするか（1文字の誤認識で最大2つの 2-gram が
+# 含まれなくなるため、2-gram が少ない短いキーは、2つを除いた残りが含まれていれば候補にする）
+MIN_NGRAM_CONTAINMENT = 0.5
+# あいまい一致で、編集距離を計算する候補の数
+FUZZY_CANDIDATES = 5
+# これ以上の長さのキーは、信頼度が min_confidence 未満でも1文字の誤認識を許容する
+# （「ローソン」の1文字違いは信頼度 0.75 になるため）
+MIN_ONE_EDIT_LENGTH = 4
+# これより短いキー（「OK」など）は、他の語の一部と一致しないよう、行の最初の語（空白まで）全体と
+# 一致する場合だけ完全一致とみなす（あいまい一致の対象にしない）
+MIN_SUBSTRING_LENGTH = 3
+# OCRで誤認識しやすい似た文字（NFKC・小文字にした後に置き換える）
+_LOOKALIKES = str.maketrans(
+    {"一": "ー", "―": "ー", "口": "ロ", "力": "カ", "工": "エ", "0": "o", "1": "l"}
+)
+# 支店名とみなす末尾の語（「渋谷店」など）
+_BRANCH_SUFFIXES = ("店", "号店", "支店", "本店")
+
+
+def normalize(text: str) -> str:
+    """比較用に正規化する（NFKC・小文字にして似た文字を揃え、文字と数字以外を除く）"""
+    return "".join(
+        char
+        for char in unicodedata.normalize("NFKC", text)
+        .casefold()
+        .translate(_LOOKALIKES)
+        if unicodedata.category(char)[0] in ("L", "N")
+    )
+
+
+def strip_branch(store_name: str) -> str:
+    """空白で区切られた末尾の支店名（「〜店」）を除く"""
+    words = unicodedata.normalize("NFKC", store_name).split()
+    while len(words) > 1 and words[-1].endswith(_BRANCH_SUFFIXES):
+        words.pop()
+    return " ".join(words)
+
+
+def ngrams(key: str) -> set[str]:
+    """文字の2-gram（1文字の場合はその文字）を返す"""
+    if len(key) < 2:
+        return {key} if key else set()
+    return {key[i : i + 2] for i in range(len(key) - 1)}
+
+
+def min_ngram_hits(n_grams: int) -> float:
+    """2-gram が n_grams 個のキーを、あいまい一致の候補にする、行に含まれる 2-gram の数の下限"""
+    return min(n_grams * MIN_NGRAM_CONTAINMENT, n_grams - 2)
+
+
+def substring_distance(pattern: str, text: str) -> int:
+    """pattern と、text のいずれかの部分文字列との編集距離の最小値を返す"""
+    previous = [0] * (len(text) + 1)
+    for i, char in enumerate(pattern, 1):
+        current = [i] + [0] * len(text)
+        for j, text_char in enumerate(text, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char != text_char),
+            )
+        previous = current
+    return min(previous)
+
+
+class StoreEntry(BaseModel):
+    # 正式な店名（最も多い表記）と、最も多いカテゴリー
+    name: str
+    category: str | None
+    # 過去の解析結果での出現回数
+    count: int
+
+
+class StoreMatch(BaseModel):
+    store_name: str
+    category: str | None
+    # 1.0 は正規化したキーが行に含まれる場合。あいまい一致の場合は 1 - 編集距離 / キーの長さ
+    confidence: float
+    # 一致したOCRの行
+    line: str
+
+
+class StoreIndex:
+    """店名の辞書。トライ木で完全一致を、2-gram の転置インデックスと編集距離であいまい一致を探す
+
+    Args:
+        entries (list[StoreEntry]): 店の一覧
+        min_confidence (float): あいまい一致とみなす信頼度の下限
+    """
+
+    def __init__(self, entries: list[StoreEntry], min_confidence: float = 0.8) -> None:
+        self.min_confidence = min_confidence
+        self.entries: list[StoreEntry] = []
+        self._keys: list[str] = []
+        # トライ木（ノードごとの 文字 -> 子ノード と、キーの終端のノードの店の番号）
+        self._children: list[dict[str, int]] = [{}]
+        self._terminals: dict[int, int] = {}
+        # 2-gram -> 店の番号と、店ごとの 2-gram の数
+        self._postings: dict[str, list[int]] = {}
+        self._ngram_counts: list[int] = []
+        # 同じキーの場合は出現回数の多い店を優先する
+        for entry in sorted(entries, key=lambda entry: -entry.count):
+            self._add(entry)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def from_details(
+        cls,
+        details: Iterable[ReceiptDetail],
+        min_count: int = 1,
+        min_confidence: float = 0.8,
+    ) -> "StoreIndex":
+        """過去の解析結果から作成する（出現回数が min_count 未満の店は含めない）"""
+        names: dict[str, Counter[str]] = {}
+        categories: dict[str, Counter[str]] = {}
+        for detail in details:
+            if not detail.store_name:
+                continue
+            name = strip_branch(detail.store_name)
+            key = normalize(name)
+            if not key:
+                continue
+            names.setdefault(key, Counter())[name] += 1
+            if detail.category:
+                categories.setdefault(key, Counter())[detail.category] += 1
+        entries = []
+        for key, counter in names.items():
+            count = sum(counter.values())
+            if count < min_count:
+                continue
+            category = categories.get(key)
+            entries.append(
+                StoreEntry(
+                    name=counter.most_common(1)[0][0],
+                    category=category.most_common(1)[0][0] if category else None,
+                    count=count,
+                )
+            )
+        return cls(entries, min_confidence)
+
+    @classmethod
+    def load(cls, fp: Path, min_confidence: float = 0.8) -> "StoreIndex":
+        """save で保存したファイルから読み込む"""
+        with open(fp, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls([StoreEntry(**entry) for entry in data["stores"]], min_confidence)
+
+    def save(self, fp: Path) -> None:
+        """店の一覧を保存する（トライ木・転置インデックスは読み込み時に作り直す）"""
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        with open(fp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"stores": [entry.model_dump() for entry in self.entries]},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+    def match(self, lines: Iterable[str]) -> StoreMatch | None:
+        """レシートの先頭 HEADER_LINES 行から、最も信頼度の高い店を返す。ない場合は None を返す"""
+        best: StoreMatch | None = None
+        header = [line for line in lines if line.strip()][:HEADER_LINES]
+        for line in header:
+            match = self.match_line(line)
+            if match is not None and (
+                best is None or match.confidence > best.confidence
+            ):
+                best = match
+                if best.confidence == 1.0:
+                    break
+        return best
+
+    def match_line(self, line: str) -> StoreMatch | None:
+        """1行から店を探す
+
+        正規化したキーが行に含まれる場合は、最も長いキーの店を信頼度 1.0 で返す。
+        含まれない場合は、2-gram が MIN_NGRAM_CONTAINMENT 以上含まれる店のうち、含まれる割合の高い
+        FUZZY_CANDIDATES 件について、行の部分文字列との編集距離から信頼度を計算する。
+        MIN_ONE_EDIT_LENGTH 以上の長さのキーは、1文字の誤認識を信頼度の下限に関わらず許容する。
+        """
+        text = normalize(line)
+        if not text:
+            return None
+        store_id = self._longest_match(text, len(normalize(line.split()[0])))
+        if store_id is not None:
+            return self._to_match(store_id, 1.0, line)
+
+        hits: Counter[int] = Counter()
+        for gram in ngrams(text):
+            for candidate in self._postings.get(gram, ()):
+                hits[candidate] += 1
+        candidates = sorted(
+            (
+                (count / self._ngram_counts[candidate], candidate)
+                for candidate, count in hits.items()
+                if count >= min_ngram_hits(self._ngram_counts[candidate])
+            ),
+            reverse=True,
+        )[:FUZZY_CANDIDATES]
+        best_id, best_confidence = None, 0.0
+        for _, candidate in candidates:
+            key = self._keys[candidate]
+            confidence = 1 - substring_distance(key, text) / len(key)
+            if confidence >= self._min_confidence(key) and confidence > best_confidence:
+                best_id, best_confidence = candidate, confidence
+        if best_id is None:
+            return None
+        return self._to_match(best_id, best_confidence, line)
+
+    def _min_confidence(self, key: str) -> float:
+        """キーの長さに応じた、あいまい一致とみなす信頼度の下限"""
+        if len(key) >= MIN_ONE_EDIT_LENGTH:
+            return min(self.min_confidence, 1 - 1 / len(key))
+        return self.min_confidence
+
+    def _add(self, entry: StoreEntry) -> None:
+        key = normalize(entry.name)
+        node = 0
+        for char in key:
+            child = self._children[node].get(char)
+            if child is None:
+                child = len(self._children)
+                self._children[node][char] = child
+                self._children.append({})
+            node = child
+        if node in self._terminals:
+            return
+        store_id = len(self.entries)
+        self._terminals[node] = store_id
+        self.entries.append(entry)
+        self._keys.append(key)
+        # 短いキーは誤認識を許容すると他の語と一致しやすいため、あいまい一致の対象にしない
+        grams = ngrams(key) if len(key) >= MIN_SUBSTRING_LENGTH else set()
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(store_id)
+        self._ngram_counts.append(len(grams))
+
+    def _longest_match(self, text: str, first_word_length: int) -> int | None:
+        """text に含まれるキーのうち、最も長いものの店の番号を返す
+
+        MIN_SUBSTRING_LENGTH より短いキーは、行の最初の語（長さ first_word_length）全体と一致する場合だけ返す。
+        """
+        best_id, best_length = None, 0
+        for start in range(len(text)):
+            node = 0
+            for end in range(start, len(text)):
+                node = self._children[node].get(text[end], -1)
+                if node < 0:
+                    break
+                store_id = self._terminals.get(node)
+                length = end - start + 1
+                if (
+                    store_id is not None
+                    and best_length < length
+                    and (
+                        length >= MIN_SUBSTRING_LENGTH
+                        or (start == 0 and length == first_word_length)
+                    )
+                ):
+                    best_id, best_length = store_id, length
+        return best_id
+
+    def _to_match(self, store_id: int, confidence: float, line: str) -> StoreMatch:
+        entry = self.entries[store_id]
+        return StoreMatch(
+            store_name=entry.name,
+            category=entry.category,
+            confidence=confidence,
+            line=line,
+        )
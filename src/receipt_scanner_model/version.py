@@ -0,0 +1,41 @@
+"""アプリケーションのバージョン
+
+Dockerイメージのビルド時に _version.py を生成し、起動時に pyproject.toml を読まずに済むようにする。
+生成していない場合（ローカルでの開発時）は、リポジトリの pyproject.toml から読み込む。
+
+    python -m src.receipt_scanner_model.version
+"""
+
+import importlib
+import tomllib
+from pathlib import Path
+
+PYPROJECT_FP = Path(__file__).resolve().parents[2] / "pyproject.toml"
+VERSION_MODULE_FP = Path(__file__).with_name("_version.py")
+
+
+def read_pyproject_version(pyproject_fp: Path = PYPROJECT_FP) -> str:
+    """pyproject.toml からバージョンを読み込む"""
+    with open(pyproject_fp, "rb") as f:
+        return tomllib.load(f)["project"]["version"]
+
+
+def get_version() -> str:
+    """ビルド時に生成したバージョン、なければ pyproject.toml のバージョンを返す"""
+    # _version.py はビルド時だけ生成するため、型チェックで解決できないよう文字列で読み込む
+    try:
+        module = importlib.import_module("src.receipt_scanner_model._version")
+    except ImportError:
+        return read_pyproject_version()
+    return module.__version__
+
+
+def write_version_module(version_module_fp: Path = VERSION_MODULE_FP) -> str:
+    """pyproject.toml のバージョンを _version.py に書き出す（ビルド時に実行する）"""
+    version = read_pyproject_version()
+    version_module_fp.write_text(f'__version__ = "{version}"\n', encoding="utf-8")
+    return version
+
+
+if __name__ == "__main__":
+    print(write_version_module())
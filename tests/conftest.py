@@ -0,0 +1,55 @@
+import pytest
+
+from src.receipt_scanner_model.circuit_breaker import (
+    s3_circuit_breaker,
+    openai_circuit_breaker,
+)
+from src.receipt_scanner_model.analyze import duplicate_index
+from src.receipt_scanner_model.audit import audit_log
+from src.receipt_scanner_model.metrics import prompt_cache_metrics, routing_metrics
+from src.receipt_scanner_model.s3_object_cache import s3_object_cache
+
+
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers():
+    """テスト間でサーキットブレーカーの状態が持ち越されないようにする"""
+    s3_circuit_breaker.reset()
+    openai_circuit_breaker.reset()
+    yield
+    s3_circuit_breaker.reset()
+    openai_circuit_breaker.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """テスト間でメトリクスの集計が持ち越されないようにする"""
+    prompt_cache_metrics.reset()
+    routing_metrics.reset()
+    yield
+    prompt_cache_metrics.reset()
+    routing_metrics.reset()
+
+
+@pytest.fixture(autouse=True)
+def clear_s3_object_cache():
+    """テスト間でS3オブジェクトのキャッシュが持ち越されないようにする"""
+    s3_object_cache.clear()
+    yield
+    s3_object_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_duplicate_index():
+    """テスト間で知覚ハッシュのインデックスが持ち越されないようにする"""
+    duplicate_index.clear()
+    yield
+    duplicate_index.clear()
+
+
+@pytest.fixture(autouse=True)
+def audit_log_fp(tmp_path, monkeypatch):
+    """テスト中の監査ログは一時ディレクトリに書き込む"""
+    fp = tmp_path / "audit.jsonl"
+    monkeypatch.setattr(audit_log, "fp", fp)
+    yield audit_log.path
+    audit_log.flush()
@@ -0,0 +1,16 @@
+from scripts.profile_startup import HEAVY_MODULES, profile_import
+
+
+def test_import_does_not_load_heavy_modules():
+    """api.main の読み込み時に、初回のリクエストまで不要なSDKを読み込まないこと"""
+    _, _, loaded = profile_import("api.main")
+
+    assert {"openai", "boto3", "cv2"} <= set(HEAVY_MODULES)
+    assert loaded == []
+
+
+def test_profile_import_detects_heavy_modules():
+    """SDKを読み込むモジュールでは、読み込まれたSDKを検出できること"""
+    _, _, loaded = profile_import("src.receipt_scanner_model.scan_receipt")
+
+    assert "cv2" in loaded
@@ -2,7 +2,13 @@ from fastapi.testclient import TestClient
 from pytest_mock import MockFixture
 import pytest
 
-from api.main import app, S3Client, handle_receipt_exception
+from api.main import (
+    app,
+    S3Client,
+    handle_receipt_exception,
+    job_runner,
+    receipt_single_flight,
+)
 from src.receipt_scanner_model.error import (
     S3BadRequest,
     S3NotFound,
@@ -10,7 +16,15 @@ from src.receipt_scanner_model.error import (
     S3ServiceUnavailable,
     S3InternalServerError,
     S3UnexpectedError,
+    JobQueueFull,
+    OpenAIServiceUnavailable,
+    OpenAIImageUrlError,
 )
+from src.receipt_scanner_model.audit import audit_log, record_openai
+from openai.types import CompletionUsage
+import json
+import threading
+import time
 import tomllib
 
 TEST_FILE_NAME = "test.png"
@@ -66,7 +80,9 @@ def test_receipt_analyze_success(client: TestClient, mocker: MockFixture):
     }
 
     mock_s3_client.assert_called_once_with(TEST_FILE_NAME)
-    mock_get_receipt_detail.assert_called_once_with(MOCK_IMAGE_BYTES, test_file_type)
+    mock_get_receipt_detail.assert_called_once_with(
+        MOCK_IMAGE_BYTES, test_file_type, ""
+    )
 
 
 def test_receipt_analyze_with_extra_fields(client: TestClient, mocker: MockFixture):
@@ -452,3 +468,583 @@ class TestHandleReceiptException:
             result.detail
             == "レシート解析中にエラーが起きました。しばらくしてから再度お試しください。問題が継続する場合は、サポートまでお問い合わせください"
         )
+
+
+def test_circuit_breakers(client: TestClient):
+    """サーキットブレーカーの状態を確認するテスト"""
+    response = client.get("/circuit-breakers")
+
+    assert response.status_code == 200
+    assert [breaker["name"] for breaker in response.json()] == ["s3", "openai"]
+    assert all(breaker["state"] == "closed" for breaker in response.json())
+
+
+class TestReceiptAnalyzeJobs:
+    """
+    非同期ジョブAPIのテスト
+    """
+
+    def wait_for_finish(self, client: TestClient, job_id: str) -> dict:
+        for _ in range(500):
+            job = client.get(f"/jobs/{job_id}").json()
+            if job["status"] in ("succeeded", "failed"):
+                return job
+            time.sleep(0.01)
+        raise TimeoutError(job_id)
+
+    def test_submit_and_poll(self, client: TestClient, mocker: MockFixture):
+        """ジョブを登録し、結果を取得できること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mocker.patch(
+            "api.main.get_receipt_detail",
+            return_value={
+                "store_name": "テストストア",
+                "amount": 1000,
+                "date": "2024/01/01",
+                "category": "食費",
+            },
+        )
+
+        response = client.post(
+            "/receipt-analyze/jobs", json={"filename": TEST_FILE_NAME}
+        )
+        assert response.status_code == 202
+        assert response.json()["status"] == "queued"
+
+        job = self.wait_for_finish(client, response.json()["job_id"])
+        assert job["status"] == "succeeded"
+        assert job["result"] == {
+            "store_name": "テストストア",
+            "amount": 1000,
+            "date": "2024/01/01",
+            "category": "食費",
+        }
+
+    def test_job_failure(self, client: TestClient, mocker: MockFixture):
+        """ジョブのエラーが同期APIと同じ形式で返ること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            side_effect=S3NotFound(404, "Not found"),
+        )
+
+        response = client.post(
+            "/receipt-analyze/jobs", json={"filename": TEST_FILE_NAME}
+        )
+        job = self.wait_for_finish(client, response.json()["job_id"])
+
+        assert job["status"] == "failed"
+        assert job["error"] == {
+            "status_code": 400,
+            "detail": "レシート解析中にエラーが起きました。再度レシートをアップロードしてください。",
+        }
+
+    def test_queue_full(self, client: TestClient, mocker: MockFixture):
+        """キューが満杯の場合503を返すこと"""
+        mocker.patch.object(
+            job_runner, "submit", side_effect=JobQueueFull(503, "queue full")
+        )
+
+        response = client.post(
+            "/receipt-analyze/jobs", json={"filename": TEST_FILE_NAME}
+        )
+
+        assert response.status_code == 503
+
+    def test_invalid_callback_url(self, client: TestClient):
+        """コールバックURLが不正な場合422を返すこと"""
+        response = client.post(
+            "/receipt-analyze/jobs",
+            json={"filename": TEST_FILE_NAME, "callback_url": "not-a-url"},
+        )
+
+        assert response.status_code == 422
+
+    def test_internal_callback_url(self, client: TestClient, mocker: MockFixture):
+        """内部のアドレスを指すコールバックURLの場合422を返すこと"""
+        mocker.patch(
+            "src.receipt_scanner_model.jobs.socket.getaddrinfo",
+            return_value=[(2, 1, 6, "", ("169.254.169.254", 80))],
+        )
+
+        response = client.post(
+            "/receipt-analyze/jobs",
+            json={
+                "filename": TEST_FILE_NAME,
+                "callback_url": "http://metadata.example/latest/meta-data",
+            },
+        )
+
+        assert response.status_code == 422
+        assert (
+            response.json()["detail"] == "指定されたコールバックURLは使用できません。"
+        )
+
+    def test_job_not_found(self, client: TestClient):
+        """存在しないジョブは404を返すこと"""
+        response = client.get("/jobs/missing")
+
+        assert response.status_code == 404
+        assert response.json()["detail"] == "指定されたジョブが存在しません。"
+
+
+class TestReceiptAnalyzeStream:
+    """
+    SSEでのレシート解析のテスト
+    """
+
+    def test_stream_success(self, client: TestClient, mocker: MockFixture):
+        """確定した項目から順にイベントが返ること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mock_stream = mocker.patch(
+            "api.main.stream_receipt_detail",
+            return_value=iter(
+                [
+                    {"event": "field", "data": {"store_name": "テストストア"}},
+                    {"event": "field", "data": {"amount": 1000}},
+                    {
+                        "event": "done",
+                        "data": {
+                            "store_name": "テストストア",
+                            "amount": 1000,
+                            "date": None,
+                            "category": None,
+                        },
+                    },
+                ]
+            ),
+        )
+
+        response = client.post(
+            "/receipt-analyze/stream", json={"filename": TEST_FILE_NAME}
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text == (
+            'event: field\ndata: {"store_name": "テストストア"}\n\n'
+            'event: field\ndata: {"amount": 1000}\n\n'
+            'event: done\ndata: {"store_name": "テストストア", "amount": 1000, '
+            '"date": null, "category": null}\n\n'
+        )
+        mock_stream.assert_called_once_with(MOCK_IMAGE_BYTES, "image/png")
+
+    def test_stream_s3_error(self, client: TestClient, mocker: MockFixture):
+        """ストリーム開始前のエラーは通常のHTTPエラーで返ること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            side_effect=S3NotFound(404, "Not found"),
+        )
+
+        response = client.post(
+            "/receipt-analyze/stream", json={"filename": TEST_FILE_NAME}
+        )
+
+        assert response.status_code == 400
+
+    def test_stream_openai_error(self, client: TestClient, mocker: MockFixture):
+        """ストリーム中のエラーはerrorイベントで返ること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+
+        def events():
+            yield {"event": "field", "data": {"store_name": "テストストア"}}
+            raise OpenAIServiceUnavailable(503, "unavailable")
+
+        mocker.patch("api.main.stream_receipt_detail", return_value=events())
+
+        response = client.post(
+            "/receipt-analyze/stream", json={"filename": TEST_FILE_NAME}
+        )
+
+        assert response.status_code == 200
+        assert response.text.endswith(
+            'event: error\ndata: {"status_code": 503, "detail": '
+            '"レシート解析中にエラーが起きました。しばらくしてから再度お試しください。"}\n\n'
+        )
+
+
+def test_metrics(client: TestClient):
+    """メトリクスを確認するテスト"""
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.json()["prompt_cache"] == {
+        "requests": 0,
+        "prompt_tokens": 0,
+        "cached_tokens": 0,
+        "cached_token_ratio": 0.0,
+    }
+    assert response.json()["s3_object_cache"] == {
+        "memory_objects": 0,
+        "memory_bytes": 0,
+        "disk_objects": 0,
+        "disk_bytes": 0,
+    }
+
+
+class TestAuditLog:
+    """
+    監査ログのテスト
+    """
+
+    USAGE = CompletionUsage(prompt_tokens=1000, completion_tokens=20, total_tokens=1020)
+
+    def read_lines(self, audit_log_fp) -> list[dict]:
+        audit_log.flush()
+        with open(audit_log_fp, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_receipt_analyze(
+        self, client: TestClient, mocker: MockFixture, audit_log_fp
+    ):
+        """1リクエストにつき1行、OpenAIのトークン数とともに記録すること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+
+        def get_receipt_detail(image_bytes, content_type, scope):
+            record_openai(0.5, self.USAGE, "gpt-4o-mini")
+            return {
+                "store_name": "テストストア",
+                "amount": 1000,
+                "date": None,
+                "category": None,
+            }
+
+        mocker.patch("api.main.get_receipt_detail", side_effect=get_receipt_detail)
+
+        client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        (line,) = self.read_lines(audit_log_fp)
+        assert line["ep"] == "/receipt-analyze"
+        assert line["file"] == TEST_FILE_NAME
+        assert line["status"] == 200
+        assert line["in"] == 1000
+        assert line["out"] == 20
+        assert line["usd"] > 0
+
+    def test_receipt_analyze_error(
+        self, client: TestClient, mocker: MockFixture, audit_log_fp
+    ):
+        """エラーの場合はレスポンスと同じステータスを記録すること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            side_effect=S3NotFound(404, "Not found"),
+        )
+
+        client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        (line,) = self.read_lines(audit_log_fp)
+        assert line["status"] == 400
+
+    def test_stream(self, client: TestClient, mocker: MockFixture, audit_log_fp):
+        """ストリーム中のOpenAIの呼び出しも同じ行に記録すること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+
+        def events():
+            yield {"event": "field", "data": {"store_name": "テストストア"}}
+            record_openai(0.5, self.USAGE, "gpt-4o-mini")
+            yield {"event": "done", "data": {"store_name": "テストストア"}}
+
+        mocker.patch("api.main.stream_receipt_detail", return_value=events())
+
+        client.post("/receipt-analyze/stream", json={"filename": TEST_FILE_NAME})
+
+        (line,) = self.read_lines(audit_log_fp)
+        assert line["ep"] == "/receipt-analyze/stream"
+        assert line["status"] == 200
+        assert line["in"] == 1000
+
+
+class TestReceiptAnalyzeBatch:
+    """
+    複数レシートのまとめて解析のテスト
+    """
+
+    def test_batch_success_with_partial_errors(
+        self, client: TestClient, mocker: MockFixture
+    ):
+        """ダウンロードに失敗したファイルはerrorに入り、他は解析されること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            side_effect=[
+                (b"image-a", "image/png"),
+                S3NotFound(404, "Not found"),
+                (b"image-c", "image/jpeg"),
+            ],
+        )
+        receipt_detail = {
+            "store_name": "テストストア",
+            "amount": 1000,
+            "date": "2024/01/01",
+            "category": "食費",
+        }
+        mock_get_receipt_details = mocker.patch(
+            "api.main.get_receipt_details",
+            return_value=[receipt_detail, receipt_detail],
+        )
+
+        response = client.post(
+            "/receipt-analyze/batch",
+            json={"filenames": ["a.png", "b.png", "c.jpeg"]},
+        )
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {"filename": "a.png", "result": receipt_detail, "error": None},
+            {
+                "filename": "b.png",
+                "result": None,
+                "error": {
+                    "status_code": 400,
+                    "detail": "レシート解析中にエラーが起きました。再度レシートをアップロードしてください。",
+                },
+            },
+            {"filename": "c.jpeg", "result": receipt_detail, "error": None},
+        ]
+        mock_get_receipt_details.assert_called_once_with(
+            [(b"image-a", "image/png"), (b"image-c", "image/jpeg")]
+        )
+
+    def test_batch_openai_error(self, client: TestClient, mocker: MockFixture):
+        """OpenAIのエラーはダウンロード済みの全ファイルのerrorに入ること"""
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mocker.patch(
+            "api.main.get_receipt_details",
+            side_effect=OpenAIServiceUnavailable(503, "unavailable"),
+        )
+
+        response = client.post(
+            "/receipt-analyze/batch", json={"filenames": ["a.png", "b.png"]}
+        )
+
+        assert response.status_code == 200
+        assert [item["error"]["status_code"] for item in response.json()] == [503, 503]
+
+    @pytest.mark.parametrize(
+        "filenames", [[], ["../../../etc/passwd"], [TEST_FILE_NAME] * 21]
+    )
+    def test_batch_invalid_filenames(self, client: TestClient, filenames):
+        """ファイル名が不正、または件数が範囲外の場合422を返すこと"""
+        response = client.post("/receipt-analyze/batch", json={"filenames": filenames})
+
+        assert response.status_code == 422
+
+
+class TestPresignedUrlDelivery:
+    """
+    署名付きURLでOpenAIに画像を渡すモードのテスト
+    """
+
+    RECEIPT_DETAIL = {
+        "store_name": "テストストア",
+        "amount": 1000,
+        "date": "2024/01/01",
+        "category": "食費",
+    }
+
+    @pytest.fixture(autouse=True)
+    def presigned_url_mode(self, mocker: MockFixture):
+        mocker.patch("api.main.setting.image_delivery", "presigned_url")
+
+    def test_presigned_url(self, client: TestClient, mocker: MockFixture):
+        """署名付きURLを渡し、画像をダウンロードしないこと"""
+        mocker.patch.object(
+            S3Client,
+            "generate_presigned_image_url",
+            return_value=("https://example.com/url", "image/png"),
+        )
+        mock_download = mocker.patch.object(S3Client, "download_image_by_filename")
+        mock_get_by_url = mocker.patch(
+            "api.main.get_receipt_detail_by_url", return_value=self.RECEIPT_DETAIL
+        )
+
+        response = client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        assert response.status_code == 200
+        assert response.json() == self.RECEIPT_DETAIL
+        mock_get_by_url.assert_called_once_with("https://example.com/url")
+        mock_download.assert_not_called()
+
+    def test_fallback_to_inline(self, client: TestClient, mocker: MockFixture):
+        """OpenAIがURLを取得できない場合、画像をダウンロードして送り直すこと"""
+        mocker.patch.object(
+            S3Client,
+            "generate_presigned_image_url",
+            return_value=("https://example.com/url", "image/png"),
+        )
+        mocker.patch(
+            "api.main.get_receipt_detail_by_url",
+            side_effect=OpenAIImageUrlError(400, "invalid image url"),
+        )
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mock_get_receipt_detail = mocker.patch(
+            "api.main.get_receipt_detail", return_value=self.RECEIPT_DETAIL
+        )
+
+        response = client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        assert response.status_code == 200
+        mock_get_receipt_detail.assert_called_once_with(
+            MOCK_IMAGE_BYTES, "image/png", ""
+        )
+
+    def test_convertible_image_is_downloaded(
+        self, client: TestClient, mocker: MockFixture
+    ):
+        """変換が必要な画像（HEIC）は署名付きURLを渡さず、ダウンロードして送ること"""
+        mocker.patch.object(
+            S3Client,
+            "generate_presigned_image_url",
+            return_value=(None, "image/heic"),
+        )
+        mock_get_by_url = mocker.patch("api.main.get_receipt_detail_by_url")
+        mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/jpeg"),
+        )
+        mock_get_receipt_detail = mocker.patch(
+            "api.main.get_receipt_detail", return_value=self.RECEIPT_DETAIL
+        )
+
+        response = client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        assert response.status_code == 200
+        mock_get_by_url.assert_not_called()
+        mock_get_receipt_detail.assert_called_once_with(
+            MOCK_IMAGE_BYTES, "image/jpeg", ""
+        )
+
+    def test_invalid_metadata(self, client: TestClient, mocker: MockFixture):
+        """HEADでの検証に失敗した場合は400を返すこと"""
+        mocker.patch.object(
+            S3Client,
+            "generate_presigned_image_url",
+            side_effect=S3BadRequest(400, "bad request"),
+        )
+
+        response = client.post("/receipt-analyze", json={"filename": TEST_FILE_NAME})
+
+        assert response.status_code == 400
+
+
+class TestReceiptAnalyzeSingleFlight:
+    """
+    同じファイルの同時リクエストをまとめるテスト
+    """
+
+    RECEIPT_DETAIL = {
+        "store_name": "テストストア",
+        "amount": 1000,
+        "date": "2024/01/01",
+        "category": "食費",
+    }
+
+    def post_concurrently(self, client: TestClient, filenames: list[str]) -> list:
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda filename=filename: responses.append(
+                    client.post("/receipt-analyze", json={"filename": filename})
+                )
+            )
+            for filename in filenames
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def slow_get_receipt_detail(self, *args):
+        time.sleep(0.2)
+        return self.RECEIPT_DETAIL
+
+    def test_concurrent_identical_requests_call_upstream_once(
+        self, client: TestClient, mocker: MockFixture
+    ):
+        """同じファイルの同時リクエストでは、S3のダウンロードとOpenAIの呼び出しが1回になること"""
+        mock_download = mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mock_get_receipt_detail = mocker.patch(
+            "api.main.get_receipt_detail", side_effect=self.slow_get_receipt_detail
+        )
+
+        responses = self.post_concurrently(client, [TEST_FILE_NAME] * 8)
+
+        assert [response.status_code for response in responses] == [200] * 8
+        assert all(response.json() == self.RECEIPT_DETAIL for response in responses)
+        assert mock_download.call_count == 1
+        assert mock_get_receipt_detail.call_count == 1
+        assert receipt_single_flight.in_flight() == 0
+
+    def test_sequential_requests_are_analyzed_separately(
+        self, client: TestClient, mocker: MockFixture
+    ):
+        """解析が終わった後のリクエストは、結果を使い回さずに再度ダウンロード・解析すること"""
+        mock_download = mocker.patch.object(
+            S3Client,
+            "download_image_by_filename",
+            return_value=(MOCK_IMAGE_BYTES, "image/png"),
+        )
+        mock_get_receipt_detail = mocker.patch(
+            "api.main.get_receipt_detail", return_value=self.RECEIPT_DETAIL
+        )
+
+        for _ in range(2):
+            response = client.post(
+                "/receipt-analyze", json={"filename": TEST_FILE_NAME}
+            )
+            assert response.status_code == 200
+
+        assert mock_download.call_count == 2
+        assert mock_get_receipt_detail.call_count == 2
+
+    def test_error_is_shared(self, client: TestClient, mocker: MockFixture):
+        """まとめたリクエストは、解析のエラーも同じように返すこと"""
+
+        def slow_not_found(*args):
+            time.sleep(0.2)
+            raise S3NotFound(404, "Not Found")
+
+        mock_download = mocker.patch.object(
+            S3Client, "download_image_by_filename", side_effect=slow_not_found
+        )
+
+        responses = self.post_concurrently(client, [TEST_FILE_NAME] * 4)
+
+        assert [response.status_code for response in responses] == [400] * 4
+        assert mock_download.call_count == 1
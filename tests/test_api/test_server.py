@@ -0,0 +1,62 @@
+from pytest_mock import MockFixture
+
+from api.server import resolve_workers, server_options
+
+
+def test_resolve_workers(mocker: MockFixture):
+    mocker.patch("api.server.os.cpu_count", return_value=8)
+
+    assert resolve_workers(3) == 3
+    assert resolve_workers(0) == 8
+
+
+def test_server_options_production(mocker: MockFixture):
+    mocker.patch("api.server.setting.server_workers", 4)
+    mocker.patch("api.server.setting.server_reload", False)
+    mocker.patch("api.server.setting.job_store", "sqlite")
+
+    options = server_options()
+
+    assert options["workers"] == 4
+    assert options["loop"] == "uvloop"
+    assert options["http"] == "httptools"
+    assert options["timeout_keep_alive"] == 65
+    assert options["backlog"] == 2048
+    assert options["timeout_graceful_shutdown"] == 60
+    assert "reload" not in options
+
+
+def test_server_options_reload(mocker: MockFixture):
+    mocker.patch("api.server.setting.server_reload", True)
+
+    options = server_options()
+
+    assert options["reload"] is True
+    assert "workers" not in options
+
+
+def test_server_options_single_worker_with_in_memory_job_store(
+    mocker: MockFixture, caplog
+):
+    """JOB_STORE=memory の場合は、ジョブを共有できないため1ワーカーで起動すること"""
+    mocker.patch("api.server.setting.server_workers", 0)
+    mocker.patch("api.server.os.cpu_count", return_value=8)
+    mocker.patch("api.server.setting.server_reload", False)
+    mocker.patch("api.server.setting.job_store", "memory")
+
+    options = server_options()
+
+    assert options["workers"] == 1
+    assert "JOB_STORE=sqlite" in caplog.text
+
+
+def test_preload(mocker: MockFixture):
+    mock_s3_client = mocker.patch("api.main.S3Client")
+    mock_create_openai_client = mocker.patch("api.main.create_openai_client")
+
+    from api.main import preload
+
+    preload()
+
+    mock_s3_client.assert_called_once_with()
+    mock_create_openai_client.assert_called_once_with()
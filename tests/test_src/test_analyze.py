@@ -7,7 +7,11 @@ from src.receipt_scanner_model.error import (
     OpenAIUnexpectedError,
     OpenAIResponseFormatError,
 )
-from src.receipt_scanner_model.analyze import get_receipt_detail
+from src.receipt_scanner_model.analyze import duplicate_scope, get_receipt_detail
+from src.receipt_scanner_model.result_cache import (
+    InMemoryResultCacheBackend,
+    ResultCache,
+)
 
 TEST_IMAGE_BYTES = b"MockImageBytesForTesting"
 TEST_IMAGE_TYPE = "png"
@@ -25,9 +29,9 @@ def test_receipt_detail() -> ReceiptDetail:
 
 
 @pytest.fixture
-def mock_encode_image(mocker: MockFixture):
+def mock_encode_data_url(mocker: MockFixture):
     return mocker.patch(
-        "src.receipt_scanner_model.analyze.encode_image",
+        "src.receipt_scanner_model.analyze.encode_data_url",
         return_value=TEST_BASE64_IMAGE,
     )
 
@@ -41,7 +45,7 @@ def test_get_receipt_detail_success(
     mock_openai_handler,
     test_receipt_detail: ReceiptDetail,
 ):
-    mock_openai_handler.analyze_image.return_value = test_receipt_detail
+    mock_openai_handler.analyze_image_url.return_value = test_receipt_detail
 
     result = get_receipt_detail(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
 
@@ -51,6 +55,102 @@ def test_get_receipt_detail_success(
     assert result.category == test_receipt_detail.category
 
 
+def test_get_receipt_detail_with_image_routing(
+    mocker: MockFixture,
+    mock_openai_handler,
+    mock_encode_data_url,
+    test_receipt_detail: ReceiptDetail,
+):
+    """画像のルーティングを有効にした場合は、ルーティングして解析すること"""
+    mocker.patch("src.receipt_scanner_model.analyze.setting.image_routing", new=True)
+    mock_routing = mocker.patch(
+        "src.receipt_scanner_model.analyze.analyze_with_routing",
+        return_value=test_receipt_detail,
+    )
+
+    result = get_receipt_detail(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
+
+    assert result == test_receipt_detail
+    mock_routing.assert_called_once_with(
+        mock_openai_handler, TEST_IMAGE_BYTES, TEST_BASE64_IMAGE
+    )
+    mock_openai_handler.analyze_image_url.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "mode, second_bytes, expected_calls",
+    [
+        ("flag", b"first", 2),
+        ("reuse", b"first", 1),
+        # 知覚ハッシュが近くても内容が違う画像（同じチェーンの別のレシートなど）は解析する
+        ("reuse", b"second", 2),
+    ],
+)
+def test_get_receipt_detail_with_duplicate_detection(
+    mocker: MockFixture,
+    mock_openai_handler,
+    mock_encode_data_url,
+    test_receipt_detail: ReceiptDetail,
+    mode: str,
+    second_bytes: bytes,
+    expected_calls: int,
+):
+    """撮り直した同じレシートは、reuse で内容が一致する場合だけ解析せずに前回の結果を返すこと"""
+    mocker.patch(
+        "src.receipt_scanner_model.analyze.setting.duplicate_detection", new=mode
+    )
+    # 2枚の画像の知覚ハッシュは 1bit 違い
+    mocker.patch(
+        "src.receipt_scanner_model.analyze.perceptual_hash", side_effect=[0b10, 0b11]
+    )
+    mock_openai_handler.analyze_image_url.return_value = test_receipt_detail
+
+    first = get_receipt_detail(b"first", TEST_IMAGE_TYPE)
+    second = get_receipt_detail(second_bytes, TEST_IMAGE_TYPE)
+
+    assert first == second == test_receipt_detail
+    assert mock_openai_handler.analyze_image_url.call_count == expected_calls
+
+
+def test_get_receipt_detail_duplicate_detection_is_scoped(
+    mocker: MockFixture,
+    mock_openai_handler,
+    mock_encode_data_url,
+    test_receipt_detail: ReceiptDetail,
+):
+    """異なるプレフィックスの画像の解析結果は使い回さないこと"""
+    mocker.patch(
+        "src.receipt_scanner_model.analyze.setting.duplicate_detection", new="reuse"
+    )
+    mocker.patch("src.receipt_scanner_model.analyze.perceptual_hash", return_value=0)
+    mock_openai_handler.analyze_image_url.return_value = test_receipt_detail
+
+    get_receipt_detail(b"same", TEST_IMAGE_TYPE, duplicate_scope("user-a/1.png"))
+    get_receipt_detail(b"same", TEST_IMAGE_TYPE, duplicate_scope("user-b/1.png"))
+    get_receipt_detail(b"same", TEST_IMAGE_TYPE, duplicate_scope("user-a/2.png"))
+
+    assert mock_openai_handler.analyze_image_url.call_count == 2
+
+
+def test_get_receipt_detail_uses_result_cache(
+    mocker: MockFixture,
+    mock_openai_handler,
+    test_receipt_detail: ReceiptDetail,
+):
+    mocker.patch(
+        "src.receipt_scanner_model.analyze.result_cache",
+        ResultCache(InMemoryResultCacheBackend()),
+    )
+    mock_openai_handler.analyze_image_url.return_value = test_receipt_detail
+
+    first = get_receipt_detail(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
+    second = get_receipt_detail(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
+    get_receipt_detail(b"OtherImageBytes", TEST_IMAGE_TYPE)
+
+    assert first == second == test_receipt_detail
+    assert mock_openai_handler.analyze_image_url.call_count == 2
+
+
 @pytest.mark.parametrize(
     "exception, status_code, expected_message",
     [
@@ -82,7 +182,7 @@ def test_get_receipt_detail_error_handling(
     status_code,
     expected_message,
 ):
-    mock_openai_handler.analyze_image.side_effect = exception(
+    mock_openai_handler.analyze_image_url.side_effect = exception(
         status_code, expected_message
     )
 
@@ -91,3 +191,17 @@ def test_get_receipt_detail_error_handling(
 
     assert exc_info.value.code == status_code
     assert exc_info.value.message == expected_message
+
+
+def test_get_receipt_detail_passes_data_url(
+    mock_openai_handler,
+    mock_encode_data_url,
+    test_receipt_detail: ReceiptDetail,
+):
+    """画像をdata URLにしてOpenAIHandlerに渡すこと"""
+    mock_openai_handler.analyze_image_url.return_value = test_receipt_detail
+
+    get_receipt_detail(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
+
+    mock_encode_data_url.assert_called_once_with(TEST_IMAGE_BYTES, TEST_IMAGE_TYPE)
+    mock_openai_handler.analyze_image_url.assert_called_once_with(TEST_BASE64_IMAGE)
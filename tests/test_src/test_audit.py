@@ -0,0 +1,161 @@
+import json
+from pathlib import Path
+
+import pytest
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
+
+from scripts.audit_report import iter_records, summarize
+from src.receipt_scanner_model.audit import (
+    AuditLog,
+    AuditRecord,
+    audit_log,
+    audit_request,
+    audit_s3,
+    estimate_cost,
+    record_openai,
+)
+from src.receipt_scanner_model.error import S3NotFound
+
+USAGE = CompletionUsage(
+    prompt_tokens=2000,
+    completion_tokens=50,
+    total_tokens=2050,
+    prompt_tokens_details=PromptTokensDetails(cached_tokens=1536),
+)
+
+
+def read_lines(fp: Path) -> list[dict]:
+    audit_log.flush()
+    with open(fp, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_estimate_cost():
+    # (464 * 0.15 + 1536 * 0.075 + 50 * 0.60) / 1,000,000
+    assert estimate_cost("gpt-4o-mini", 2000, 1536, 50) == pytest.approx(0.0002148)
+    assert estimate_cost("unknown-model", 2000, 1536, 50) == 0.0
+
+
+def test_record_to_json_omits_empty_values():
+    record = AuditRecord("/receipt-analyze", "receipt.png")
+    record.add_s3(0.0125, 1024)
+    record.add_openai(1.5, USAGE, "gpt-4o-mini")
+
+    line = json.loads(record.to_json(2.0))
+
+    assert line["ep"] == "/receipt-analyze"
+    assert line["file"] == "receipt.png"
+    assert line["status"] == 200
+    assert line["ms"] == 2000.0
+    assert line["bytes"] == 1024
+    assert line["s3_ms"] == 12.5
+    assert line["ai_ms"] == 1500.0
+    assert (line["calls"], line["in"], line["cached"], line["out"]) == (
+        1,
+        2000,
+        1536,
+        50,
+    )
+    assert line["usd"] == pytest.approx(0.0002148)
+    assert set(json.loads(AuditRecord("/").to_json(0))) == {"ts", "ep", "status"}
+
+
+def test_audit_request_collects_calls_in_scope(audit_log_fp: Path):
+    @audit_s3
+    def download(filename: str) -> tuple[bytes, str]:
+        return b"image", "image/png"
+
+    # スコープの外の呼び出しは記録しない
+    download("outside.png")
+    record_openai(1.0, USAGE, "gpt-4o-mini")
+
+    with audit_request("/receipt-analyze", "receipt.png"):
+        download("receipt.png")
+        record_openai(1.0, USAGE, "gpt-4o-mini")
+
+    (line,) = read_lines(audit_log_fp)
+    assert line["file"] == "receipt.png"
+    assert line["bytes"] == 5
+    assert line["calls"] == 1
+    assert line["in"] == 2000
+
+
+def test_audit_request_records_error_status(audit_log_fp: Path):
+    with pytest.raises(S3NotFound):
+        with audit_request("/receipt-analyze", "missing.png"):
+            raise S3NotFound(404, "Not found")
+
+    (line,) = read_lines(audit_log_fp)
+    assert line["status"] == 404
+
+
+def test_audit_log_buffers_and_rotates(tmp_path: Path):
+    fp = tmp_path / "audit.jsonl"
+    log = AuditLog(fp, max_bytes=30, backup_count=2, buffer_size=2, flush_interval=60)
+
+    log.write('{"n":1}')
+    assert not fp.exists()
+    log.write('{"n":2}')
+    assert fp.read_text() == '{"n":1}\n{"n":2}\n'
+
+    for n in range(3, 9):
+        log.write(f'{{"n":{n}}}')
+    log.flush()
+
+    assert fp.read_text() == '{"n":7}\n{"n":8}\n'
+    assert (tmp_path / "audit.jsonl.1").read_text() == '{"n":5}\n{"n":6}\n'
+    assert (tmp_path / "audit.jsonl.2").read_text() == '{"n":3}\n{"n":4}\n'
+    assert not (tmp_path / "audit.jsonl.3").exists()
+
+
+def test_audit_log_per_process(tmp_path: Path, mocker):
+    mocker.patch("os.getpid", return_value=123)
+    log = AuditLog(tmp_path / "audit.jsonl", buffer_size=1, per_process=True)
+
+    log.write('{"n":1}')
+
+    assert log.path == tmp_path / "audit.123.jsonl"
+    assert (tmp_path / "audit.123.jsonl").read_text() == '{"n":1}\n'
+    assert not (tmp_path / "audit.jsonl").exists()
+
+
+def test_audit_log_disabled(tmp_path: Path):
+    log = AuditLog(None, buffer_size=1)
+
+    log.write('{"n":1}')
+    log.flush()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_report_reads_rotated_files_and_summarizes(tmp_path: Path):
+    fp = tmp_path / "audit.jsonl"
+    (tmp_path / "audit.jsonl.1").write_text(
+        '{"ts":0,"ms":100,"usd":0.001,"in":10}\n'
+        '{"ts":10,"ms":300,"status":502,"usd":0.002,"in":20}\n'
+    )
+    fp.write_text('{"ts":65,"ms":200,"usd":0.003,"in":30}\n{"ts":70,"ms"')
+
+    summaries = summarize(iter_records(fp), window=60)
+
+    assert [s["start"] for s in summaries] == [0, 60]
+    assert summaries[0]["requests"] == 2
+    assert summaries[0]["errors"] == 1
+    assert summaries[0]["p50_ms"] == 100
+    assert summaries[0]["p95_ms"] == 300
+    assert summaries[0]["in"] == 30
+    assert summaries[0]["usd"] == pytest.approx(0.003)
+    # 書き込み途中の行は読み飛ばす
+    assert summaries[1]["requests"] == 1
+
+
+def test_report_reads_per_process_files(tmp_path: Path):
+    fp = tmp_path / "audit.jsonl"
+    fp.write_text('{"ts":0,"n":1}\n')
+    (tmp_path / "audit.123.jsonl").write_text('{"ts":0,"n":2}\n')
+    (tmp_path / "audit.123.jsonl.1").write_text('{"ts":0,"n":3}\n')
+    (tmp_path / "audit.456.jsonl").write_text('{"ts":0,"n":4}\n')
+    (tmp_path / "audit.other.jsonl").write_text('{"ts":0,"n":5}\n')
+
+    assert sorted(record["n"] for record in iter_records(fp)) == [1, 2, 3, 4]
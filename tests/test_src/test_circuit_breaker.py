@@ -0,0 +1,226 @@
+import pytest
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model.circuit_breaker import (
+    CircuitBreaker,
+    CircuitState,
+    circuit_breaker,
+    s3_circuit_breaker,
+    openai_circuit_breaker,
+)
+from src.receipt_scanner_model.error import (
+    S3ServiceUnavailable,
+    S3NotFound,
+    OpenAIServiceUnavailable,
+)
+from src.receipt_scanner_model.s3_client import S3Client
+from src.receipt_scanner_model.open_ai import OpenAIHandler
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock: FakeClock) -> CircuitBreaker:
+    return CircuitBreaker(
+        name="test",
+        failure_rate_threshold=0.5,
+        slow_call_duration=1.0,
+        slow_call_rate_threshold=1.0,
+        window_size=4,
+        minimum_calls=4,
+        open_duration=10.0,
+        half_open_max_calls=1,
+        clock=clock,
+    )
+
+
+def test_opens_when_failure_rate_exceeds_threshold(breaker: CircuitBreaker):
+    """エラー率が閾値を超えるとOPENになること"""
+    breaker.record_success(0.1)
+    breaker.record_success(0.1)
+    breaker.record_failure(0.1)
+    assert breaker.state == CircuitState.CLOSED
+
+    breaker.record_failure(0.1)
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.allow_request() is False
+
+
+def test_opens_when_all_calls_are_slow(breaker: CircuitBreaker):
+    """遅延呼び出し率が閾値を超えるとOPENになること"""
+    for _ in range(4):
+        breaker.record_success(5.0)
+    assert breaker.state == CircuitState.OPEN
+
+
+def test_stays_closed_below_minimum_calls(breaker: CircuitBreaker):
+    """最小呼び出し数に満たない間はOPENにならないこと"""
+    for _ in range(3):
+        breaker.record_failure(0.1)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_probe_success_closes(breaker: CircuitBreaker, clock: FakeClock):
+    """HALF_OPENの試験呼び出しが成功するとCLOSEDに戻ること"""
+    for _ in range(4):
+        breaker.record_failure(0.1)
+    clock.now = 10.0
+    assert breaker.state == CircuitState.HALF_OPEN
+
+    assert breaker.allow_request() is True
+    # 試験呼び出し数を超えた分は遮断される
+    assert breaker.allow_request() is False
+
+    breaker.record_success(0.1)
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.allow_request() is True
+
+
+def test_half_open_probe_failure_reopens(breaker: CircuitBreaker, clock: FakeClock):
+    """HALF_OPENの試験呼び出しが失敗するとOPENに戻ること"""
+    for _ in range(4):
+        breaker.record_failure(0.1)
+    clock.now = 10.0
+    assert breaker.allow_request() is True
+
+    breaker.record_failure(0.1)
+    assert breaker.state == CircuitState.OPEN
+    clock.now = 15.0
+    assert breaker.allow_request() is False
+
+
+def test_ignores_calls_admitted_before_opening(
+    breaker: CircuitBreaker, clock: FakeClock
+):
+    """OPEN になる前に許可した呼び出しの結果は、OPEN の期間を延ばさないこと"""
+    admission = breaker.acquire()
+    for _ in range(4):
+        breaker.record_failure(0.1)
+    assert breaker.state == CircuitState.OPEN
+
+    clock.now = 5.0
+    breaker.record_failure(0.1, admission)
+    clock.now = 10.0
+
+    assert breaker.state == CircuitState.HALF_OPEN
+
+
+def test_half_open_counts_only_probes(breaker: CircuitBreaker, clock: FakeClock):
+    """CLOSED で許可した呼び出しが HALF_OPEN 中に終わっても、試験呼び出しとして数えないこと"""
+    admission = breaker.acquire()
+    for _ in range(4):
+        breaker.record_failure(0.1)
+    clock.now = 10.0
+    probe = breaker.acquire()
+    assert probe is not None and probe.probe
+
+    breaker.record_success(0.1, admission)
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.acquire() is None
+
+    breaker.record_success(0.1, probe)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_decorator_does_not_count_closed_generator(
+    breaker: CircuitBreaker, clock: FakeClock
+):
+    """最後まで読まずに閉じたストリーミングは、成功・失敗のどちらにも数えず、試験呼び出しの枠を空けること"""
+
+    @circuit_breaker(
+        breaker,
+        failure_errors=(S3ServiceUnavailable,),
+        open_error=lambda: S3ServiceUnavailable(503, "open"),
+    )
+    def stream():
+        yield 1
+        yield 2
+
+    chunks = stream()
+    next(chunks)
+    chunks.close()
+    assert breaker.snapshot()["calls"] == 0
+
+    for _ in range(4):
+        breaker.record_failure(0.1)
+    clock.now = 10.0
+    chunks = stream()
+    next(chunks)
+    chunks.close()
+
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert list(stream()) == [1, 2]
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_snapshot(breaker: CircuitBreaker):
+    """監視用の状態が取得できること"""
+    breaker.record_failure(0.1)
+    breaker.record_success(0.1)
+
+    assert breaker.snapshot() == {
+        "name": "test",
+        "state": "closed",
+        "calls": 2,
+        "failure_rate": 0.5,
+        "slow_call_rate": 0.0,
+        "rejected": 0,
+    }
+
+
+def test_decorator_ignores_client_errors(breaker: CircuitBreaker):
+    """クライアント起因のエラーは障害として数えないこと"""
+
+    @circuit_breaker(
+        breaker,
+        failure_errors=(S3ServiceUnavailable,),
+        open_error=lambda: S3ServiceUnavailable(503, "open"),
+    )
+    def not_found():
+        raise S3NotFound(404, "Not Found")
+
+    for _ in range(4):
+        with pytest.raises(S3NotFound):
+            not_found()
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_s3_client_fails_fast_when_open(mocker: MockFixture):
+    """OPEN中はS3を呼び出さずにS3ServiceUnavailableを送出すること"""
+    mock_aws_s3_client = mocker.patch("boto3.client").return_value
+    for _ in range(s3_circuit_breaker.window_size):
+        s3_circuit_breaker.record_failure(0.1)
+
+    with pytest.raises(S3ServiceUnavailable) as exc_info:
+        S3Client().download_image_by_filename("test.png")
+
+    assert exc_info.value.code == 503
+    mock_aws_s3_client.head_object.assert_not_called()
+
+
+def test_openai_handler_fails_fast_when_open(mocker: MockFixture):
+    """OPEN中はOpenAIを呼び出さずにOpenAIServiceUnavailableを送出すること"""
+    mock_client = mocker.MagicMock()
+    mocker.patch(
+        "src.receipt_scanner_model.open_ai.create_openai_client",
+        return_value=mock_client,
+    )
+    for _ in range(openai_circuit_breaker.window_size):
+        openai_circuit_breaker.record_failure(0.1)
+
+    with pytest.raises(OpenAIServiceUnavailable) as exc_info:
+        OpenAIHandler().analyze_image("MockImageData", "image/png")
+
+    assert exc_info.value.code == 503
+    mock_client.beta.chat.completions.parse.assert_not_called()
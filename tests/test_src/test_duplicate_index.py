@@ -0,0 +1,127 @@
+import os
+import random
+
+import cv2
+import numpy as np
+import pytest
+
+from src.receipt_scanner_model.duplicate_index import (
+    PerceptualHashIndex,
+    perceptual_hash,
+)
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+RAW_DIR = os.path.join(current_dir, "../../raw")
+
+
+def read_raw(name: str) -> bytes:
+    with open(os.path.join(RAW_DIR, name), "rb") as f:
+        return f.read()
+
+
+def reframe(img_bytes: bytes) -> bytes:
+    """少し切り抜いて背景を付け、縮小してJPEGで保存し直す（撮り直しの代わり）"""
+    image = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image is not None
+    height, width = image.shape[:2]
+    image = image[
+        int(height * 0.03) : int(height * 0.97), int(width * 0.03) : int(width * 0.97)
+    ]
+    image = cv2.copyMakeBorder(
+        image, 40, 20, 30, 10, cv2.BORDER_CONSTANT, value=(60, 50, 40)
+    )
+    image = cv2.resize(image, None, fx=0.8, fy=0.8)
+    _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 70])
+    return buffer.tobytes()
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def test_perceptual_hash_nearest_is_same_receipt():
+    """撮り直した画像に最も近いのは、元のレシートの画像であること"""
+    names = sorted(os.listdir(RAW_DIR))
+    hashes = {name: perceptual_hash(read_raw(name)) for name in names}
+
+    for name in names:
+        reframed = perceptual_hash(reframe(read_raw(name)))
+        nearest = min(names, key=lambda other: distance(reframed, hashes[other]))
+        assert nearest == name
+
+
+def test_perceptual_hash_is_far_for_different_receipts():
+    hashes = [perceptual_hash(read_raw(name)) for name in sorted(os.listdir(RAW_DIR))]
+    for i, a in enumerate(hashes):
+        for b in hashes[i + 1 :]:
+            assert distance(a, b) > 8
+
+
+def test_perceptual_hash_invalid_image():
+    with pytest.raises(ValueError):
+        perceptual_hash(b"not an image")
+
+
+def test_find_within_max_distance():
+    index: PerceptualHashIndex[str] = PerceptualHashIndex(max_distance=8)
+    index.add(0, "zero")
+    index.add((1 << 64) - 1, "ones")
+
+    assert index.find(0) == ("zero", 0)
+    # 8bit 違いまでは見つかる
+    assert index.find(0b1111_1111 << 20) == ("zero", 8)
+    assert index.find(0b1_1111_1111 << 20) is None
+    assert index.snapshot() == {"entries": 2, "lookups": 3, "matches": 2}
+
+
+def test_find_returns_nearest():
+    index: PerceptualHashIndex[str] = PerceptualHashIndex(max_distance=8)
+    index.add(0b111, "far")
+    index.add(0b1, "near")
+
+    assert index.find(0) == ("near", 1)
+
+
+def test_find_within_scope():
+    """同じ scope で登録した値だけを返すこと"""
+    index: PerceptualHashIndex[str] = PerceptualHashIndex(max_distance=8)
+    index.add(0, "a", scope="user-a")
+    index.add(1, "b", scope="user-b")
+
+    assert index.find(0, scope="user-a") == ("a", 0)
+    assert index.find(0, scope="user-b") == ("b", 1)
+    assert index.find(0) is None
+
+
+def test_evicts_oldest_entries():
+    index: PerceptualHashIndex[str] = PerceptualHashIndex(max_entries=2)
+    index.add(1 << 10, "a")
+    index.add(1 << 30, "b")
+    index.add(1 << 50, "c")
+
+    assert len(index) == 2
+    assert index.find(1 << 10) == ("b", 2)
+    assert index.find(1 << 50) == ("c", 0)
+
+
+@pytest.mark.parametrize("blocks", [3, 4])
+def test_matches_brute_force(blocks: int):
+    """ブロックに分けて探した結果が、全件の距離を計算した結果と一致すること"""
+    rng = random.Random(0)
+    index: PerceptualHashIndex[int] = PerceptualHashIndex(max_distance=8, blocks=blocks)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    for i, phash in enumerate(hashes):
+        index.add(phash, i)
+
+    for _ in range(300):
+        query = rng.choice(hashes)
+        for bit in rng.sample(range(64), rng.randint(0, 12)):
+            query ^= 1 << bit
+        nearest = min(distance(query, phash) for phash in hashes)
+
+        found = index.find(query)
+
+        if nearest <= 8:
+            assert found is not None and found[1] == nearest
+        else:
+            assert found is None
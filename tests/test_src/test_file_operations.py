@@ -0,0 +1,54 @@
+import base64
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from src.receipt_scanner_model.file_operations import (
+    BASE64_CHUNK_SIZE,
+    encode_data_url,
+    encode_image,
+)
+
+
+@pytest.mark.parametrize(
+    "size",
+    [0, 1, 2, 3, BASE64_CHUNK_SIZE - 1, BASE64_CHUNK_SIZE, BASE64_CHUNK_SIZE + 1],
+)
+def test_encode_data_url(size: int):
+    """チャンクの境界によらずdata URLが正しく作成されること"""
+    image_bytes = os.urandom(size)
+
+    expected = f"data:image/png;base64,{encode_image(image_bytes)}"
+    assert encode_data_url(image_bytes, "image/png") == expected
+    assert base64.b64decode(expected.split(",", 1)[1]) == image_bytes
+
+
+def measure_peak(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_encode_data_url_reduces_peak_memory():
+    """リクエストボディ作成までのピークメモリが、従来の方法より小さいこと"""
+    image_bytes = os.urandom(5 * 1024 * 1024)
+
+    def legacy():
+        base64_image = encode_image(image_bytes)
+        image_url = f"data:image/png;base64,{base64_image}"
+        # SDKがリクエストボディをJSONにシリアライズする処理を模擬する
+        json.dumps({"url": image_url})
+
+    def current():
+        image_url = encode_data_url(image_bytes, "image/png")
+        json.dumps({"url": image_url})
+
+    legacy_peak = measure_peak(legacy)
+    current_peak = measure_peak(current)
+
+    assert current_peak < legacy_peak * 0.8
@@ -0,0 +1,169 @@
+import io
+import struct
+import time
+import zlib
+
+import pytest
+from PIL import Image
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model.error import S3BadRequest
+from src.receipt_scanner_model.image_validation import (
+    sniff_image_type,
+    validate_image_bytes,
+    validate_image_header,
+)
+
+
+def make_image(
+    image_format: str = "PNG", size: tuple[int, int] = (8, 8), mode: str = "RGB"
+) -> bytes:
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def png_header(width: int, height: int) -> bytes:
+    """ヘッダーだけ指定した大きさで、画素データを持たないPNGを作成する"""
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + png_chunk(b"IDAT", b"")
+        + png_chunk(b"IEND", b"")
+    )
+
+
+@pytest.mark.parametrize(
+    "head, expected",
+    [
+        (b"\x89PNG\r\n\x1a\n" + b"\x00" * 8, "image/png"),
+        (b"\xff\xd8\xff\xe0" + b"\x00" * 12, "image/jpeg"),
+        (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+        (b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", "image/heic"),
+        (b"\x00\x00\x00\x18ftypmif1\x00\x00\x00\x00", "image/heic"),
+        (b"GIF89a" + b"\x00" * 10, "image/gif"),
+        (b"%PDF-1.7" + b"\x00" * 8, None),
+        (b"", None),
+    ],
+)
+def test_sniff_image_type(head: bytes, expected: str | None):
+    assert sniff_image_type(head) == expected
+
+
+@pytest.mark.parametrize(
+    "image_format, content_type", [("PNG", "image/png"), ("JPEG", "image/jpeg")]
+)
+def test_passthrough(image_format: str, content_type: str):
+    """PNG・JPEG はそのまま返すこと"""
+    image = make_image(image_format)
+
+    assert validate_image_bytes(image, content_type) == (image, content_type)
+
+
+def test_sniffed_type_overrides_content_type():
+    """Content-Typeではなく、実際の形式を返すこと"""
+    image = make_image("JPEG")
+
+    assert validate_image_bytes(image, "image/png") == (image, "image/jpeg")
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_webp_is_converted_to_jpeg(mode: str):
+    """WebP は JPEG に変換すること（透過がある場合も含む）"""
+    body, content_type = validate_image_bytes(
+        make_image("WEBP", (20, 10), mode), "image/webp"
+    )
+
+    assert content_type == "image/jpeg"
+    with Image.open(io.BytesIO(body)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (20, 10)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"<html>not an image</html>",
+        make_image("GIF"),
+        # マジックバイトだけ正しく、中身が壊れている
+        b"\x89PNG\r\n\x1a\n" + b"\x00" * 32,
+    ],
+)
+def test_rejects_invalid_body(body: bytes):
+    with pytest.raises(S3BadRequest) as exc_info:
+        validate_image_bytes(body, "image/png")
+
+    assert exc_info.value.code == 400
+
+
+@pytest.mark.parametrize("size", [10_000, 100_000])
+def test_rejects_decompression_bomb(size: int):
+    """展開すると巨大になる画像は、画素をデコードせずにすぐ拒否すること"""
+    body = png_header(size, size)
+
+    start = time.perf_counter()
+    with pytest.raises(S3BadRequest) as exc_info:
+        validate_image_bytes(body, "image/png")
+
+    assert time.perf_counter() - start < 0.1
+    assert "ピクセル数が制限を超えています" in exc_info.value.message
+
+
+def test_max_pixels_setting(mocker: MockFixture):
+    mocker.patch(
+        "src.receipt_scanner_model.image_validation.setting.image_max_pixels", 63
+    )
+
+    with pytest.raises(S3BadRequest):
+        validate_image_bytes(make_image(size=(8, 8)), "image/png")
+    assert validate_image_bytes(make_image(size=(7, 9)), "image/png")[1] == "image/png"
+
+
+def test_heic_requires_pillow_heif(mocker: MockFixture):
+    """pillow-heif がない場合、HEIC は S3BadRequest で拒否すること"""
+    mocker.patch.dict("sys.modules", {"pillow_heif": None})
+    body = b"\x00\x00\x00\x18ftypheic" + b"\x00" * 32
+
+    with pytest.raises(S3BadRequest) as exc_info:
+        validate_image_bytes(body, "image/heic")
+
+    assert "pillow-heif" in exc_info.value.message
+
+
+def test_validate_image_header():
+    """先頭のバイトデータだけで、形式と縦横のピクセル数を検証すること"""
+    jpeg = make_image("JPEG", size=(64, 64))
+
+    assert validate_image_header(png_header(8, 8), "image/png") == "image/png"
+    # JPEG は画素データ（SOS）の手前までのヘッダーがあれば判定できる
+    head = jpeg[: jpeg.index(b"\xff\xda") + 16]
+    assert validate_image_header(head, "image/jpeg") == "image/jpeg"
+    with pytest.raises(S3BadRequest):
+        validate_image_header(png_header(100_000, 100_000), "image/png")
+    with pytest.raises(S3BadRequest):
+        validate_image_header(b"%PDF-1.7" + b"\x00" * 8, "image/png")
+
+
+@pytest.mark.parametrize(
+    "head, declared",
+    [
+        # Content-Type と中身が一致しない
+        (make_image("JPEG"), "image/png"),
+        # 変換が必要な形式
+        (make_image("WEBP"), "image/webp"),
+        # 先頭だけではヘッダーを読めない
+        (b"\xff\xd8\xff\xe0" + b"\x00" * 12, "image/jpeg"),
+    ],
+)
+def test_validate_image_header_requires_download(head: bytes, declared: str):
+    """先頭だけでは送れると判断できない画像は None を返すこと"""
+    assert validate_image_header(head, declared) is None
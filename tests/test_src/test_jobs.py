@@ -0,0 +1,381 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model.error import (
+    JobCallbackForbidden,
+    JobNotFound,
+    JobQueueFull,
+    S3NotFound,
+)
+from src.receipt_scanner_model.jobs import (
+    InMemoryJobStore,
+    JobError,
+    JobRecord,
+    JobRunner,
+    JOB_STATUS,
+    JobStore,
+    SQLiteJobStore,
+    validate_callback_url,
+)
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+
+TEST_FILE_NAME = "test.png"
+
+
+@pytest.fixture
+def test_receipt_detail() -> ReceiptDetail:
+    return ReceiptDetail(
+        store_name="Test Store",
+        date="2023/10/01",
+        amount=1500,
+        category="食費",
+    )
+
+
+def to_error(e: Exception, filename: str) -> JobError:
+    return JobError(status_code=getattr(e, "code", 500), detail=str(filename))
+
+
+def wait_for_finish(runner: JobRunner, job_id: str, timeout: float = 5.0) -> JobRecord:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = runner.get(job_id)
+        if job.status in ("succeeded", "failed"):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path: Path) -> JobStore:
+    if request.param == "sqlite":
+        return SQLiteJobStore(tmp_path / "jobs.sqlite3")
+    return InMemoryJobStore()
+
+
+def test_store_save_and_get(store: JobStore, test_receipt_detail: ReceiptDetail):
+    """ジョブの保存と取得ができること"""
+    job = JobRecord(
+        job_id="job-1",
+        status="succeeded",
+        filename=TEST_FILE_NAME,
+        result=test_receipt_detail,
+        created_at=1.0,
+        updated_at=2.0,
+    )
+    store.save(job)
+
+    assert store.get("job-1") == job
+    assert store.get("missing") is None
+
+
+def test_in_memory_store_evicts_oldest():
+    """上限を超えると古いジョブから削除されること"""
+    store = InMemoryJobStore(max_jobs=2)
+    for i in range(3):
+        store.save(
+            JobRecord(
+                job_id=f"job-{i}",
+                status="queued",
+                filename=TEST_FILE_NAME,
+                created_at=0.0,
+                updated_at=0.0,
+            )
+        )
+
+    assert store.get("job-0") is None
+    assert store.get("job-2") is not None
+
+
+def test_runner_success(store: JobStore, test_receipt_detail: ReceiptDetail):
+    """ジョブが処理され結果が保存されること"""
+    runner = JobRunner(store, lambda filename: test_receipt_detail, to_error)
+
+    job = runner.submit(TEST_FILE_NAME)
+    assert job.status == "queued"
+
+    finished = wait_for_finish(runner, job.job_id)
+    runner.stop()
+    assert finished.status == "succeeded"
+    assert finished.result == test_receipt_detail
+
+
+def test_runner_failure(store: JobStore):
+    """処理中の例外がジョブのエラーとして保存されること"""
+
+    def process(filename: str) -> ReceiptDetail:
+        raise S3NotFound(404, "Not Found")
+
+    runner = JobRunner(store, process, to_error)
+
+    job = runner.submit(TEST_FILE_NAME)
+    finished = wait_for_finish(runner, job.job_id)
+    runner.stop()
+
+    assert finished.status == "failed"
+    assert finished.error == JobError(status_code=404, detail=TEST_FILE_NAME)
+
+
+def test_runner_queue_full(test_receipt_detail: ReceiptDetail):
+    """キューが満杯の場合JobQueueFullを送出すること"""
+    release = threading.Event()
+
+    def process(filename: str) -> ReceiptDetail:
+        release.wait()
+        return test_receipt_detail
+
+    runner = JobRunner(InMemoryJobStore(), process, to_error, workers=1, queue_size=1)
+    running = runner.submit(TEST_FILE_NAME)
+    # ワーカーが1件目を取り出すまで待つ
+    while runner.get(running.job_id).status != "running":
+        time.sleep(0.01)
+    runner.submit(TEST_FILE_NAME)
+
+    with pytest.raises(JobQueueFull) as exc_info:
+        runner.submit(TEST_FILE_NAME)
+    assert exc_info.value.code == 503
+
+    release.set()
+    runner.stop()
+
+
+def test_runner_get_not_found():
+    """存在しないジョブはJobNotFoundを送出すること"""
+    runner = JobRunner(InMemoryJobStore(), lambda filename: None, to_error)  # type: ignore[arg-type]
+
+    with pytest.raises(JobNotFound) as exc_info:
+        runner.get("missing")
+    assert exc_info.value.code == 404
+
+
+def test_runner_callback(mocker: MockFixture, test_receipt_detail: ReceiptDetail):
+    """コールバックURLに結果がPOSTされること"""
+    mock_post = mocker.patch("requests.post")
+    runner = JobRunner(
+        InMemoryJobStore(),
+        lambda filename: test_receipt_detail,
+        to_error,
+        callback_allowed_hosts=["example.com"],
+    )
+
+    job = runner.submit(TEST_FILE_NAME, callback_url="https://example.com/callback")
+    wait_for_finish(runner, job.job_id)
+    runner.stop()
+
+    mock_post.assert_called_once()
+    assert mock_post.call_args.args[0] == "https://example.com/callback"
+    posted = JobRecord.model_validate_json(mock_post.call_args.kwargs["data"])
+    assert posted.status == "succeeded"
+    assert posted.result == test_receipt_detail
+
+
+def mock_resolve(mocker: MockFixture, address: str):
+    return mocker.patch(
+        "src.receipt_scanner_model.jobs.socket.getaddrinfo",
+        return_value=[(2, 1, 6, "", (address, 443))],
+    )
+
+
+@pytest.mark.parametrize(
+    "address",
+    ["127.0.0.1", "10.0.0.1", "169.254.169.254", "::1", "::ffff:192.168.0.1"],
+)
+def test_validate_callback_url_rejects_internal_address(
+    mocker: MockFixture, address: str
+):
+    """内部のアドレスに名前解決されるコールバックURLを拒否すること"""
+    mock_resolve(mocker, address)
+
+    with pytest.raises(JobCallbackForbidden):
+        validate_callback_url("https://hooks.example.com/callback")
+
+
+def test_validate_callback_url_accepts_global_address(mocker: MockFixture):
+    mock_resolve(mocker, "93.184.216.34")
+
+    validate_callback_url("https://hooks.example.com/callback")
+
+
+def test_validate_callback_url_allowed_hosts(mocker: MockFixture):
+    """許可するホストを指定した場合は、そのホストだけを許可すること"""
+    getaddrinfo = mock_resolve(mocker, "10.0.0.1")
+
+    validate_callback_url("http://Callback.internal/hook", ["callback.internal"])
+    with pytest.raises(JobCallbackForbidden):
+        validate_callback_url("https://example.com/hook", ["callback.internal"])
+    with pytest.raises(JobCallbackForbidden):
+        validate_callback_url("file:///etc/passwd", ["callback.internal"])
+    getaddrinfo.assert_not_called()
+
+
+def test_runner_rejects_internal_callback_url(mocker: MockFixture):
+    mock_resolve(mocker, "169.254.169.254")
+    store = InMemoryJobStore()
+    runner = JobRunner(store, lambda filename: None, to_error)  # type: ignore[arg-type]
+
+    with pytest.raises(JobCallbackForbidden):
+        runner.submit(TEST_FILE_NAME, callback_url="http://metadata.example/latest")
+    assert store.find_by_status(["queued"]) == []
+
+
+def test_store_claim(store: JobStore):
+    """queued のジョブだけを1回だけ running にすること"""
+    job = JobRecord(
+        job_id="job-1",
+        status="queued",
+        filename=TEST_FILE_NAME,
+        created_at=1.0,
+        updated_at=1.0,
+    )
+    store.save(job)
+
+    claimed = store.claim("job-1", "worker-a")
+
+    assert claimed is not None
+    assert claimed.status == "running"
+    assert claimed.worker_id == "worker-a"
+    assert store.get("job-1") == claimed
+    assert store.claim("job-1", "worker-b") is None
+    assert store.claim("missing", "worker-b") is None
+
+
+def test_store_lease(store: JobStore):
+    """heartbeat で処理中のジョブのリースを延長し、期限が切れたジョブだけを失敗にすること"""
+    for job_id in ["live", "dead"]:
+        store.save(
+            JobRecord(
+                job_id=job_id,
+                status="running",
+                filename=TEST_FILE_NAME,
+                created_at=1.0,
+                updated_at=1.0,
+                worker_id=f"worker-{job_id}",
+            )
+        )
+
+    store.heartbeat("worker-live")
+    failed = store.fail_expired(
+        time.time() - 60, JobError(status_code=500, detail="中断")
+    )
+
+    assert [job.job_id for job in failed] == ["dead"]
+    dead, live = store.get("dead"), store.get("live")
+    assert dead is not None and dead.status == "failed"
+    assert live is not None and live.status == "running" and live.updated_at > 1.0
+    assert (
+        store.fail_expired(time.time() - 60, JobError(status_code=500, detail="")) == []
+    )
+
+
+def test_runner_recover(store: JobStore, test_receipt_detail: ReceiptDetail):
+    """再起動時に queued のジョブを処理し、リースが切れた running のジョブだけを失敗にすること"""
+    jobs: list[tuple[str, JOB_STATUS, float]] = [
+        ("queued", "queued", 2.0),
+        ("running", "running", 1.0),
+        ("done", "succeeded", 0.0),
+    ]
+    for job_id, status, created_at in jobs:
+        store.save(
+            JobRecord(
+                job_id=job_id,
+                status=status,
+                filename=TEST_FILE_NAME,
+                created_at=created_at,
+                updated_at=created_at,
+            )
+        )
+    # 他のプロセスが処理中のジョブ（リースが切れていない）
+    now = time.time()
+    store.save(
+        JobRecord(
+            job_id="other",
+            status="running",
+            filename=TEST_FILE_NAME,
+            created_at=3.0,
+            updated_at=now,
+            worker_id="other-worker",
+        )
+    )
+    assert [job.job_id for job in store.find_by_status(["queued", "running"])] == [
+        "running",
+        "queued",
+        "other",
+    ]
+    runner = JobRunner(store, lambda filename: test_receipt_detail, to_error)
+
+    runner.recover()
+    queued = wait_for_finish(runner, "queued")
+    runner.stop()
+
+    assert queued.status == "succeeded"
+    assert queued.result == test_receipt_detail
+    running = runner.get("running")
+    assert running.status == "failed"
+    assert running.error is not None and running.error.status_code == 500
+    assert runner.get("done").status == "succeeded"
+    assert runner.get("other").status == "running"
+
+
+def test_runner_fails_jobs_whose_lease_expires(
+    store: JobStore, test_receipt_detail: ReceiptDetail
+):
+    """起動後に他のプロセスのリースが切れた場合も失敗にし、自分の処理中のジョブは延長すること"""
+    release = threading.Event()
+
+    def slow_process(filename: str) -> ReceiptDetail:
+        release.wait(5)
+        return test_receipt_detail
+
+    store.save(
+        JobRecord(
+            job_id="other",
+            status="running",
+            filename=TEST_FILE_NAME,
+            created_at=1.0,
+            updated_at=time.time(),
+            worker_id="other-worker",
+        )
+    )
+    runner = JobRunner(store, slow_process, to_error, lease_seconds=0.1)
+    runner.recover()
+    job = runner.submit(TEST_FILE_NAME)
+
+    other = wait_for_finish(runner, "other")
+    time.sleep(0.2)
+    assert runner.get(job.job_id).status == "running"
+    release.set()
+    finished = wait_for_finish(runner, job.job_id)
+    runner.stop()
+
+    assert other.status == "failed"
+    assert finished.status == "succeeded"
+
+
+def test_runner_survives_store_errors(test_receipt_detail: ReceiptDetail):
+    """結果を保存できなかった場合も、ワーカースレッドを止めずに次のジョブを処理すること"""
+
+    class FlakyStore(InMemoryJobStore):
+        def __init__(self) -> None:
+            super().__init__()
+            self.failures = 1
+
+        def save(self, job: JobRecord) -> None:
+            if job.status == "succeeded" and self.failures:
+                self.failures -= 1
+                raise OSError("disk full")
+            super().save(job)
+
+    store = FlakyStore()
+    runner = JobRunner(store, lambda filename: test_receipt_detail, to_error, workers=1)
+
+    first = runner.submit(TEST_FILE_NAME)
+    second = runner.submit(TEST_FILE_NAME)
+    finished = wait_for_finish(runner, second.job_id)
+    runner.stop()
+
+    assert finished.status == "succeeded"
+    assert runner.get(first.job_id).status == "running"
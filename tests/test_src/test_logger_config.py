@@ -0,0 +1,117 @@
+import json
+import logging
+import queue
+import threading
+from pathlib import Path
+
+import pytest
+
+from src.receipt_scanner_model.logger_config import (
+    SAMPLED,
+    BoundedQueueHandler,
+    JsonFormatter,
+    SamplingFilter,
+    logging_snapshot,
+    set_logger,
+    stop_logger,
+)
+
+
+def make_record(level: int = logging.INFO, sampled: bool = False) -> logging.LogRecord:
+    record = logging.LogRecord("test", level, __file__, 1, "message", None, None)
+    if sampled:
+        setattr(record, SAMPLED, True)
+    return record
+
+
+@pytest.fixture
+def restore_logging():
+    yield
+    stop_logger()
+    for name in ["", "uvicorn", "uvicorn.access", "uvicorn.error"]:
+        logger = logging.getLogger(name)
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+        logger.propagate = name == ""
+
+
+def test_bounded_queue_handler_drops_when_full():
+    handler = BoundedQueueHandler(queue.Queue(2), policy="drop")
+
+    for _ in range(5):
+        handler.handle(make_record())
+
+    assert handler.log_queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_bounded_queue_handler_blocks_when_full():
+    log_queue: queue.Queue = queue.Queue(1)
+    handler = BoundedQueueHandler(log_queue, policy="block")
+    handler.handle(make_record())
+
+    thread = threading.Thread(target=handler.handle, args=(make_record(),))
+    thread.start()
+    thread.join(timeout=0.1)
+    assert thread.is_alive()
+
+    log_queue.get()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert handler.dropped == 0
+
+
+def test_sampling_filter():
+    drop_all = SamplingFilter(0.0)
+    keep_all = SamplingFilter(1.0)
+
+    assert drop_all.filter(make_record(sampled=True)) is False
+    assert drop_all.filter(make_record(sampled=False)) is True
+    assert drop_all.filter(make_record(logging.ERROR, sampled=True)) is True
+    assert keep_all.filter(make_record(sampled=True)) is True
+
+
+def test_sampling_filter_rate():
+    values = iter([0.05, 0.5, 0.09, 0.95])
+    sampling_filter = SamplingFilter(0.1, rand=lambda: next(values))
+
+    kept = [sampling_filter.filter(make_record(sampled=True)) for _ in range(4)]
+
+    assert kept == [True, False, True, False]
+
+
+def test_json_formatter():
+    record = make_record(logging.WARNING)
+
+    log = json.loads(JsonFormatter().format(record))
+
+    assert log["level"] == "WARNING"
+    assert log["logger"] == "test"
+    assert log["message"] == "message"
+
+
+def test_set_logger_writes_through_queue(tmp_path: Path, restore_logging):
+    log_fp = tmp_path / "server.log"
+    set_logger(log_fp=log_fp, log_format="json", sample_rate=0.0)
+
+    logger = logging.getLogger("test_logger_config")
+    logger.info("レシート解析結果", extra={SAMPLED: True})
+    logger.info("起動しました")
+    logging.getLogger("uvicorn.error").warning("uvicorn")
+    stop_logger()
+
+    logs = [json.loads(line) for line in log_fp.read_text().splitlines()]
+    assert [log["message"] for log in logs] == ["起動しました", "uvicorn"]
+
+    # 停止後のログはハンドラーで直接書き込む
+    logger.warning("停止後")
+    assert "停止後" in log_fp.read_text()
+
+
+def test_logging_snapshot(tmp_path: Path, restore_logging):
+    assert logging_snapshot() == {"queued": 0, "dropped": 0}
+
+    set_logger(log_fp=tmp_path / "server.log")
+
+    assert logging_snapshot()["dropped"] == 0
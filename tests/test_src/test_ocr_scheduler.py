@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+from pathlib import Path
+
+import cv2
+import pytest
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model import ocr_scheduler
+from src.receipt_scanner_model.ocr_scheduler import (
+    OcrSchedule,
+    available_cpus,
+    cgroup_cpu_limit,
+    configure_worker,
+    plan_schedule,
+)
+
+
+@pytest.mark.parametrize(
+    "cpu_max, expected", [("max 100000\n", None), ("150000 100000\n", 1.5)]
+)
+def test_cgroup_v2_cpu_limit(tmp_path: Path, cpu_max: str, expected):
+    (tmp_path / "cpu.max").write_text(cpu_max)
+
+    assert cgroup_cpu_limit(tmp_path) == expected
+
+
+@pytest.mark.parametrize("quota, expected", [("-1", None), ("400000", 4.0)])
+def test_cgroup_v1_cpu_limit(tmp_path: Path, quota: str, expected):
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text(f"{quota}\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+
+    assert cgroup_cpu_limit(tmp_path) == expected
+
+
+def test_cgroup_without_files(tmp_path: Path):
+    assert cgroup_cpu_limit(tmp_path) is None
+
+
+def test_available_cpus_uses_smaller_of_affinity_and_quota(
+    tmp_path: Path, mocker: MockFixture
+):
+    mocker.patch.object(ocr_scheduler, "affinity_cpus", return_value=list(range(8)))
+
+    assert available_cpus(tmp_path) == 8
+    (tmp_path / "cpu.max").write_text("250000 100000")
+    assert available_cpus(tmp_path) == 2
+    (tmp_path / "cpu.max").write_text("50000 100000")
+    assert available_cpus(tmp_path) == 1
+
+
+def test_plan_schedule(mocker: MockFixture):
+    mocker.patch.object(ocr_scheduler, "available_cpus", return_value=8)
+    mocker.patch.object(ocr_scheduler, "affinity_cpus", return_value=list(range(8)))
+
+    assert plan_schedule(threads=1, pin=False) == OcrSchedule(jobs=8, threads=1)
+    assert plan_schedule(threads=2, pin=False) == OcrSchedule(jobs=4, threads=2)
+    assert plan_schedule(threads=16, pin=False) == OcrSchedule(jobs=1, threads=16)
+    assert plan_schedule(threads=2, pin=True).cpus == list(range(8))
+
+
+def test_plan_schedule_warns_when_oversubscribed(mocker: MockFixture, caplog):
+    mocker.patch.object(ocr_scheduler, "available_cpus", return_value=2)
+    mocker.patch.object(ocr_scheduler, "affinity_cpus", return_value=[0, 1])
+
+    schedule = plan_schedule(threads=2, jobs=2, pin=True)
+
+    assert schedule.cpus is None
+    assert "コア数を超えています" in caplog.text
+    assert "CPU アフィニティを設定しません" in caplog.text
+
+
+def test_configure_worker(monkeypatch: pytest.MonkeyPatch, mocker: MockFixture):
+    monkeypatch.delenv("OMP_THREAD_LIMIT", raising=False)
+    threads = cv2.getNumThreads()
+    set_affinity = mocker.patch.object(os, "sched_setaffinity", create=True)
+
+    try:
+        configure_worker(2, [3, 4])
+
+        assert os.environ["OMP_THREAD_LIMIT"] == "2"
+        assert cv2.getNumThreads() == 2
+        set_affinity.assert_called_once_with(0, {3, 4})
+    finally:
+        cv2.setNumThreads(threads)
+
+
+def test_workers_get_disjoint_cpus(mocker: MockFixture):
+    """起動した順に、プロセスごとに重ならないコアを割り当てること"""
+    configure = mocker.patch.object(ocr_scheduler, "configure_worker")
+    schedule = OcrSchedule(jobs=3, threads=2, cpus=[0, 1, 2, 3, 4, 5])
+    counter = multiprocessing.Value("i", 0)
+
+    for _ in range(3):
+        ocr_scheduler._init_worker(schedule, counter)
+
+    assert [c.args for c in configure.call_args_list] == [
+        (2, [0, 1]),
+        (2, [2, 3]),
+        (2, [4, 5]),
+    ]
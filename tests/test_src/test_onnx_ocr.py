@@ -0,0 +1,214 @@
+import io
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+from PIL import Image
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model import onnx_ocr, scan_receipt
+from src.receipt_scanner_model.onnx_ocr import OnnxOcrEngine, to_ocr_result
+
+CHARACTERS = ["合", "計", "1", ",", "2", "5", "¥"]
+
+
+class FakeDetSession:
+    """入力と同じ大きさの確率マップで、regions（top, bottom, left, right）を文字とする"""
+
+    def __init__(self, regions: list[tuple[int, int, int, int]]) -> None:
+        self.regions = regions
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="x")]
+
+    def run(self, _, feeds: dict) -> list[np.ndarray]:
+        _, _, height, width = feeds["x"].shape
+        prob = np.zeros((1, 1, height, width), dtype=np.float32)
+        for top, bottom, left, right in self.regions:
+            prob[0, 0, top:bottom, left:right] = 0.9
+        return [prob]
+
+
+class FakeRecSession:
+    """全ての入力に対して、labels を認識した結果を返す"""
+
+    def __init__(self, labels: list[int]) -> None:
+        self.labels = labels
+        self.inputs: list[np.ndarray] = []
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="x")]
+
+    def run(self, _, feeds: dict) -> list[np.ndarray]:
+        self.inputs.append(feeds["x"])
+        probs = np.zeros(
+            (len(feeds["x"]), len(self.labels), len(CHARACTERS) + 2), dtype=np.float32
+        )
+        probs[:, np.arange(len(self.labels)), self.labels] = 0.8
+        return [probs]
+
+
+@pytest.fixture
+def dict_path(tmp_path: Path) -> Path:
+    fp = tmp_path / "dict.txt"
+    fp.write_text("\n".join(CHARACTERS) + "\n", encoding="utf-8")
+    return fp
+
+
+def create_engine(
+    mocker: MockFixture,
+    dict_path: Path,
+    det: FakeDetSession,
+    rec: FakeRecSession,
+    **kwargs,
+) -> OnnxOcrEngine:
+    sessions = {Path("det.onnx"): det, Path("rec.onnx"): rec}
+    mocker.patch.object(
+        onnx_ocr, "load_session", side_effect=lambda fp, threads: sessions[fp]
+    )
+    return OnnxOcrEngine(Path("det.onnx"), Path("rec.onnx"), dict_path, **kwargs)
+
+
+def test_load_characters(dict_path: Path):
+    characters = onnx_ocr.load_characters(dict_path)
+
+    assert characters == ["", *CHARACTERS, " "]
+
+
+def test_decode_ctc(mocker: MockFixture, dict_path: Path):
+    """同じラベルの連続はまとめ、空白ラベルを挟んだ場合は別の文字にすること"""
+    engine = create_engine(mocker, dict_path, FakeDetSession([]), FakeRecSession([]))
+    probs = np.zeros((6, len(CHARACTERS) + 2), dtype=np.float32)
+    probs[np.arange(6), [1, 1, 0, 3, 0, 3]] = [0.9, 0.9, 0.5, 0.7, 0.5, 0.8]
+
+    text, conf = engine.decode(probs)
+
+    assert text == "合11"
+    assert conf == pytest.approx((0.9 + 0.7 + 0.8) / 3 * 100)
+    assert engine.decode(np.eye(len(CHARACTERS) + 2)[[0, 0]]) == ("", 0.0)
+
+
+def test_detect_scales_boxes_to_image(mocker: MockFixture, dict_path: Path):
+    det = FakeDetSession([(10, 20, 10, 80), (50, 60, 100, 180)])
+    engine = create_engine(mocker, dict_path, det, FakeRecSession([]))
+
+    # 400x200 の画像は、検出の入力では 384x192（32の倍数）になる
+    boxes = engine.detect(np.zeros((200, 400, 3), dtype=np.uint8))
+
+    assert len(boxes) == 2
+    boxes = boxes[np.argsort(boxes[:, 1])]
+    left, top, right, bottom = boxes[0]
+    assert left < 10 * 400 / 384 and right > 80 * 400 / 384
+    assert top < 10 * 200 / 192 and bottom > 20 * 200 / 192
+    assert (boxes[:, [0, 1]] >= 0).all() and (boxes[:, 2] <= 400).all()
+
+
+def test_detect_drops_low_score_regions(mocker: MockFixture, dict_path: Path):
+    det = FakeDetSession([(10, 11, 10, 80)])
+    engine = create_engine(mocker, dict_path, det, FakeRecSession([]))
+
+    assert len(engine.detect(np.zeros((96, 96, 3), dtype=np.uint8))) == 0
+
+
+def test_recognize_crops_in_batches(mocker: MockFixture, dict_path: Path):
+    """縦横比の順に rec_batch_size ずつ、バッチ内で最も横長の幅に揃えて入力すること"""
+    rec = FakeRecSession([2, 0, 7])
+    engine = create_engine(mocker, dict_path, FakeDetSession([]), rec, rec_batch_size=2)
+    crops = [np.zeros((48, width, 3), dtype=np.uint8) for width in (960, 48, 480)]
+
+    texts, confs = engine.recognize_crops(crops)
+
+    assert texts == ["計¥"] * 3
+    assert confs == pytest.approx([80.0] * 3)
+    assert [batch.shape[0] for batch in rec.inputs] == [2, 1]
+    assert rec.inputs[0].shape[2:] == (48, 480)
+    assert rec.inputs[1].shape[2:] == (48, 960)
+
+
+def test_to_ocr_result_orders_lines():
+    boxes = np.array(
+        [
+            [100, 52, 180, 68],  # 2行目の右
+            [10, 10, 80, 30],  # 1行目
+            [10, 50, 80, 70],  # 2行目の左
+            [10, 90, 80, 100],  # 空の文字列
+        ]
+    )
+
+    result = to_ocr_result(
+        boxes, ["¥1,125", "レシート", "合計", " "], np.array([90, 80, 70, 10.0])
+    )
+
+    assert result.lines() == ["レシート", "合計 ¥1,125"]
+    assert result.conf.tolist() == [80, 70, 90]
+    assert scan_receipt.extract_total_amount(result) == 1125
+
+
+def test_recognize(mocker: MockFixture, dict_path: Path):
+    det = FakeDetSession([(10, 20, 10, 80), (50, 60, 10, 80)])
+    rec = FakeRecSession([1, 2])
+    engine = create_engine(mocker, dict_path, det, rec)
+
+    result = engine.recognize(Image.new("L", (96, 96), 255))
+
+    assert result.lines() == ["合計", "合計"]
+    assert len(rec.inputs) == 1
+
+
+def test_load_session_reuses_sessions(monkeypatch: pytest.MonkeyPatch):
+    fake = MagicMock()
+    fake.SessionOptions.side_effect = SimpleNamespace
+    monkeypatch.setitem(sys.modules, "onnxruntime", fake)
+    onnx_ocr.load_session.cache_clear()
+
+    try:
+        first = onnx_ocr.load_session(Path("det.onnx"), 2)
+        second = onnx_ocr.load_session(Path("det.onnx"), 2)
+        onnx_ocr.load_session(Path("det.onnx"), 4)
+    finally:
+        onnx_ocr.load_session.cache_clear()
+
+    assert first is second
+    assert fake.InferenceSession.call_count == 2
+    options = fake.InferenceSession.call_args_list[0].kwargs["sess_options"]
+    assert options.intra_op_num_threads == 2
+    assert options.inter_op_num_threads == 1
+
+
+def test_default_ocr_engine(mocker: MockFixture):
+    engine = mocker.patch.object(onnx_ocr, "OnnxOcrEngine")
+    scan_receipt.default_ocr_engine.cache_clear()
+
+    try:
+        assert isinstance(
+            scan_receipt.default_ocr_engine(), scan_receipt.TesseractEngine
+        )
+        scan_receipt.default_ocr_engine.cache_clear()
+        mocker.patch.object(scan_receipt.setting, "ocr_engine", "onnx")
+        mocker.patch.object(scan_receipt.setting, "ocr_threads", 3)
+
+        assert scan_receipt.default_ocr_engine() is engine.return_value
+    finally:
+        scan_receipt.default_ocr_engine.cache_clear()
+
+    assert engine.call_args.kwargs["threads"] == 3
+
+
+def test_scan_with_engine(mocker: MockFixture, dict_path: Path):
+    """scan に渡したエンジンでOCRすること（Tesseract は使わない）"""
+    tesseract = mocker.patch.object(scan_receipt.pytesseract, "image_to_data")
+    det = FakeDetSession([(10, 20, 10, 80)])
+    rec = FakeRecSession([1, 2, 0, 7, 3, 4, 3, 5, 6])
+    engine = create_engine(mocker, dict_path, det, rec)
+    buffer = io.BytesIO()
+    Image.new("RGB", (96, 96), (255, 255, 255)).save(buffer, format="PNG")
+    config = scan_receipt.PreprocessConfig(contrast=1.0, denoise="none")
+
+    result = scan_receipt.scan(buffer.getvalue(), config, engine=engine)
+
+    assert result["text"] == "合計¥1,125"
+    assert result["amount"] == 1125
+    tesseract.assert_not_called()
@@ -1,12 +1,26 @@
+from types import SimpleNamespace
+from typing import cast
 from pytest_mock import MockFixture
 import pytest
-from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
+from src.receipt_scanner_model.open_ai import (
+    OpenAIHandler,
+    PackedReceiptDetail,
+    PackedReceiptDetails,
+    PromptBuilder,
+    ReceiptDetail,
+    prompt_builder,
+)
+from src.receipt_scanner_model.metrics import prompt_cache_metrics
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
 from src.receipt_scanner_model.error import (
     OpenAIAuthenticationError,
     OpenAIServiceUnavailable,
     OpenAIUnexpectedError,
     OpenAIResponseFormatError,
+    OpenAIImageUrlError,
 )
+from openai.types.chat import ChatCompletionUserMessageParam
 from openai.types.chat.parsed_chat_completion import (
     ParsedChatCompletion,
     ParsedChoice,
@@ -14,6 +28,7 @@ from openai.types.chat.parsed_chat_completion import (
 )
 from openai import (
     APITimeoutError,
+    BadRequestError,
     PermissionDeniedError,
     InternalServerError,
     RateLimitError,
@@ -22,9 +37,15 @@ from openai import (
 
 TEST_BASE64_IMAGE = "data:image/png;base64,MockImageDataForTesting"
 TEST_IMAGE_TYPE = "png"
+USAGE = CompletionUsage(
+    prompt_tokens=2000,
+    completion_tokens=50,
+    total_tokens=2050,
+    prompt_tokens_details=PromptTokensDetails(cached_tokens=1536),
+)
 
 
-def create_mock_completion(parsed_data=None):
+def create_mock_completion(parsed_data=None, usage=None):
     return ParsedChatCompletion[ReceiptDetail](
         id="chatcmpl-Test1234567890",
         choices=[
@@ -47,6 +68,7 @@ def create_mock_completion(parsed_data=None):
         created=1756420606,
         model=OpenAIHandler.MODEL,
         object="chat.completion",
+        usage=usage,
     )
 
 
@@ -63,7 +85,10 @@ def test_receipt_detail() -> ReceiptDetail:
 @pytest.fixture
 def mock_openai_client(mocker: MockFixture):
     mock_client = mocker.MagicMock()
-    mocker.patch("src.receipt_scanner_model.open_ai.OpenAI", return_value=mock_client)
+    mocker.patch(
+        "src.receipt_scanner_model.open_ai.create_openai_client",
+        return_value=mock_client,
+    )
     return mock_client
 
 
@@ -184,3 +209,250 @@ def test_analyze_image_error_handling(
 
     assert exc_info.value.code == status_code
     assert exc_info.value.message == expected_message
+
+
+class StubStream:
+    """チャンクを順に返すOpenAIストリーミングのスタブ"""
+
+    def __init__(self, chunks: list[str]) -> None:
+        self.chunks = chunks
+
+    def __enter__(self):
+        return iter(
+            [SimpleNamespace(type="chunk", chunk=SimpleNamespace(usage=None))]
+            + [SimpleNamespace(type="content.delta", delta=c) for c in self.chunks]
+            + [SimpleNamespace(type="content.done")]
+            + [SimpleNamespace(type="chunk", chunk=SimpleNamespace(usage=USAGE))]
+        )
+
+    def __exit__(self, *args) -> None:
+        return None
+
+
+def test_stream_analyze_image_success(mock_openai_client):
+    chunks = [
+        '{"store_name": "Test',
+        ' Store", "date": "2023/10/01"',
+        ', "amount": 15',
+        '00, "category": "食費"}',
+    ]
+    mock_openai_client.beta.chat.completions.stream.return_value = StubStream(chunks)
+
+    openai_handler = OpenAIHandler()
+    events = list(
+        openai_handler.stream_analyze_image(TEST_BASE64_IMAGE, TEST_IMAGE_TYPE)
+    )
+
+    assert events == [
+        {"event": "field", "data": {"store_name": "Test Store"}},
+        {"event": "field", "data": {"date": "2023/10/01"}},
+        {"event": "field", "data": {"amount": 1500}},
+        {"event": "field", "data": {"category": "食費"}},
+        {
+            "event": "done",
+            "data": {
+                "store_name": "Test Store",
+                "date": "2023/10/01",
+                "amount": 1500,
+                "category": "食費",
+            },
+        },
+    ]
+    assert prompt_cache_metrics.snapshot()["cached_tokens"] == 1536
+
+
+def test_stream_analyze_image_response_format_error(mock_openai_client):
+    mock_openai_client.beta.chat.completions.stream.return_value = StubStream(
+        ['{"store_name": "Test Store"}']
+    )
+
+    openai_handler = OpenAIHandler()
+    with pytest.raises(OpenAIResponseFormatError) as exc_info:
+        list(openai_handler.stream_analyze_image(TEST_BASE64_IMAGE, TEST_IMAGE_TYPE))
+
+    assert exc_info.value.code == 503
+
+
+def test_stream_analyze_image_error_handling(mocker: MockFixture, mock_openai_client):
+    mock_openai_client.beta.chat.completions.stream.side_effect = APITimeoutError(
+        request=mocker.MagicMock()
+    )
+
+    openai_handler = OpenAIHandler()
+    with pytest.raises(OpenAIServiceUnavailable) as exc_info:
+        list(openai_handler.stream_analyze_image(TEST_BASE64_IMAGE, TEST_IMAGE_TYPE))
+
+    assert exc_info.value.code == 503
+
+
+def test_prompt_builder_static_prefix_is_reused():
+    """静的なシステムメッセージが毎回同じオブジェクトで先頭に置かれること"""
+    builder = PromptBuilder()
+
+    first = builder.build_messages("data:image/png;base64,AAAA")
+    second = builder.build_messages("data:image/jpeg;base64,BBBB")
+
+    assert first[0] is second[0] is builder.system_message
+    system_content = cast(str, builder.system_message["content"])
+    assert "store_name" in system_content
+    # 出力スキーマは response_format で送るため、システムプロンプトには含めない
+    assert '"properties"' not in system_content
+    assert cast(ChatCompletionUserMessageParam, first[1])["content"] == [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}
+    ]
+    assert builder.prompt_cache_key == PromptBuilder().prompt_cache_key
+
+
+def test_analyze_image_records_cached_tokens(
+    mock_openai_client, test_receipt_detail: ReceiptDetail
+):
+    """prompt_cache_keyを渡し、usageのキャッシュ割合を集計すること"""
+    mock_openai_client.beta.chat.completions.parse.return_value = (
+        create_mock_completion(test_receipt_detail, usage=USAGE)
+    )
+
+    OpenAIHandler().analyze_image(TEST_BASE64_IMAGE, TEST_IMAGE_TYPE)
+
+    kwargs = mock_openai_client.beta.chat.completions.parse.call_args.kwargs
+    assert kwargs["prompt_cache_key"] == prompt_builder.prompt_cache_key
+    assert kwargs["messages"][0] is prompt_builder.system_message
+    assert prompt_cache_metrics.snapshot() == {
+        "requests": 1,
+        "prompt_tokens": 2000,
+        "cached_tokens": 1536,
+        "cached_token_ratio": 0.768,
+    }
+
+
+def test_analyze_image_url_with_model_and_detail(
+    mock_openai_client, test_receipt_detail: ReceiptDetail
+):
+    """モデルと画像の解像度を指定できること"""
+    mock_openai_client.beta.chat.completions.parse.return_value = (
+        create_mock_completion(test_receipt_detail)
+    )
+
+    OpenAIHandler().analyze_image_url(
+        TEST_BASE64_IMAGE, model=OpenAIHandler.STRONG_MODEL, detail="low"
+    )
+
+    kwargs = mock_openai_client.beta.chat.completions.parse.call_args.kwargs
+    assert kwargs["model"] == OpenAIHandler.STRONG_MODEL
+    assert kwargs["messages"][1]["content"] == [
+        {"type": "image_url", "image_url": {"url": TEST_BASE64_IMAGE, "detail": "low"}}
+    ]
+
+
+def create_packed_completion(receipts):
+    return SimpleNamespace(
+        usage=None,
+        choices=[
+            SimpleNamespace(
+                message=SimpleNamespace(
+                    parsed=PackedReceiptDetails(receipts=receipts)
+                    if receipts is not None
+                    else None
+                )
+            )
+        ],
+    )
+
+
+def packed(index: int, store_name: str) -> PackedReceiptDetail:
+    return PackedReceiptDetail(
+        index=index, store_name=store_name, date=None, amount=100, category="食費"
+    )
+
+
+def test_analyze_images_packs_into_one_request(mocker: MockFixture, mock_openai_client):
+    """pack_size枚までを1回のリクエストで解析し、indexの順に並べ直すこと"""
+    mocker.patch("src.receipt_scanner_model.open_ai.setting.openai_pack_size", 3)
+    mock_openai_client.beta.chat.completions.parse.return_value = (
+        create_packed_completion([packed(2, "C"), packed(0, "A"), packed(1, "B")])
+    )
+
+    results = OpenAIHandler().analyze_images(
+        [
+            "data:image/png;base64,AAAA",
+            "data:image/jpeg;base64,BBBB",
+            "data:image/png;base64,CCCC",
+        ]
+    )
+
+    assert [result.store_name for result in results] == ["A", "B", "C"]
+    assert all(type(result) is ReceiptDetail for result in results)
+    mock_openai_client.beta.chat.completions.parse.assert_called_once()
+    kwargs = mock_openai_client.beta.chat.completions.parse.call_args.kwargs
+    assert kwargs["response_format"] is PackedReceiptDetails
+    assert kwargs["messages"][1]["content"][0] == {"type": "text", "text": "index: 0"}
+    assert kwargs["messages"][1]["content"][3] == {
+        "type": "image_url",
+        "image_url": {"url": "data:image/jpeg;base64,BBBB"},
+    }
+
+
+def test_analyze_images_resplits_misaligned_results(
+    mocker: MockFixture, mock_openai_client, test_receipt_detail: ReceiptDetail
+):
+    """indexが欠けたり重複した画像だけを1枚ずつ解析し直すこと"""
+    mocker.patch("src.receipt_scanner_model.open_ai.setting.openai_pack_size", 3)
+    mock_openai_client.beta.chat.completions.parse.side_effect = [
+        create_packed_completion([packed(0, "A"), packed(1, "B"), packed(1, "B2")]),
+        create_mock_completion(test_receipt_detail),
+        create_mock_completion(test_receipt_detail),
+    ]
+
+    results = OpenAIHandler().analyze_images(
+        [
+            "data:image/png;base64,AAAA",
+            "data:image/png;base64,BBBB",
+            "data:image/png;base64,CCCC",
+        ]
+    )
+
+    assert [result.store_name for result in results] == [
+        "A",
+        test_receipt_detail.store_name,
+        test_receipt_detail.store_name,
+    ]
+    assert mock_openai_client.beta.chat.completions.parse.call_count == 3
+
+
+def test_analyze_images_resplits_on_format_error(
+    mocker: MockFixture, mock_openai_client, test_receipt_detail: ReceiptDetail
+):
+    """まとめた応答が解析できない場合は全て1枚ずつ解析し直すこと"""
+    mocker.patch("src.receipt_scanner_model.open_ai.setting.openai_pack_size", 2)
+    mock_openai_client.beta.chat.completions.parse.side_effect = [
+        create_packed_completion(None),
+        create_mock_completion(test_receipt_detail),
+        create_mock_completion(test_receipt_detail),
+        create_mock_completion(test_receipt_detail),
+    ]
+
+    results = OpenAIHandler().analyze_images(
+        [
+            "data:image/png;base64,AAAA",
+            "data:image/png;base64,BBBB",
+            "data:image/png;base64,CCCC",
+        ]
+    )
+
+    assert results == [test_receipt_detail] * 3
+    assert mock_openai_client.beta.chat.completions.parse.call_count == 4
+
+
+def test_analyze_image_url_invalid_image_url(mocker: MockFixture, mock_openai_client):
+    """OpenAIが画像URLを取得できない場合OpenAIImageUrlErrorを送出すること"""
+    mock_response = mocker.MagicMock()
+    mock_response.status_code = 400
+    mock_openai_client.beta.chat.completions.parse.side_effect = BadRequestError(
+        message="Error while downloading",
+        response=mock_response,
+        body={"code": "invalid_image_url"},
+    )
+
+    with pytest.raises(OpenAIImageUrlError) as exc_info:
+        OpenAIHandler().analyze_image_url("https://example.com/receipt.png")
+
+    assert exc_info.value.code == 400
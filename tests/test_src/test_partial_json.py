@@ -0,0 +1,52 @@
+import pytest
+
+from src.receipt_scanner_model.partial_json import PartialJSONObjectParser
+
+RECEIPT_JSON = (
+    '{"store_name": "OK\\"ストア\\"", "date": "2024/01/01", '
+    '"amount": 1000, "category": null}'
+)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, len(RECEIPT_JSON)])
+def test_feed_emits_members_when_completed(chunk_size: int):
+    """チャンクの区切り方によらず、確定した順にメンバーが返ること"""
+    parser = PartialJSONObjectParser()
+    members = []
+    for i in range(0, len(RECEIPT_JSON), chunk_size):
+        members += list(parser.feed(RECEIPT_JSON[i : i + chunk_size]))
+
+    assert members == [
+        ("store_name", 'OK"ストア"'),
+        ("date", "2024/01/01"),
+        ("amount", 1000),
+        ("category", None),
+    ]
+    assert parser.finished
+    assert parser.text == RECEIPT_JSON
+
+
+def test_feed_does_not_emit_incomplete_number():
+    """数値の途中ではメンバーを返さないこと"""
+    parser = PartialJSONObjectParser()
+
+    assert list(parser.feed('{"amount": 10')) == []
+    assert list(parser.feed("00")) == []
+    assert list(parser.feed("}")) == [("amount", 1000)]
+
+
+def test_feed_ignores_delimiters_in_strings_and_nested_values():
+    """文字列中やネストした値の区切り文字ではメンバーを確定させないこと"""
+    parser = PartialJSONObjectParser()
+
+    members = list(parser.feed('{"store_name": "a,b}", "items": [1, {"x": 2}]}'))
+
+    assert members == [("store_name", "a,b}"), ("items", [1, {"x": 2}])]
+
+
+def test_feed_empty_object():
+    """空のオブジェクトでは何も返さないこと"""
+    parser = PartialJSONObjectParser()
+
+    assert list(parser.feed("{}")) == []
+    assert parser.finished
@@ -0,0 +1,309 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+from src.receipt_scanner_model.result_cache import (
+    InMemoryResultCacheBackend,
+    RedisResultCacheBackend,
+    ResultCache,
+    ResultCacheBackend,
+    SQLiteResultCacheBackend,
+    decode_receipt_detail,
+    encode_receipt_detail,
+)
+from src.receipt_scanner_model.single_flight import SingleFlight
+
+
+@pytest.fixture
+def test_receipt_detail() -> ReceiptDetail:
+    return ReceiptDetail(
+        store_name="Test Store",
+        date="2023/10/01",
+        amount=1500,
+        category="食費",
+    )
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend_factory(request, tmp_path: Path):
+    def factory(clock: FakeClock) -> ResultCacheBackend:
+        if request.param == "memory":
+            return InMemoryResultCacheBackend(clock=clock)
+        if request.param == "sqlite":
+            return SQLiteResultCacheBackend(tmp_path / "results.sqlite3", clock=clock)
+        fakeredis = pytest.importorskip("fakeredis")
+        return RedisResultCacheBackend(client=fakeredis.FakeRedis())
+
+    factory.kind = request.param  # type: ignore[attr-defined]
+    return factory
+
+
+def test_encode_decode_receipt_detail(test_receipt_detail: ReceiptDetail):
+    data = encode_receipt_detail(test_receipt_detail)
+
+    assert data == '["Test Store","2023/10/01",1500,"食費"]'.encode("utf-8")
+    assert decode_receipt_detail(data) == test_receipt_detail
+
+
+def test_encode_receipt_detail_is_smaller_than_model_dump_json(
+    test_receipt_detail: ReceiptDetail,
+):
+    assert len(encode_receipt_detail(test_receipt_detail)) < len(
+        test_receipt_detail.model_dump_json()
+    )
+
+
+def test_backend_get_set(backend_factory):
+    backend = backend_factory(FakeClock())
+
+    assert backend.get("key") is None
+    backend.set("key", b"value", ttl=60)
+
+    assert backend.get("key") == b"value"
+
+
+def test_redis_backend_with_decoded_responses():
+    """decode_responses=True のクライアントでも bytes を返し、自分のロックを解放できること"""
+    fakeredis = pytest.importorskip("fakeredis")
+    backend = RedisResultCacheBackend(client=fakeredis.FakeRedis(decode_responses=True))
+    backend.set("key", b"value", ttl=60)
+    backend.acquire_lock("key", "a", ttl=60)
+
+    backend.release_lock("key", "a")
+
+    assert backend.get("key") == b"value"
+    assert backend.is_locked("key") is False
+
+
+def test_backend_expires_after_ttl(backend_factory):
+    if backend_factory.kind == "redis":
+        pytest.skip("Redis側で有効期限を管理するため")
+    clock = FakeClock()
+    backend = backend_factory(clock)
+    backend.set("key", b"value", ttl=60)
+
+    clock.now += 61
+
+    assert backend.get("key") is None
+
+
+def test_backend_lock(backend_factory):
+    backend = backend_factory(FakeClock())
+
+    assert backend.acquire_lock("key", "a", ttl=60) is True
+    assert backend.acquire_lock("key", "b", ttl=60) is False
+    assert backend.is_locked("key") is True
+
+    backend.release_lock("key", "a")
+
+    assert backend.is_locked("key") is False
+    assert backend.acquire_lock("key", "b", ttl=60) is True
+
+
+def test_backend_lock_is_released_only_by_owner(backend_factory):
+    backend = backend_factory(FakeClock())
+    backend.acquire_lock("key", "a", ttl=60)
+
+    backend.release_lock("key", "b")
+
+    assert backend.is_locked("key") is True
+
+
+def test_in_memory_backend_evicts_least_recently_used():
+    backend = InMemoryResultCacheBackend(max_entries=2)
+    backend.set("a", b"1", ttl=60)
+    backend.set("b", b"2", ttl=60)
+    backend.get("a")
+    backend.set("c", b"3", ttl=60)
+
+    assert backend.get("a") == b"1"
+    assert backend.get("b") is None
+    assert backend.get("c") == b"3"
+
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path: Path):
+    db_fp = tmp_path / "results.sqlite3"
+    SQLiteResultCacheBackend(db_fp).set("key", b"value", ttl=60)
+
+    assert SQLiteResultCacheBackend(db_fp).get("key") == b"value"
+
+
+def test_result_cache_returns_cached_result(test_receipt_detail: ReceiptDetail):
+    cache = ResultCache(InMemoryResultCacheBackend())
+    calls = []
+
+    def compute() -> ReceiptDetail:
+        calls.append(1)
+        return test_receipt_detail
+
+    assert cache.get_or_compute("key", compute) == test_receipt_detail
+    assert cache.get_or_compute("key", compute) == test_receipt_detail
+    assert len(calls) == 1
+
+
+def test_result_cache_without_backend_always_computes(
+    test_receipt_detail: ReceiptDetail,
+):
+    cache = ResultCache(None)
+    calls = []
+
+    def compute() -> ReceiptDetail:
+        calls.append(1)
+        return test_receipt_detail
+
+    cache.get_or_compute("key", compute)
+    cache.get_or_compute("key", compute)
+
+    assert len(calls) == 2
+
+
+def test_result_cache_does_not_cache_errors(test_receipt_detail: ReceiptDetail):
+    cache = ResultCache(InMemoryResultCacheBackend())
+
+    def fail() -> ReceiptDetail:
+        raise ValueError("error")
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute("key", fail)
+
+    assert cache.get_or_compute("key", lambda: test_receipt_detail) == (
+        test_receipt_detail
+    )
+
+
+def test_result_cache_concurrent_requests_compute_once(
+    test_receipt_detail: ReceiptDetail,
+):
+    cache = ResultCache(InMemoryResultCacheBackend())
+    calls = []
+    started = threading.Event()
+
+    def compute() -> ReceiptDetail:
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return test_receipt_detail
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_compute("key", compute))
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [test_receipt_detail] * 8
+
+
+def test_result_cache_waits_for_other_worker(
+    tmp_path: Path, test_receipt_detail: ReceiptDetail
+):
+    # 別プロセスのワーカーを、同じSQLiteファイルを参照する別インスタンスで再現する
+    db_fp = tmp_path / "results.sqlite3"
+    worker_a = ResultCache(SQLiteResultCacheBackend(db_fp), poll_interval=0.01)
+    worker_b = ResultCache(SQLiteResultCacheBackend(db_fp), poll_interval=0.01)
+    calls = []
+    started = threading.Event()
+
+    def compute() -> ReceiptDetail:
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return test_receipt_detail
+
+    thread = threading.Thread(target=worker_a.get_or_compute, args=("key", compute))
+    thread.start()
+    started.wait()
+
+    assert worker_b.get_or_compute("key", compute) == test_receipt_detail
+    thread.join()
+    assert len(calls) == 1
+
+
+class BrokenBackend(InMemoryResultCacheBackend):
+    """接続できないバックエンド"""
+
+    def get(self, key: str) -> bytes | None:
+        raise ConnectionError("unavailable")
+
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        raise ConnectionError("unavailable")
+
+    def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        raise ConnectionError("unavailable")
+
+    def release_lock(self, key: str, token: str) -> None:
+        raise ConnectionError("unavailable")
+
+    def is_locked(self, key: str) -> bool:
+        raise ConnectionError("unavailable")
+
+
+def test_result_cache_computes_when_backend_is_unavailable(
+    test_receipt_detail: ReceiptDetail,
+):
+    cache = ResultCache(BrokenBackend())
+
+    assert cache.get_or_compute("key", lambda: test_receipt_detail) == (
+        test_receipt_detail
+    )
+
+
+def test_result_cache_does_not_release_lock_of_other_worker(
+    test_receipt_detail: ReceiptDetail,
+):
+    """待機がタイムアウトしてロックを取得できなかった場合、他のワーカーのロックを解放しないこと"""
+    backend = InMemoryResultCacheBackend()
+    backend.acquire_lock("key", "other", ttl=60)
+    cache = ResultCache(backend, lock_ttl=0.05, poll_interval=0.01)
+
+    assert cache.get_or_compute("key", lambda: test_receipt_detail) == (
+        test_receipt_detail
+    )
+    assert backend.is_locked("key") is True
+    assert backend._locks["key"][1] == "other"
+
+
+def test_single_flight_propagates_exception_to_followers():
+    single_flight: SingleFlight[int] = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fail() -> int:
+        release.wait()
+        raise ValueError("error")
+
+    def call() -> None:
+        try:
+            single_flight.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while single_flight.in_flight() == 0:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 4
+    assert single_flight.in_flight() == 0
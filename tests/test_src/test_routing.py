@@ -0,0 +1,165 @@
+import os
+from unittest.mock import MagicMock, call
+
+import cv2
+import numpy as np
+import pytest
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model.metrics import routing_metrics
+from src.receipt_scanner_model.open_ai import OpenAIHandler, ReceiptDetail
+from src.receipt_scanner_model.routing import (
+    ROUTES,
+    ImageFeatures,
+    analyze_with_routing,
+    choose_route,
+    measure_image,
+    validate_receipt_detail,
+)
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+TEST_IMAGE_PATH = os.path.join(current_dir, "../../raw/coffee.jpeg")
+TEST_IMAGE_URL = "data:image/png;base64,MockImageDataForTesting"
+
+VALID = ReceiptDetail(
+    store_name="Test", date="2024/06/01", amount=1500, category="食費"
+)
+MISSING_AMOUNT = ReceiptDetail(
+    store_name="Test", date="2024/06/01", amount=None, category="食費"
+)
+
+
+def features(
+    width: int = 400, height: int = 600, text_density=0.1, sharpness=5000.0
+) -> ImageFeatures:
+    return ImageFeatures(
+        width=width, height=height, text_density=text_density, sharpness=sharpness
+    )
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    _, buffer = cv2.imencode(".png", image)
+    return buffer.tobytes()
+
+
+def test_measure_image():
+    with open(TEST_IMAGE_PATH, "rb") as f:
+        result = measure_image(f.read())
+
+    assert (result.width, result.height) == (360, 598)
+    assert 0 < result.text_density < 1
+    assert result.sharpness > 0
+
+
+def test_measure_image_detects_blur():
+    rng = np.random.default_rng(0)
+    sharp = (rng.random((400, 300)) > 0.9).astype(np.uint8) * 255
+    blurred = cv2.GaussianBlur(sharp, (15, 15), 5)
+
+    assert (
+        measure_image(encode_png(blurred)).sharpness
+        < measure_image(encode_png(sharp)).sharpness
+    )
+
+
+def test_measure_image_invalid():
+    with pytest.raises(ValueError):
+        measure_image(b"not an image")
+
+
+@pytest.mark.parametrize(
+    "image_features, expected",
+    [
+        (features(), 0),
+        # 縮小すると文字が潰れる
+        (features(width=400, height=1600), 1),
+        # 文字が密集している
+        (features(text_density=0.3), 1),
+        # ぼけている
+        (features(sharpness=10), len(ROUTES) - 1),
+    ],
+)
+def test_choose_route(image_features: ImageFeatures, expected: int):
+    assert choose_route(image_features) == expected
+
+
+@pytest.mark.parametrize(
+    "receipt_detail, expected",
+    [
+        (VALID, []),
+        (VALID.model_copy(update={"date": None}), []),
+        (VALID.model_copy(update={"amount": None}), ["amount"]),
+        (VALID.model_copy(update={"amount": 0}), ["amount"]),
+        (VALID.model_copy(update={"date": "2024-06-01"}), ["date"]),
+        (VALID.model_copy(update={"date": "2024/13/01"}), ["date"]),
+    ],
+)
+def test_validate_receipt_detail(receipt_detail: ReceiptDetail, expected: list[str]):
+    assert validate_receipt_detail(receipt_detail) == expected
+
+
+def test_analyze_with_routing_uses_chosen_route(mocker: MockFixture):
+    mocker.patch(
+        "src.receipt_scanner_model.routing.measure_image", return_value=features()
+    )
+    handler = MagicMock(spec=OpenAIHandler)
+    handler.analyze_image_url.return_value = VALID
+
+    result = analyze_with_routing(handler, b"image", TEST_IMAGE_URL)
+
+    assert result == VALID
+    handler.analyze_image_url.assert_called_once_with(
+        TEST_IMAGE_URL, model=OpenAIHandler.MODEL, detail="low"
+    )
+    assert routing_metrics.snapshot() == {
+        "routes": {f"{OpenAIHandler.MODEL}/low": 1},
+        "escalations": {},
+    }
+
+
+def test_analyze_with_routing_escalates_on_invalid_result(mocker: MockFixture):
+    mocker.patch(
+        "src.receipt_scanner_model.routing.measure_image", return_value=features()
+    )
+    handler = MagicMock(spec=OpenAIHandler)
+    handler.analyze_image_url.side_effect = [MISSING_AMOUNT, MISSING_AMOUNT, VALID]
+
+    result = analyze_with_routing(handler, b"image", TEST_IMAGE_URL)
+
+    assert result == VALID
+    assert handler.analyze_image_url.call_args_list == [
+        call(TEST_IMAGE_URL, model=route.model, detail=route.detail) for route in ROUTES
+    ]
+    assert routing_metrics.snapshot()["escalations"] == {
+        f"{OpenAIHandler.MODEL}/high": 1,
+        f"{OpenAIHandler.STRONG_MODEL}/high": 1,
+    }
+
+
+def test_analyze_with_routing_returns_last_result(mocker: MockFixture):
+    """最後の段階でも検証に失敗した場合は、その結果を返すこと"""
+    mocker.patch(
+        "src.receipt_scanner_model.routing.measure_image",
+        return_value=features(sharpness=10),
+    )
+    handler = MagicMock(spec=OpenAIHandler)
+    handler.analyze_image_url.return_value = MISSING_AMOUNT
+
+    result = analyze_with_routing(handler, b"image", TEST_IMAGE_URL)
+
+    assert result == MISSING_AMOUNT
+    handler.analyze_image_url.assert_called_once_with(
+        TEST_IMAGE_URL, model=OpenAIHandler.STRONG_MODEL, detail="high"
+    )
+
+
+def test_analyze_with_routing_unreadable_image():
+    """計測できない画像は detail: high で解析すること"""
+    handler = MagicMock(spec=OpenAIHandler)
+    handler.analyze_image_url.return_value = VALID
+
+    analyze_with_routing(handler, b"not an image", TEST_IMAGE_URL)
+
+    handler.analyze_image_url.assert_called_once_with(
+        TEST_IMAGE_URL, model=OpenAIHandler.MODEL, detail="high"
+    )
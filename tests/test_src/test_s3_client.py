@@ -1,12 +1,14 @@
 from pytest_mock import MockFixture
 import pytest
 import io
+from PIL import Image
 from botocore.exceptions import (
     ClientError,
     EndpointConnectionError,
     ConnectTimeoutError,
 )
 from src.receipt_scanner_model.s3_client import S3Client, MAX_FILE_SIZE
+from src.receipt_scanner_model.image_validation import HEADER_PROBE_BYTES
 from src.receipt_scanner_model.error import (
     S3BadRequest,
     S3NotFound,
@@ -17,6 +19,18 @@ from src.receipt_scanner_model.error import (
 )
 
 
+def make_image(
+    image_format: str = "PNG", color: tuple[int, int, int] = (255, 255, 255)
+) -> bytes:
+    """テスト用の小さな画像を作成する"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), color).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+PNG_IMAGE = make_image()
+
+
 @pytest.fixture
 def s3_client():
     return S3Client()
@@ -25,19 +39,19 @@ def s3_client():
 @pytest.fixture
 def mock_boto3_client(mocker: MockFixture):
     """boto3.client関数自体をモック（初期化パラメータのテスト用）"""
-    return mocker.patch("src.receipt_scanner_model.s3_client.boto3.client")
+    return mocker.patch("boto3.client")
 
 
 @pytest.fixture
 def mock_aws_s3_client(mocker: MockFixture):
     """S3クライアントインスタンスをモック（S3操作のテスト用）"""
-    return mocker.patch("src.receipt_scanner_model.s3_client.boto3.client").return_value
+    return mocker.patch("boto3.client").return_value
 
 
 def setup_s3_mocks(
     mock_s3_client,
     content_length=1024,
-    file_content=b"test_content",
+    file_content=PNG_IMAGE,
     content_type="image/png",
 ):
     """S3モックの共通セットアップ"""
@@ -72,7 +86,7 @@ def test_init_creates_s3_client_with_specific_parameters(mocker, mock_boto3_clie
 def test_download_image_by_filename_success(mock_aws_s3_client, s3_client):
     """download_image_by_filenameが正常に動作することをテスト"""
     test_filename = "test_receipt.jpg"
-    file_content = b"test_image_content"
+    file_content = make_image(color=(0, 0, 0))
     content_type = "image/png"
 
     setup_s3_mocks(mock_aws_s3_client, content_length=1024, file_content=file_content)
@@ -112,7 +126,7 @@ def test_file_size_boundary_values(
 ):
     """境界値テスト: ファイルサイズの上限・下限値"""
     test_filename = "test_receipt.jpg"
-    file_content = b"test_content"
+    file_content = PNG_IMAGE
     content_type = "image/png"
 
     if expected_success:
@@ -313,3 +327,233 @@ def test_invalid_content_type(file_name, content_type, mock_aws_s3_client, s3_cl
         s3_client.download_image_by_filename(file_name)
 
     assert exc_info.value.code == 400
+
+
+def test_generate_presigned_image_url_success(mock_aws_s3_client, s3_client):
+    """HEADで検証した上で署名付きURLを発行することをテスト"""
+    test_filename = "test_receipt.jpg"
+    setup_s3_mocks(
+        mock_aws_s3_client, file_content=make_image("JPEG"), content_type="image/jpeg"
+    )
+    mock_aws_s3_client.generate_presigned_url.return_value = "https://example.com/url"
+
+    url, content_type = s3_client.generate_presigned_image_url(
+        test_filename, expires_in=60
+    )
+
+    assert url == "https://example.com/url"
+    assert content_type == "image/jpeg"
+    mock_aws_s3_client.generate_presigned_url.assert_called_once_with(
+        "get_object",
+        Params={"Bucket": s3_client.bucket_name, "Key": test_filename},
+        ExpiresIn=60,
+    )
+    # 画像全体ではなく、先頭だけを取得して検証する
+    assert mock_aws_s3_client.get_object.call_args.kwargs["Range"] == (
+        f"bytes=0-{HEADER_PROBE_BYTES - 1}"
+    )
+
+
+@pytest.mark.parametrize(
+    "file_content, content_type",
+    [
+        # Content-Type と中身が一致しない
+        (make_image("JPEG"), "image/png"),
+        # 変換が必要な形式（範囲指定の取得も行わない）
+        (make_image("WEBP"), "image/webp"),
+    ],
+)
+def test_generate_presigned_image_url_requires_download(
+    mock_aws_s3_client, s3_client, file_content: bytes, content_type: str
+):
+    """そのまま送れると確認できない画像は、署名付きURLを発行しないことをテスト"""
+    setup_s3_mocks(
+        mock_aws_s3_client, file_content=file_content, content_type=content_type
+    )
+
+    url, _ = s3_client.generate_presigned_image_url("test.png")
+
+    assert url is None
+    mock_aws_s3_client.generate_presigned_url.assert_not_called()
+
+
+def test_generate_presigned_image_url_rejects_invalid_body(
+    mock_aws_s3_client, s3_client
+):
+    """中身が画像ではない場合は、ダウンロード時と同様に400とすることをテスト"""
+    setup_s3_mocks(mock_aws_s3_client, file_content=b"%PDF-1.7" + b"\x00" * 8)
+
+    with pytest.raises(S3BadRequest):
+        s3_client.generate_presigned_image_url("test.png")
+
+    mock_aws_s3_client.generate_presigned_url.assert_not_called()
+
+
+def test_generate_presigned_image_url_invalid_metadata(mock_aws_s3_client, s3_client):
+    """メタデータが不正な場合は署名付きURLを発行しないことをテスト"""
+    mock_aws_s3_client.head_object.return_value = {
+        "ContentLength": MAX_FILE_SIZE + 1,
+        "ContentType": "image/png",
+    }
+
+    with pytest.raises(S3BadRequest):
+        s3_client.generate_presigned_image_url("test.png")
+
+    mock_aws_s3_client.generate_presigned_url.assert_not_called()
+
+
+def not_modified_error() -> ClientError:
+    return ClientError(
+        {
+            "Error": {"Code": "304", "Message": "Not Modified"},
+            "ResponseMetadata": {"HTTPStatusCode": 304},
+        },
+        "GetObject",
+    )
+
+
+def test_download_revalidates_cached_object(mock_aws_s3_client, s3_client):
+    """キャッシュした画像はIfNoneMatchで再検証し、変更がなければ転送しないことをテスト"""
+    image_v1 = make_image(color=(0, 0, 0))
+    setup_s3_mocks(mock_aws_s3_client, file_content=image_v1)
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+    s3_client.download_image_by_filename("test_receipt.jpg")
+
+    mock_aws_s3_client.reset_mock()
+    mock_aws_s3_client.get_object.side_effect = not_modified_error()
+
+    result = s3_client.download_image_by_filename("test_receipt.jpg")
+
+    assert result == (image_v1, "image/png")
+    mock_aws_s3_client.head_object.assert_not_called()
+    mock_aws_s3_client.get_object.assert_called_once_with(
+        Bucket=s3_client.bucket_name, Key="test_receipt.jpg", IfNoneMatch='"v1"'
+    )
+
+
+def test_download_refreshes_changed_object(mock_aws_s3_client, s3_client):
+    """ETagが変わった場合は新しい画像を返し、キャッシュを更新することをテスト"""
+    setup_s3_mocks(mock_aws_s3_client)
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+    s3_client.download_image_by_filename("test_receipt.jpg")
+
+    image_v2 = make_image("JPEG")
+    mock_aws_s3_client.get_object.return_value = {
+        "Body": io.BytesIO(image_v2),
+        "ETag": '"v2"',
+        "ContentLength": len(image_v2),
+        "ContentType": "image/jpeg",
+    }
+
+    assert s3_client.download_image_by_filename("test_receipt.jpg") == (
+        image_v2,
+        "image/jpeg",
+    )
+    cached = s3_client.object_cache.get(f"{s3_client.bucket_name}/test_receipt.jpg")
+    assert cached is not None
+    assert cached.etag == '"v2"'
+
+
+def test_download_changed_object_is_validated(mock_aws_s3_client, s3_client):
+    """再検証で取得した画像もサイズ・Content-Typeを検証することをテスト"""
+    setup_s3_mocks(mock_aws_s3_client)
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+    s3_client.download_image_by_filename("test_receipt.jpg")
+
+    mock_aws_s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b"text"),
+        "ETag": '"v2"',
+        "ContentLength": 4,
+        "ContentType": "text/plain",
+    }
+
+    with pytest.raises(S3BadRequest):
+        s3_client.download_image_by_filename("test_receipt.jpg")
+
+
+def test_download_rejects_body_that_is_not_image(mock_aws_s3_client, s3_client):
+    """Content-Typeが画像でも、中身が画像でない場合はS3BadRequestを送出しキャッシュしないことをテスト"""
+    setup_s3_mocks(mock_aws_s3_client, file_content=b"<html>not an image</html>")
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+
+    with pytest.raises(S3BadRequest) as exc_info:
+        s3_client.download_image_by_filename("test_receipt.png")
+
+    assert exc_info.value.code == 400
+    assert (
+        s3_client.object_cache.get(f"{s3_client.bucket_name}/test_receipt.png") is None
+    )
+
+
+def test_download_converts_webp_to_jpeg(mock_aws_s3_client, s3_client):
+    """WebPの画像はJPEGに変換し、変換後の画像をキャッシュすることをテスト"""
+    setup_s3_mocks(
+        mock_aws_s3_client, file_content=make_image("WEBP"), content_type="image/webp"
+    )
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+
+    body, content_type = s3_client.download_image_by_filename("test_receipt.webp")
+
+    assert content_type == "image/jpeg"
+    assert body.startswith(b"\xff\xd8\xff")
+    cached = s3_client.object_cache.get(f"{s3_client.bucket_name}/test_receipt.webp")
+    assert cached is not None
+    assert (cached.body, cached.content_type) == (body, "image/jpeg")
+
+
+def test_download_revalidates_converted_object_by_original_size(
+    mock_aws_s3_client, s3_client
+):
+    """変換した画像の再検証では、変換後ではなく元の画像の大きさで検証することをテスト"""
+    webp_image = make_image("WEBP")
+    setup_s3_mocks(
+        mock_aws_s3_client,
+        content_length=len(webp_image),
+        file_content=webp_image,
+        content_type="image/webp",
+    )
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+    body, _ = s3_client.download_image_by_filename(
+        "test_receipt.webp", max_size=len(webp_image)
+    )
+    assert len(body) > len(webp_image)
+
+    mock_aws_s3_client.get_object.side_effect = not_modified_error()
+
+    assert s3_client.download_image_by_filename(
+        "test_receipt.webp", max_size=len(webp_image)
+    ) == (body, "image/jpeg")
+
+
+def test_download_evicts_deleted_object(mock_aws_s3_client, s3_client):
+    """再検証でオブジェクトが削除されていた場合はキャッシュから削除することをテスト"""
+    setup_s3_mocks(mock_aws_s3_client)
+    mock_aws_s3_client.get_object.return_value["ETag"] = '"v1"'
+    s3_client.download_image_by_filename("test_receipt.jpg")
+
+    mock_aws_s3_client.get_object.side_effect = ClientError(
+        {
+            "Error": {"Code": "NoSuchKey", "Message": "Not Found"},
+            "ResponseMetadata": {"HTTPStatusCode": 404},
+        },
+        "GetObject",
+    )
+
+    with pytest.raises(S3NotFound):
+        s3_client.download_image_by_filename("test_receipt.jpg")
+
+    assert (
+        s3_client.object_cache.get(f"{s3_client.bucket_name}/test_receipt.jpg") is None
+    )
+
+
+def test_get_image_validates_body(mock_aws_s3_client, s3_client):
+    """get_imageも中身が画像でない場合はS3BadRequestを送出することをテスト"""
+    mock_aws_s3_client.get_object.return_value = {
+        "Body": io.BytesIO(b"GIF89a" + b"\x00" * 16),
+        "ContentLength": 22,
+        "ContentType": "image/png",
+    }
+
+    with pytest.raises(S3BadRequest):
+        s3_client.get_image("test_receipt.png")
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+from src.receipt_scanner_model.s3_object_cache import CachedObject, S3ObjectCache
+
+
+def cached_object(body: bytes, etag: str = '"etag"') -> CachedObject:
+    return CachedObject(body=body, etag=etag, content_type="image/png", size=len(body))
+
+
+def test_get_put():
+    cache = S3ObjectCache(max_bytes=100)
+
+    assert cache.get("a") is None
+    cache.put("a", cached_object(b"12345"))
+
+    assert cache.get("a") == cached_object(b"12345")
+    assert cache.snapshot()["memory_bytes"] == 5
+
+
+def test_evicts_least_recently_used_by_bytes():
+    cache = S3ObjectCache(max_bytes=10)
+    cache.put("a", cached_object(b"1234"))
+    cache.put("b", cached_object(b"1234"))
+    cache.get("a")
+    cache.put("c", cached_object(b"1234"))
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.snapshot()["memory_bytes"] == 8
+
+
+def test_does_not_keep_object_larger_than_limit():
+    cache = S3ObjectCache(max_bytes=4)
+    cache.put("a", cached_object(b"12345"))
+
+    assert cache.get("a") is None
+    assert cache.snapshot()["memory_bytes"] == 0
+
+
+def test_replace_updates_bytes():
+    cache = S3ObjectCache(max_bytes=100)
+    cache.put("a", cached_object(b"1234", etag='"v1"'))
+    cache.put("a", cached_object(b"12", etag='"v2"'))
+
+    assert cache.get("a") == cached_object(b"12", etag='"v2"')
+    assert cache.snapshot()["memory_bytes"] == 2
+
+
+def test_disk_tier_survives_restart(tmp_path: Path):
+    S3ObjectCache(max_bytes=0, disk_dir=tmp_path, disk_max_bytes=1000).put(
+        "a", cached_object(b"image")
+    )
+
+    cache = S3ObjectCache(max_bytes=100, disk_dir=tmp_path, disk_max_bytes=1000)
+
+    assert cache.get("a") == cached_object(b"image")
+    # ディスクから読んだ画像はメモリにも保持する
+    assert cache.snapshot()["memory_objects"] == 1
+
+
+def test_disk_tier_evicts_oldest(tmp_path: Path):
+    cache = S3ObjectCache(max_bytes=0, disk_dir=tmp_path, disk_max_bytes=150)
+    cache.put("a", cached_object(b"x" * 50))
+    cache.put("b", cached_object(b"x" * 50))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_clear(tmp_path: Path):
+    cache = S3ObjectCache(max_bytes=100, disk_dir=tmp_path, disk_max_bytes=1000)
+    cache.put("a", cached_object(b"image"))
+
+    cache.clear()
+
+    assert cache.get("a") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_delete(tmp_path: Path):
+    cache = S3ObjectCache(max_bytes=100, disk_dir=tmp_path, disk_max_bytes=1000)
+    cache.put("a", cached_object(b"image"))
+    cache.put("b", cached_object(b"image"))
+
+    cache.delete("a")
+    cache.delete("missing")
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.snapshot()["memory_objects"] == 1
+    assert cache.snapshot()["disk_objects"] == 1
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,195 @@
+import io
+import time
+from pathlib import Path
+
+import boto3
+import pytest
+from PIL import Image
+
+from src.receipt_scanner_model.audit import AuditRecord
+from src.receipt_scanner_model.error import S3Forbidden, S3NotFound
+from src.receipt_scanner_model.s3_client import S3Client
+from src.receipt_scanner_model.s3_scan import S3PrefixScanner
+from src.receipt_scanner_model.setting import setting
+
+moto = pytest.importorskip("moto")
+
+PREFIX = "receipts/"
+
+
+def make_image(image_format: str = "PNG", width: int = 4) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, 4), (255, 255, 255)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+PNG_IMAGE = make_image()
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        region = setting.aws_default_region
+        client = boto3.client("s3", region_name=region)
+        # us-east-1 では LocationConstraint を指定できない
+        if region == "us-east-1":
+            client.create_bucket(Bucket=setting.bucket_name)
+        else:
+            client.create_bucket(
+                Bucket=setting.bucket_name,
+                CreateBucketConfiguration={"LocationConstraint": region},
+            )
+        yield client
+
+
+def put(s3, key: str, body: bytes, content_type: str) -> None:
+    s3.put_object(
+        Bucket=setting.bucket_name, Key=key, Body=body, ContentType=content_type
+    )
+
+
+def test_iter_objects_follows_pages(s3):
+    for i in range(5):
+        put(s3, f"{PREFIX}{i}.png", PNG_IMAGE, "image/png")
+    put(s3, "other/0.png", PNG_IMAGE, "image/png")
+    client = S3Client()
+    client.s3_client = s3
+    original = s3.list_objects_v2
+    pages = []
+
+    def list_objects_v2(**kwargs):
+        pages.append(kwargs)
+        return original(MaxKeys=2, **kwargs)
+
+    s3.list_objects_v2 = list_objects_v2
+
+    keys = [key for key, _ in client.iter_objects(PREFIX)]
+
+    assert keys == [f"{PREFIX}{i}.png" for i in range(5)]
+    assert len(pages) == 3
+
+
+def test_iter_objects_records_list_calls(s3, mocker):
+    put(s3, f"{PREFIX}0.png", PNG_IMAGE, "image/png")
+    client = S3Client()
+    client.s3_client = s3
+    original = s3.list_objects_v2
+
+    def list_objects_v2(**kwargs):
+        time.sleep(0.05)
+        return original(**kwargs)
+
+    s3.list_objects_v2 = list_objects_v2
+    record = AuditRecord("/backfill")
+    add_s3 = mocker.spy(record, "add_s3")
+
+    with record.activate():
+        keys = [key for key, _ in client.iter_objects(PREFIX)]
+
+    assert keys == [f"{PREFIX}0.png"]
+    # 一覧の取得1回分の処理時間が記録される
+    add_s3.assert_called_once()
+    assert record.s3_seconds >= 0.05
+
+
+def test_scan_filters_and_downloads(s3):
+    jpeg_image = make_image("JPEG")
+    put(s3, f"{PREFIX}a.png", PNG_IMAGE, "image/png")
+    put(s3, f"{PREFIX}b.jpg", jpeg_image, "image/jpeg")
+    put(s3, f"{PREFIX}c.txt", b"text", "text/plain")
+    put(s3, f"{PREFIX}d.png", b"", "image/png")
+    put(s3, f"{PREFIX}e.png", PNG_IMAGE + b"\x00" * 1000, "image/png")
+    # 拡張子は画像だがContent-Typeが画像ではない
+    put(s3, f"{PREFIX}f.png", b"text", "text/plain")
+    # Content-Typeは画像だが中身が画像ではない
+    put(s3, f"{PREFIX}g.png", b"text", "image/png")
+    # 拡張子はないがContent-Typeが画像（アップロード時のUUIDのキー）
+    put(s3, f"{PREFIX}h", PNG_IMAGE, "image/png")
+
+    scanner = S3PrefixScanner(workers=2, max_size=1000)
+
+    results = sorted(scanner.scan(PREFIX))
+
+    assert results == [
+        (f"{PREFIX}a.png", PNG_IMAGE, "image/png"),
+        (f"{PREFIX}b.jpg", jpeg_image, "image/jpeg"),
+        (f"{PREFIX}h", PNG_IMAGE, "image/png"),
+    ]
+
+
+def test_scan_filters_by_original_content_type(s3):
+    put(s3, f"{PREFIX}a.png", PNG_IMAGE, "image/png")
+    put(s3, f"{PREFIX}b.webp", make_image("WEBP"), "image/webp")
+
+    scanner = S3PrefixScanner(workers=2, content_types=("image/webp",))
+
+    results = list(scanner.scan(PREFIX))
+
+    # 変換後の image/jpeg ではなく、元のContent-Typeで絞り込む
+    assert [(key, content_type) for key, _, content_type in results] == [
+        (f"{PREFIX}b.webp", "image/jpeg")
+    ]
+
+
+def test_scan_many_objects(s3):
+    keys = [f"{PREFIX}{i:03}.png" for i in range(50)]
+    images = {key: make_image(width=i + 1) for i, key in enumerate(keys)}
+    for key, image in images.items():
+        put(s3, key, image, "image/png")
+
+    scanner = S3PrefixScanner(workers=4)
+
+    results = list(scanner.scan(PREFIX))
+
+    assert sorted(key for key, _, _ in results) == keys
+    assert all(body == images[key] for key, body, _ in results)
+
+
+def test_scan_resumes_from_checkpoint(s3, tmp_path: Path):
+    keys = [f"{PREFIX}{i}.png" for i in range(6)]
+    for key in keys:
+        put(s3, key, PNG_IMAGE, "image/png")
+    checkpoint_fp = tmp_path / "checkpoint.json"
+
+    # 1件ずつ処理する場合、次を要求した時点で前の画像が処理済みになる
+    scanner = S3PrefixScanner(workers=1, checkpoint_fp=checkpoint_fp)
+    scan = scanner.scan(PREFIX)
+    processed = [next(scan)[0] for _ in range(3)]
+    scan.close()
+
+    assert processed == keys[:3]
+    assert scanner.load_checkpoint(PREFIX) == keys[1]
+    assert scanner.load_checkpoint("other/") is None
+
+    resumed = [key for key, _, _ in scanner.scan(PREFIX)]
+
+    assert resumed == keys[2:]
+    assert scanner.load_checkpoint(PREFIX) == keys[-1]
+
+
+def test_scan_skips_deleted_object(s3, mocker):
+    """一覧の取得後に削除されたオブジェクトはスキップして続けること"""
+    put(s3, f"{PREFIX}a.png", PNG_IMAGE, "image/png")
+    put(s3, f"{PREFIX}b.png", PNG_IMAGE, "image/png")
+    original = S3Client.get_image
+
+    def get_image(self, filename: str, *args):
+        if filename == f"{PREFIX}a.png":
+            raise S3NotFound(404, "Not Found")
+        return original(self, filename, *args)
+
+    mocker.patch.object(S3Client, "get_image", get_image)
+
+    results = list(S3PrefixScanner(workers=1).scan(PREFIX))
+
+    assert [key for key, _, _ in results] == [f"{PREFIX}b.png"]
+
+
+def test_scan_raises_download_error(s3, mocker):
+    put(s3, f"{PREFIX}a.png", PNG_IMAGE, "image/png")
+    mocker.patch.object(
+        S3Client, "get_image", side_effect=S3Forbidden(500, "Forbidden")
+    )
+
+    with pytest.raises(S3Forbidden):
+        list(S3PrefixScanner(workers=1).scan(PREFIX))
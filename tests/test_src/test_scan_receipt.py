@@ -4,6 +4,7 @@ import os
 from src.receipt_scanner_model import scan_receipt
 from PIL import Image
 import io
+import json
 import pytest
 
 # 現在のスクリプトのディレクトリを取得
@@ -67,3 +68,213 @@ def test_get_most_likely():
     expected = 1125
     actual = scan_receipt.get_most_likely(kws_amount_dict, count_amount_dict)
     assert expected == actual
+
+
+def ocr_data(words: list[tuple]) -> dict[str, list]:
+    """image_to_data（Output.DICT）と同じ形式のデータを作成する
+
+    words の各要素は (block_num, line_num, text, left, top, width, height, conf)
+    """
+    keys = ["level", "page_num", "block_num", "par_num", "line_num", "word_num"]
+    keys += ["left", "top", "width", "height", "conf", "text"]
+    data: dict[str, list] = {key: [] for key in keys}
+    # ページ全体を表す行（単語ではない）
+    for key, value in zip(keys, [1, 1, 0, 0, 0, 0, 0, 0, 1000, 1000, -1, ""]):
+        data[key].append(value)
+    for i, (block, line, text, left, top, width, height, conf) in enumerate(words):
+        values = [5, 1, block, 1, line, i + 1, left, top, width, height, conf, text]
+        for key, value in zip(keys, values):
+            data[key].append(value)
+    return data
+
+
+def test_ocr_result_from_data():
+    """単語だけを列ごとの配列にし、ブロック・行の組み合わせを読み取り順の行番号にすること"""
+    result = scan_receipt.OcrResult.from_data(
+        ocr_data(
+            [
+                (1, 1, "ローソン", 10, 10, 80, 20, 91.5),
+                (1, 2, "おにぎり", 10, 40, 80, 20, 88.0),
+                (1, 2, "150", 200, 40, 30, 20, 95.0),
+                (1, 2, " ", 240, 40, 5, 20, 95.0),
+                (2, 1, "合計", 10, 70, 40, 20, 90.0),
+            ]
+        )
+    )
+
+    assert len(result) == 4
+    assert result.line.tolist() == [0, 1, 1, 2]
+    assert result.lines() == ["ローソン", "おにぎり 150", "合計"]
+    assert result.to_text() == "ローソン\nおにぎり 150\n合計"
+    assert result.boxes.tolist()[2] == [200, 40, 30, 20]
+    assert result.conf.tolist() == [91.5, 88.0, 95.0, 90.0]
+
+
+def test_ocr_result_empty():
+    result = scan_receipt.OcrResult.from_data(ocr_data([]))
+
+    assert len(result) == 0
+    assert result.lines() == []
+    assert scan_receipt.extract_total_amount(result) == 0
+
+
+def test_extract_total_amount_uses_layout():
+    """右寄せの金額が別のブロックと判定されていても、合計の行と同じ高さの金額を取得すること"""
+    result = scan_receipt.OcrResult.from_data(
+        ocr_data(
+            [
+                (1, 1, "おにぎり", 10, 40, 80, 20, 90.0),
+                (1, 2, "合計", 10, 70, 40, 20, 90.0),
+                (2, 1, "150", 300, 41, 30, 18, 90.0),
+                (2, 2, "¥1,125", 300, 72, 60, 18, 90.0),
+            ]
+        )
+    )
+
+    # テキストだけでは合計の行に金額がない
+    assert scan_receipt.extract_total_amount(result.to_text()) == 0
+    assert scan_receipt.extract_total_amount(result) == 1125
+
+
+def test_ocr_image_calls_tesseract_once(mocker):
+    """OCRは image_to_data の1回だけで、テキストもその結果から作成すること"""
+    mock_image_to_data = mocker.patch(
+        "src.receipt_scanner_model.scan_receipt.pytesseract.image_to_data",
+        return_value=ocr_data([(1, 1, "合計", 10, 70, 40, 20, 90.0)]),
+    )
+    mock_image_to_string = mocker.patch(
+        "src.receipt_scanner_model.scan_receipt.pytesseract.image_to_string"
+    )
+
+    assert scan_receipt.extract_text_from_image(Image.new("L", (10, 10))) == "合計"
+    mock_image_to_data.assert_called_once()
+    mock_image_to_string.assert_not_called()
+
+
+def test_load_preprocess_config(tmp_path):
+    """保存した推奨設定を読み込み、ファイルがない場合はデフォルトを返すこと"""
+    fp = tmp_path / "ocr_config.json"
+    assert scan_receipt.load_preprocess_config(fp) == scan_receipt.PreprocessConfig()
+    assert scan_receipt.load_preprocess_config(None) == scan_receipt.PreprocessConfig()
+
+    config = scan_receipt.PreprocessConfig(denoise="median", denoise_strength=3, psm=6)
+    fp.write_text(config.model_dump_json())
+
+    assert scan_receipt.load_preprocess_config(fp) == config
+    assert config.tesseract_config == "--psm 6 --oem 3"
+
+
+@pytest.mark.parametrize("method", ["luma", "average", "min"])
+@pytest.mark.parametrize("denoise", ["none", "nlmeans", "median", "bilateral"])
+def test_preprocess_image_config(method, denoise):
+    image = Image.new("RGB", (20, 10), (200, 100, 50))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    config = scan_receipt.PreprocessConfig(
+        grayscale=method, scale=1.5, denoise=denoise, denoise_strength=3
+    )
+
+    preprocessed = scan_receipt.preprocess_image(buffer.getvalue(), config)
+
+    assert preprocessed.mode == "L"
+    assert preprocessed.size == (30, 15)
+
+
+def make_receipt_like(noise: float = 0.0, seed: int = 0) -> bytes:
+    """白地に黒い横線（文字の行）を並べた画像を作る。noise はガウスノイズの標準偏差"""
+    import numpy as np
+
+    gray = np.full((200, 200), 230, dtype=np.float32)
+    for top in range(20, 180, 20):
+        gray[top : top + 6, 20:180] = 20
+    gray += np.random.default_rng(seed).normal(0, noise, gray.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(gray, 0, 255).astype(np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_estimate_noise():
+    import numpy as np
+
+    clean = np.asarray(Image.open(io.BytesIO(make_receipt_like())))
+    noisy = np.asarray(Image.open(io.BytesIO(make_receipt_like(noise=10))))
+
+    assert scan_receipt.estimate_noise(clean) < 0.5
+    assert 7 < scan_receipt.estimate_noise(noisy) < 13
+    assert scan_receipt.estimate_dynamic_range(clean) == 210
+    assert scan_receipt.estimate_sharpness(clean) > scan_receipt.BLUR_SKIP_SHARPNESS
+
+
+def test_adaptive_preprocessing_skips_denoise_on_clean_image(mocker):
+    denoise = mocker.spy(scan_receipt, "denoise")
+    config = scan_receipt.PreprocessConfig(adaptive=True)
+
+    image, path = scan_receipt.preprocess_image_with_path(make_receipt_like(), config)
+
+    denoise.assert_not_called()
+    assert image.size == (200, 200)
+    assert path.adaptive
+    assert path.contrast == 1.0
+    assert path.denoise == "none"
+    assert path.noise is not None and path.noise < scan_receipt.NOISE_SKIP_SIGMA
+
+
+def test_adaptive_preprocessing_scales_denoise_strength(mocker):
+    """ノイズの推定値に応じた強さ（設定の強さが上限）でノイズ除去すること"""
+    denoise = mocker.spy(scan_receipt, "denoise")
+    config = scan_receipt.PreprocessConfig(adaptive=True, denoise_strength=20)
+
+    _, path = scan_receipt.preprocess_image_with_path(
+        make_receipt_like(noise=3), config
+    )
+
+    assert path.denoise == "nlmeans"
+    assert 1 <= path.denoise_strength < 20
+    assert denoise.call_args.args[1:] == ("nlmeans", path.denoise_strength)
+
+
+def test_preprocessing_path_without_adaptive():
+    config = scan_receipt.PreprocessConfig(denoise="median", denoise_strength=3)
+
+    _, path = scan_receipt.preprocess_image_with_path(make_receipt_like(), config)
+
+    assert path.model_dump() == {
+        "adaptive": False,
+        "contrast": 2.0,
+        "denoise": "median",
+        "denoise_strength": 3,
+        "noise": None,
+        "sharpness": None,
+        "dynamic_range": None,
+    }
+
+
+def test_tuner_pareto_frontier():
+    from scripts.tune_ocr import pareto_frontier, recommend
+
+    summaries = [
+        {"config": "a", "accuracy": 0.5, "latency": 0.5},
+        {"config": "b", "accuracy": 0.75, "latency": 1.0},
+        {"config": "c", "accuracy": 0.5, "latency": 2.0},
+        {"config": "d", "accuracy": 0.875, "latency": 3.0},
+        {"config": "e", "accuracy": 0.875, "latency": 4.0},
+    ]
+
+    frontier = pareto_frontier(summaries)
+
+    assert [s["config"] for s in frontier] == ["a", "b", "d"]
+    assert recommend(frontier)["config"] == "d"
+    assert recommend(frontier, max_latency=1.5)["config"] == "b"
+    assert recommend(frontier, max_latency=0.1)["config"] == "a"
+
+
+def test_tuner_includes_baseline():
+    from scripts.tune_ocr import sample_preprocess_configs
+
+    configs = sample_preprocess_configs(5)
+
+    assert len(configs) == 5
+    assert (
+        scan_receipt.PreprocessConfig(**configs[0]) == scan_receipt.PreprocessConfig()
+    )
+    assert len({json.dumps(c, sort_keys=True) for c in configs}) == 5
@@ -0,0 +1,146 @@
+import io
+import os
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import cv2
+import numpy as np
+from PIL import Image
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model import scan_receipt
+from src.receipt_scanner_model.stage_cache import SINGLE_ARRAY, StageCache, StageChain
+
+ARRAY = np.arange(12, dtype=np.uint8).reshape(3, 4)
+IMAGE = {SINGLE_ARRAY: ARRAY}
+
+
+def test_array_roundtrip_is_memory_mapped(tmp_path: Path):
+    cache = StageCache(tmp_path)
+    cache.put("key", IMAGE)
+
+    cached = cache.get("key")
+
+    assert cached is not None
+    assert isinstance(cached[SINGLE_ARRAY], np.memmap)
+    np.testing.assert_array_equal(cached[SINGLE_ARRAY], ARRAY)
+    assert (tmp_path / "key.npy").exists()
+
+
+def test_arrays_roundtrip(tmp_path: Path):
+    """名前付きの複数の配列（OCR結果の列など）を保存できること"""
+    cache = StageCache(tmp_path, compress=True)
+    arrays = {"text": np.array(["合計", "1,125"]), "conf": np.array([90.0, 95.5])}
+    cache.put("ocr", arrays)
+    cache.put("single", IMAGE)
+
+    cached = cache.get("ocr")
+    single = cache.get("single")
+    assert cached is not None and single is not None
+    assert cached["text"].tolist() == ["合計", "1,125"]
+    np.testing.assert_array_equal(cached["conf"], arrays["conf"])
+    np.testing.assert_array_equal(single[SINGLE_ARRAY], ARRAY)
+    assert (tmp_path / "single.npz").exists()
+
+
+def test_get_or_compute(tmp_path: Path):
+    cache = StageCache(tmp_path)
+    compute = MagicMock(return_value=IMAGE)
+
+    cache.get_or_compute("key", compute)
+    cache.get_or_compute("key", compute)
+
+    compute.assert_called_once()
+    assert cache.snapshot()["hits"] == 1
+    assert cache.snapshot()["misses"] == 1
+
+
+def test_evicts_least_recently_used(tmp_path: Path):
+    """合計サイズが上限を超えた場合、最後に使った時刻が古いものから削除すること"""
+    size = StageCache(tmp_path / "size")
+    size.put("a", IMAGE)
+    file_size = size.snapshot()["bytes"]
+    cache = StageCache(tmp_path / "lru", max_bytes=file_size * 2)
+
+    cache.put("a", IMAGE)
+    cache.put("b", IMAGE)
+    cache.get("a")
+    cache.put("c", IMAGE)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert not (tmp_path / "lru" / "b.npy").exists()
+    assert cache.snapshot()["bytes"] == file_size * 2
+
+
+def test_loads_existing_files(tmp_path: Path):
+    """再起動後も、保存済みのファイルを最後に使った時刻の順で引き継ぐこと"""
+    cache = StageCache(tmp_path)
+    cache.put("old", IMAGE)
+    cache.put("new", IMAGE)
+    os.utime(tmp_path / "old.npy", (0, 0))
+
+    reloaded = StageCache(tmp_path, max_bytes=cache.snapshot()["bytes"])
+    reloaded.put("newest", IMAGE)
+
+    assert reloaded.get("old") is None
+    assert reloaded.get("new") is not None
+
+
+def test_chain_recomputes_only_downstream(tmp_path: Path):
+    cache = StageCache(tmp_path)
+    calls = []
+
+    def run(first: int, second: int) -> None:
+        chain = StageChain(cache, b"image")
+        chain.run("first", {"p": first}, lambda: calls.append("first") or ARRAY)
+        chain.run("second", {"p": second}, lambda: calls.append("second") or ARRAY)
+
+    run(1, 1)
+    run(1, 2)
+    run(2, 2)
+    run(1, 2)
+
+    assert calls == ["first", "second", "second", "first", "second"]
+
+
+def test_scan_reuses_stages(tmp_path: Path, mocker: MockFixture):
+    """コントラストを変えずにノイズ除去の強さだけ変えた場合、読み込み・コントラストを再計算しないこと"""
+    image_to_data = mocker.patch(
+        "src.receipt_scanner_model.scan_receipt.pytesseract.image_to_data",
+        return_value={
+            "level": [5],
+            "page_num": [1],
+            "block_num": [1],
+            "par_num": [1],
+            "line_num": [1],
+            "word_num": [1],
+            "left": [0],
+            "top": [0],
+            "width": [10],
+            "height": [10],
+            "conf": [90.0],
+            "text": ["合計1,125"],
+        },
+    )
+    denoise = mocker.spy(cv2, "fastNlMeansDenoising")
+    contrast = mocker.spy(scan_receipt.ImageEnhance, "Contrast")
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), (255, 255, 255)).save(buffer, format="PNG")
+    cache = StageCache(tmp_path)
+
+    config = scan_receipt.PreprocessConfig(contrast=2.0, denoise_strength=20)
+    changed = config.model_copy(update={"denoise_strength": 10})
+
+    first = scan_receipt.scan(buffer.getvalue(), config, cache=cache)
+    second = scan_receipt.scan(buffer.getvalue(), changed, cache=cache)
+    third = scan_receipt.scan(buffer.getvalue(), changed, cache=cache)
+
+    for result in (first, second, third):
+        assert result["amount"] == 1125
+        assert result["text"] == "合計1,125"
+    assert first["preprocessing"]["denoise_strength"] == 20
+    assert second == third
+    assert contrast.call_count == 1
+    assert denoise.call_count == 2
+    assert image_to_data.call_count == 2
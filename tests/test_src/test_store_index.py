@@ -0,0 +1,169 @@
+import io
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from pytest_mock import MockFixture
+
+from src.receipt_scanner_model import scan_receipt
+from src.receipt_scanner_model.open_ai import ReceiptDetail
+from src.receipt_scanner_model.store_index import (
+    StoreEntry,
+    StoreIndex,
+    normalize,
+    strip_branch,
+    substring_distance,
+)
+
+
+def detail(store_name: str | None, category: str | None = "食費") -> ReceiptDetail:
+    return ReceiptDetail(
+        store_name=store_name, date="2024-06-01", amount=1000, category=category
+    )
+
+
+@pytest.fixture
+def index() -> StoreIndex:
+    return StoreIndex.from_details(
+        [
+            detail("BOOKOFF 渋谷センター街店", "趣味"),
+            detail("ＢＯＯＫＯＦＦ", "趣味"),
+            detail("BOOKOFF 新宿店", "日用品"),
+            detail("OK", "食費"),
+            detail("築地銀だこ", "外食"),
+            detail("築地銀だこ 原宿店", "外食"),
+            detail("一度だけの店", "食費"),
+            detail(None, "食費"),
+        ],
+        min_count=2,
+    )
+
+
+def test_normalize():
+    assert normalize("ＢＯＯＫＯＦＦ　渋谷-店!") == "bookoff渋谷店"
+    assert normalize("（株）オーケー") == "株オーケー"
+    # OCRで誤認識しやすい似た文字は同じ文字にする
+    assert normalize("ロ一ソン") == normalize("口ーソン") == "ローソン"
+    assert normalize("B00KOFF") == normalize("bookoff")
+
+
+def test_strip_branch():
+    assert strip_branch("BOOKOFF 渋谷センター街店") == "BOOKOFF"
+    assert strip_branch("築地銀だこ 原宿店 2号店") == "築地銀だこ"
+    assert strip_branch("ローソン") == "ローソン"
+
+
+def test_substring_distance():
+    assert substring_distance("bookoff", "xxbookoffxx") == 0
+    assert substring_distance("bookoff", "b00koff渋谷") == 2
+    assert substring_distance("abc", "") == 3
+
+
+def test_from_details(index: StoreIndex):
+    """支店名を除いたキーでまとめ、最も多い表記とカテゴリーを使うこと"""
+    entries = {entry.name: entry for entry in index.entries}
+
+    assert set(entries) == {"BOOKOFF", "築地銀だこ"}
+    assert entries["BOOKOFF"].count == 3
+    assert entries["BOOKOFF"].category == "趣味"
+    assert entries["築地銀だこ"].category == "外食"
+
+
+def test_match_exact(index: StoreIndex):
+    match = index.match_line("ＢＯＯＫＯＦＦ 池袋店")
+
+    assert match is not None
+    assert match.store_name == "BOOKOFF"
+    assert match.category == "趣味"
+    assert match.confidence == 1.0
+
+
+def test_match_fuzzy(index: StoreIndex):
+    """OCRの誤認識を、編集距離から計算した信頼度で許容すること"""
+    match = index.match_line("築地銀だ乙 原宿店")
+
+    assert match is not None
+    assert match.store_name == "築地銀だこ"
+    assert match.confidence == pytest.approx(0.8)
+    assert index.match_line("TEL 03-1234-5678") is None
+    assert index.match_line("築地まぐろ") is None
+
+
+def test_match_fuzzy_short_key():
+    """4文字のキーは、信頼度の下限に関わらず1文字の誤認識を許容すること"""
+    index = StoreIndex([StoreEntry(name="ローソン", category="食費", count=10)])
+
+    exact = index.match_line("ロ一ソン 新宿店")
+    fuzzy = index.match_line("ローンン 新宿店")
+
+    assert exact is not None and exact.confidence == 1.0
+    assert fuzzy is not None
+    assert fuzzy.store_name == "ローソン"
+    assert fuzzy.confidence == pytest.approx(0.75)
+    assert index.match_line("ロンンン") is None
+
+
+def test_short_key_matches_only_first_word():
+    index = StoreIndex(
+        [
+            StoreEntry(name="OK", category="食費", count=10),
+            StoreEntry(name="ゆ", category="日用品", count=10),
+        ]
+    )
+
+    assert index.match_line("OK 八王子店") is not None
+    assert index.match_line("ゆ") is not None
+    assert index.match_line("TOKYO") is None
+    assert index.match_line("OKINAWA 本店") is None
+    assert index.match_line("ゆうちょ銀行") is None
+
+
+def test_match_header(index: StoreIndex):
+    lines = ["", "領収書", "築地銀だこ 原宿店", "BOOKOFF", "合計 ¥1,000"]
+
+    match = index.match(lines)
+
+    assert match is not None
+    assert match.store_name == "築地銀だこ"
+    assert match.line == "築地銀だこ 原宿店"
+    assert index.match(["合計 ¥1,000"]) is None
+
+
+def test_save_and_load(index: StoreIndex, tmp_path: Path):
+    fp = tmp_path / "stores" / "store_index.json"
+    index.save(fp)
+
+    loaded = StoreIndex.load(fp)
+
+    assert loaded.entries == index.entries
+    assert loaded.match_line("BOOKOFF") == index.match_line("BOOKOFF")
+
+
+def test_scan_returns_store(index: StoreIndex, mocker: MockFixture):
+    mocker.patch(
+        "src.receipt_scanner_model.scan_receipt.pytesseract.image_to_data",
+        return_value={
+            "level": [5, 5],
+            "page_num": [1, 1],
+            "block_num": [1, 1],
+            "par_num": [1, 1],
+            "line_num": [1, 2],
+            "word_num": [1, 1],
+            "left": [0, 0],
+            "top": [0, 20],
+            "width": [10, 10],
+            "height": [10, 10],
+            "conf": [90.0, 90.0],
+            "text": ["BOOKOFF", "合計1,125"],
+        },
+    )
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), (255, 255, 255)).save(buffer, format="PNG")
+    config = scan_receipt.PreprocessConfig(contrast=1.0, denoise="none")
+
+    result = scan_receipt.scan(buffer.getvalue(), config, store_index=index)
+
+    assert result["amount"] == 1125
+    assert result["store"] is not None
+    assert result["store"]["store_name"] == "BOOKOFF"
+    assert result["store"]["category"] == "趣味"
@@ -0,0 +1,52 @@
+import sys
+import tomllib
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from src.receipt_scanner_model import version
+from src.receipt_scanner_model.version import (
+    get_version,
+    read_pyproject_version,
+    write_version_module,
+)
+
+PYPROJECT_FP = Path(__file__).parents[2] / "pyproject.toml"
+
+
+@pytest.fixture
+def pyproject_version() -> str:
+    with open(PYPROJECT_FP, "rb") as f:
+        return tomllib.load(f)["project"]["version"]
+
+
+def test_read_pyproject_version_does_not_depend_on_cwd(
+    pyproject_version: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.chdir(tmp_path)
+
+    assert read_pyproject_version() == pyproject_version
+
+
+def test_get_version_without_version_module(pyproject_version: str):
+    assert get_version() == pyproject_version
+
+
+def test_write_version_module(pyproject_version: str, tmp_path: Path):
+    version_module_fp = tmp_path / "_version.py"
+
+    assert write_version_module(version_module_fp) == pyproject_version
+    assert version_module_fp.read_text() == f'__version__ = "{pyproject_version}"\n'
+
+
+def test_get_version_prefers_version_module(monkeypatch: pytest.MonkeyPatch):
+    # ビルド時に生成したバージョンがあれば pyproject.toml を読まない
+    monkeypatch.setitem(
+        sys.modules,
+        "src.receipt_scanner_model._version",
+        SimpleNamespace(__version__="9.9.9"),
+    )
+    monkeypatch.setattr(version, "read_pyproject_version", pytest.fail)
+
+    assert get_version() == "9.9.9"